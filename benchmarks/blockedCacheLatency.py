@@ -0,0 +1,57 @@
+import sys
+import time
+import numpy
+from lazyflow.graph import Graph
+from lazyflow.request import Request
+from lazyflow.operators import OpArrayPiper, OpBlockedArrayCache
+
+# Measures the latency of cold viewport requests to OpBlockedArrayCache.
+# The source takes a fixed time for each request (like an expensive filter),
+#  so the latency shows how many of the missing blocks are computed at the same time.
+
+shape = (1,1024,1024,1,1)
+innerBlockShape = (1,64,64,1,1)
+outerBlockShape = (1,128,128,1,1)
+viewport = ((0,0,0,0,0), (1,1024,1024,1,1)) # 8*8 = 64 missing outer blocks
+computeTime = 0.02 # seconds per source request
+repeats = 3
+
+if len(sys.argv) > 1:
+    computeTime = float(sys.argv[1])
+if len(sys.argv) > 2:
+    # (The source only sleeps, so more workers than cores still help.)
+    Request.reset_thread_pool( int(sys.argv[2]) )
+
+class OpSlowSource(OpArrayPiper):
+    def execute(self, slot, subindex, roi, result):
+        time.sleep( computeTime )
+        super(OpSlowSource, self).execute(slot, subindex, roi, result)
+
+data = numpy.random.random( shape ).astype( numpy.float32 )
+
+def coldRequestLatency( maxParallelFetches ):
+    latencies = []
+    for i in range(repeats):
+        graph = Graph()
+        opSource = OpSlowSource( graph=graph )
+        opSource.Input.setValue( data )
+        opCache = OpBlockedArrayCache( graph=graph )
+        opCache.Input.connect( opSource.Output )
+        opCache.innerBlockShape.setValue( innerBlockShape )
+        opCache.outerBlockShape.setValue( outerBlockShape )
+        opCache.fixAtCurrent.setValue( False )
+        if maxParallelFetches is not None:
+            opCache.maxParallelFetches.setValue( maxParallelFetches )
+
+        start = time.time()
+        opCache.Output( *viewport ).wait()
+        latencies.append( time.time() - start )
+        opCache.cleanUp()
+    return min(latencies)
+
+print "Cold {} viewport request, {} s per source request, {} worker threads".format(
+      tuple(numpy.subtract(viewport[1], viewport[0])), computeTime, len(Request.global_thread_pool.workers) )
+for name, maxParallelFetches in [ ("one block at a time", 1),
+                                  ("4 blocks in parallel", 4),
+                                  ("default", None) ]:
+    print "{:25}: {:.3f} seconds".format( name, coldRequestLatency( maxParallelFetches ) )
@@ -0,0 +1,43 @@
+import sys
+import time
+import numpy
+import vigra
+from lazyflow.graph import Graph
+from lazyflow.operators import OpPixelFeaturesPresmoothed
+
+# Requests the features of a 2D image tile by tile (like a viewer does), once computing each tile
+#  with its own halo, and once in cached halo blocks for several efficiencies.
+# Prints the time and the useful/computed voxel ratio of each mode.
+
+shape = (1024,1024,1)
+tileSize = 64
+scales = [0.3, 1.0, 3.5, 10.0]
+featureIds = OpPixelFeaturesPresmoothed.DefaultFeatureIds
+efficiencies = [0.0, 0.25, 0.5, 0.75]
+
+if len(sys.argv) > 1:
+    tileSize = int(sys.argv[1])
+
+data = numpy.random.random( shape ).astype( numpy.float32 )
+data = vigra.taggedView( data, 'xyc' )
+matrix = numpy.ones( (len(featureIds), len(scales)), dtype=bool )
+
+def requestTiles( efficiency ):
+    op = OpPixelFeaturesPresmoothed( graph=Graph() )
+    op.Input.setValue( data )
+    op.Scales.setValue( scales )
+    op.FeatureIds.setValue( featureIds )
+    op.Matrix.setValue( matrix )
+    op.HaloEfficiency.setValue( efficiency )
+
+    start = time.time()
+    for x in range(0, shape[0], tileSize):
+        for y in range(0, shape[1], tileSize):
+            op.Output[x:x+tileSize, y:y+tileSize, :].wait()
+    return time.time() - start, op.haloStatistics()['ratio'], op._haloBlockShape
+
+print "Features of a {} image in {}x{} tiles, largest sigma {}".format( shape[:2], tileSize, tileSize, max(scales) )
+for efficiency in efficiencies:
+    seconds, ratio, blockShape = requestTiles( efficiency )
+    name = "per tile" if efficiency == 0 else "blocks {} ({})".format( blockShape[:2], efficiency )
+    print "{:25}: {:.3f} seconds, useful/computed voxels: {:.3f}".format( name, seconds, ratio )
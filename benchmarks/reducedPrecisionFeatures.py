@@ -0,0 +1,81 @@
+import sys
+import time
+import numpy
+import vigra
+from lazyflow.graph import Graph
+from lazyflow.operators import OpPixelFeaturesPresmoothed, OpTrainRandomForest, OpPredictRandomForest, OpValueCache
+from lazyflow.utility import dequantize
+
+# Computes the full feature matrix of an image with each OutputDtype of OpPixelFeaturesPresmoothed.
+# Prints the size of the feature block (what a cache behind the operator holds),
+#  the largest feature error, and how well the random forest predictions agree with the float32 features.
+
+shape = (512,512,1)
+scales = [0.3, 1.0, 1.6, 3.5, 5.0]
+featureIds = OpPixelFeaturesPresmoothed.DefaultFeatureIds
+dtypes = [numpy.float32, numpy.float16, numpy.uint16, numpy.uint8]
+
+if len(sys.argv) > 1:
+    shape = (int(sys.argv[1]), int(sys.argv[1]), 1)
+
+# A smooth random image with some noise (uint8, like most raw data)
+data = vigra.filters.gaussianSmoothing( numpy.random.random( shape ).astype( numpy.float32 ), 4.0 )
+data = (data - data.min()) / (data.max() - data.min()) * 200 + numpy.random.random( shape ) * 55
+data = vigra.taggedView( data.astype( numpy.uint8 ), 'xyc' )
+matrix = numpy.ones( (len(featureIds), len(scales)), dtype=bool )
+
+# Label two bands of intensity
+labels = numpy.zeros( shape, dtype=numpy.uint8 )
+labels[::7, ::7][ data[::7, ::7] < 100 ] = 1
+labels[::7, ::7][ data[::7, ::7] > 150 ] = 2
+labels = vigra.taggedView( labels, 'xyc' )
+
+graph = Graph()
+def makeFeatures( dtype ):
+    op = OpPixelFeaturesPresmoothed( graph=graph )
+    op.Input.setValue( data )
+    op.Scales.setValue( scales )
+    op.FeatureIds.setValue( featureIds )
+    op.Matrix.setValue( matrix )
+    op.OutputDtype.setValue( dtype )
+    return op
+
+opReference = makeFeatures( numpy.float32 )
+reference = opReference.Output[:].wait()
+
+opTrain = OpTrainRandomForest( graph=graph )
+opTrain.fixClassifier.setValue( False )
+opTrain.Images.resize(1)
+opTrain.Images[0].connect( opReference.Output )
+opTrain.Labels.resize(1)
+opTrain.Labels[0].setValue( labels )
+
+# Train only once for all predictions
+opForests = OpValueCache( graph=graph )
+opForests.Input.connect( opTrain.Classifier )
+
+referencePrediction = None
+print "Features of a {} image: {} channels".format( shape[:2], reference.shape[-1] )
+for dtype in dtypes:
+    opFeatures = makeFeatures( dtype )
+    start = time.time()
+    features = opFeatures.Output[:].wait()
+    seconds = time.time() - start
+
+    error = numpy.abs( dequantize( features, opFeatures.Output.meta.quantScale, opFeatures.Output.meta.quantOffset ) - reference )
+    relativeError = error.max( axis=(0,1) ) / numpy.maximum( numpy.abs(reference).max( axis=(0,1) ), 1e-6 )
+
+    opPredict = OpPredictRandomForest( graph=graph )
+    opPredict.Image.connect( opFeatures.Output )
+    opPredict.Classifier.connect( opForests.Output )
+    opPredict.LabelsCount.setValue( 2 )
+    prediction = opPredict.PMaps[:].wait()
+    if referencePrediction is None:
+        referencePrediction = prediction
+    agreement = ( prediction.argmax(axis=-1) == referencePrediction.argmax(axis=-1) ).mean()
+    probabilityError = numpy.abs( prediction - referencePrediction ).max()
+
+    print "{:8}: {:7.1f} MB, {:.3f} s, max error {:.2g} (relative to channel max {:.2g}), " \
+          "prediction agreement {:.4f}, max probability error {:.3f}".format(
+          numpy.dtype(dtype).name, features.nbytes / 2.0**20, seconds,
+          error.max(), relativeError.max(), agreement, probabilityError )
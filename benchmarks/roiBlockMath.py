@@ -0,0 +1,59 @@
+import time
+import numpy
+from lazyflow.roi import TinyVector, getIntersection, roiFromShape, getIntersectingBlocks, getBlockBounds, getBlockGrid
+
+# Compares the block lookups the caches do on every request:
+#  the old TinyVector-based functions (block by block) vs. the vectorized BlockGrid (all blocks at once).
+
+shape = (1,512,512,128,1)
+blockShape = (1,32,32,32,1)
+roi = ((0,10,10,10,0), (1,500,500,120,1))
+repeats = 10
+
+def legacyGetIntersectingBlocks( blockshape, roi ):
+    roistart = TinyVector( roi[0] )
+    roistop = TinyVector( roi[1] )
+    blockshape = TinyVector( blockshape )
+    block_index_map_start = roistart / blockshape
+    block_index_map_stop = ( roistop + (blockshape - 1) ) / blockshape
+    block_indices = numpy.indices( block_index_map_stop - block_index_map_start )
+    block_indices = numpy.rollaxis( block_indices, 0, len(blockshape)+1 )
+    block_indices += block_index_map_start
+    block_indices *= blockshape
+    return numpy.reshape( block_indices, (-1, len(blockshape)) )
+
+def legacyGetBlockBounds( dataset_shape, block_shape, block_start ):
+    block_bounds = ( block_start, block_start + TinyVector( block_shape ) )
+    return getIntersection( block_bounds, roiFromShape( dataset_shape ) )
+
+def legacy():
+    for block_start in legacyGetIntersectingBlocks( blockShape, roi ):
+        bounds = legacyGetBlockBounds( shape, blockShape, block_start )
+        intersection = getIntersection( roi, bounds )
+        numpy.subtract( intersection, roi[0] )
+        numpy.subtract( intersection, block_start )
+
+def blockByBlock():
+    for block_start in getIntersectingBlocks( blockShape, roi ):
+        bounds = getBlockBounds( shape, blockShape, block_start )
+        intersection = getIntersection( roi, bounds )
+        numpy.subtract( intersection, roi[0] )
+        numpy.subtract( intersection, block_start )
+
+def vectorized():
+    grid = getBlockGrid( shape, blockShape )
+    block_starts, block_stops, inter_starts, inter_stops = grid.intersections( *roi )
+    inter_starts - roi[0], inter_stops - roi[0]
+    inter_starts - block_starts, inter_stops - block_starts
+
+numBlocks = len( getIntersectingBlocks( blockShape, roi ) )
+print "Computing bounds and intersections of {} blocks, {} times".format( numBlocks, repeats )
+
+for name, f in [ ("legacy TinyVector functions", legacy),
+                 ("numpy functions, block by block", blockByBlock),
+                 ("BlockGrid, all blocks at once", vectorized) ]:
+    start = time.time()
+    for i in range(repeats):
+        f()
+    stop = time.time()
+    print "{:35}: {:.4f} seconds per lookup".format( name, (stop - start) / repeats )
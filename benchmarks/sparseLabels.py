@@ -0,0 +1,90 @@
+import sys
+import time
+import numpy
+from lazyflow.graph import Graph
+from lazyflow.operators.opSparseLabelArray import OpSparseLabelArray
+from lazyflow.operators.opBlockedSparseLabelArray import OpBlockedSparseLabelArray
+from lazyflow.roi import getBlockGrid, roiToSlice
+
+# Paints random brush strokes into a label volume and compares
+#  the old storage (one OpSparseLabelArray per touched block: dense block + sorteddict)
+#  with OpBlockedSparseLabelArray (SparseLabelStore).
+
+shape = (1,512,512,64,1)
+blockShape = (1,64,64,64,1)
+brushSize = 5
+strokeLength = 100
+numStrokes = 400
+eraser = 255
+
+if len(sys.argv) > 1:
+    numStrokes = int(sys.argv[1])
+
+rng = numpy.random.RandomState(0)
+def generateStrokes():
+    strokes = []
+    for i in range(numStrokes):
+        label = rng.randint(1,4)
+        pos = numpy.array( [0, rng.randint(0, shape[1]-brushSize), rng.randint(0, shape[2]-brushSize), rng.randint(0, shape[3]), 0] )
+        direction = rng.choice( [-1,1], size=2 )
+        for j in range(strokeLength):
+            pos[1:3] = numpy.clip( pos[1:3] + direction * rng.randint(0,2,size=2), 0, numpy.array(shape[1:3]) - brushSize )
+            start = pos.copy()
+            stop = pos + (1,brushSize,brushSize,1,1)
+            strokes.append( (start, stop, label) )
+    return strokes
+
+strokes = generateStrokes()
+numVoxels = len(strokes) * brushSize * brushSize
+print "Painting {} brush positions ({} voxels, {}x{} brush)".format( len(strokes), numVoxels, brushSize, brushSize )
+
+graph = Graph()
+
+# The old storage: a child operator per touched block
+grid = getBlockGrid( shape, blockShape )
+children = {}
+start_time = time.time()
+for start, stop, label in strokes:
+    block_starts, block_stops, inter_starts, inter_stops = grid.intersections( start, stop )
+    for block_start, block_stop, inter_start, inter_stop in zip( block_starts, block_stops, inter_starts, inter_stops ):
+        key = tuple(block_start)
+        if key not in children:
+            child = OpSparseLabelArray( graph=graph )
+            child.shape.setValue( block_stop - block_start )
+            child.eraser.setValue( eraser )
+            child.deleteLabel.setValue( -1 )
+            children[key] = child
+        values = numpy.ones( tuple(inter_stop - inter_start), dtype=numpy.uint8 ) * label
+        children[key].Input[ roiToSlice( inter_start - block_start, inter_stop - block_start ) ] = values
+old_time = time.time() - start_time
+old_bytes = sum( child._denseArray.nbytes for child in children.values() )
+old_entries = sum( len(child._sparseNZ) for child in children.values() )
+
+start_time = time.time()
+old_values = set()
+for child in children.values():
+    old_values |= set( child._sparseNZ.values() )
+old_nonzero_time = time.time() - start_time
+
+# The label store
+op = OpBlockedSparseLabelArray( graph=graph )
+op.shape.setValue( shape )
+op.blockShape.setValue( blockShape )
+op.eraser.setValue( eraser )
+op.Input.setValue( numpy.zeros( shape, dtype=numpy.uint8 ) ) # (Only provides the metadata)
+start_time = time.time()
+for start, stop, label in strokes:
+    op.Input[ roiToSlice( start, stop ) ] = numpy.ones( tuple(stop - start), dtype=numpy.uint8 ) * label
+new_time = time.time() - start_time
+new_bytes = op._labelStore.nbytes()
+
+start_time = time.time()
+new_values = op.nonzeroValues.value
+new_nonzero_time = time.time() - start_time
+
+assert set(new_values) == old_values
+
+print "{:25}: {:8.3f} s painting, {:8.5f} s nonzeroValues, {:10d} bytes (dense blocks) + {} sorteddict entries".format(
+      "OpSparseLabelArray blocks", old_time, old_nonzero_time, old_bytes, old_entries )
+print "{:25}: {:8.3f} s painting, {:8.5f} s nonzeroValues, {:10d} bytes".format(
+      "SparseLabelStore", new_time, new_nonzero_time, new_bytes )
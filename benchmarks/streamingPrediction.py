@@ -0,0 +1,97 @@
+import sys
+import time
+import resource
+import subprocess
+import numpy
+import vigra
+from functools import partial
+from lazyflow.graph import Graph
+from lazyflow.request import RequestPool
+from lazyflow.operators import OpTrainRandomForest, OpPredictRandomForest, OpValueCache
+
+# Predicts a big roi with OpPredictRandomForest for several chunk sizes,
+#  and once with the whole roi at once, like OpPredictRandomForest did before it streamed its chunks
+#  (every forest predicts into its own full size array, which are stacked and averaged).
+# Each run is done in a new python process, so its peak memory (maxrss) can be measured separately.
+# (A forked process wouldn't have the worker threads of the request thread pool.)
+# Prints the time, the throughput and the memory the prediction needed on top of its features and result.
+
+shape = (1024,1024,1)
+numFeatures = 30
+numLabels = 4
+chunkSizes = [2**12, 2**16, 2**20]
+
+if len(sys.argv) > 1:
+    shape = (int(sys.argv[1]), int(sys.argv[1]), 1)
+
+def maxrss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 # (kilobytes on linux)
+
+def setup():
+    numpy.random.seed(0)
+    features = numpy.random.random( shape[:-1] + (numFeatures,) ).astype( numpy.float32 )
+    features = vigra.taggedView( features, 'xyc' )
+    labels = numpy.zeros( shape, dtype=numpy.uint8 )
+    labels[::50, ::50] = numpy.random.randint( 1, numLabels+1, labels[::50, ::50].shape )
+    labels = vigra.taggedView( labels, 'xyc' )
+
+    graph = Graph()
+    opTrain = OpTrainRandomForest( graph=graph )
+    opTrain.fixClassifier.setValue( False )
+    opTrain.Images.resize(1)
+    opTrain.Images[0].setValue( features )
+    opTrain.Labels.resize(1)
+    opTrain.Labels[0].setValue( labels )
+
+    # Train only once (not in every prediction)
+    opForests = OpValueCache( graph=graph )
+    opForests.Input.connect( opTrain.Classifier )
+
+    opPredict = OpPredictRandomForest( graph=graph )
+    opPredict.Image.setValue( features )
+    opPredict.Classifier.connect( opForests.Output )
+    opPredict.LabelsCount.setValue( numLabels )
+    opPredict.Classifier[:].wait()
+    return opPredict, features
+
+def predictAllAtOnce( opPredict, features ):
+    forests = opPredict.Classifier[:].wait()
+    flatFeatures = features.view(numpy.ndarray).reshape( (-1, numFeatures) )
+    predictions = [ numpy.ndarray( (len(flatFeatures), numLabels), dtype=numpy.float32 ) for f in forests ]
+    pool = RequestPool()
+    for f, prediction in zip(forests, predictions):
+        pool.request( partial(opPredict._predictForest, prediction, f, flatFeatures) )
+    pool.wait()
+    pool.clean()
+    prediction = numpy.average( numpy.dstack(predictions), axis=2 )
+    result = numpy.ndarray( shape[:-1] + (numLabels,), dtype=numpy.float32 )
+    prediction.shape = result.shape
+    for c in range(numLabels):
+        result[...,c] = prediction[...,c]
+    return result
+
+def run( chunkSize ):
+    opPredict, features = setup()
+    before = maxrss()
+    start = time.time()
+    if chunkSize is None:
+        predictAllAtOnce( opPredict, features )
+    else:
+        opPredict.ChunkPixels = chunkSize
+        opPredict.PMaps[:].wait()
+    seconds = time.time() - start
+    resultBytes = numpy.prod( shape[:-1] ) * numLabels * 4
+    print seconds, maxrss() - before - resultBytes
+
+if len(sys.argv) > 2:
+    # Child process: a single run
+    run( None if sys.argv[2] == 'None' else int(sys.argv[2]) )
+    sys.exit(0)
+
+print "Prediction of a {} roi with {} features and {} labels".format( shape[:-1], numFeatures, numLabels )
+for chunkSize in [None] + chunkSizes:
+    output = subprocess.check_output( [sys.executable, __file__, str(shape[0]), str(chunkSize)] )
+    seconds, extraBytes = map( float, output.split()[-2:] )
+    name = "whole roi (unchunked)" if chunkSize is None else "chunks of {} pixels".format( chunkSize )
+    print "{:25}: {:.3f} seconds, {:.2f} Mpixels/s, {:.1f} MB extra memory".format(
+          name, seconds, numpy.prod( shape[:-1] ) / seconds / 1e6, max(extraBytes, 0) / 2.0**20 )
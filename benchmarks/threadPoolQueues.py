@@ -0,0 +1,72 @@
+import time
+import functools
+import multiprocessing
+
+from lazyflow.request import Request
+from lazyflow.request.threadPool import ThreadPool, PriorityQueue, FifoQueue, LifoQueue, WorkStealingQueue
+
+num_workers = multiprocessing.cpu_count()
+num_parents = 500
+num_children = 20
+mcount = 50000
+
+def empty_func(b):
+    a = 7 + b
+    a = "lksejhkl JSFLAJSSDFJH   AKDHAJKSDH ADKJADHK AJHSKA AKJ KAJSDH AKDAJHSKAJHD KASHDAKDJH".split(" ")
+    return b
+
+def spawn_children(b):
+    """
+    Simulates an operator that fans its work out into many small block requests.
+    """
+    requests = []
+    for i in range(num_children):
+        req = Request( functools.partial(empty_func, b=i) )
+        req.submit()
+        requests.append(req)
+    return sum( map( lambda req: req.wait(), requests ) )
+
+def benchmark_flat():
+    """
+    Lots of tiny requests, all submitted from a foreign thread.
+    """
+    requests = []
+    for i in range(mcount):
+        req = Request( functools.partial(empty_func, b=11) )
+        req.submit()
+        requests.append(req)
+    for req in requests:
+        req.wait()
+
+def benchmark_nested():
+    """
+    Requests that spawn child requests from within the worker threads.
+    """
+    requests = []
+    for i in range(num_parents):
+        req = Request( functools.partial(spawn_children, b=i) )
+        req.submit()
+        requests.append(req)
+    for req in requests:
+        req.wait()
+
+for queue_type in [PriorityQueue, FifoQueue, LifoQueue, WorkStealingQueue]:
+    Request.reset_thread_pool( num_workers, queue_type )
+
+    t1 = time.time()
+    benchmark_flat()
+    t2 = time.time()
+    print "\n\n"
+    print "{} ({} workers)".format( queue_type.__name__, num_workers )
+    print "FLAT REQUESTS:   %f seconds for %d requests" % (t2-t1,mcount)
+    print "                                %fus latency" % ((t2-t1)*1e6/mcount,)
+
+    t1 = time.time()
+    benchmark_nested()
+    t2 = time.time()
+    total = num_parents*(num_children+1)
+    print "NESTED REQUESTS: %f seconds for %d requests" % (t2-t1,total)
+    print "                                %fus latency" % ((t2-t1)*1e6/total,)
+
+# Set it back to the default
+Request.reset_thread_pool()
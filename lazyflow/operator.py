@@ -4,9 +4,13 @@ import logging
 import threading
 import functools
 
+#SciPy
+import numpy
+
 #lazyflow
 from lazyflow.slot import InputSlot, OutputSlot, Slot
 from lazyflow.utility import Tracer
+from lazyflow.request import Request, RequestPool, ProcessPool
 
 class InputDict(collections.OrderedDict):
 
@@ -146,6 +150,11 @@ class Operator(object):
     description = ""
     category = "lazyflow"
 
+    # If True, functions decorated with @Operator.subprocessKernel are
+    # executed in a child process (see ProcessPool).  May be overridden
+    # per subclass or per instance.
+    executeInSubprocess = False
+
     __metaclass__ = OperatorMetaClass
 
     def __new__(cls, *args, **kwargs):
@@ -398,6 +407,34 @@ class Operator(object):
         wrapper.__wrapped__ = func # Emulate python 3 behavior of @wraps
         return wrapper
 
+    @staticmethod
+    def subprocessKernel(func):
+        """Use this decorator with CPU-bound operator methods of the
+        form ``func(self, destination, *args, **kwargs)``, which write
+        their result into destination.
+
+        - If ``self.executeInSubprocess`` is False (the default), the
+          function is simply called.
+
+        - Otherwise, it is executed in a child process of
+          ``ProcessPool.global_process_pool``, so it doesn't compete for
+          the GIL with the request worker threads.  The result is
+          written into destination and cancellation of the calling
+          request terminates the child.
+
+        The decorated function must not request data from slots.
+        Fetch all inputs in execute() and pass them as arguments.
+
+        """
+        @functools.wraps(func)
+        def wrapper(self, destination, *args, **kwargs):
+            if not self.executeInSubprocess:
+                func(self, destination, *args, **kwargs)
+                return destination
+            return ProcessPool.global_process_pool.run( functools.partial(func, self), destination, *args, **kwargs )
+        wrapper.__wrapped__ = func # Emulate python 3 behavior of @wraps
+        return wrapper
+
     def _setupOutputs(self):
         with Tracer(self.traceLogger, msg=self.name):
             # Don't setup this operator if there are currently
@@ -514,6 +551,38 @@ class Operator(object):
         raise NotImplementedError("Operator {} does not implement"
                                   " execute()".format(self.name))
 
+    def executeBatch(self, slot, subindex, rois, results):
+        """ This method is called when somebody retrieves the contents
+        of an output slot for a list of rois at once (see
+        Slot.getBatch()).  results is a list of destination arrays,
+        one for each roi.  The method must return a list with the
+        result of each roi (like execute(), it may simply write into
+        the given destinations and return them).
+
+        Operators that can handle many (small) rois more efficiently
+        in a single vectorized call should override this method.  The
+        default implementation calls execute() for each roi, in a few
+        parallel requests (one for each chunk of consecutive rois)
+        instead of one request per roi. """
+
+        outputs = list(results)
+        def executeChunk(indexes):
+            for i in indexes:
+                result = self.execute(slot, subindex, rois[i], results[i])
+                if result is not None:
+                    outputs[i] = result
+
+        numChunks = min( len(rois), len(Request.global_thread_pool.workers) )
+        if numChunks <= 1:
+            executeChunk( range(len(rois)) )
+        else:
+            pool = RequestPool()
+            for indexes in numpy.array_split( numpy.arange(len(rois)), numChunks ):
+                pool.add( Request( functools.partial(executeChunk, indexes) ) )
+            pool.wait()
+            pool.clean()
+        return outputs
+
     def setInSlot(self, slot, subindex, key, value):
         raise NotImplementedError("Can't use __setitem__ with Operator {}"
                                   " because it doesn't implement"
@@ -1,14 +1,16 @@
 #Python
 import gc
 import time
+import json
+import heapq
+import itertools
+import weakref
 import threading
 import logging
-import gc
 logger = logging.getLogger(__name__)
 traceLogger = logging.getLogger("TRACE." + __name__)
 
 #external dependencies
-import blist
 import psutil
 
 #lazyflow
@@ -24,36 +26,117 @@ class MemInfoNode:
         self.fractionOfUsedMemoryDirty = None
         self.lastAccessTime = None
         self.name = None
+        self.statistics = None # see CacheStatistics.snapshot()
         self.children = []
 
+class CacheBlockInfo(object):
+    """
+    Bookkeeping for one evictable block of cached data, as seen by the memory manager.
+    """
+    def __init__(self, cache, key, nbytes, cost):
+        self.cacheRef = weakref.ref(cache)
+        self.blockId = (id(cache), key)
+        self.key = key
+        self.nbytes = nbytes
+        self.cost = cost # Time (in seconds) it took to compute the block's data
+        self.lastAccess = time.time()
+        self.accessCount = 1
+
+class EvictionPolicy(object):
+    """
+    Decides which cache blocks are evicted first when memory must be freed.
+    """
+    def score(self, info, now):
+        """
+        Return a sortable score for the given CacheBlockInfo.  Blocks with the lowest score are evicted first.
+        """
+        raise NotImplementedError
+
+class LRUPolicy(EvictionPolicy):
+    """
+    Evict the least recently used blocks first.
+    """
+    def score(self, info, now):
+        return info.lastAccess
+
+class LFUPolicy(EvictionPolicy):
+    """
+    Evict the least frequently used blocks first.  Ties are broken by recency.
+    """
+    def score(self, info, now):
+        return (info.accessCount, info.lastAccess)
+
+class CostAwarePolicy(EvictionPolicy):
+    """
+    Evict the blocks that are cheapest to recompute (per byte) first, weighted by recency:
+    A block that was expensive to compute is kept longer, but not forever if nobody uses it.
+    Blocks with unknown cost are treated as free to recompute, and are evicted in LRU order.
+    """
+    def score(self, info, now):
+        costPerByte = info.cost / max(1, info.nbytes)
+        return (costPerByte / (1.0 + now - info.lastAccess), info.lastAccess)
+
 class ArrayCacheMemoryMgr(threading.Thread):
-    
+    """
+    Keeps track of the memory used by the cache operators and evicts cached blocks when memory runs low.
+
+    Caches register each block of data they hold with :py:meth:`register()` (and unregister it when they free it),
+    and report accesses with :py:meth:`touch()`.  To evict a block, the manager calls ``cache._evictBlock(key)``,
+    which must free the block and return the number of bytes freed, or return 0 if the block can't be freed right now.
+    (It must not block, since it may be called from within another cache.)
+
+    If a memory budget is set (see :py:meth:`setMemoryBudget()`), blocks are evicted synchronously in :py:meth:`register()`
+    whenever a new block would exceed the budget.  Otherwise, the system memory usage is polled periodically,
+    and blocks are evicted when it gets too high.  In both cases, the blocks to evict are chosen by the eviction policy
+    (see :py:meth:`setEvictionPolicy()`).
+
+    If a DiskCacheTier is set (see :py:meth:`setDiskTier()`), caches write the blocks they evict to disk,
+    and read them back from there instead of recomputing them.
+    """
+
     totalCacheMemory = OrderedSignal()
 
     loggingName = __name__ + ".ArrayCacheMemoryMgr"
     logger = logging.getLogger(loggingName)
     traceLogger = logging.getLogger("TRACE." + loggingName)
 
-    def __init__(self):
+    def __init__(self, memoryBudget=None, policy=None):
+        """
+        :param memoryBudget: The maximum number of bytes all caches may use together, or None to use a percentage of system memory.
+        :param policy: An EvictionPolicy (default: LRUPolicy)
+        """
         threading.Thread.__init__(self)
         self.daemon = True
 
-        self.caches = self._new_list()
         self.namedCaches = []
 
         self._max_usage = 85
         self._target_usage = 70
+        self._poll_interval = 10
         self._lock = threading.Lock()
+        self._evictionLock = threading.Lock()
         self._last_usage = 0
 
-    def _new_list(self):
-        def getPrio(array_cache):
-            return array_cache._cache_priority
-        return blist.sortedlist((), getPrio)
+        self._memoryBudget = memoryBudget
+        self._policy = policy or LRUPolicy()
+        self._blocks = {} # (id(cache), key) -> CacheBlockInfo
+        self._usedBytes = 0
+
+        # Eviction candidates, as a heap of (score, sequence number, CacheBlockInfo) (see _popCandidateLocked())
+        self._candidates = []
+        self._candidatesTime = time.time()
+        self._sequence = itertools.count()
+        self._max_candidates_age = 1.0 # seconds
+
+        self._statisticsExport = None
+
+        self._diskTier = None
+        self._memoryHits = 0
+        self._memoryMisses = 0
 
     def addNamedCache(self, array_cache):
         """add a cache to a special list of named caches
-        
+
            The list of named caches should contain only top-level caches.
            This way, when showing memory usage, we can provide a tree-view, where the
            named caches are the top-level items and the user can then drill down into the caches
@@ -61,16 +144,250 @@ class ArrayCacheMemoryMgr(threading.Thread):
         """
         self.namedCaches.append(array_cache)
 
-    def add(self, array_cache):
+    def removeNamedCache(self, array_cache):
+        try:
+            self.namedCaches.remove(array_cache)
+        except ValueError:
+            pass
+
+    def setMemoryBudget(self, nbytes):
+        """
+        Set the maximum number of bytes the registered cache blocks may occupy.
+        If None, evict blocks only when the system memory usage is too high.
+        If the caches already use more than the new budget, blocks are evicted immediately.
+        """
+        self._memoryBudget = nbytes
+        if nbytes is not None:
+            self._evictUntil( lambda: self._usedBytes <= nbytes )
+
+    def memoryBudget(self):
+        return self._memoryBudget
+
+    def setEvictionPolicy(self, policy):
+        """
+        Choose which blocks are evicted first.  See LRUPolicy, LFUPolicy, CostAwarePolicy.
+        """
+        with self._lock:
+            self._policy = policy
+            self._rebuildCandidatesLocked( time.time() )
+
+    def evictionPolicy(self):
+        return self._policy
+
+    def setDiskTier(self, diskTier):
+        """
+        Set the DiskCacheTier that evicted blocks are written to, or None to discard evicted blocks.
+        """
+        self._diskTier = diskTier
+
+    def diskTier(self):
+        return self._diskTier
+
+    def recordAccess(self, hits, misses):
+        """
+        Called by the caches to count the blocks that were (or were not) found in memory.
+        """
+        with self._lock:
+            self._memoryHits += hits
+            self._memoryMisses += misses
+
+    def tierStatistics(self):
+        """
+        Return the hit/miss counters of the memory tier and the disk tier (if any).
+        """
+        stats = { 'memory' : { 'hits' : self._memoryHits,
+                               'misses' : self._memoryMisses,
+                               'usedBytes' : self._usedBytes,
+                               'blocks' : len(self._blocks) } }
+        if self._diskTier is not None:
+            stats['disk'] = self._diskTier.stats()
+        return stats
+
+    def statisticsSnapshot(self):
+        """
+        Return the current statistics of all named (top-level) caches and the cache tiers, as a dict.
+        """
+        caches = []
+        for c in list(self.namedCaches):
+            caches.append( { 'name' : c.name,
+                             'id' : id(c),
+                             'usedMemory' : c.usedMemory(),
+                             'statistics' : c.statistics().snapshot() } )
+        return { 'time' : time.time(),
+                 'tiers' : self.tierStatistics(),
+                 'caches' : caches }
+
+    def exportStatistics(self, fileOrPath):
+        """
+        Append the current statistics (see statisticsSnapshot()) to the given file as a single line of json.
+        """
+        if isinstance(fileOrPath, basestring):
+            with open(fileOrPath, 'a') as f:
+                self.exportStatistics(f)
+            return
+        fileOrPath.write( json.dumps( self.statisticsSnapshot() ) + "\n" )
+        fileOrPath.flush()
+
+    def setStatisticsExport(self, fileOrPath):
+        """
+        Export the statistics (see exportStatistics()) each time the memory usage is polled,
+        or stop exporting if fileOrPath is None.
+        """
+        self._statisticsExport = fileOrPath
+
+    def usedBytes(self):
+        """
+        Total size of all registered cache blocks.
+        """
+        return self._usedBytes
+
+    def register(self, cache, key, nbytes, cost=0.0):
+        """
+        Record that the given cache holds a block of data (identified by key) of the given size.
+        If the block was registered before, its size and cost are updated.
+        If a memory budget is set, other blocks are evicted first to make room for this one.
+        Call this *before* allocating the block's memory.
+        """
+        blockId = (id(cache), key)
+        with self._lock:
+            old = self._blocks.pop(blockId, None)
+            if old is not None:
+                self._usedBytes -= old.nbytes
+
+        info = CacheBlockInfo(cache, key, nbytes, cost)
+        if old is not None:
+            info.accessCount = old.accessCount
+
+        while True:
+            budget = self._memoryBudget
+            with self._lock:
+                # Check the budget and add the block at once,
+                #  so concurrent registrations can't all fit into the same free space.
+                if budget is None or self._usedBytes + nbytes <= budget:
+                    self._addLocked(info)
+                    return
+            freed, exhausted = self._evict( lambda: self._usedBytes + nbytes <= budget )
+            if exhausted:
+                # Nothing else can be evicted right now: exceed the budget.
+                with self._lock:
+                    self._addLocked(info)
+                return
+
+    def _addLocked(self, info):
+        # Caller must hold self._lock
+        self._blocks[info.blockId] = info
+        self._usedBytes += info.nbytes
+        heapq.heappush( self._candidates, (self._policy.score(info, info.lastAccess), next(self._sequence), info) )
+
+    def unregister(self, cache, key):
+        """
+        Record that the given cache no longer holds the given block.
+        """
         with self._lock:
-            self.caches.add(array_cache)
+            info = self._blocks.pop( (id(cache), key), None )
+            if info is not None:
+                self._usedBytes -= info.nbytes
 
-    def remove(self, array_cache):
+    def unregisterAll(self, cache):
+        """
+        Unregister all blocks of the given cache.
+        """
         with self._lock:
+            for blockId in self._blocks.keys():
+                if blockId[0] == id(cache):
+                    self._usedBytes -= self._blocks.pop(blockId).nbytes
+
+    def touch(self, cache, key, cost=None):
+        """
+        Record an access to the given block.
+        If cost is given, it replaces the block's recorded cost (the time it took to compute the block).
+        """
+        info = self._blocks.get( (id(cache), key) )
+        if info is not None:
+            info.lastAccess = time.time()
+            info.accessCount += 1
+            if cost is not None:
+                info.cost = cost
+
+    def _rebuildCandidatesLocked(self, now):
+        # Caller must hold self._lock
+        self._candidates = [ (self._policy.score(info, now), next(self._sequence), info) for info in self._blocks.values() ]
+        heapq.heapify( self._candidates )
+        self._candidatesTime = now
+
+    def _popCandidateLocked(self, now):
+        """
+        Remove the registered block with the lowest score from the candidates heap and return it (or None).
+        Caller must hold self._lock.
+
+        The scores in the heap are computed when the blocks are added, and checked again when they come out:
+        blocks whose score has grown since then (e.g. because they were touched) are put back with their new score.
+        For LRUPolicy and LFUPolicy, scores never shrink, so this is the exact order.
+        For other policies, the heap is rebuilt every _max_candidates_age seconds.
+        (It is also rebuilt when it holds too many blocks that were unregistered in the meantime.)
+        """
+        if now - self._candidatesTime > self._max_candidates_age or len(self._candidates) > 2*len(self._blocks) + 100:
+            self._rebuildCandidatesLocked(now)
+        while self._candidates:
+            score, _, info = heapq.heappop( self._candidates )
+            if self._blocks.get(info.blockId) is not info:
+                # Unregistered (or registered again) since it was added
+                continue
+            newScore = self._policy.score(info, now)
+            if newScore > score:
+                heapq.heappush( self._candidates, (newScore, next(self._sequence), info) )
+                continue
+            return info
+        return None
+
+    def _evictUntil(self, done):
+        """
+        Evict blocks in the order chosen by the eviction policy until done() returns True
+        (or there are no more blocks that can be evicted).
+        Return the number of bytes freed.
+        """
+        return self._evict(done)[0]
+
+    def _evict(self, done):
+        """
+        Implementation of _evictUntil().
+        Return the number of bytes freed, and whether we stopped because there were no more blocks that could be evicted.
+        """
+        freed = 0
+        exhausted = False
+        with self._evictionLock:
+            now = time.time()
+            count = 0
+            skipped = []
             try:
-                self.caches.remove(array_cache)
-            except ValueError:
-                pass
+                while not done():
+                    with self._lock:
+                        info = self._popCandidateLocked(now)
+                    if info is None:
+                        exhausted = True
+                        break
+                    cache = info.cacheRef()
+                    blockFreed = 0
+                    if cache is not None:
+                        blockFreed = cache._evictBlock(info.key)
+                    if cache is None or blockFreed > 0:
+                        with self._lock:
+                            if self._blocks.get(info.blockId) is info:
+                                del self._blocks[info.blockId]
+                                self._usedBytes -= info.nbytes
+                        freed += blockFreed
+                        count += 1
+                    else:
+                        # Can't be freed right now: keep it as a candidate for later.
+                        skipped.append(info)
+            finally:
+                with self._lock:
+                    for info in skipped:
+                        if self._blocks.get(info.blockId) is info:
+                            heapq.heappush( self._candidates, (self._policy.score(info, now), next(self._sequence), info) )
+            if count > 0:
+                self.traceLogger.debug("Evicted {} blocks ({} bytes)".format( count, freed ))
+        return freed, exhausted
 
     def run(self):
         while True:
@@ -90,39 +407,24 @@ class ArrayCacheMemoryMgr(threading.Thread):
             for c in self.namedCaches:
                 tot += c.usedMemory()
             self.totalCacheMemory(tot)
-                
-            time.sleep(10)
 
-            if mem_usage > self._max_usage:
-                self.logger.info("freeing memory...")
-                with self._lock:
-                    count = 0
-                    not_freed = []
-                    old_length = len(self.caches)
-                    new_caches = self._new_list()
-                    self.traceLogger.debug("Updating {} caches".format( len(self.caches) ))
-                    for c in iter(self.caches):
-                        c._updatePriority(c._last_access)
-                        new_caches.add(c)
-                    self.caches = new_caches
-                    gc.collect()
-                    self.traceLogger.debug("Target mem usage: {}".format(self._target_usage))
-                    while mem_usage > self._target_usage and len(self.caches) > 0:
-                        self.traceLogger.debug("Mem usage: {}".format(mem_usage))
-                        last_cache = self.caches.pop(-1)
-                            
-                        freed = last_cache._freeMemory(refcheck = True)
-                        self.traceLogger.debug("Freed: {}".format(freed))
-                        mem_usage = psutil.phymem_usage().percent
-                        count += 1
-                        if freed == 0:
-                            # store the caches which could not be freed
-                            not_freed.append(last_cache)
+            if self._statisticsExport is not None:
+                try:
+                    self.exportStatistics(self._statisticsExport)
+                except Exception:
+                    self.logger.error("Failed to export cache statistics", exc_info=True)
 
-                gc.collect()
+            time.sleep(self._poll_interval)
 
-                self.logger.info("freed %d/%d blocks, new usage = %f%%" % (count,old_length, mem_usage))
-                
-                for c in not_freed:
-                    # add the caches which could not be freed
-                    self.add(c)
+            budget = self._memoryBudget
+            if budget is not None:
+                # Normally, the budget is enforced whenever a block is registered,
+                #  but blocks that couldn't be evicted at that time may be evictable now.
+                self._evictUntil( lambda: self._usedBytes <= budget )
+            elif mem_usage > self._max_usage:
+                self.logger.info("freeing memory...")
+                gc.collect()
+                self.traceLogger.debug("Target mem usage: {}".format(self._target_usage))
+                freed = self._evictUntil( lambda: psutil.virtual_memory().percent <= self._target_usage )
+                gc.collect()
+                self.logger.info("freed {} bytes, new usage = {}%".format( freed, psutil.virtual_memory().percent ))
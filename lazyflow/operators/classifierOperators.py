@@ -1,6 +1,7 @@
 #Python
 import time
 import copy
+import threading
 from functools import partial
 import logging
 logger = logging.getLogger(__name__)
@@ -14,7 +15,7 @@ import vigra
 from lazyflow.graph import Operator, InputSlot, OutputSlot, OrderedSignal
 from lazyflow.roi import sliceToRoi, roiToSlice
 from lazyflow.request import Request, RequestPool
-from lazyflow.utility import traceLogged
+from lazyflow.utility import traceLogged, dequantize
 
 class OpTrainRandomForest(Operator):
     name = "TrainRandomForest"
@@ -24,8 +25,8 @@ class OpTrainRandomForest(Operator):
     inputSlots = [InputSlot("Images", level=1),InputSlot("Labels", level=1), InputSlot("fixClassifier", stype="bool")]
     outputSlots = [OutputSlot("Classifier")]
 
-    def __init__(self, parent = None):
-        Operator.__init__(self, parent)
+    def __init__(self, *args, **kwargs):
+        super(OpTrainRandomForest, self).__init__(*args, **kwargs)
         self._forest_count = 4
         # TODO: Make treecount configurable via an InputSlot
         self._tree_count = 25
@@ -50,7 +51,9 @@ class OpTrainRandomForest(Operator):
 
                 image=self.inputs["Images"][i][:].wait()
 
-                features=image[indexes]
+                # Reduced precision features are dequantized (as in OpPredictRandomForest)
+                imageMeta = self.inputs["Images"][i].meta
+                features=dequantize(image[indexes], imageMeta.quantScale, imageMeta.quantOffset)
                 labels=labels[indexes]
 
                 featMatrix.append(features)
@@ -120,57 +123,43 @@ class OpTrainRandomForestBlocked(Operator):
                 progress += 10/numImages
                 self.progressSignal(progress)
 
-                reqlistlabels = []
-                reqlistfeat = []
+                # Fetch all label blocks and all feature blocks in two batches
+                #  (instead of two requests per block)
                 traceLogger.debug("Sending requests for {} non-zero blocks (labels and data)".format( len(blocks[0])) )
+                labelRois = []
+                featureRois = []
                 for b in blocks[0]:
+                    start, stop = sliceToRoi(b, labels.meta.shape)
+                    labelRois.append( (start, stop) )
+                    # All feature channels
+                    featureStart, featureStop = list(start), list(stop)
+                    featureStart[-1] = 0
+                    featureStop[-1] = self.inputs["Images"][i].meta.shape[-1]
+                    featureRois.append( (featureStart, featureStop) )
+
+                reqlabels = labels.getBatch(labelRois)
+                reqfeat = self.inputs["Images"][i].getBatch(featureRois)
+                reqlabels.submit()
+                reqfeat.submit()
+
+                labblocks = reqlabels.wait()
+                progress += 35/numImages
+                self.progressSignal(progress)
 
-                    request = labels[b]
-                    featurekey = list(b)
-                    featurekey[-1] = slice(None, None, None)
-                    request2 = self.inputs["Images"][i][featurekey]
-
-                    reqlistlabels.append(request)
-                    reqlistfeat.append(request2)
-
-                traceLogger.debug("Requests prepared")
-
-                numLabelBlocks = len(reqlistlabels)
-                progress_outer = [progress] # Store in list for closure access
-                if numLabelBlocks > 0:
-                    progressInc = (80-10)/numLabelBlocks/numImages
-
-                def progressNotify(req):
-                    # Note: If we wanted perfect progress reporting, we could use lock here
-                    #       to protect the progress from being incremented simultaneously.
-                    #       But that would slow things down and imperfect reporting is okay for our purposes.
-                    progress_outer[0] += progressInc/2
-                    self.progressSignal(progress_outer[0])
-
-                for ir, req in enumerate(reqlistfeat):
-                    image = req.notify_finished(progressNotify)
-
-                for ir, req in enumerate(reqlistlabels):
-                    labblock = req.notify_finished(progressNotify)
-
-                traceLogger.debug("Requests fired")
-
-                for ir, req in enumerate(reqlistlabels):
-                    traceLogger.debug("Waiting for a label block...")
-                    labblock = req.wait()
-
-                    traceLogger.debug("Waiting for an image block...")
-                    image = reqlistfeat[ir].wait()
+                images = reqfeat.wait()
+                progress += 35/numImages
+                self.progressSignal(progress)
 
+                # Reduced precision features are dequantized (as in OpPredictRandomForest)
+                imageMeta = self.inputs["Images"][i].meta
+                for labblock, image in zip(labblocks, images):
                     indexes=numpy.nonzero(labblock[...,0].view(numpy.ndarray))
-                    features=image[indexes]
+                    features=dequantize(image[indexes], imageMeta.quantScale, imageMeta.quantOffset)
                     labbla=labblock[indexes]
 
                     featMatrix.append(features)
                     labelsMatrix.append(labbla)
 
-                progress = progress_outer[0]
-
                 traceLogger.debug("Requests processed")
 
         self.progressSignal(80/numImages)
@@ -223,6 +212,11 @@ class OpPredictRandomForest(Operator):
     inputSlots = [InputSlot("Image"),InputSlot("Classifier"),InputSlot("LabelsCount",stype='integer')]
     outputSlots = [OutputSlot("PMaps")]
 
+    # Predictions are computed (and reduced precision features are dequantized,
+    #  see OpPixelFeaturesPresmoothed.OutputDtype) this many pixels at a time.
+    # (Not chunked if executeInSubprocess is True.)
+    ChunkPixels = 2**16
+
     def setupOutputs(self):
         nlabels=self.inputs["LabelsCount"].value
         self.PMaps.meta.dtype = numpy.float32
@@ -248,45 +242,82 @@ class OpPredictRandomForest(Operator):
         newKey = key[:-1]
         newKey += (slice(0,self.inputs["Image"].meta.shape[-1],None),)
 
-        res = self.inputs["Image"][newKey].wait()
+        features = self.inputs["Image"][newKey].wait()
 
-        shape=res.shape
+        shape=features.shape
         prod = numpy.prod(shape[:-1])
-        res.shape = (prod, shape[-1])
-        features=res
+        features = features.reshape( (prod, shape[-1]) )
 
-        predictions = [0]*len(forests)
+        # float16 or quantized uint8/uint16 features carry their dequantization parameters in the meta
+        scale = self.Image.meta.quantScale
+        offset = self.Image.meta.quantOffset
 
-        def predict_forest(number):
-            predictions[number] = forests[number].predictProbabilities(numpy.asarray(features, dtype=numpy.float32))
+        chunkPixels = self.ChunkPixels
+        if self.executeInSubprocess:
+            # Don't start a child process for every chunk:
+            #  each forest predicts the whole roi in a single child process.
+            chunkPixels = max(prod, 1)
+            if features.dtype != numpy.float32:
+                features = dequantize(features, scale, offset)
+
+        # If our LabelsCount is higher than the number of labels in the training set,
+        # then our results aren't really valid.  FIXME !!!
+        # Duplicate the last label's predictions
+        labelCount = forests[0].labelCount()
+        channels = [ min(c+key[-1].start, labelCount-1) for c in range(result.shape[-1]) ]
+
+        # The average of the forests is accumulated in place, in the result itself (if possible)
+        output = result.view(numpy.ndarray)
+        inPlace = True
+        try:
+            output.shape = (prod, result.shape[-1])
+        except AttributeError:
+            # Not contiguous
+            output = numpy.ndarray( (prod, result.shape[-1]), dtype=numpy.float32 )
+            inPlace = False
+        output[...] = 0
+
+        def predict_chunk(forest, start, stop, lock):
+            if features.dtype == numpy.float32:
+                chunk = features[start:stop]
+            else:
+                chunk = dequantize(features[start:stop], scale, offset)
+            prediction = numpy.ndarray( (stop-start, labelCount), dtype=numpy.float32 )
+            self._predictForest(prediction, forest, chunk)
+            prediction = prediction[:, channels]
+            with lock:
+                output[start:stop] += prediction
 
         t2 = time.time()
 
-        # predict the data with all the forests in parallel
+        # predict the chunks with all the forests in parallel
         pool = RequestPool()
 
-        for i,f in enumerate(forests):
-            req = pool.request(partial(predict_forest, i))
+        for start in range(0, prod, chunkPixels):
+            stop = min(start + chunkPixels, prod)
+            lock = threading.Lock() # (The forests of a chunk add to the same output pixels)
+            for f in forests:
+                pool.request(partial(predict_chunk, f, start, stop, lock))
 
         pool.wait()
         pool.clean()
 
-        prediction=numpy.dstack(predictions)
-        prediction = numpy.average(prediction, axis=2)
-        prediction.shape =  shape[:-1] + (forests[0].labelCount(),)
-        #prediction = prediction.reshape(*(shape[:-1] + (forests[0].labelCount(),)))
-
-        # If our LabelsCount is higher than the number of labels in the training set,
-        # then our results aren't really valid.  FIXME !!!
-        # Duplicate the last label's predictions
-        for c in range(result.shape[-1]):
-            result[...,c] = prediction[...,min(c+key[-1].start, prediction.shape[-1]-1)]
+        output /= len(forests)
+        if not inPlace:
+            result[...] = output.reshape(result.shape)
 
         t3 = time.time()
 
         # logger.info("Predict took %fseconds, actual RF time was %fs, feature time was %fs" % (t3-t1, t3-t2, t2-t1))
         return result
 
+    @Operator.subprocessKernel
+    def _predictForest(self, destination, forest, features):
+        """
+        Compute the prediction of a single forest.
+        Runs in a child process if self.executeInSubprocess is True.
+        """
+        destination[...] = forest.predictProbabilities(features)
 
 
     def propagateDirty(self, slot, subindex, roi):
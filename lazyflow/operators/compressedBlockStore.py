@@ -0,0 +1,217 @@
+#Python
+import zlib
+import logging
+logger = logging.getLogger(__name__)
+
+#SciPy
+import numpy
+import h5py
+
+try:
+    import lzf
+    _has_lzf = True
+except ImportError:
+    _has_lzf = False
+
+try:
+    import blosc
+    _has_blosc = True
+except ImportError:
+    _has_blosc = False
+
+class RawCodec(object):
+    """
+    Stores the data uncompressed.
+    """
+    name = 'raw'
+
+    def compress(self, data):
+        return data.tostring()
+
+    def decompress(self, compressed, dtype, shape):
+        return numpy.fromstring( compressed, dtype=dtype ).reshape(shape)
+
+class ZlibCodec(object):
+    """
+    zlib (deflate) compression.  Always available.
+    """
+    name = 'zlib'
+
+    def __init__(self, level=1):
+        self.level = level
+
+    def compress(self, data):
+        return zlib.compress( data.data, self.level )
+
+    def decompress(self, compressed, dtype, shape):
+        return numpy.fromstring( zlib.decompress(compressed), dtype=dtype ).reshape(shape)
+
+class LzfCodec(object):
+    """
+    lzf compression (the same algorithm the hdf5 backend uses).  Requires the python-lzf package.
+    """
+    name = 'lzf'
+
+    def compress(self, data):
+        # lzf gives up (returns None) if the data doesn't compress: store it raw in that case.
+        compressed = lzf.compress( data.data, data.nbytes - 1 )
+        if compressed is None:
+            return '\x00' + data.tostring()
+        return '\x01' + compressed
+
+    def decompress(self, compressed, dtype, shape):
+        nbytes = int(numpy.prod(shape)) * numpy.dtype(dtype).itemsize
+        if compressed[0] == '\x00':
+            data = compressed[1:]
+        else:
+            data = lzf.decompress( compressed[1:], nbytes )
+        return numpy.fromstring( data, dtype=dtype ).reshape(shape)
+
+class BloscCodec(object):
+    """
+    blosc with byte shuffling and lz4 compression.  Requires the python-blosc package.
+    """
+    name = 'blosc'
+
+    def __init__(self, level=5, cname='lz4'):
+        self.level = level
+        self.cname = cname
+
+    def compress(self, data):
+        return blosc.compress( data.tostring(), typesize=data.dtype.itemsize, clevel=self.level,
+                               shuffle=blosc.SHUFFLE, cname=self.cname )
+
+    def decompress(self, compressed, dtype, shape):
+        return numpy.fromstring( blosc.decompress(compressed), dtype=dtype ).reshape(shape)
+
+_codecs = { 'raw' : RawCodec,
+            'zlib' : ZlibCodec }
+if _has_lzf:
+    _codecs['lzf'] = LzfCodec
+if _has_blosc:
+    _codecs['blosc'] = BloscCodec
+
+def availableCodecs():
+    """
+    Return the names of the codecs that can be used on this system.
+    """
+    return sorted( _codecs.keys() )
+
+def getCodec(name):
+    """
+    Return a codec instance for the given name.
+    The optional codecs (lzf, blosc) fall back to zlib if their package isn't installed.
+    """
+    if name not in _codecs and name in ('lzf', 'blosc'):
+        logger.warn( "Codec '{}' is not available on this system.  Using zlib instead.".format( name ) )
+        name = 'zlib'
+    assert name in _codecs, "Unknown codec: {}.  Choose from: {}".format( name, availableCodecs() )
+    return _codecs[name]()
+
+class Hdf5Block(object):
+    """
+    A block stored as a compressed dataset in its own in-memory hdf5 file.
+
+    h5py serializes all access to hdf5 data, so these blocks can only be read one at a time,
+    and they must not be closed while they are in use.
+    """
+    threadSafe = False
+
+    def __init__(self, filename, shape, dtype, chunkshape):
+        self.shape = tuple(shape)
+        self.dtype = numpy.dtype(dtype)
+        self._file = h5py.File(filename, driver='core', backing_store=False, mode='w')
+        self._file.create_dataset('data',
+                                  shape=self.shape,
+                                  dtype=self.dtype,
+                                  chunks=chunkshape,
+                                  compression='lzf' ) # lzf should be faster than gzip,
+                                                      # with a slightly worse compression ratio
+
+    def read(self, slicing=Ellipsis):
+        return self._file['data'][slicing]
+
+    def write(self, slicing, data):
+        self._file['data'][slicing] = data
+
+    def storageSize(self):
+        return self._file['data'].id.get_storage_size()
+
+    def compressionRatio(self):
+        return _compressionRatio( self )
+
+    def copyToHdf5(self, group, name):
+        group.copy( self._file['data'], name )
+
+    def copyFromHdf5(self, dataset):
+        assert dataset.dtype == self.dtype
+        assert dataset.shape == self.shape
+        del self._file['data']
+        self._file.copy( dataset, 'data' )
+
+    def close(self):
+        self._file.close()
+
+class CompressedBlock(object):
+    """
+    A block stored as a compressed byte string in ordinary memory.
+
+    The codecs don't hold any global lock, so any number of blocks can be decompressed in parallel.
+    Writes replace the byte string as a whole, so a block can be read without locking it:
+    readers see either the old or the new data.
+    """
+    threadSafe = True
+
+    def __init__(self, shape, dtype, codec):
+        self.shape = tuple(shape)
+        self.dtype = numpy.dtype(dtype)
+        self.codec = codec
+        self._compressed = None # Not written yet: all zeros (like a fresh hdf5 dataset)
+
+    def read(self, slicing=Ellipsis):
+        compressed = self._compressed
+        if compressed is None:
+            data = numpy.zeros( self.shape, dtype=self.dtype )
+        else:
+            data = self.codec.decompress( compressed, self.dtype, self.shape )
+        return data[slicing]
+
+    def isWritten(self):
+        return self._compressed is not None
+
+    def write(self, slicing, data):
+        # Partial writes must recompress the whole block
+        block_data = self.read().copy()
+        block_data[slicing] = data
+        self._compressed = self.codec.compress( block_data )
+
+    def storageSize(self):
+        compressed = self._compressed
+        if compressed is None:
+            return 0
+        return len(compressed)
+
+    def compressionRatio(self):
+        return _compressionRatio( self )
+
+    def copyToHdf5(self, group, name):
+        group.create_dataset( name, data=self.read(), compression='lzf' )
+
+    def copyFromHdf5(self, dataset):
+        assert dataset.dtype == self.dtype
+        assert dataset.shape == self.shape
+        self.write( Ellipsis, dataset[...] )
+
+    def close(self):
+        # Nothing to release.  (Readers that still hold a reference to this block can finish.)
+        pass
+
+def _compressionRatio(block):
+    """
+    Uncompressed size / compressed size of the given block, or None if it has no data yet.
+    """
+    storage_size = block.storageSize()
+    if storage_size == 0:
+        return None
+    uncompressed_size = numpy.prod( block.shape ) * block.dtype.itemsize
+    return float(uncompressed_size) / storage_size
@@ -0,0 +1,165 @@
+#Python
+import os
+import zlib
+import shutil
+import weakref
+import tempfile
+import threading
+import collections
+import logging
+logger = logging.getLogger(__name__)
+
+#SciPy
+import numpy
+
+class _SpilledBlock(object):
+    def __init__(self, cache, index, path, shape, dtype, nbytes):
+        self.cacheRef = weakref.ref(cache)
+        self.index = index
+        self.path = path
+        self.shape = shape
+        self.dtype = dtype
+        self.nbytes = nbytes # size on disk
+
+class DiskCacheTier(object):
+    """
+    A second cache tier for blocks that were evicted from memory by the ArrayCacheMemoryMgr.
+
+    Instead of discarding an evicted block, a cache stores it here (compressed, one file per block
+    in a scratch directory), and looks it up here again before recomputing it.
+    Caches must discard the blocks that become dirty.
+
+    If the files exceed the disk budget, the least recently used blocks are deleted.
+
+    Activate the tier with ``ArrayCacheMemoryMgr.instance.setDiskTier( DiskCacheTier(...) )``.
+    """
+
+    loggingName = __name__ + ".DiskCacheTier"
+    logger = logging.getLogger(loggingName)
+
+    def __init__(self, directory=None, diskBudget=None, compressionLevel=1):
+        """
+        :param directory: Where to store the blocks.  By default, a temporary directory is created (and removed by close()).
+        :param diskBudget: The maximum number of bytes to store, or None for no limit.
+        :param compressionLevel: zlib compression level (0-9)
+        """
+        self._ownsDirectory = directory is None
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix="lazyflow_cache_")
+        elif not os.path.exists(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.diskBudget = diskBudget
+        self.compressionLevel = compressionLevel
+
+        self._lock = threading.Lock()
+        self._blocks = collections.OrderedDict() # (id(cache), index) -> _SpilledBlock, least recently used first
+        self._usedBytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def store(self, cache, index, data):
+        """
+        Write a block of the given cache to disk.  The block must be clean.
+        Return False if the block can't be stored (e.g. because its dtype is object).
+        """
+        if data.dtype == object:
+            return False
+        key = (id(cache), index)
+        with self._lock:
+            block = self._blocks.get(key)
+            if block is not None and block.cacheRef() is cache:
+                # Still on disk from the last time it was evicted.
+                self._blocks[key] = self._blocks.pop(key)
+                return True
+
+        compressed = zlib.compress( numpy.ascontiguousarray(data).tostring(), self.compressionLevel )
+        if self.diskBudget is not None and len(compressed) > self.diskBudget:
+            return False
+        path = os.path.join( self.directory, "{}_{}.blk".format( id(cache), "_".join(map(str, index)) ) )
+        with self._lock:
+            self._removeLocked(key)
+            with open(path, 'wb') as f:
+                f.write(compressed)
+            self._blocks[key] = _SpilledBlock(cache, index, path, data.shape, data.dtype, len(compressed))
+            self._usedBytes += len(compressed)
+            self.stores += 1
+
+            if self.diskBudget is not None:
+                while self._usedBytes > self.diskBudget:
+                    self._removeLocked( next(iter(self._blocks)) )
+                    self.evictions += 1
+        return True
+
+    def load(self, cache, index):
+        """
+        Return the given block of the given cache, or None if it isn't stored.
+        """
+        key = (id(cache), index)
+        with self._lock:
+            block = self._blocks.get(key)
+            if block is None or block.cacheRef() is not cache:
+                self.misses += 1
+                return None
+            self._blocks[key] = self._blocks.pop(key)
+            self.hits += 1
+            with open(block.path, 'rb') as f:
+                compressed = f.read()
+        data = numpy.fromstring( zlib.decompress(compressed), dtype=block.dtype )
+        return data.reshape(block.shape)
+
+    def discard(self, cache, blockStart, blockStop):
+        """
+        Delete the stored blocks of the given cache whose indexes lie within [blockStart, blockStop).
+        """
+        blockStart = numpy.asarray(blockStart)
+        blockStop = numpy.asarray(blockStop)
+        with self._lock:
+            for key, block in self._blocks.items():
+                if key[0] == id(cache) and (blockStart <= block.index).all() and (block.index < blockStop).all():
+                    self._removeLocked(key)
+
+    def discardAll(self, cache):
+        """
+        Delete all stored blocks of the given cache.
+        """
+        with self._lock:
+            for key in self._blocks.keys():
+                if key[0] == id(cache):
+                    self._removeLocked(key)
+
+    def usedBytes(self):
+        return self._usedBytes
+
+    def stats(self):
+        """
+        Return the hit/miss counters and disk usage of this tier as a dict.
+        """
+        return { 'hits' : self.hits,
+                 'misses' : self.misses,
+                 'stores' : self.stores,
+                 'evictions' : self.evictions,
+                 'usedBytes' : self._usedBytes,
+                 'blocks' : len(self._blocks) }
+
+    def close(self):
+        """
+        Delete all stored blocks (and the scratch directory, if we created it).
+        """
+        with self._lock:
+            for key in self._blocks.keys():
+                self._removeLocked(key)
+            if self._ownsDirectory:
+                shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _removeLocked(self, key):
+        block = self._blocks.pop(key, None)
+        if block is not None:
+            self._usedBytes -= block.nbytes
+            try:
+                os.remove(block.path)
+            except OSError:
+                self.logger.warn("Couldn't remove cache file: {}".format(block.path))
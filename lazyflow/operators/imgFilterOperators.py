@@ -8,6 +8,7 @@ import vigra
 from math import sqrt
 from functools import partial
 from lazyflow.roi import roiToSlice,sliceToRoi
+from lazyflow.request import RequestPool
 import collections
 import warnings
 
@@ -54,6 +55,23 @@ class OpBaseVigraFilter(Operator):
         else:
             return 2*numpy.ceil(sigma*self.windowSize)+1
     
+    def spatialAxisCount(self):
+        """
+        returns the number of spatial axes the filter works on
+        (without the z axis, if the filter is applied slice by slice)
+        """
+        count = self.Input.meta.axistags.axisTypeCount(vigra.AxisType.Space)
+        if self.computeIn2d():
+            count -= 1
+        return count
+    
+    def computeIn2d(self):
+        """
+        returns True if the filter is applied to each z-slice separately
+        """
+        axistags = self.Input.meta.axistags
+        return bool(self.ComputeIn2d.value) and axistags.index('z') < len(axistags)
+    
     def propagateDirty(self,slot,subindex,roi):
         if slot == self.Input:
             cIndex = self.Input.meta.axistags.channelIndex
@@ -61,6 +79,8 @@ class OpBaseVigraFilter(Operator):
             retRoi.start[cIndex] *= self.channelsPerChannel()
             retRoi.stop[cIndex] *= self.channelsPerChannel()
             self.Output.setDirty(retRoi)
+        elif slot == self.ComputeIn2d:
+            self.Output.setDirty(slice(None))
     
     def setupIterator(self,source,result):
         self.iterator = AxisIterator(source,'spatialc',result,'spatialc',[(),(1,1,1,1,self.resultingChannels())])
@@ -83,44 +103,61 @@ class OpBaseVigraFilter(Operator):
         timeIndex = axistags.index('t')
         if timeIndex >= roi.dim:
             timeIndex = None
+        #in 2D, the z axis is handled like the time axis: no halo, one slice at a time
+        zIndex = None
+        if self.computeIn2d():
+            zIndex = axistags.index('z')
+        #(work on a copy, the roi belongs to the caller)
+        roi = roi.copy()
         roi.setInputShape(inputShape)
         origRoi = roi.copy()
         sigma = self.setupFilter()
         halo = self.calculateHalo(sigma)
+        sourceHalo = halo
+        if zIndex is not None and isinstance(halo, tuple):
+            #the halo has one entry for each axis of the slices, z has none
+            sourceHalo = list(halo)
+            sourceHalo.insert(len([i for i in range(zIndex) if i not in (channelIndex, timeIndex)]), 0)
+            sourceHalo = tuple(sourceHalo)
         
         #set up the roi to get the necessary source
-        roi.expandByShape(halo,channelIndex,timeIndex).adjustChannel(channelsPerC,channelIndex,channelRes)
+        roi.expandByShape(sourceHalo,channelIndex,timeIndex)
+        if zIndex is not None:
+            roi.setDim(zIndex, origRoi.start[zIndex], origRoi.stop[zIndex])
+        roi.adjustChannel(channelsPerC,channelIndex,channelRes)
         source = self.Input(roi.start,roi.stop).wait()
         source = vigra.VigraArray(source,axistags=axistags)
         
         #set up the grid for the iterator, and the iterator
         srcGrid = [source.shape[i] if i!= channelIndex else channelRes for i in range(len(source.shape))]
         trgtGrid = [inputShape[i]  if i != channelIndex else self.channelsPerChannel() for i in range(len(source.shape))]
-        if timeIndex is not None:
-            srcGrid[timeIndex] = 1
-            trgtGrid[timeIndex] = 1
-        nIt = newIterator(origRoi,srcGrid,trgtGrid,timeIndex=timeIndex,channelIndex = channelIndex)
+        boundIndices = [i for i in (timeIndex, zIndex) if i is not None]
+        for i in boundIndices:
+            srcGrid[i] = 1
+            trgtGrid[i] = 1
+        nIt = newIterator(origRoi,srcGrid,trgtGrid,timeIndex=timeIndex,channelIndex = channelIndex,
+                          bindIndices = [zIndex] if zIndex is not None else [])
         
         #set up roi to work with vigra filters
-        if timeIndex > channelIndex and timeIndex is not None:
-            origRoi.popDim(timeIndex)
-            origRoi.popDim(channelIndex)
-        elif timeIndex < channelIndex and timeIndex is not None:
-            origRoi.popDim(channelIndex)
-            origRoi.popDim(timeIndex)
-        else:
-            origRoi.popDim(channelIndex)
+        for i in sorted(boundIndices + [channelIndex], reverse=True):
+            origRoi.popDim(i)
+        if isinstance(halo, tuple):
+            halo = list(halo)
         origRoi.adjustRoi(halo)
         
-        #iterate over the requested volumes
-        
-        warnings.warn("TODO: This loop could be parallelized for better performance.")
+        #filter the requested volumes (e.g. the slices or time steps) in parallel
+        pool = RequestPool()
         for src,trgt,mask in nIt:
-            result[trgt] = self.vigraFilter(source = source[src],window_size=self.windowSize,roi=origRoi)[mask]
+            pool.request(partial(self._filterInto, source[src], origRoi, mask, result, trgt))
+        pool.wait()
+        pool.clean()
         return result
     
+    def _filterInto(self, source, roi, mask, result, target):
+        result[target] = self.vigraFilter(source = source,window_size=self.windowSize,roi=roi)[mask]
+    
 class OpGaussianSmoothing(OpBaseVigraFilter):
-    inputSlots = [InputSlot("Input"),InputSlot("Sigma")]
+    inputSlots = [InputSlot("Input"),InputSlot("Sigma"), InputSlot("ComputeIn2d", value=False)]
     name = "GaussianSmoothing"
     
     def __init__(self, *args, **kwargs):
@@ -145,7 +182,7 @@ class OpGaussianSmoothing(OpBaseVigraFilter):
         return 1
     
 class OpDifferenceOfGaussians(OpBaseVigraFilter):
-    inputSlots = [InputSlot("Input"), InputSlot("Sigma", stype = "float"), InputSlot("Sigma2", stype = "float")]
+    inputSlots = [InputSlot("Input"), InputSlot("Sigma", stype = "float"), InputSlot("Sigma2", stype = "float"), InputSlot("ComputeIn2d", value=False)]
     name = "DifferenceOfGaussians"
     
     def __init__(self, *args, **kwargs):
@@ -170,7 +207,7 @@ class OpDifferenceOfGaussians(OpBaseVigraFilter):
 
         
 class OpHessianOfGaussian(OpBaseVigraFilter):
-    inputSlots = [InputSlot("Input"),InputSlot("Sigma")]
+    inputSlots = [InputSlot("Input"),InputSlot("Sigma"), InputSlot("ComputeIn2d", value=False)]
     name = "OpHessianOfGaussian"
     
     def __init__(self, *args, **kwargs):
@@ -190,13 +227,13 @@ class OpHessianOfGaussian(OpBaseVigraFilter):
         return sigma
         
     def resultingChannels(self):
-        return self.Input.meta.axistags.axisTypeCount(vigra.AxisType.Space)*(self.Input.meta.axistags.axisTypeCount(vigra.AxisType.Space) + 1) / 2
+        return self.spatialAxisCount()*(self.spatialAxisCount() + 1) / 2
     
     def channelsPerChannel(self):
-        return self.Input.meta.axistags.axisTypeCount(vigra.AxisType.Space)*(self.Input.meta.axistags.axisTypeCount(vigra.AxisType.Space) + 1) / 2
+        return self.spatialAxisCount()*(self.spatialAxisCount() + 1) / 2
     
 class OpLaplacianOfGaussian(OpBaseVigraFilter):
-    inputSlots = [InputSlot("Input"), InputSlot("Sigma", stype = "float")]
+    inputSlots = [InputSlot("Input"), InputSlot("Sigma", stype = "float"), InputSlot("ComputeIn2d", value=False)]
     name = "LaplacianOfGaussian"
     
     def __init__(self, *args, **kwargs):
@@ -219,7 +256,7 @@ class OpLaplacianOfGaussian(OpBaseVigraFilter):
         return 1
 
 class OpStructureTensorEigenvaluesSummedChannels(OpBaseVigraFilter):
-    inputSlots = [InputSlot("Input"), InputSlot("Sigma", stype = "float"),InputSlot("Sigma2", stype = "float")]
+    inputSlots = [InputSlot("Input"), InputSlot("Sigma", stype = "float"),InputSlot("Sigma2", stype = "float"), InputSlot("ComputeIn2d", value=False)]
     name = "StructureTensorEigenvalues"
     
     def __init__(self, *args, **kwargs):
@@ -249,13 +286,13 @@ class OpStructureTensorEigenvaluesSummedChannels(OpBaseVigraFilter):
         self.iterator = AxisIterator(source,'spatial',result,'spatial',[(),({'c':self.channelsPerChannel()})])   
         
     def resultingChannels(self):
-        return self.Input.meta.axistags.axisTypeCount(vigra.AxisType.Space)
+        return self.spatialAxisCount()
     
     def channelsPerChannel(self):
-        return self.Input.meta.axistags.axisTypeCount(vigra.AxisType.Space)
+        return self.spatialAxisCount()
     
 class OpStructureTensorEigenvalues(OpBaseVigraFilter):
-    inputSlots = [InputSlot("Input"), InputSlot("Sigma", stype = "float"),InputSlot("Sigma2", stype = "float")]
+    inputSlots = [InputSlot("Input"), InputSlot("Sigma", stype = "float"),InputSlot("Sigma2", stype = "float"), InputSlot("ComputeIn2d", value=False)]
     name = "StructureTensorEigenvalues"
     
     def __init__(self, *args, **kwargs):
@@ -282,14 +319,14 @@ class OpStructureTensorEigenvalues(OpBaseVigraFilter):
         self.iterator = AxisIterator(source,'spatial',result,'spatial',[(),({'c':self.channelsPerChannel()})])   
         
     def resultingChannels(self):
-        return self.Input.meta.axistags.axisTypeCount(vigra.AxisType.Space)*self.Input.meta.shape[self.Input.meta.axistags.channelIndex]
+        return self.spatialAxisCount()*self.Input.meta.shape[self.Input.meta.axistags.channelIndex]
     
     def channelsPerChannel(self):
-        return self.Input.meta.axistags.axisTypeCount(vigra.AxisType.Space)
+        return self.spatialAxisCount()
 
 
 class OpHessianOfGaussianEigenvalues(OpBaseVigraFilter):
-    inputSlots = [InputSlot("Input"), InputSlot("Sigma", stype = "float")]
+    inputSlots = [InputSlot("Input"), InputSlot("Sigma", stype = "float"), InputSlot("ComputeIn2d", value=False)]
     name = "HessianOfGaussianEigenvalues"
     
     def __init__(self, *args, **kwargs):
@@ -310,13 +347,13 @@ class OpHessianOfGaussianEigenvalues(OpBaseVigraFilter):
         self.iterator = AxisIterator(source,'spatial',result,'spatial',[(),({'c':self.channelsPerChannel()})])   
   
     def resultingChannels(self):
-        return self.Input.meta.axistags.axisTypeCount(vigra.AxisType.Space)*self.Input.meta.shape[self.Input.meta.axistags.channelIndex]
+        return self.spatialAxisCount()*self.Input.meta.shape[self.Input.meta.axistags.channelIndex]
     
     def channelsPerChannel(self):
-        return self.Input.meta.axistags.axisTypeCount(vigra.AxisType.Space)
+        return self.spatialAxisCount()
     
 class OpGaussianGradientMagnitude(OpBaseVigraFilter):
-    inputSlots = [InputSlot("Input"), InputSlot("Sigma", stype = "float")]
+    inputSlots = [InputSlot("Input"), InputSlot("Sigma", stype = "float"), InputSlot("ComputeIn2d", value=False)]
     name = "GaussianGradientMagnitude"
     
     def __init__(self, *args, **kwargs):
@@ -347,7 +384,8 @@ class OpPixelFeaturesPresmoothed(Operator):
     inputSlots = [InputSlot("Input"),
                   InputSlot("Matrix"),
                   InputSlot("Scales"),
-                  InputSlot("FeatureIds")] # The selection of features to compute
+                  InputSlot("FeatureIds"), # The selection of features to compute
+                  InputSlot("ComputeIn2d", value=False)] # Compute the features of each z-slice separately
 
     outputSlots = [OutputSlot("Output"), # The entire block of features as a single image (many channels)
                    OutputSlot("Features", level=1)] # Each feature image listed separately, with feature name provided in metadata
@@ -378,6 +416,7 @@ class OpPixelFeaturesPresmoothed(Operator):
         self.stacker.Images.connect(self.multi.Outputs)
         self.smoother = OpGaussianSmoothing(parent=self)
         self.smoother.Input.connect(self.Input)
+        self.smoother.ComputeIn2d.connect(self.ComputeIn2d)
         
         # Defaults
         self.inputs["FeatureIds"].setValue( self.DefaultFeatureIds )
@@ -438,6 +477,7 @@ class OpPixelFeaturesPresmoothed(Operator):
             for j in xrange(len(self.inMatrix[i])): #Cycle through sigmas == j
                 if self.inMatrix[i][j]:
                     self.operatorMatrix[i][j] = self.FeatureInfos[self.features[i]][0](graph=self.graph)
+                    self.operatorMatrix[i][j].ComputeIn2d.connect(self.ComputeIn2d)
                     self.operatorMatrix[i][j].Input.connect(self.Input)
                     self.operatorMatrix[i][j].Sigma.setValue(self.inScales[i])
                     if self.FeatureInfos[self.features[i]][1]:
@@ -535,6 +575,10 @@ class OpPixelFeaturesPresmoothed(Operator):
             halo = max(halo,self.smoother.calculateHalo(max(self.incrSigmas)))
             roi.expandByShape(halo,cIndex,tIndex)
             roi.setDim(cIndex,0,inputShape[cIndex])
+            if self.smoother.computeIn2d():
+                #the slices are filtered separately, so no halo along z
+                zIndex = axistags.index('z')
+                roi.setDim(zIndex,origRoi.start[zIndex],origRoi.stop[zIndex])
             source = self.Input(roi.start,roi.stop).wait()
             source = vigra.VigraArray(source,axistags=axistags)
 
@@ -622,7 +666,8 @@ class OpPixelFeaturesPresmoothed(Operator):
 
         elif (slot == self.Matrix
               or slot == self.Scales
-              or slot == self.FeatureIds):
+              or slot == self.FeatureIds
+              or slot == self.ComputeIn2d):
             self.Output.setDirty(slice(None))
         else:
             assert False, "Unknown dirty input slot."
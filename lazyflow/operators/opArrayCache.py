@@ -2,7 +2,7 @@
 import time
 import weakref
 import itertools
-from threading import Lock
+from threading import Lock, current_thread
 import logging
 logger = logging.getLogger(__name__)
 from functools import partial
@@ -11,12 +11,12 @@ from functools import partial
 import numpy
 
 #lazyflow
-from lazyflow.request import RequestPool
+from lazyflow.request import Request, RequestPool
 from lazyflow.drtile import drtile
-from lazyflow.roi import sliceToRoi, roiToSlice, getBlockBounds, TinyVector
+from lazyflow.roi import sliceToRoi, roiToSlice, getBlockGrid, TinyVector
 from lazyflow.graph import InputSlot, OutputSlot
 from lazyflow.utility import fastWhere, Tracer
-from lazyflow.operators.opCache import OpCache
+from lazyflow.operators.opCache import OpCache, coalesceDirtyBlocks
 from lazyflow.operators.opArrayPiper import OpArrayPiper
 from lazyflow.operators.arrayCacheMemoryMgr import ArrayCacheMemoryMgr, MemInfoNode
 
@@ -25,6 +25,9 @@ class OpArrayCache(OpCache):
         with the same dtype in order to be able to cache results.
         
         blockShape: dirty regions are tracked with a granularity of blockShape
+        blockedStorage: If True, allocate a separate buffer for each block instead of one big array.
+                        Blocks are only allocated when they are needed, and the memory manager
+                        can free individual (cold) blocks instead of the whole cache.
     """
     
     name = "ArrayCache"
@@ -37,6 +40,7 @@ class OpArrayCache(OpCache):
     Input = InputSlot()
     blockShape = InputSlot(value = DefaultBlockSize)
     fixAtCurrent = InputSlot(value = False)
+    blockedStorage = InputSlot(value = False)
    
     #Output
     CleanBlocks = OutputSlot()
@@ -64,23 +68,36 @@ class OpArrayCache(OpCache):
         self._lock = Lock()
         self._cacheLock = Lock()
         self._lazyAlloc = True
-        self._cacheHits = 0
         self._has_fixed_dirty_blocks = False
         self._memory_manager = ArrayCacheMemoryMgr.instance
         self._running = 0
+        self._last_access = None
+        self._fillTime = 0.0 # Total time spent computing the data currently in the cache
+
+        # Blocked storage mode
+        self._blocked = False
+        self._blocks = {} # block index -> ndarray
+        self._blockBytes = 0
+        self._blockPins = None # Number of executions currently using each block
+        self._allocatingThread = None
 
     def usedMemory(self):
-        if self._cache is not None:
+        if self._blocked:
+            return self._blockBytes
+        elif self._cache is not None:
             return self._cache.nbytes
         else:
             return 0
 
     def _blockShapeForIndex(self, index):
-        cacheShape = numpy.array(self._cache.shape)
-        blockStart = index * self._blockShape
+        cacheShape = numpy.array(self.Output.meta.shape)
+        blockStart = numpy.array(numpy.unravel_index(index, self._blockState.shape)) * self._blockShape
         blockStop = numpy.minimum(blockStart + self._blockShape, cacheShape)
+        return blockStop - blockStart
         
     def fractionOfUsedMemoryDirty(self):
+        if self._blockState is None:
+            return 0
         totAll   = numpy.prod(self.Output.meta.shape)
         totDirty = 0
         for i, v in enumerate(self._blockState.ravel()):
@@ -102,27 +119,129 @@ class OpArrayCache(OpCache):
         report.dtype = self.Output.meta.dtype
         report.type = type(self)
         report.id = id(self)
+        report.statistics = self.statistics().snapshot()
 
     def _freeMemory(self, refcheck = True):
         with self._cacheLock:
-            freed  = self.usedMemory()
-            if self._cache is not None:
-                fshape = self._cache.shape
-                try:
-                    self._cache.resize((1,), refcheck = refcheck)
-                except ValueError:
-                    freed = 0
-                    self.logger.warn("OpArrayCache: freeing failed due to view references")
-                if freed > 0:
-                    self.logger.debug("OpArrayCache: freed cache of shape:{}".format(fshape))
-    
-                    self._lock.acquire()
-                    self._blockState[:] = OpArrayCache.DIRTY
-                    del self._cache
-                    self._cache = None
-                    self._lock.release()
+            self._lock.acquire()
+            try:
+                return self._freeCacheLocked(refcheck)
+            finally:
+                self._lock.release()
+
+    def _evictBlock(self, key):
+        # Called by the memory manager, possibly from within another cache.
+        if key is not None and self._allocatingThread is current_thread():
+            # The memory manager is making room for blocks we are allocating right now,
+            #  so we already own the lock (see _allocateBlocks).
+            return self._freeBlockLocked(key)
+
+        # Don't wait for our locks: if we're busy, we can't be freed right now.
+        if not self._cacheLock.acquire(False):
+            return 0
+        try:
+            if not self._lock.acquire(False):
+                return 0
+            try:
+                if key is None:
+                    return self._freeCacheLocked(refcheck = True)
+                return self._freeBlockLocked(key)
+            finally:
+                self._lock.release()
+        finally:
+            self._cacheLock.release()
+
+    def _freeBlockLocked(self, index):
+        # Caller must hold self._lock
+        # Blocks that are in use, being computed, or kept while we're fixed can't be freed.
+        block = self._blocks.get(index)
+        if block is None or self._blockPins[index] > 0 \
+           or self._blockState[index] not in (OpArrayCache.CLEAN, OpArrayCache.DIRTY):
+            return 0
+        if self._blockState[index] == OpArrayCache.CLEAN:
+            self._spillBlockLocked(index, block)
+        del self._blocks[index]
+        self._blockState[index] = OpArrayCache.DIRTY
+        self._blockQuery[index] = None
+        self._blockBytes -= block.nbytes
+        self._memory_manager.unregister(self, index)
+        self._statistics.recordEviction()
+        return block.nbytes
+
+    def _freeCacheLocked(self, refcheck):
+        # Caller must hold both self._cacheLock and self._lock
+        if self._blocked:
+            freed = 0
+            for index in self._blocks.keys():
+                freed += self._freeBlockLocked(index)
             return freed
 
+        freed  = self.usedMemory()
+        if self._cache is not None:
+            fshape = self._cache.shape
+            # The resize destroys the data, but it fails if there are views of the cache.
+            # Copy the clean blocks first, and spill them only once the cache is actually freed.
+            spilled = []
+            if self._memory_manager.diskTier() is not None:
+                for index in numpy.transpose(numpy.nonzero(self._blockState == OpArrayCache.CLEAN)):
+                    bStart, bStop = self._blockRoi(index)
+                    spilled.append( (tuple(map(int, index)), self._cache[roiToSlice(bStart, bStop)].copy()) )
+            try:
+                self._cache.resize((1,), refcheck = refcheck)
+            except ValueError:
+                freed = 0
+                self.logger.warn("OpArrayCache: freeing failed due to view references")
+            if freed > 0:
+                self.logger.debug("OpArrayCache: freed cache of shape:{}".format(fshape))
+                for index, data in spilled:
+                    self._spillBlockLocked(index, data)
+
+                self._blockState[:] = OpArrayCache.DIRTY
+                del self._cache
+                self._cache = None
+                self._fillTime = 0.0
+                self._memory_manager.unregister(self, None)
+                self._statistics.recordEviction()
+        return freed
+
+    def _spillBlockLocked(self, index, data):
+        # Caller must hold self._lock
+        # Save a clean block that is about to be freed to the disk tier (if any)
+        diskTier = self._memory_manager.diskTier()
+        if diskTier is not None:
+            diskTier.store(self, index, data)
+
+    def _loadSpilledBlocksLocked(self, blockStart, blockStop):
+        # Caller must hold self._lock, and the blocks must be pinned.
+        # Restore the dirty blocks in the given range that were spilled to the disk tier.
+        diskTier = self._memory_manager.diskTier()
+        if diskTier is None:
+            return
+        blockStart = numpy.asarray(blockStart, dtype=int)
+        blockKey = roiToSlice(blockStart, numpy.asarray(blockStop, dtype=int))
+        dirtyIndexes = numpy.transpose(numpy.nonzero(self._blockState[blockKey] == OpArrayCache.DIRTY)) + blockStart
+        for index in dirtyIndexes:
+            index = tuple(map(int, index))
+            data = diskTier.load(self, index)
+            if data is not None:
+                bStart, bStop = self._blockRoi(index)
+                if self._blocked:
+                    self._allocateBlocks(bStart, bStop)
+                    self._blocks[index][:] = data
+                else:
+                    self._cache[roiToSlice(bStart, bStop)] = data
+                self._blockState[index] = OpArrayCache.CLEAN
+
+    def _discardSpilledBlocks(self, blockStart, blockStop):
+        diskTier = self._memory_manager.diskTier()
+        if diskTier is not None:
+            diskTier.discard(self, blockStart, blockStop)
+
+    def _blockRoi(self, index):
+        blockStart = numpy.asarray(index, dtype=int) * self._blockShape
+        blockStop = numpy.minimum(blockStart + self._blockShape, self.Output.meta.shape)
+        return blockStart, blockStop
+
     def _allocateManagementStructures(self):
         with Tracer(self.traceLogger):
             shape = self.Output.meta.shape
@@ -146,20 +265,92 @@ class OpArrayCache(OpCache):
     
             self._blockState[:]= OpArrayCache.DIRTY
             self._dirtyState = OpArrayCache.CLEAN
+
+            self._blockPins = numpy.zeros(self._dirtyShape, numpy.uint32)
+
+            # Any existing block buffers (in memory or on disk) don't fit the new block grid
+            diskTier = self._memory_manager.diskTier()
+            if diskTier is not None:
+                diskTier.discardAll(self)
+            if self._blocks:
+                self._blocks = {}
+                self._blockBytes = 0
+                self._memory_manager.unregisterAll(self)
     
     def _allocateCache(self):
         with self._cacheLock:
             self._last_access = None
-            self._cache_priority = 0
             self._running = 0
 
             if self._cache is None or (self._cache.shape != self.Output.meta.shape):
+                # Make room for the new cache before we allocate it
+                nbytes = numpy.prod(self.Output.meta.shape) * numpy.dtype(self.Output.meta.dtype).itemsize
+                self._memory_manager.register(self, None, nbytes)
                 mem = numpy.zeros(self.Output.meta.shape, dtype = self.Output.meta.dtype)
                 self.logger.debug("OpArrayCache: Allocating cache (size: %dbytes)" % mem.nbytes)
                 if self._blockState is None:
                     self._allocateManagementStructures()
                 self._cache = mem
-        self._memory_manager.add(self)
+                self._fillTime = 0.0
+
+    def _allocateBlocks(self, start, stop):
+        # Caller must hold self._lock, and the blocks must be pinned
+        #  so the memory manager can't evict them while we're making room for the others.
+        dtype = numpy.dtype(self.Output.meta.dtype)
+        self._allocatingThread = current_thread()
+        try:
+            for index, blockKey, _ in self._iterBlocks(start, stop):
+                if index not in self._blocks:
+                    blockShape = [ s.stop - s.start for s in blockKey ]
+                    nbytes = numpy.prod(blockShape) * dtype.itemsize
+                    self._memory_manager.register(self, index, nbytes)
+                    self._blocks[index] = numpy.zeros(blockShape, dtype=dtype)
+                    self._blockBytes += nbytes
+        finally:
+            self._allocatingThread = None
+
+    def _iterBlocks(self, start, stop):
+        """
+        For each block that intersects the given roi, yield the block index,
+        and the slicing of the intersection relative to the block and relative to the roi.
+        """
+        start = numpy.asarray(start, dtype=numpy.int64)
+        grid = getBlockGrid(self.Output.meta.shape, self._blockShape)
+        bStarts, bStops, iStarts, iStops = grid.intersections(start, stop)
+        indexes = (bStarts // grid.blockShape).tolist()
+        blockKeys = zip((iStarts - bStarts).tolist(), (iStops - bStarts).tolist())
+        resultKeys = zip((iStarts - start).tolist(), (iStops - start).tolist())
+        for index, blockKey, resultKey in zip(indexes, blockKeys, resultKeys):
+            yield tuple(index), roiToSlice(*blockKey), roiToSlice(*resultKey)
+
+    def _readCache(self, start, stop, result):
+        if not self._blocked:
+            result[:] = self._cache[roiToSlice(start, stop)]
+            return
+        for index, blockKey, resultKey in self._iterBlocks(start, stop):
+            block = self._blocks.get(index)
+            if block is not None:
+                result[resultKey] = block[blockKey]
+            else:
+                # Never computed (we're fixed)
+                result[resultKey] = 0
+
+    def _writeBlocks(self, start, stop, data):
+        for index, blockKey, dataKey in self._iterBlocks(start, stop):
+            self._blocks[index][blockKey] = data[dataKey]
+
+    def _fetchBlocks(self, start, stop):
+        # Fetch the given roi from our input and distribute it to the block buffers.
+        # The buffers were allocated (and pinned) when this request was created.
+        fetchStart = time.time()
+        data = self.Input(start, stop).wait()
+        self._writeBlocks(start, stop, data)
+
+        # Share the fetch time among the blocks, for the memory manager's cost-aware eviction
+        indexes = [ index for index, _, _ in self._iterBlocks(start, stop) ]
+        cost = (time.time() - fetchStart) / len(indexes)
+        for index in indexes:
+            self._memory_manager.touch(self, index, cost=cost)
 
     def setupOutputs(self):
         self.CleanBlocks.meta.shape = (1,)
@@ -180,11 +371,23 @@ class OpArrayCache(OpCache):
             inputSlot = self.inputs["Input"]
             self.outputs["Output"].meta.assignFrom(inputSlot.meta)
 
+        if self.blockedStorage.ready() and self.blockedStorage.value != self._blocked:
+            # Drop the storage of the old mode.
+            # (Running requests keep their own references to the old data.)
+            self._freeMemory()
+            with self._lock:
+                self._cache = None
+                self._blocks = {}
+                self._blockBytes = 0
+                self._memory_manager.unregisterAll(self)
+                self._blocked = self.blockedStorage.value
+            reconfigure = reconfigure or self.Input.ready()
+
         shape = self.Output.meta.shape
         if reconfigure and shape is not None:
             self._lock.acquire()
             self._allocateManagementStructures()
-            if not self._lazyAlloc:
+            if not self._lazyAlloc and not self._blocked:
                 self._allocateCache()
             self._lock.release()
 
@@ -200,6 +403,8 @@ class OpArrayCache(OpCache):
                     blockStart = numpy.floor(1.0 * start / self._blockShape)
                     blockStop = numpy.ceil(1.0 * stop / self._blockShape)
                     blockKey = roiToSlice(blockStart,blockStop)
+                    self._discardSpilledBlocks(blockStart, blockStop)
+                    self._statistics.recordInvalidation( numpy.count_nonzero(self._blockState[blockKey] == OpArrayCache.CLEAN) )
                     if self._fixed:
                         # Remember that this block became dirty while we were fixed 
                         #  so we can notify downstream operators when we become unfixed.
@@ -221,33 +426,20 @@ class OpArrayCache(OpCache):
                         cond = (self._blockState[...] == OpArrayCache.FIXED_DIRTY)
                         self._blockState[...]  = fastWhere(cond, OpArrayCache.DIRTY, self._blockState, numpy.uint8)
                         self._has_fixed_dirty_blocks = False
-                    newDirtyBlocks = numpy.transpose(numpy.nonzero(cond))
-                    
-                    # To avoid lots of setDirty notifications, we simply merge all the dirtyblocks into one single superblock.
-                    # This should be the best option in most cases, but could be bad in some cases.
-                    # TODO: Optimize this by merging the dirty blocks via connected components or something.
-                    cacheShape = numpy.array(self.Output.meta.shape)
-                    dirtyStart = cacheShape
-                    dirtyStop = [0] * len(cacheShape)
-                    for index in newDirtyBlocks:
-                        blockStart = index * self._blockShape
-                        blockStop = numpy.minimum(blockStart + self._blockShape, cacheShape)
-                        
-                        dirtyStart = numpy.minimum(dirtyStart, blockStart)
-                        dirtyStop = numpy.maximum(dirtyStop, blockStop)
-
-                    if len(newDirtyBlocks > 0):
-                        self.Output.setDirty( dirtyStart, dirtyStop )
 
-    def _updatePriority(self, new_access = None):
-        if self._last_access is None:
-            self._last_access = new_access or time.time()
-        cur_time = time.time()
-        delta = cur_time - self._last_access + 1e-9
+                    # To avoid lots of setDirty notifications (and to avoid invalidating everything between
+                    #  the dirty blocks), the dirty blocks are merged into a few rectangular regions.
+                    for dirtyStart, dirtyStop in coalesceDirtyBlocks(cond, self._blockShape, self.Output.meta.shape):
+                        self.Output.setDirty( dirtyStart, dirtyStop )
 
-        self._last_access = cur_time
-        new_prio = 0.5 * self._cache_priority + delta
-        self._cache_priority = new_prio
+    def _updatePriority(self, start, stop):
+        # Inform the memory manager of this access
+        self._last_access = time.time()
+        if self._blocked:
+            for index, _, _ in self._iterBlocks(start, stop):
+                self._memory_manager.touch(self, index)
+        else:
+            self._memory_manager.touch(self, None, cost=self._fillTime)
 
     def execute(self, slot, subindex, roi, result):
         if slot == self.Output:
@@ -265,16 +457,17 @@ class OpArrayCache(OpCache):
         self._lock.acquire()
         self.traceLogger.debug("ArrayCache lock acquired.")
 
-        ch = self._cacheHits
-        ch += 1
-        self._cacheHits = ch
 
         self._running += 1
 
-        if self._cache is None:
-            self._allocateCache()
-
-        cacheView = self._cache[:] #prevent freeing of cache during running this function
+        if self._blocked:
+            if self._blockState is None:
+                self._allocateManagementStructures()
+            cacheView = None
+        else:
+            if self._cache is None:
+                self._allocateCache()
+            cacheView = self._cache[:] #prevent freeing of cache during running this function
 
 
         blockStart = (1.0 * start / self._blockShape).floor()
@@ -283,13 +476,26 @@ class OpArrayCache(OpCache):
 
         blockSet = self._blockState[blockKey]
 
+        #prevent eviction of our blocks during running this function
+        blockPins = self._blockPins[blockKey]
+        blockPins += 1
+
+        missing = numpy.count_nonzero(blockSet == OpArrayCache.DIRTY)
+        self._memory_manager.recordAccess(blockSet.size - missing, missing)
+        if missing > 0:
+            self._loadSpilledBlocksLocked(blockStart, blockStop)
+
+        cachedBlocks = numpy.count_nonzero(numpy.logical_or(blockSet == OpArrayCache.CLEAN, blockSet == OpArrayCache.FIXED_DIRTY))
+        self._statistics.recordAccess(cachedBlocks, blockSet.size, result.nbytes)
+
         # this is a little optimization to shortcut
         # many lines of python code when all data is
         # is already in the cache:
-        if numpy.logical_or(blockSet == OpArrayCache.CLEAN, blockSet == OpArrayCache.FIXED_DIRTY).all():
-            result[:] = self._cache[roiToSlice(start, stop)]
+        if cachedBlocks == blockSet.size:
+            self._readCache(start, stop, result)
+            blockPins -= 1
             self._running -= 1
-            self._updatePriority()
+            self._updatePriority(start, stop)
             cacheView = None
             self._lock.release()
             return
@@ -303,6 +509,8 @@ class OpArrayCache(OpCache):
         tileArray = drtile.test_DRTILE(tileWeights, 128**3).swapaxes(0,1)
 
         dirtyRois = []
+        computedBytes = 0
+        itemsize = numpy.dtype(self.Output.meta.dtype).itemsize
         half = tileArray.shape[0]/2
         dirtyPool = RequestPool()
 
@@ -330,8 +538,13 @@ class OpArrayCache(OpCache):
 
             if not self._fixed:
                 dirtyRois.append([drStart,drStop])
+                computedBytes += numpy.prod(drStop - drStart) * itemsize
 
-                req = self.inputs["Input"][key].writeInto(self._cache[key])
+                if self._blocked:
+                    self._allocateBlocks(drStart, drStop)
+                    req = Request( partial(self._fetchBlocks, drStart, drStop) )
+                else:
+                    req = self.inputs["Input"][key].writeInto(self._cache[key])
 
                 req.uncancellable = True #FIXME
                 
@@ -367,8 +580,12 @@ class OpArrayCache(OpCache):
 
         #wait for all requests to finish
         self.traceLogger.debug( "Firing all {} cache input requests...".format(len(dirtyPool)) )
+        fillStart = time.time()
         dirtyPool.wait()
         if len( dirtyPool ) > 0:
+            fillTime = time.time() - fillStart
+            self._fillTime += fillTime
+            self._statistics.recordFill(computedBytes, fillTime)
             # Signal that something was updated.
             # Note that we don't need to do this for the 'in process' queries (below)  
             #  because they are already in the dirtyPool in some other thread
@@ -394,23 +611,21 @@ class OpArrayCache(OpCache):
 
         # finally, store results in result area
         self._lock.acquire()
-        if self._cache is not None:
-            result[:] = self._cache[roiToSlice(start, stop)]
+        if self._blocked or self._cache is not None:
+            self._readCache(start, stop, result)
         else:
             self.traceLogger.debug( "WAITING FOR INPUT WITH THE CACHE LOCK LOCKED!" )
             self.inputs["Input"][roiToSlice(start, stop)].writeInto(result).wait()
             self.traceLogger.debug( "INPUT RECEIVED WITH THE CACHE LOCK LOCKED." )
+        blockPins -= 1
         self._running -= 1
-        self._updatePriority()
+        self._updatePriority(start, stop)
         cacheView = None
 
         self._lock.release()
 
     def setInSlot(self, slot, subindex, roi, value):
         assert slot == self.inputs["Input"]
-        ch = self._cacheHits
-        ch += 1
-        self._cacheHits = ch
         start, stop = roi.start, roi.stop
         blockStart = numpy.ceil(1.0 * start / self._blockShape)
         blockStop = numpy.floor(1.0 * stop / self._blockShape)
@@ -423,9 +638,17 @@ class OpArrayCache(OpCache):
             stop2 = numpy.minimum(stop2, self.Output.meta.shape)
             key2 = roiToSlice(start2,stop2)
             self._lock.acquire()
-            if self._cache is None:
-                self._allocateCache()
-            self._cache[key2] = value[roiToSlice(start2-start,stop2-start)]
+            self._discardSpilledBlocks(blockStart, blockStop)
+            if self._blocked:
+                blockPins = self._blockPins[blockKey]
+                blockPins += 1
+                self._allocateBlocks(start2, stop2)
+                self._writeBlocks(start2, stop2, value[roiToSlice(start2-start,stop2-start)])
+                blockPins -= 1
+            else:
+                if self._cache is None:
+                    self._allocateCache()
+                self._cache[key2] = value[roiToSlice(start2-start,stop2-start)]
             self._blockState[blockKey] = self._dirtyState
             self._blockQuery[blockKey] = None
             self._lock.release()
@@ -434,8 +657,8 @@ class OpArrayCache(OpCache):
         indexCols = numpy.where(self._blockState == OpArrayCache.CLEAN)
         clean_block_starts = numpy.array(indexCols).transpose()
             
-        inputShape = self.Input.meta.shape
-        clean_block_rois = map( partial( getBlockBounds, inputShape, self._blockShape ),
-                                clean_block_starts )
-        destination[0] = map( partial(map, TinyVector), clean_block_rois )
+        grid = getBlockGrid( self.Input.meta.shape, self._blockShape )
+        # (The block state array is indexed by block, so scale the indexes to get the block starts.)
+        starts, stops = grid.blockBounds( clean_block_starts.reshape(-1, len(grid.shape)) * grid.blockShape )
+        destination[0] = [ [TinyVector(start), TinyVector(stop)] for start, stop in zip( starts.tolist(), stops.tolist() ) ]
         return destination
@@ -1,22 +1,38 @@
 #Python
-import generic
+import time
+import weakref
+import collections
 import logging
 logger = logging.getLogger(__name__)
-from threading import Lock
+from threading import Lock, current_thread
+from functools import partial
 
 #SciPy
 import numpy
 
 #lazyflow
-from lazyflow.roi import roiToSlice
-from lazyflow.graph import Operator, InputSlot, OutputSlot
+from lazyflow.request import Request, RequestPool
+from lazyflow.drtile import drtile
+from lazyflow.roi import roiToSlice, getBlockGrid
+from lazyflow.graph import InputSlot, OutputSlot
 from lazyflow.rtype import SubRegion
-from lazyflow.utility import Tracer
-from lazyflow.operators.opCache import OpCache
-from lazyflow.operators.opArrayCache import OpArrayCache
+from lazyflow.utility import Tracer, fastWhere
+from lazyflow.operators.opCache import OpCache, CacheStatistics, coalesceDirtyBlocks
 from lazyflow.operators.arrayCacheMemoryMgr import ArrayCacheMemoryMgr, MemInfoNode
 
 class OpBlockedArrayCache(OpCache):
+    """
+    Caches its input in a flat table of blocks.
+
+    The volume is divided into outer blocks.  Each outer block gets its own buffer, which is allocated
+    when the block is first needed and registered with the memory manager, so cold blocks can be evicted one by one.
+    Within the outer blocks, the dirty state is tracked per inner block, in one state table for the whole volume.
+
+    A request fetches the dirty inner blocks of all the outer blocks it touches in parallel
+    (a few rectangular tiles per outer block), and waits for the blocks that other requests are already computing.
+    At most maxParallelFetches tiles are requested from upstream at the same time
+    (default: twice the number of worker threads).
+    """
     name = "OpBlockedArrayCache"
     description = ""
 
@@ -26,7 +42,8 @@ class OpBlockedArrayCache(OpCache):
     outerBlockShape = InputSlot()
     fixAtCurrent = InputSlot()
     forward_dirty = InputSlot(value = True)
-   
+    maxParallelFetches = InputSlot(optional = True)
+
     #Output
     Output = OutputSlot("Output")
 
@@ -34,6 +51,11 @@ class OpBlockedArrayCache(OpCache):
     logger = logging.getLogger(loggerName)
     traceLogger = logging.getLogger("TRACE." + loggerName)
 
+    # Inner block states
+    IN_PROCESS  = 0
+    DIRTY       = 1
+    CLEAN       = 2
+
     def __init__(self, *args, **kwargs):
         with Tracer(self.traceLogger):
             super(OpBlockedArrayCache, self).__init__( *args, **kwargs )
@@ -46,9 +68,17 @@ class OpBlockedArrayCache(OpCache):
             self._blockShape = None
             self._fixed_all_dirty = False  # this is a shortcut for storing wehter all subblocks are dirty
             self._forward_dirty = False
-            self._opDummy = None
-            self._opSub_list = {}
-            self._cache_list = {}
+            self._memory_manager = ArrayCacheMemoryMgr.instance
+            self._last_access = None
+            self._allocatingThread = None
+
+            self._grid = None             # The outer blocks
+            self._blocks = {}             # outer block index -> buffer
+            self._blockBytes = 0
+            self._blockPins = None        # Number of executions currently using each outer block
+            self._blockStatistics = {}    # outer block index -> CacheStatistics
+            self._blockState = None       # The state table of the inner blocks (see _tableKey())
+            self._blockQuery = None       # The (weakrefs to the) requests that compute the IN_PROCESS inner blocks
 
     def setupOutputs(self):
         with Tracer(self.traceLogger):
@@ -61,14 +91,14 @@ class OpBlockedArrayCache(OpCache):
                  or self._outerBlockShape != self.outerBlockShape.value
                  or self._innerBlockShape != self.innerBlockShape.value ):
                 self._configured = False
-                
+
             if min(shape) == 0:
                 self._configured = False
                 return
             else:
                 if self.Output.partner is not None:
                     self.Output.disconnect()
-    
+
             if not self._configured:
                 self.Output.meta.assignFrom(inputSlot.meta)
                 with self._lock:
@@ -79,41 +109,73 @@ class OpBlockedArrayCache(OpCache):
                         notifyOutputDirty = True # Notify dirty output after we're fully configured
                     else:
                         notifyOutputDirty = False
-    
+
                     self.shape = self.Input.meta.shape
                     self._blockShape = self.inputs["outerBlockShape"].value
                     self._blockShape = tuple(numpy.minimum(self._blockShape, self.shape))
                     assert numpy.array(self._blockShape).min() > 0, "ERROR in OpBlockedArrayCache: invalid blockShape = {blockShape}".format(blockShape=self._blockShape)
-                    self._dirtyShape = numpy.ceil(1.0 * numpy.array(self.shape) / numpy.array(self._blockShape))
-                    assert numpy.array(self._dirtyShape).min() > 0, "ERROR in OpBlockedArrayCache: invalid dirtyShape = {dirtyShape}".format(dirtyShape=self._dirtyShape)
-
-                    self._blockState = numpy.ones(self._dirtyShape, numpy.uint8)
-
-                _blockNumbers = numpy.dstack(numpy.nonzero(self._blockState.ravel()))
-                _blockNumbers.shape = self._dirtyShape
-
-                _blockIndices = numpy.dstack(numpy.nonzero(self._blockState))
-                _blockIndices.shape = self._blockState.shape + (_blockIndices.shape[-1],)
-
-                self._blockNumbers = _blockNumbers
-
-                # allocate queryArray object
-                self._flatBlockIndices =  _blockIndices[:]
-                self._flatBlockIndices = self._flatBlockIndices.reshape(self._flatBlockIndices.size/self._flatBlockIndices.shape[-1],self._flatBlockIndices.shape[-1],)
-
-                for op in self._cache_list.values():
-                    op.cleanUp()
-                for op in self._opSub_list.values():
-                    op.cleanUp()
-
-                self._opSub_list = {}
-                self._cache_list = {}
+                    self._allocateManagementStructures()
 
                 self._configured = True
 
                 if notifyOutputDirty:
                     self.Output.setDirty(slice(None))
 
+    def _allocateManagementStructures(self):
+        # Caller must hold self._lock
+        self._grid = getBlockGrid( self.shape, self._blockShape )
+        self._innerShape = numpy.minimum( self._innerBlockShape, self._grid.blockShape )
+        # Number of inner blocks per outer block (along each axis)
+        self._innerPerOuter = (self._grid.blockShape + self._innerShape - 1) // self._innerShape
+
+        # The inner blocks of outer block o have the indexes [o*innerPerOuter, (o+1)*innerPerOuter) in the state table.
+        # (The last inner block of each outer block may be smaller than innerBlockShape,
+        #  and the table entries past the end of the volume are never used.)
+        tableShape = tuple( self._grid.gridShape * self._innerPerOuter )
+        self._blockState = OpBlockedArrayCache.DIRTY * numpy.ones( tableShape, numpy.uint8 )
+        self._blockQuery = numpy.ndarray( tableShape, dtype=object )
+        self._blockPins = numpy.zeros( tuple(self._grid.gridShape), numpy.uint32 )
+
+        # The old buffers don't fit the new blocks
+        self._blocks = {}
+        self._blockBytes = 0
+        self._blockStatistics = {}
+        self._memory_manager.unregisterAll(self)
+        diskTier = self._memory_manager.diskTier()
+        if diskTier is not None:
+            diskTier.discardAll(self)
+
+    def _tableKey(self, start, stop):
+        """
+        Return the slicing of the state table for the inner blocks that intersect the roi [start, stop).
+        """
+        start = numpy.asarray( start, dtype=numpy.int64 )
+        last = numpy.asarray( stop, dtype=numpy.int64 ) - 1
+        outerShape = self._grid.blockShape
+        tableStart = (start // outerShape) * self._innerPerOuter + (start % outerShape) // self._innerShape
+        tableStop = (last // outerShape) * self._innerPerOuter + (last % outerShape) // self._innerShape + 1
+        return roiToSlice( tableStart, tableStop )
+
+    def _tileRoi(self, index, tileStart, tileStop):
+        """
+        Return the roi of the inner blocks [tileStart, tileStop) (state table indexes) of the given outer block.
+        """
+        outerStart, outerStop = self._grid.blockBounds( numpy.array(index) * self._grid.blockShape )
+        firstInner = numpy.array(index) * self._innerPerOuter
+        start = outerStart + (tileStart - firstInner) * self._innerShape
+        stop = numpy.minimum( outerStart + (tileStop - firstInner) * self._innerShape, outerStop )
+        return start, stop
+
+    def _blockRoi(self, index):
+        return self._grid.blockBounds( numpy.array(index) * self._grid.blockShape )
+
+    def _blockStatisticsLocked(self, index):
+        # Caller must hold self._lock
+        stats = self._blockStatistics.get(index)
+        if stats is None:
+            stats = self._blockStatistics[index] = CacheStatistics()
+        return stats
+
     def generateReport(self, report):
         report.name = self.name
         report.fractionOfUsedMemoryDirty = self.fractionOfUsedMemoryDirty()
@@ -121,21 +183,119 @@ class OpBlockedArrayCache(OpCache):
         report.lastAccessTime = self.lastAccessTime()
         report.type = type(self)
         report.id = id(self)
-       
-        for i, block in enumerate(self._cache_list.values()):
-            start = self._blockShape*self._flatBlockIndices[i]
-            stop  = numpy.minimum(start + self._blockShape, self.Output.meta.shape)
-            
+        report.statistics = self.statistics().snapshot()
+
+        with self._lock:
+            blocks = self._blocks.items()
+            statistics = dict( self._blockStatistics )
+        for index, block in sorted( blocks ):
             n = MemInfoNode()
-            n.roi = (start, stop)
+            n.roi = self._blockRoi(index)
+            n.name = "block"
+            n.usedMemory = block.nbytes
+            n.dtype = block.dtype
+            n.fractionOfUsedMemoryDirty = self._fractionDirty(index)
+            n.statistics = statistics.get( index, CacheStatistics() ).snapshot()
             report.children.append(n)
-            block.generateReport(n)
-            
+
+    def statistics(self):
+        stats = CacheStatistics().merge( self._statistics )
+        with self._lock:
+            blockStatistics = self._blockStatistics.values()
+        for blockStats in blockStatistics:
+            stats.merge( blockStats )
+        return stats
+
+    def resetStatistics(self):
+        self._statistics.reset()
+        with self._lock:
+            self._blockStatistics = {}
+
     def usedMemory(self):
-        tot = 0.0
-        for block in self._cache_list.values():
-            tot += block.usedMemory()
-        return tot
+        return self._blockBytes
+
+    def _fractionDirty(self, index):
+        states = self._blockState[ self._tableKey( *self._blockRoi(index) ) ]
+        return numpy.count_nonzero( states != OpBlockedArrayCache.CLEAN ) / float(states.size)
+
+    def fractionOfUsedMemoryDirty(self):
+        with self._lock:
+            if self._blockBytes == 0:
+                return 0.0
+            dirtyBytes = sum( block.nbytes * self._fractionDirty(index) for index, block in self._blocks.items() )
+            return dirtyBytes / float(self._blockBytes)
+
+    def lastAccessTime(self):
+        return self._last_access
+
+    def _allocateBlock(self, index):
+        # Caller must hold self._lock, and the block must be pinned.
+        block = self._blocks.get(index)
+        if block is None:
+            start, stop = self._blockRoi(index)
+            dtype = numpy.dtype(self.Output.meta.dtype)
+            nbytes = int(numpy.prod(stop - start)) * dtype.itemsize
+            # Registering may evict some of our own blocks (see _evictBlock)
+            self._allocatingThread = current_thread()
+            try:
+                self._memory_manager.register(self, index, nbytes)
+            finally:
+                self._allocatingThread = None
+            block = self._blocks[index] = numpy.zeros( tuple(stop - start), dtype=dtype )
+            self._blockBytes += nbytes
+        return block
+
+    def _loadSpilledBlockLocked(self, index):
+        # Caller must hold self._lock, and the block must be pinned.
+        # Restore a block that was spilled to the disk tier when it was evicted.
+        diskTier = self._memory_manager.diskTier()
+        if diskTier is None or index in self._blocks:
+            return
+        data = diskTier.load(self, index)
+        if data is not None:
+            self._allocateBlock(index)[...] = data
+            self._blockState[ self._tableKey( *self._blockRoi(index) ) ] = OpBlockedArrayCache.CLEAN
+
+    def _evictBlock(self, index):
+        # Called by the memory manager, possibly from within another cache.
+        if self._allocatingThread is current_thread():
+            # We're making room for a new block of our own, so we already own the lock (see _allocateBlock).
+            return self._freeBlockLocked(index)
+
+        # Don't wait for the lock: if we're busy, we can't be freed right now.
+        if not self._lock.acquire(False):
+            return 0
+        try:
+            return self._freeBlockLocked(index)
+        finally:
+            self._lock.release()
+
+    def _freeBlockLocked(self, index):
+        # Caller must hold self._lock
+        # Blocks that are in use, or kept while we're fixed, can't be freed.
+        block = self._blocks.get(index)
+        if block is None or self._blockPins[index] > 0 or self._fixed:
+            return 0
+        tableKey = self._tableKey( *self._blockRoi(index) )
+        if (self._blockState[tableKey] == OpBlockedArrayCache.CLEAN).all():
+            diskTier = self._memory_manager.diskTier()
+            if diskTier is not None:
+                diskTier.store(self, index, block)
+        del self._blocks[index]
+        self._blockState[tableKey] = OpBlockedArrayCache.DIRTY
+        self._blockQuery[tableKey] = None
+        self._blockBytes -= block.nbytes
+        self._memory_manager.unregister(self, index)
+        self._blockStatisticsLocked(index).recordEviction()
+        return block.nbytes
+
+    def _fetchTile(self, index, block, start, stop):
+        # Fetch the given roi of an outer block from our input, directly into the block's buffer.
+        # (The block is pinned until the request that called this is finished.)
+        fetchStart = time.time()
+        blockStart, _ = self._blockRoi(index)
+        self.Input(start, stop).writeInto( block[roiToSlice(start - blockStart, stop - blockStart)] ).wait()
+        self._memory_manager.touch(self, index, cost=time.time() - fetchStart)
 
     def execute(self, slot, subindex, roi, result):
         if not self._configured:
@@ -143,129 +303,192 @@ class OpBlockedArrayCache(OpCache):
             result[:] = 0
             return
 
-        #find the block key
-        key = roi.toSlice()
-        start, stop = roi.start, roi.stop
-
-        blockStart = (start / self._blockShape)
-        blockStop = (stop * 1.0 / self._blockShape).ceil()
-        #blockStop = numpy.where(stop == self.shape, self._dirtyShape, blockStop)
-        blockKey = roiToSlice(blockStart,blockStop)
-        innerBlocks = self._blockNumbers[blockKey]
-
-        requests = []
-        for b_ind in innerBlocks.flat:
-            #which part of the original key does this block fill?
-            offset = self._blockShape*self._flatBlockIndices[b_ind]
-            bigstart = numpy.maximum(offset, start)
-            bigstop = numpy.minimum(offset + self._blockShape, stop)
-
-
-            smallstart = bigstart-offset
-            smallstop = bigstop - offset
-
-            diff = smallstop - smallstart
-            smallkey = roiToSlice(smallstart, smallstop)
-
-            bigkey = roiToSlice(bigstart-start, bigstop-start)
-
-            with self._lock:    
-                if not self._fixed:
-                    if not self._cache_list.has_key(b_ind):
-
-                        self._opSub_list[b_ind] = generic.OpSubRegion(parent=self)
-                        self._opSub_list[b_ind].inputs["Input"].connect(self.inputs["Input"])
-                        tstart = self._blockShape*self._flatBlockIndices[b_ind]
-                        tstop = numpy.minimum((self._flatBlockIndices[b_ind]+numpy.ones(self._flatBlockIndices[b_ind].shape, numpy.uint8))*self._blockShape, self.shape)
-    
-                        self._opSub_list[b_ind].inputs["Start"].setValue(tuple(tstart))
-                        self._opSub_list[b_ind].inputs["Stop"].setValue(tuple(tstop))
-    
-                        self._cache_list[b_ind] = OpArrayCache(parent=self)
-                        self._cache_list[b_ind].inputs["Input"].connect(self._opSub_list[b_ind].outputs["Output"])
-                        self._cache_list[b_ind].inputs["fixAtCurrent"].connect( self.fixAtCurrent )
-                        self._cache_list[b_ind].inputs["blockShape"].setValue(self.inputs["innerBlockShape"].value)
-                        # we dont register a callback for dirtyness, since we already forward the signal
-                        
-                        # Forward value changed notifications to our own output.
-                        self._cache_list[b_ind].Output.notifyValueChanged( self.Output._sig_value_changed )
-
-            if self._cache_list.has_key(b_ind):
-                op = self._cache_list[b_ind]
-                #req = self._cache_list[b_ind].outputs["Output"][smallkey].writeInto(result[bigkey])
-
-                smallroi = SubRegion(op.outputs["Output"], start = smallstart , stop= smallstop)
-                req = op.Output(smallroi.start, smallroi.stop)
-                req.writeInto(result[bigkey])
-                req.wait()
-                #op.execute(op.outputs["Output"], (), smallroi, result[bigkey])
-
-                ####op.getOutSlot(op.outputs["Output"],smallkey,result[bigkey])
-                #requests.append(req)
-            else:
-                #When this block has never been in the cache and the current
-                #value is fixed (fixAtCurrent=True), return 0  values
-                #This prevents random noise appearing in such cases.
-                result[bigkey] = 0
+        start = numpy.asarray(roi.start, dtype=numpy.int64)
+        stop = numpy.asarray(roi.stop, dtype=numpy.int64)
+        blockStarts, _, interStarts, interStops = self._grid.intersections(start, stop)
+        indexes = map( tuple, (blockStarts // self._grid.blockShape).tolist() )
+
+        itemsize = numpy.dtype(self.Output.meta.dtype).itemsize
+        fetchRequests = []
+        fetchedTiles = []
+        inProcessQueries = []
+        computedBytes = 0
+
+        with self._lock:
+            self._last_access = time.time()
+            fixed = self._fixed
+            for index, interStart, interStop in zip( indexes, interStarts, interStops ):
+                #prevent eviction of this block during running this function
+                self._blockPins[index] += 1
+                # (Spilled data is still valid: dirty notifications discard it.  So load it even if we're fixed.)
+                self._loadSpilledBlockLocked(index)
+
+                tableKey = self._tableKey(interStart, interStop)
+                states = self._blockState[tableKey]
+                dirty = (states == OpBlockedArrayCache.DIRTY)
+                cachedBlocks = numpy.count_nonzero(states == OpBlockedArrayCache.CLEAN)
+                self._blockStatisticsLocked(index).recordAccess( cachedBlocks, states.size,
+                                                                 numpy.prod(interStop - interStart) * itemsize )
+                self._memory_manager.recordAccess( cachedBlocks, states.size - cachedBlocks )
+
+                if fixed:
+                    if index not in self._blocks or dirty.any():
+                        # A downstream operator has expressed an interest in this block,
+                        #  so mark it to be signaled as dirty when we become unfixed.
+                        # Otherwise, downstream operators won't know when there's valid data in this block.
+                        self._fixed_dirty_blocks.add(index)
+                    continue
+
+                inProcessQueries += list( self._blockQuery[tableKey][states == OpBlockedArrayCache.IN_PROCESS] )
+
+                if not dirty.any():
+                    continue
+
+                # Fetch the dirty inner blocks in a few rectangular tiles
+                block = self._allocateBlock(index)
+                tileWeights = fastWhere(dirty, 1, 128**3, numpy.uint32)
+                tileArray = drtile.test_DRTILE(tileWeights, 128**3).swapaxes(0,1)
+                tableStart = numpy.array( [s.start for s in tableKey] )
+                half = tileArray.shape[0]/2
+                for i in range(tileArray.shape[1]):
+                    tileStart = tileArray[:half,i] + tableStart
+                    tileStop = tileArray[half:,i] + tableStart
+                    tileKey = roiToSlice(tileStart, tileStop)
+                    fetchStart, fetchStop = self._tileRoi(index, tileStart, tileStop)
+
+                    req = Request( partial(self._fetchTile, index, block, fetchStart, fetchStop) )
+                    req.uncancellable = True
+                    fetchRequests.append(req)
+                    fetchedTiles.append(tileKey)
+                    computedBytes += numpy.prod(fetchStop - fetchStart) * itemsize
+
+                    self._blockState[tileKey] = OpBlockedArrayCache.IN_PROCESS
+                    self._blockQuery[tileKey] = weakref.ref(req)
+
+        try:
+            # Compute all missing tiles in parallel
+            fillStart = time.time()
+            try:
+                self._waitForFetches(fetchRequests)
+            except:
                 with self._lock:
-                    # Since a downstream operator has expressed an interest in this block,
-                    #  mark it to be signaled as dirty when we become unfixed.
-                    # Otherwise, downstream operators won't know when there's valid data in this block.
-                    self._fixed_dirty_blocks.add(b_ind)
-
-        for r in requests:
-            r.wait()
-
+                    for tileKey in fetchedTiles:
+                        self._blockState[tileKey] = OpBlockedArrayCache.DIRTY
+                        self._blockQuery[tileKey] = None
+                raise
+            del fetchRequests[:]
+
+            if fetchedTiles:
+                fillTime = time.time() - fillStart
+                with self._lock:
+                    for tileKey in fetchedTiles:
+                        # (Tiles that became dirty while they were computed stay dirty.)
+                        states = self._blockState[tileKey]
+                        states[:] = fastWhere( states == OpBlockedArrayCache.IN_PROCESS, OpBlockedArrayCache.CLEAN, states, numpy.uint8 )
+                        self._blockQuery[tileKey] = None
+                self._statistics.recordFill(computedBytes, fillTime)
+                # Signal that something was updated.
+                self.Output._sig_value_changed()
+
+            # Wait for the blocks that other requests are computing
+            inProcessRequests = {}
+            for req in inProcessQueries:
+                req = req() # get original req object from weakref
+                if req is not None:
+                    inProcessRequests[id(req)] = req
+            inProcessPool = RequestPool()
+            for req in inProcessRequests.values():
+                inProcessPool.add(req)
+            inProcessPool.wait()
+            inProcessPool.clean()
+
+            # Copy the data from the (pinned) blocks
+            for index, blockStart, interStart, interStop in zip( indexes, blockStarts, interStarts, interStops ):
+                resultKey = roiToSlice(interStart - start, interStop - start)
+                block = self._blocks.get(index)
+                if block is None:
+                    #When this block has never been in the cache and the current
+                    #value is fixed (fixAtCurrent=True), return 0  values
+                    #This prevents random noise appearing in such cases.
+                    result[resultKey] = 0
+                else:
+                    result[resultKey] = block[roiToSlice(interStart - blockStart, interStop - blockStart)]
+        finally:
+            with self._lock:
+                for index in indexes:
+                    self._blockPins[index] -= 1
+                    self._memory_manager.touch(self, index)
+
+    def _waitForFetches(self, requests):
+        """
+        Run the given requests, but no more than maxParallelFetches at a time,
+        so a large request doesn't make upstream compute (and hold) the data of all its tiles at once.
+        """
+        if self.maxParallelFetches.ready():
+            maxParallel = self.maxParallelFetches.value
+        else:
+            maxParallel = 2 * len(Request.global_thread_pool.workers)
+        maxParallel = max(1, maxParallel)
+
+        active = collections.deque()
+        for req in requests:
+            if len(active) >= maxParallel:
+                active.popleft().wait()
+            req.submit()
+            active.append(req)
+        for req in active:
+            req.wait()
 
     def propagateDirty(self, slot, subindex, roi):
         key = roi.toSlice()
-        if slot == self.inputs["Input"] and self._forward_dirty:
-            if not self._fixed:
-                self.outputs["Output"].setDirty(key)                    
-            elif self._blockShape is not None:
-                # Find the block key
+        if slot == self.inputs["Input"]:
+            if self._blockState is not None:
                 roi = SubRegion(slot, pslice=key)
-                start, stop = roi.start, roi.stop
-        
-                blockStart = (start / self._blockShape)
-                blockStop = (stop * 1.0 / self._blockShape).ceil()
-                
+                start = numpy.asarray(roi.start, dtype=numpy.int64)
+                stop = numpy.asarray(roi.stop, dtype=numpy.int64)
+                blockIndexes = self._grid.intersectingBlockIndices(start, stop)
+                tableKey = self._tableKey(start, stop)
                 with self._lock:
-                    # check wether the dirty region encompasses the whole cache
-                    if (blockStart == 0).all() and (blockStop == self._blockNumbers.shape).all():
-                        self._fixed_all_dirty = True
+                    diskTier = self._memory_manager.diskTier()
+                    if diskTier is not None:
+                        diskTier.discard(self, blockIndexes.min(axis=0), blockIndexes.max(axis=0) + 1)
+                    states = self._blockState[tableKey]
+                    cleanBlocks = numpy.count_nonzero(states == OpBlockedArrayCache.CLEAN)
+                    if cleanBlocks > 0:
+                        self._statistics.recordInvalidation(cleanBlocks)
+                    # (The buffers keep their data, which is still served while we're fixed.)
+                    states[...] = OpBlockedArrayCache.DIRTY
+
+            if self._forward_dirty:
+                if not self._fixed:
+                    self.outputs["Output"].setDirty(key)
+                elif self._blockState is not None:
+                    with self._lock:
+                        # check wether the dirty region encompasses the whole cache
+                        if (blockIndexes.min(axis=0) == 0).all() and (blockIndexes.max(axis=0) + 1 == self._grid.gridShape).all():
+                            self._fixed_all_dirty = True
 
-                    # shortcut, if everything is dirty already, dont loop over the blocks
-                    if self._fixed_all_dirty is False:
-                        blockKey = roiToSlice(blockStart,blockStop)
-                        innerBlocks = self._blockNumbers[blockKey]
-                        for b_ind in innerBlocks.flat:
-                            self._fixed_dirty_blocks.add(b_ind)            
+                        # shortcut, if everything is dirty already, dont loop over the blocks
+                        if self._fixed_all_dirty is False:
+                            self._fixed_dirty_blocks.update( map( tuple, blockIndexes.tolist() ) )
 
         if slot == self.fixAtCurrent:
             self._fixed = self.fixAtCurrent.value
             if not self._fixed:
                 # We've become unfixed.
-                # Take the superset of all the blocks that became dirty in the meantime and notify our output
-                dirtystart, dirtystop = (None,None)
+                # Notify our output of all the blocks that became dirty in the meantime (merged into a few regions)
+                dirtyRois = []
                 with self._lock:
                     if self._fixed_all_dirty is True:
-                        dirtystop = self.Output.meta.shape
-                        dirtystart = [0] * len(self.Output.meta.shape)
+                        dirtyRois = [ ([0] * len(self.Output.meta.shape), self.Output.meta.shape) ]
                     elif len(self._fixed_dirty_blocks) > 0:
-                        dirtystart = self.Output.meta.shape
-                        dirtystop = [0] * len(self.Output.meta.shape)
-                        for b_ind in self._fixed_dirty_blocks:
-                            offset = self._blockShape*self._flatBlockIndices[b_ind]
-                            bigstart = offset
-                            bigstop = numpy.minimum(offset + self._blockShape, self.Output.meta.shape)
-                            
-                            dirtystart = numpy.minimum(bigstart, dirtystart)
-                            dirtystop = numpy.maximum(bigstop, dirtystop)
-                        
+                        dirtyBlocks = numpy.zeros( tuple(self._grid.gridShape), dtype=bool )
+                        dirtyBlocks[ tuple( numpy.transpose( list(self._fixed_dirty_blocks) ) ) ] = True
+                        dirtyRois = coalesceDirtyBlocks( dirtyBlocks, self._grid.blockShape, self.Output.meta.shape )
+
                         self._fixed_dirty_blocks = set()
                     # reset all dirty state to false
-                    self._fixed_all_dirty = False 
+                    self._fixed_all_dirty = False
 
-                if dirtystart is not None:
+                for dirtystart, dirtystop in dirtyRois:
                     self.Output.setDirty(dirtystart, dirtystop)
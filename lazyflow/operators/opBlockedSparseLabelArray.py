@@ -3,21 +3,17 @@ import threading
 import logging
 import copy
 import time
-from functools import partial
 logger = logging.getLogger(__name__)
 
 #SciPy
 import numpy
 
-#third-party
-import blist
-
 #lazyflow
 from lazyflow.utility import Tracer
 from lazyflow.rtype import SubRegion
 from lazyflow.graph import Operator, InputSlot, OutputSlot
 from lazyflow.roi import sliceToRoi, roiToSlice
-from lazyflow.operators.opSparseLabelArray import OpSparseLabelArray
+from lazyflow.operators.sparseLabelStore import SparseLabelStore
 
 class OpBlockedSparseLabelArray(Operator):
     """
@@ -38,6 +34,7 @@ class OpBlockedSparseLabelArray(Operator):
                         will cause all 2s to be deleted, and then the 3s are converted to 2s.  
                         The end result is a stored array that contains label values for 1 and 2.
         blockShape - The shape of the internal blocks used to store (sparsely) the label values in the array
+                     (see SparseLabelStore)
     
     Outputs:
         Output - The stored values.  Any data that has not been marked with a label yet will be given as zeros.
@@ -70,13 +67,11 @@ class OpBlockedSparseLabelArray(Operator):
             super(OpBlockedSparseLabelArray, self).__init__( *args, **kwargs )
             self.lock = threading.Lock()
 
-            self._sparseNZ = None
-            self._labelers = {}
-            self._oldMaxLabels = {}
+            self._labelStore = None
             self._cacheShape = None
             self._cacheEraser = None
-            self._maxLabel = 0
-            self._maxLabelHistogram = numpy.zeros((1024,), numpy.uint32) # keeps track of how many sub- OpSparseLabelArrays vote for a vertain maxLabel
+            self._blockShape = None
+            self._deleteLabelState = -1
             self.deleteLabel.setValue(-1)
 
     def setupOutputs(self):
@@ -110,17 +105,10 @@ class OpBlockedSparseLabelArray(Operator):
                 self.outputs["nonzeroBlocks"].meta.dtype = object
                 self.outputs["nonzeroBlocks"].meta.shape = (1,)
 
-                self.outputs["maxLabel"].setValue(self._maxLabel)
-
-                #Filled on request
-                self._sparseNZ =  blist.sorteddict()
-
             if self.inputs["eraser"].ready():
                 self._cacheEraser = self.inputs["eraser"].value
-                for l in self._labelers.values():
-                    l.inputs['eraser'].setValue(self._cacheEraser)
 
-            if self.inputs["blockShape"].ready():
+            if self.inputs["blockShape"].ready() and self._cacheShape is not None:
                 self._origBlockShape = self.inputs["blockShape"].value
 
                 if type(self._origBlockShape) != tuple:
@@ -128,174 +116,82 @@ class OpBlockedSparseLabelArray(Operator):
                 else:
                     self._blockShape = self._origBlockShape
 
-                self._blockShape = numpy.minimum(self._blockShape, self._cacheShape)
-
-                self._dirtyShape = numpy.ceil(1.0 * numpy.array(self._cacheShape) / numpy.array(self._blockShape))
-
-                self.logger.debug( "Reconfigured Sparse labels with {}, {}, {}, {}".format( self._cacheShape, self._blockShape, self._dirtyShape, self._origBlockShape ) )
-                #FIXME: we don't really need this blockState thing
-                self._blockState = numpy.ones(self._dirtyShape, numpy.uint8)
-
-                _blockNumbers = numpy.dstack(numpy.nonzero(self._blockState.ravel()))
-                _blockNumbers.shape = self._dirtyShape
-
-                _blockIndices = numpy.dstack(numpy.nonzero(self._blockState))
-                _blockIndices.shape = self._blockState.shape + (_blockIndices.shape[-1],)
-
+                self._blockShape = tuple( numpy.minimum(self._blockShape, self._cacheShape) )
 
-                self._blockNumbers = _blockNumbers
-                #self._blockIndices = _blockIndices
+                self.logger.debug( "Reconfigured Sparse labels with {}, {}, {}".format( self._cacheShape, self._blockShape, self._origBlockShape ) )
 
-                # allocate queryArray object
-                self._flatBlockIndices =  _blockIndices[:]
-                self._flatBlockIndices = self._flatBlockIndices.reshape(self._flatBlockIndices.size/self._flatBlockIndices.shape[-1],self._flatBlockIndices.shape[-1],)
+                # Keep our labels unless the blocking changed
+                if self._labelStore is None \
+                or self._labelStore.shape != tuple(self._cacheShape) \
+                or self._labelStore.blockShape != self._blockShape:
+                    self._labelStore = SparseLabelStore( self._cacheShape, self._blockShape, numpy.uint8 )
 
+            if self._labelStore is not None:
+                self.outputs["maxLabel"].setValue( self._labelStore.maxLabel() )
 
+            # The deleteLabel input is monitored for transitions (see above)
             if self.inputs["deleteLabel"].ready():
-                for l in self._labelers.values():
-                    l.inputs["deleteLabel"].setValue(self.inputs['deleteLabel'].value)
-                    
-                    # Our internal labelers will mark their outputs as dirty,
-                    # But we aren't hooked up to forward those dirty notifications to our outputs.
-                    # Instead, we'll just mark our whole output dirty right now.
-                    self.Output.setDirty(slice(None))
+                labelNr = self.inputs["deleteLabel"].value
+                if labelNr != self._deleteLabelState:
+                    self._deleteLabelState = labelNr
+                    if labelNr != -1 and self._labelStore is not None:
+                        self._labelStore.deleteLabel(labelNr)
+                        self.Output.setDirty(slice(None))
+                        self.outputs["maxLabel"].setValue( self._labelStore.maxLabel() )
 
     def execute(self, slot, subindex, roi, result):
-        key = roi.toSlice()
         self.lock.acquire()
         assert(self.inputs["eraser"].ready() == True and self.inputs["shape"].ready() == True and self.inputs["blockShape"].ready()==True), \
         "OpBlockedSparseLabelArray:  One of the neccessary input slots is not ready: shape: %r, eraser: %r" % \
         (self.inputs["eraser"].ready(), self.inputs["shape"].ready())
         if slot.name == "Output":
-                #result[:] = self._denseArray[key]
-                #find the block key
-            start, stop = sliceToRoi(key, self._cacheShape)
-            blockStart = (1.0 * start / self._blockShape).floor()
-            blockStop = (1.0 * stop / self._blockShape).ceil()
-            blockKey = roiToSlice(blockStart,blockStop)
-            innerBlocks = self._blockNumbers[blockKey]
-            for b_ind in innerBlocks.ravel():
-                #which part of the original key does this block fill?
-                offset = self._blockShape*self._flatBlockIndices[b_ind]
-                bigstart = numpy.maximum(offset, start)
-                bigstop = numpy.minimum(offset + self._blockShape, stop)
-
-                smallstart = bigstart-offset
-                smallstop = bigstop - offset
-
-                bigkey = roiToSlice(bigstart-start, bigstop-start)
-                smallkey = roiToSlice(smallstart, smallstop)
-                if not b_ind in self._labelers or not self._labelers[b_ind].Output.ready():
-                    result[bigkey]=0
-                else:
-                    try:
-                        labeler = self._labelers[b_ind]
-                        denseArray = labeler._denseArray[smallkey]
-                        result[bigkey]= denseArray
-                    except:
-                        print "Exception in OpBlockedSparseLabelArray.execute, probably due to simultaneous calls to setInSlot() and execute()"
-                        print "labeler =", labeler
-                        print "denseArray =", denseArray
-                        print "result =", result
-                        raise
+            self._labelStore.read( roi.start, roi.stop, result )
 
         elif slot.name == "nonzeroValues":
-            nzvalues = set()
-            for l in self._labelers.values():
-                nzvalues |= set(l._sparseNZ.values())
-            result[0] = numpy.array(list(nzvalues))
+            result[0] = self._labelStore.nonzeroValues()
 
         elif slot.name == "nonzeroCoordinates":
             print "not supported yet"
             #result[0] = numpy.array(self._sparseNZ.keys())
         elif slot.name == "nonzeroBlocks":
             #we only return all non-zero blocks, no keys
-            slicelist = []
-            for b_ind in self._labelers.keys():
-                offset = self._blockShape*self._flatBlockIndices[b_ind]
-                bigstart = offset
-                bigstop = numpy.minimum(offset + self._blockShape, self._cacheShape)
-                bigkey = roiToSlice(bigstart, bigstop)
-                slicelist.append(bigkey)
-
-            result[0] = slicelist
+            result[0] = [ roiToSlice(start, stop) for start, stop in self._labelStore.nonzeroBlocks() ]
+
         elif slot.name == "maxLabel":
-            result[0] = self._maxLabel
+            result[0] = self._labelStore.maxLabel()
 
         self.lock.release()
         return result
 
+    def executeBatch(self, slot, subindex, rois, results):
+        if slot.name != "Output":
+            return super(OpBlockedSparseLabelArray, self).executeBatch(slot, subindex, rois, results)
+        # Read all rois in one go (e.g. the nonzero blocks when a classifier is trained)
+        with self.lock:
+            for roi, result in zip(rois, results):
+                self._labelStore.read( roi.start, roi.stop, result )
+        return results
+
     def setInSlot(self, slot, subindex, roi, value):
         key = roi.toSlice()
         with Tracer(self.traceLogger):
             time1 = time.time()
             start, stop = sliceToRoi(key, self._cacheShape)
+            if type(value) != numpy.ndarray:
+                # Don't pay for vigra.VigraArray's axistag handling
+                value = value.view(numpy.ndarray)
+
+            oldMaxLabel = self._labelStore.maxLabel()
+            with self.lock:
+                self._labelStore.write( start, stop, value, self._cacheEraser )
+            newMaxLabel = self._labelStore.maxLabel()
 
-            blockStart = (1.0 * start / self._blockShape).floor()
-            blockStop = (1.0 * stop / self._blockShape).ceil()
-            blockStop = numpy.where(stop == self._cacheShape, self._dirtyShape, blockStop)
-            blockKey = roiToSlice(blockStart,blockStop)
-            innerBlocks = self._blockNumbers[blockKey]
-            for b_ind in innerBlocks.ravel():
-
-                offset = self._blockShape*self._flatBlockIndices[b_ind]
-                bigstart = numpy.maximum(offset, start)
-                bigstop = numpy.minimum(offset + self._blockShape, stop)
-                smallstart = bigstart-offset
-                smallstop = bigstop - offset
-                bigkey = roiToSlice(bigstart-start, bigstop-start)
-                smallkey = roiToSlice(smallstart, smallstop)
-                smallvalues = value[tuple(bigkey)]
-                if (smallvalues != 0 ).any():
-                    if not b_ind in self._labelers:
-                        self._labelers[b_ind]=OpSparseLabelArray(self)
-                        # Don't connect deletelabel; it is set manually (here and also above)
-                        self._labelers[b_ind].inputs["deleteLabel"].setValue(self.inputs["deleteLabel"].value)
-                        self._labelers[b_ind].inputs["shape"].setValue(self._blockShape)
-                        self._labelers[b_ind].inputs["eraser"].setValue(self.inputs["eraser"].value)
-
-                        # remember old max labele, i.e. 0 since we just created
-                        self._oldMaxLabels[b_ind] = 0
-                        # add the 0 to the histogram
-                        self._maxLabelHistogram[0] += 1
-                        
-                        def max_label_changed(b_ind, slot, *args):
-                            self.lock.acquire()
-
-                            newmax = slot.value
-
-                            # make sure histogram is large enough
-                            if newmax > self._maxLabelHistogram.shape[0] -1:
-                                self._maxLabelHistogram.resize((newmax+1,))
-
-                            # update histogram
-                            oldmax = self._oldMaxLabels[b_ind]
-                            self._maxLabelHistogram[oldmax] -= 1
-                            self._maxLabelHistogram[newmax] += 1
-                            self._oldMaxLabels[b_ind] = newmax
-                            
-                            # check wether self._maxlabel needs to be updated (up and down)
-                            maxdirty = False
-                            if newmax > self._maxLabel:
-                                assert self._maxLabelHistogram[newmax] == 1
-                                self._maxLabel = newmax
-                            elif self._maxLabelHistogram[oldmax] == 0:
-                                self._maxLabel = numpy.max(numpy.nonzero(self._maxLabelHistogram)[0])
-
-                            self.lock.release()
-                            
-                            self.maxLabel.setValue(self._maxLabel)
-
-
-                            
-                        self._labelers[b_ind].inputs["maxLabel"].notifyDirty(partial(max_label_changed, b_ind))
-                        
-                    self._labelers[b_ind].inputs["Input"][smallkey] = smallvalues
-            
             time2 = time.time()
             logger.debug("OpBlockedSparseLabelArray: setInSlot writing took %fs" % (time2-time1,))
-            # Set our max label output dirty
 
+            # Set our max label output dirty if necessary
+            if newMaxLabel != oldMaxLabel:
+                self.maxLabel.setValue(newMaxLabel)
             self.Output.setDirty(key)
 
             time3 = time.time()
@@ -305,4 +201,4 @@ class OpBlockedSparseLabelArray(Operator):
     def propagateDirty(self, slot, subindex, roi):
         key = roi.toSlice()
         if slot == self.inputs["Input"]:
-            self.Output.setDirty(key)
\ No newline at end of file
+            self.Output.setDirty(key)
@@ -1,23 +1,180 @@
+#Python
+import threading
+import collections
+
+#SciPy
+import numpy
+
 #lazyflow
 from lazyflow.graph import Operator
+from lazyflow.drtile import drtile
+from lazyflow.roi import getBlockGrid
 from lazyflow.operators.arrayCacheMemoryMgr import ArrayCacheMemoryMgr
 
+class CacheStatistics(object):
+    """
+    Counters that describe how well a cache is doing:
+
+    - hits, partialHits, misses: Number of requests whose blocks were all, some, or none in the cache
+    - bytesServed: Number of bytes the cache returned
+    - bytesComputed: Number of bytes the cache requested from upstream to fill itself
+    - fill latency: Time it took to fill the cache (see meanFillLatency() and fillLatencyPercentile())
+    - evictions: Number of times cached data was freed by the memory manager
+    - dirtyInvalidations: Number of cached blocks that were invalidated because the input became dirty
+    """
+    MaxLatencySamples = 10000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.hits = 0
+        self.partialHits = 0
+        self.misses = 0
+        self.bytesServed = 0
+        self.bytesComputed = 0
+        self.evictions = 0
+        self.dirtyInvalidations = 0
+        self.fillLatencies = collections.deque( maxlen=self.MaxLatencySamples )
+
+    def recordAccess(self, cachedBlocks, totalBlocks, bytesServed):
+        with self._lock:
+            if cachedBlocks == totalBlocks:
+                self.hits += 1
+            elif cachedBlocks == 0:
+                self.misses += 1
+            else:
+                self.partialHits += 1
+            self.bytesServed += bytesServed
+
+    def recordFill(self, bytesComputed, fillTime):
+        with self._lock:
+            self.bytesComputed += bytesComputed
+            self.fillLatencies.append( fillTime )
+
+    def recordEviction(self, count=1):
+        with self._lock:
+            self.evictions += count
+
+    def recordInvalidation(self, count):
+        with self._lock:
+            self.dirtyInvalidations += count
+
+    def merge(self, other):
+        """
+        Add the counters of another CacheStatistics object to this one.  Returns self.
+        """
+        with self._lock:
+            self.hits += other.hits
+            self.partialHits += other.partialHits
+            self.misses += other.misses
+            self.bytesServed += other.bytesServed
+            self.bytesComputed += other.bytesComputed
+            self.evictions += other.evictions
+            self.dirtyInvalidations += other.dirtyInvalidations
+            self.fillLatencies.extend( other.fillLatencies )
+        return self
+
+    def meanFillLatency(self):
+        if len(self.fillLatencies) == 0:
+            return None
+        return sum(self.fillLatencies) / len(self.fillLatencies)
+
+    def fillLatencyPercentile(self, q):
+        """
+        Return the q-th percentile (0-100) of the recent fill latencies, or None if the cache was never filled.
+        """
+        if len(self.fillLatencies) == 0:
+            return None
+        return float( numpy.percentile( list(self.fillLatencies), q ) )
+
+    def snapshot(self):
+        """
+        Return the current values as a dict.
+        """
+        return { 'hits' : self.hits,
+                 'partialHits' : self.partialHits,
+                 'misses' : self.misses,
+                 'bytesServed' : int(self.bytesServed),
+                 'bytesComputed' : int(self.bytesComputed),
+                 'evictions' : self.evictions,
+                 'dirtyInvalidations' : self.dirtyInvalidations,
+                 'fillLatencyMean' : self.meanFillLatency(),
+                 'fillLatency50' : self.fillLatencyPercentile(50),
+                 'fillLatency90' : self.fillLatencyPercentile(90),
+                 'fillLatency99' : self.fillLatencyPercentile(99) }
+
+MaxDirtyRois = 32
+
+def coalesceDirtyBlocks(dirtyBlocks, blockShape, shape, maxRois=MaxDirtyRois):
+    """
+    Return a short list of rois (start, stop) that together cover exactly the dirty blocks,
+    for sending dirty notifications.
+
+    :param dirtyBlocks: A boolean array with an entry for each block (of the given blockShape) of a dataset of the given shape
+    :param maxRois: If the dirty blocks can't be covered with this many rectangular tiles,
+                    the bounding box of all dirty blocks is returned instead.
+
+    Neighboring dirty blocks are merged into rectangular tiles with drtile (as for the fetch planning in OpArrayCache),
+    so a few small changes in a big volume don't invalidate everything in between.
+    """
+    dirtyBlocks = numpy.asarray(dirtyBlocks, dtype=bool)
+    if not dirtyBlocks.any():
+        return []
+    grid = getBlockGrid( shape, blockShape )
+    assert tuple(dirtyBlocks.shape) == tuple(grid.gridShape), "dirtyBlocks doesn't match the block grid"
+
+    tileWeights = numpy.where(dirtyBlocks, 1, 128**3).astype(numpy.uint32)
+    tileArray = drtile.test_DRTILE(tileWeights, 128**3)
+    ndim = len(grid.shape)
+    if len(tileArray) > maxRois:
+        indexes = numpy.transpose( numpy.nonzero(dirtyBlocks) )
+        tileStarts = indexes.min(axis=0)[None, :]
+        tileStops = indexes.max(axis=0)[None, :] + 1
+    else:
+        tileStarts = tileArray[:, :ndim]
+        tileStops = tileArray[:, ndim:]
+
+    starts = tileStarts * grid.blockShape
+    stops = numpy.minimum( tileStops * grid.blockShape, grid.shape )
+    return zip( starts.tolist(), stops.tolist() )
+
 class OpCache(Operator):
     """Implements the interface for a caching operator
     """
-    
+
     def __init__(self, parent=None, graph=None):
         super(OpCache, self).__init__(parent=parent, graph=graph)
+        self._statistics = CacheStatistics()
         if parent is None or not isinstance(parent, OpCache):
             ArrayCacheMemoryMgr.instance.addNamedCache(self)
-            
+
+    def cleanUp(self):
+        super(OpCache, self).cleanUp()
+        ArrayCacheMemoryMgr.instance.unregisterAll(self)
+        diskTier = ArrayCacheMemoryMgr.instance.diskTier()
+        if diskTier is not None:
+            diskTier.discardAll(self)
+        ArrayCacheMemoryMgr.instance.removeNamedCache(self)
+
     def generateReport(self, report):
         raise NotImplementedError()
-        
+
+    def statistics(self):
+        """
+        Return the CacheStatistics of this cache.
+        Caches that consist of other caches return the combined statistics of their children.
+        """
+        return self._statistics
+
+    def resetStatistics(self):
+        self._statistics.reset()
+
     def usedMemory(self):
         """used memory in bytes"""
         return 0 #overwrite me
-    
+
     def fractionOfUsedMemoryDirty(self):
         """fraction of the currently used memory that is marked as dirty"""
         return 0 #overwrite me
@@ -25,4 +182,10 @@ class OpCache(Operator):
     def lastAccessTime(self):
         """timestamp of last access (time.time())"""
         return 0 #overwrite me
-    
\ No newline at end of file
+
+    def _evictBlock(self, key):
+        """Called by the memory manager to free the block that was
+        registered with the given key.  Must not block.  Return the
+        number of bytes freed, or 0 if the block can't be freed right
+        now (e.g. because it is in use)."""
+        return 0 #overwrite me
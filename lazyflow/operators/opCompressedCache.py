@@ -1,5 +1,6 @@
 # Built-in
 import copy
+import time
 import logging
 from functools import partial
 import collections
@@ -11,17 +12,25 @@ import h5py
 # Lazyflow
 from lazyflow.request import Request, RequestPool, RequestLock
 from lazyflow.graph import Operator, InputSlot, OutputSlot
-from lazyflow.roi import TinyVector, getIntersectingBlocks, getBlockBounds, roiToSlice, getIntersection
+from lazyflow.roi import TinyVector, getIntersectingBlocks, getBlockBounds, getBlockGrid, roiToSlice
 from lazyflow.operators.opCache import OpCache
+from lazyflow.operators.arrayCacheMemoryMgr import ArrayCacheMemoryMgr
+from lazyflow.operators.compressedBlockStore import Hdf5Block, CompressedBlock, getCodec
 
 logger = logging.getLogger(__name__)
 
 class OpCompressedCache(OpCache):
     """
-    A blockwise cache that stores each block as a separate in-memory hdf5 file with a compressed dataset.
+    A blockwise cache that stores each block in compressed form.
+
+    By default, each block is a separate in-memory hdf5 file with a compressed dataset.
+    If the Codec slot names a codec (e.g. 'zlib', see compressedBlockStore.availableCodecs()),
+    the blocks are kept as compressed byte strings instead, which can be decompressed in parallel.
     """
     Input = InputSlot() # Also used to asynchronously force data into the cache via __setitem__ (see setInSlot(), below()
     BlockShape = InputSlot(optional=True) # If not provided, the entire input is treated as one block
+    Codec = InputSlot(value='hdf5') # 'hdf5' or the name of a codec for the in-memory byte store
+    MemoryBudget = InputSlot(optional=True) # Max. number of bytes (of compressed storage) for this cache.  If not provided, only the memory manager limits it.
     
     Output = OutputSlot() # Output as numpy arrays
 
@@ -32,20 +41,24 @@ class OpCompressedCache(OpCache):
     def __init__(self, *args, **kwargs):
         super( OpCompressedCache, self ).__init__( *args, **kwargs )
         self._blockshape = None
-        self._cacheFiles = {}
+        self._codec = None # None: use hdf5 files
+        self._cacheBlocks = {}
+        self._blockSizes = collections.OrderedDict() # block_start -> storage size, least recently used first
         self._dirtyBlocks = set()
+        self._last_access = None
         self._lock = RequestLock()
         self._blockLocks = {}
+        self._memory_manager = ArrayCacheMemoryMgr.instance
 
 
     def cleanUp(self):
         logger.debug( "Cleaning up" )
-        self._closeAllCacheFiles()
+        self._closeAllCacheBlocks()
         super( OpCompressedCache, self ).cleanUp()
 
 
     def setupOutputs(self):
-        self._closeAllCacheFiles()
+        self._closeAllCacheBlocks()
         self.Output.meta.assignFrom(self.Input.meta)
         self.OutputHdf5.meta.assignFrom(self.Input.meta)
         self.CleanBlocks.meta.shape = (1,)
@@ -60,6 +73,37 @@ class OpCompressedCache(OpCache):
         # Choose optimal chunkshape
         self._chunkshape = self._chooseChunkshape(self._blockshape)
 
+        if self.Codec.value == 'hdf5':
+            self._codec = None
+        else:
+            self._codec = getCodec( self.Codec.value )
+
+
+    def generateReport(self, report):
+        report.name = self.name
+        report.usedMemory = self.usedMemory()
+        report.fractionOfUsedMemoryDirty = self.fractionOfUsedMemoryDirty()
+        report.lastAccessTime = self.lastAccessTime()
+        report.dtype = self.Output.meta.dtype
+        report.type = type(self)
+        report.id = id(self)
+        report.statistics = self.statistics().snapshot()
+
+    def usedMemory(self):
+        """
+        The compressed storage size of all blocks.
+        """
+        return sum( self._blockSizes.values() )
+
+    def fractionOfUsedMemoryDirty(self):
+        usedMemory = self.usedMemory()
+        if usedMemory == 0:
+            return 0
+        dirtyMemory = sum( self._blockSizes.get( block_start, 0 ) for block_start in list(self._dirtyBlocks) )
+        return dirtyMemory / float(usedMemory)
+
+    def lastAccessTime(self):
+        return self._last_access
 
     def execute(self, slot, subindex, roi, destination):
         if slot == self.Output:
@@ -76,36 +120,74 @@ class OpCompressedCache(OpCache):
         assert len(roi.stop) == len(self.Input.meta.shape), "roi: {} has the wrong number of dimensions for Input shape: {}".format( roi, self.Input.meta.shape )
         assert numpy.less_equal(roi.stop, self.Input.meta.shape).all(), "roi: {} is out-of-bounds for Input shape: {}".format( roi, self.Input.meta.shape )
         
-        block_starts = getIntersectingBlocks( self._blockshape, (roi.start, roi.stop) )
+        # Compute the bounds of all blocks and their intersections with the roi at once
+        grid = getBlockGrid( self.Input.meta.shape, self._blockshape )
+        block_starts, block_stops, inter_starts, inter_stops = grid.intersections( roi.start, roi.stop )
+        destination_relative_intersections = zip( inter_starts - roi.start, inter_stops - roi.start )
+        block_relative_intersections = zip( inter_starts - block_starts, inter_stops - block_starts )
+        entire_block_rois = zip( block_starts, block_stops )
         block_starts = map( tuple, block_starts )
 
+        self._last_access = time.time()
+        cached_blocks = len( filter( self._isClean, block_starts ) )
+        self._statistics.recordAccess( cached_blocks, len(block_starts), destination.nbytes )
+
         # Ensure all block cache files are up-to-date
         reqPool = RequestPool() # (Do the work in parallel.)
-        for block_start in block_starts:
-            entire_block_roi = getBlockBounds( self.Input.meta.shape, self._blockshape, block_start )
+        for entire_block_roi in entire_block_rois:
             f = partial( self._ensureCached, entire_block_roi)
             reqPool.add( Request(f) )
         logger.debug( "Waiting for {} blocks...".format( len(block_starts) ) )
         reqPool.wait()
 
         # Copy data from each block
-        # (Parallelism not needed here: h5py will serialize these requests anyway)
         logger.debug( "Copying data from {} blocks...".format( len(block_starts) ) )
-        for block_start in block_starts:
-            entire_block_roi = getBlockBounds( self.Input.meta.shape, self._blockshape, block_start )
-
-            # This block's portion of the roi
-            intersecting_roi = getIntersection( (roi.start, roi.stop), entire_block_roi )
-            
-            # Compute slicing within destination array and slicing within this block
-            destination_relative_intersection = numpy.subtract(intersecting_roi, roi.start)
-            block_relative_intersection = numpy.subtract(intersecting_roi, block_start)
-            
-            # Copy from block to destination
-            dataset = self._getBlockDataset( entire_block_roi )
-            destination[ roiToSlice(*destination_relative_intersection) ] = dataset[ roiToSlice( *block_relative_intersection ) ]
+        copyFuncs = []
+        for i, block_start in enumerate( block_starts ):
+            copyFuncs.append( partial( self._copyFromBlock,
+                                       block_start,
+                                       entire_block_rois[i],
+                                       roiToSlice( *block_relative_intersections[i] ),
+                                       destination,
+                                       roiToSlice( *destination_relative_intersections[i] ) ) )
+
+        if self._codec is None or len(copyFuncs) == 1:
+            # (Parallelism not needed here: h5py will serialize these requests anyway)
+            for f in copyFuncs:
+                f()
+        else:
+            # The byte store decompresses in parallel.
+            reqPool = RequestPool()
+            for f in copyFuncs:
+                reqPool.add( Request(f) )
+            reqPool.wait()
         return destination
 
+    def _copyFromBlock(self, block_start, entire_block_roi, block_slicing, destination, destination_slicing):
+        """
+        Copy the given part of a block into the destination.
+        """
+        # The block lock prevents the memory manager from evicting the block while we read it.
+        #  If it was evicted since we cached it, we simply cache it again.
+        # (Thread-safe blocks can be read without the lock: eviction doesn't affect readers that already hold the block.
+        #  But a block that was recreated after an eviction has no data until it is filled again,
+        #  so only written blocks that aren't dirty are read without the lock.)
+        while True:
+            block = self._cacheBlocks.get( block_start )
+            if block is not None and block.threadSafe and block.isWritten() and block_start not in self._dirtyBlocks:
+                destination[ destination_slicing ] = block.read( block_slicing )
+                break
+            with self._blockLocks[block_start]:
+                block = self._cacheBlocks.get( block_start )
+                if block is not None and block_start not in self._dirtyBlocks:
+                    destination[ destination_slicing ] = block.read( block_slicing )
+                    break
+            self._ensureCached( entire_block_roi )
+        self._touchBlock( block_start )
+
+
+    def _isClean(self, block_start):
+        return block_start in self._cacheBlocks and block_start not in self._dirtyBlocks
 
     def _executeCleanBlocks(self, destination):
         """
@@ -113,12 +195,14 @@ class OpCompressedCache(OpCache):
         an *unsorted* list of block rois that the cache currently holds.
         """
         # Set difference: clean = existing - dirty
-        clean_block_starts = set( self._cacheFiles.keys() ) - self._dirtyBlocks
+        clean_block_starts = set( self._cacheBlocks.keys() ) - self._dirtyBlocks
         
-        inputShape = self.Input.meta.shape
-        clean_block_rois = map( partial( getBlockBounds, inputShape, self._blockshape ),
-                                clean_block_starts )
-        destination[0] = map( partial(map, TinyVector), clean_block_rois )
+        if not clean_block_starts:
+            destination[0] = []
+            return destination
+        grid = getBlockGrid( self.Input.meta.shape, self._blockshape )
+        starts, stops = grid.blockBounds( list(clean_block_starts) )
+        destination[0] = [ [TinyVector(start), TinyVector(stop)] for start, stop in zip( starts.tolist(), stops.tolist() ) ]
         return destination
 
     def _executeOutputHdf5(self, roi, destination):
@@ -130,10 +214,16 @@ class OpCompressedCache(OpCache):
         assert (block_roi == numpy.array((roi.start, roi.stop))).all(), "OutputHdf5 slot requires roi to be exactly one block."
 
         block_roi = [roi.start, roi.stop]
-        self._ensureCached( block_roi )
-        dataset = self._getBlockDataset( block_roi )
+        block_start = tuple(roi.start)
         assert str(block_roi) not in destination, "destination hdf5 group already has a dataset with this block's name"
-        destination.copy( dataset, str(block_roi) )
+        while True:
+            self._ensureCached( block_roi )
+            with self._blockLocks[block_start]:
+                block = self._cacheBlocks.get( block_start )
+                if block is not None:
+                    block.copyToHdf5( destination, str(block_roi) )
+                    break
+        self._touchBlock( block_start )
         return destination        
 
     def propagateDirty(self, slot, subindex, roi):
@@ -142,6 +232,7 @@ class OpCompressedCache(OpCache):
             with self._lock:
                 block_starts = getIntersectingBlocks( self._blockshape, (roi.start, roi.stop) )
                 block_starts = map( tuple, block_starts )
+                self._statistics.recordInvalidation( len( filter( self._isClean, block_starts ) ) )
                 
                 for block_start in block_starts:
                     self._dirtyBlocks.add( block_start )
@@ -150,6 +241,9 @@ class OpCompressedCache(OpCache):
         elif slot == self.BlockShape:
             # Everything is dirty
             self.Output.setDirty( slice(None) )
+        elif slot == self.Codec or slot == self.MemoryBudget:
+            # The data doesn't change, only the way we store it.
+            pass
         else:
             assert False, "Unknown output slot"
             
@@ -216,34 +310,30 @@ class OpCompressedCache(OpCache):
         return dtype().nbytes
 
 
-    def _getCacheFile(self, entire_block_roi):
+    def _getCacheBlock(self, entire_block_roi):
         """
-        Get the cache file for the block that starts at block_start.
+        Get the storage for the block that starts at block_start.
         If it doesn't exist yet, create it first.
         """
         block_start = tuple(entire_block_roi[0])
-        if block_start in self._cacheFiles:
-            return self._cacheFiles[block_start]
+        if block_start in self._cacheBlocks:
+            return self._cacheBlocks[block_start]
         with self._lock:
-            if block_start not in self._cacheFiles:
-                logger.debug("Creating a cache file for block: {}".format( list(block_start) ))
-                # Create an in-memory hdf5 file with a unique name
-                filename = str(id(self)) + str(id(self._cacheFiles)) + str(block_start) 
-                mem_file = h5py.File(filename, driver='core', backing_store=False, mode='w')                
-                
-                # Make a compressed dataset
-                datashape = tuple( entire_block_roi[1] - entire_block_roi[0] )
-                mem_file.create_dataset('data',
-                                        shape=datashape,
-                                        dtype=self.Input.meta.dtype,
-                                        chunks=self._chunkshape,
-                                        compression='lzf' ) # lzf should be faster than gzip, 
-                                                            # with a slightly worse compression ratio
+            if block_start not in self._cacheBlocks:
+                logger.debug("Creating a cache block: {}".format( list(block_start) ))
+                datashape = tuple( numpy.subtract( entire_block_roi[1], entire_block_roi[0] ) )
+                if self._codec is None:
+                    # Create an in-memory hdf5 file with a unique name
+                    filename = str(id(self)) + str(id(self._cacheBlocks)) + str(block_start) 
+                    block = Hdf5Block( filename, datashape, self.Input.meta.dtype, self._chunkshape )
+                else:
+                    block = CompressedBlock( datashape, self.Input.meta.dtype, self._codec )
                     
                 self._blockLocks[block_start] = RequestLock()
-                self._cacheFiles[block_start] = mem_file
+                # (Mark it dirty before lock-free readers can see it.)
                 self._dirtyBlocks.add( block_start )
-            return self._cacheFiles[block_start]
+                self._cacheBlocks[block_start] = block
+            return self._cacheBlocks[block_start]
 
 
     def _ensureCached(self, entire_block_roi):
@@ -252,7 +342,7 @@ class OpCompressedCache(OpCache):
         (Refresh it if it's dirty.)
         """
         block_start = tuple(entire_block_roi[0])
-        block_file = self._getCacheFile(entire_block_roi)
+        self._getCacheBlock(entire_block_roi)
         if block_start in self._dirtyBlocks:
             updated_cache = False
             with self._blockLocks[block_start]:
@@ -262,18 +352,28 @@ class OpCompressedCache(OpCache):
                     # Can't write directly into the hdf5 dataset because 
                     #  h5py.dataset.__getitem__ creates a copy, not a view.
                     # We must use a temporary numpy array to hold the data.
+                    fillStart = time.time()
                     data = self.Input(*entire_block_roi).wait()
-                    block_file['data'][...] = data
+                    fillTime = time.time() - fillStart
+                    self._statistics.recordFill( data.nbytes, fillTime )
+
+                    # (Fetch the block now that we own the block lock: it may have been evicted in the meantime.)
+                    block = self._getCacheBlock(entire_block_roi)
+                    block.write( Ellipsis, data )
+                    storage_size = block.storageSize()
                     
                     if logger.isEnabledFor(logging.DEBUG):
-                        uncompressed_size = numpy.prod(data.shape) * self._getDtypeBytes(data.dtype)
-                        storage_size = block_file["data"].id.get_storage_size()
-                        logger.debug("Storage for block: {} is {}. ({}% of original)".format( block_start, storage_size, 100*storage_size/uncompressed_size ))
+                        logger.debug("Storage for block: {} is {}. (compression ratio: {:.2f})".format( block_start, storage_size, block.compressionRatio() ))
                     with self._lock:
-                        self._dirtyBlocks.remove( block_start )
+                        self._dirtyBlocks.discard( block_start )
+                    # (Register the block while we own its lock, so it can't be evicted before it is registered.)
+                    self._registerBlock( block_start, storage_size, fillTime )
                     updated_cache = True
 
             if updated_cache:
+                # The memory manager may have evicted other blocks to make room for this one.
+                self._enforceMemoryBudget( block_start )
+
                 # Now that the lock is released, signal that the cache was updated. 
                 self.Output._sig_value_changed()
                 self.OutputHdf5._sig_value_changed()
@@ -294,29 +394,33 @@ class OpCompressedCache(OpCache):
         assert len(roi.stop) == len(self.Input.meta.shape), "roi: {} has the wrong number of dimensions for Input shape: {}".format( roi, self.Input.meta.shape )
         assert numpy.less_equal(roi.stop, self.Input.meta.shape).all(), "roi: {} is out-of-bounds for Input shape: {}".format( roi, self.Input.meta.shape )
         
-        block_starts = getIntersectingBlocks( self._blockshape, (roi.start, roi.stop) )
+        grid = getBlockGrid( self.Input.meta.shape, self._blockshape )
+        block_starts, block_stops, inter_starts, inter_stops = grid.intersections( roi.start, roi.stop )
+        source_relative_intersections = zip( inter_starts - roi.start, inter_stops - roi.start )
+        block_relative_intersections = zip( inter_starts - block_starts, inter_stops - block_starts )
+        entire_block_rois = zip( block_starts, block_stops )
         block_starts = map( tuple, block_starts )
 
         # Copy data to each block
         logger.debug( "Copying data INTO {} blocks...".format( len(block_starts) ) )
-        for block_start in block_starts:
-            entire_block_roi = getBlockBounds( self.Input.meta.shape, self._blockshape, block_start )
+        for i, block_start in enumerate( block_starts ):
+            entire_block_roi = entire_block_rois[i]
+            source_relative_intersection = source_relative_intersections[i]
+            block_relative_intersection = block_relative_intersections[i]
 
-            # This block's portion of the roi
-            intersecting_roi = getIntersection( (roi.start, roi.stop), entire_block_roi )
-            
-            # Compute slicing within source array and slicing within this block
-            source_relative_intersection = numpy.subtract(intersecting_roi, roi.start)
-            block_relative_intersection = numpy.subtract(intersecting_roi, block_start)
-            
             # Copy from source to block
-            dataset = self._getBlockDataset( entire_block_roi )
-            dataset[ roiToSlice( *block_relative_intersection ) ] = value[ roiToSlice(*source_relative_intersection) ]
+            self._getCacheBlock( entire_block_roi )
+            with self._blockLocks[block_start]:
+                block = self._getCacheBlock( entire_block_roi )
+                block.write( roiToSlice( *block_relative_intersection ), value[ roiToSlice(*source_relative_intersection) ] )
+                storage_size = block.storageSize()
 
-            # Here, we assume that if this function is used to update ANY PART of a 
-            #  block, he is responsible for updating the ENTIRE block.
-            # Therefore, this block is no longer 'dirty'
-            self._dirtyBlocks.discard( block_start )
+                # Here, we assume that if this function is used to update ANY PART of a 
+                #  block, he is responsible for updating the ENTIRE block.
+                # Therefore, this block is no longer 'dirty'
+                self._dirtyBlocks.discard( block_start )
+                self._registerBlock( block_start, storage_size )
+            self._enforceMemoryBudget( block_start )
 
 #            self.Output._sig_value_changed()
 #            self.OutputHdf5._sig_value_changed()
@@ -329,38 +433,111 @@ class OpCompressedCache(OpCache):
         block_roi = getBlockBounds( self.Input.meta.shape, self._blockshape, roi.start )
         assert (block_roi == numpy.array((roi.start, roi.stop))).all(), "InputHdf5 slot requires roi to be exactly one block."
 
-        cachefile = self._getCacheFile( block_roi )
-        logger.debug( "Copying HDF5 data directly into block {}".format( block_roi ) )
-        assert cachefile['data'].dtype == value.dtype
-        assert cachefile['data'].shape == value.shape
-        del cachefile['data']
-        cachefile.copy( value, 'data' )
-
         block_start = tuple(roi.start)
-        self._dirtyBlocks.discard( block_start )
+        self._getCacheBlock( block_roi )
+        with self._blockLocks[block_start]:
+            block = self._getCacheBlock( block_roi )
+            logger.debug( "Copying HDF5 data directly into block {}".format( block_roi ) )
+            block.copyFromHdf5( value )
+            storage_size = block.storageSize()
+
+            self._dirtyBlocks.discard( block_start )
+            self._registerBlock( block_start, storage_size )
+        self._enforceMemoryBudget( block_start )
 
 #        self.Output._sig_value_changed()
 #        self.OutputHdf5._sig_value_changed()
 #        self.CleanBlocks._sig_value_changed()
 
-    def _getBlockDataset(self, entire_block_roi):
+    def compressionRatios(self):
+        """
+        Return a dict of { block_start : compression ratio } for all blocks that hold data.
+        (The compression ratio is the uncompressed size divided by the storage size.)
+        """
+        ratios = {}
+        for block_start, block in self._cacheBlocks.items():
+            ratio = block.compressionRatio()
+            if ratio is not None:
+                ratios[block_start] = ratio
+        return ratios
+
+    def _registerBlock(self, block_start, storage_size, cost=0.0):
         """
-        Get the correct cache file and return the *dataset* handle,
-        not a numpy array of its contents.
+        Record the storage size of a block that was just written.
+        The caller must own the block's lock (so the block can't be evicted in the meantime),
+        and should call _enforceMemoryBudget() after releasing it.
         """
-        block_file = self._getCacheFile(entire_block_roi)
-        return block_file['data']
+        with self._lock:
+            self._blockSizes.pop( block_start, None )
+            self._blockSizes[block_start] = storage_size
+        self._memory_manager.register( self, block_start, storage_size, cost )
 
+    def _touchBlock(self, block_start):
+        with self._lock:
+            storage_size = self._blockSizes.pop( block_start, None )
+            if storage_size is not None:
+                self._blockSizes[block_start] = storage_size
+        self._memory_manager.touch( self, block_start )
 
-    def _closeAllCacheFiles(self):
+    def _enforceMemoryBudget(self, keep_block_start):
+        """
+        Evict blocks until our storage fits into the MemoryBudget.
+        Dirty blocks go first (their data is stale anyway), then the least recently used clean blocks.
+        Blocks that are in use (and the given block) are skipped.
+        """
+        if not self.MemoryBudget.ready():
+            return
+        budget = self.MemoryBudget.value
+        if self.usedMemory() <= budget:
+            return
+        with self._lock:
+            candidates = [ b for b in self._blockSizes if b in self._dirtyBlocks ] \
+                       + [ b for b in self._blockSizes if b not in self._dirtyBlocks ]
+        for block_start in candidates:
+            if self.usedMemory() <= budget:
+                break
+            if block_start != keep_block_start and self._evictBlock( block_start ) > 0:
+                self._memory_manager.unregister( self, block_start )
+
+    def _evictBlock(self, block_start):
+        """
+        Overridden from OpCache.
+        Close the storage for the given block.  (It will be recomputed when it is needed again.)
+        """
+        # Don't wait: if someone is using this block right now, it can't be evicted.
+        blockLock = self._blockLocks.get( block_start )
+        if blockLock is None or not blockLock.acquire(False):
+            return 0
+        try:
+            if not self._lock.acquire(False):
+                return 0
+            try:
+                block = self._cacheBlocks.pop( block_start, None )
+                self._blockSizes.pop( block_start, None )
+                self._dirtyBlocks.discard( block_start )
+            finally:
+                self._lock.release()
+            if block is None:
+                return 0
+            freed = block.storageSize()
+            block.close()
+            logger.debug( "Evicted block {} ({} bytes)".format( list(block_start), freed ) )
+            self._statistics.recordEviction()
+            return max(1, freed)
+        finally:
+            blockLock.release()
+
+    def _closeAllCacheBlocks(self):
         logger.debug( "Closing all caches" )
-        cacheFiles = self._cacheFiles
-        for k,v in cacheFiles.items():
+        cacheBlocks = self._cacheBlocks
+        for k,v in cacheBlocks.items():
             with self._blockLocks[k]:
                 v.close()
         with self._lock:
             self._blockLocks = {}
-            self._cacheFiles = {}
+            self._cacheBlocks = {}
+            self._blockSizes = collections.OrderedDict()
+        self._memory_manager.unregisterAll(self)
 
 
 
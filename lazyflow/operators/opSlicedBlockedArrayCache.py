@@ -1,19 +1,141 @@
 #Python
 import logging
 import sys
+import collections
+import threading
+from functools import partial
 
 #SciPy
 import numpy
 
 #lazyflow
 from lazyflow.graph import Operator, InputSlot, OutputSlot
+from lazyflow.request import Request
 from lazyflow.utility import Tracer
 from lazyflow.operators.opBlockedArrayCache import OpBlockedArrayCache
-from lazyflow.roi import sliceToRoi
+from lazyflow.roi import sliceToRoi, roiToSlice, getBlockGrid
 from lazyflow.operators.arrayCacheMemoryMgr import ArrayCacheMemoryMgr, MemInfoNode
-from lazyflow.operators.opCache import OpCache
+from lazyflow.operators.opCache import OpCache, CacheStatistics, coalesceDirtyBlocks
+
+class _SlabPrefetcher(object):
+    """
+    Watches the requests to one inner cache of OpSlicedBlockedArrayCache,
+    and prefetches the next slabs when it sees that a viewer scrolls through the data.
+
+    The slab axis is the axis along which the inner blocks are thinnest (the axis the inner cache is sliced along).
+    Requests are grouped by their footprint (the roi without the slab axis), so the tiles of a viewer are tracked independently.
+    When two requests with the same footprint hit adjacent slabs, the next slabs in that direction are requested
+    in the background.  The prefetches of a footprint are cancelled when its pattern breaks.
+    """
+    MaxFootprints = 256
+
+    def __init__(self, cache, axis, shape):
+        self._cache = cache
+        self._axis = axis
+        self._shape = shape
+        self._lock = threading.Lock()
+        self._history = collections.OrderedDict() # footprint -> (position, thickness, direction, run)
+        self._outstanding = {}                    # footprint -> { position : request }
+        self.issued = 0
+        self.hits = 0
+        self.cancelled = 0
+        self.skipped = 0
+
+    def _footprint(self, start, stop):
+        a = self._axis
+        return ( tuple(start[:a]) + tuple(start[a+1:]), tuple(stop[:a]) + tuple(stop[a+1:]) )
+
+    def access(self, start, stop, depth, itemsize):
+        """
+        Record a request for the roi [start, stop), and prefetch the next depth slabs if it continues a sequence.
+        """
+        a = self._axis
+        footprint = self._footprint(start, stop)
+        position = start[a]
+        thickness = stop[a] - start[a]
+
+        with self._lock:
+            outstanding = self._outstanding.setdefault(footprint, {})
+            if position in outstanding:
+                del outstanding[position]
+                self.hits += 1
+
+            last = self._history.pop(footprint, None)
+            direction, run = 0, 0
+            if last is not None:
+                lastPosition, lastThickness, lastDirection, lastRun = last
+                step = position - lastPosition
+                if step == 0:
+                    # The same slab again: nothing changes
+                    self._history[footprint] = last
+                    return
+                direction = 1 if step > 0 else -1
+                if thickness == lastThickness and abs(step) == thickness and lastDirection in (0, direction):
+                    run = lastRun + 1
+                else:
+                    self._cancelLocked(footprint)
+            self._history[footprint] = (position, thickness, direction, run)
+            while len(self._history) > self.MaxFootprints:
+                oldFootprint, _ = self._history.popitem(last=False)
+                self._cancelLocked(oldFootprint)
+
+            if run == 0:
+                return
+
+            # Prefetch the next slabs in the scrolling direction
+            for k in range(1, depth+1):
+                nextStart = list(start)
+                nextStop = list(stop)
+                nextStart[a] = position + k * direction * thickness
+                nextStop[a] = nextStart[a] + thickness
+                if nextStart[a] < 0 or nextStop[a] > self._shape[a]:
+                    break
+                if nextStart[a] in outstanding:
+                    continue
+                if not self._haveRoomFor( numpy.prod(numpy.subtract(nextStop, nextStart)) * itemsize ):
+                    self.skipped += 1
+                    break
+                outstanding[nextStart[a]] = self._prefetch( nextStart, nextStop )
+                self.issued += 1
+
+    def _haveRoomFor(self, nbytes):
+        # Prefetched data must not evict data that is actually in use
+        mgr = ArrayCacheMemoryMgr.instance
+        budget = mgr.memoryBudget()
+        return budget is None or mgr.usedBytes() + nbytes <= budget
+
+    def _prefetch(self, start, stop):
+        req = Request( partial(self._fetch, start, stop) )
+        # The prefetch doesn't belong to the request that triggered it,
+        #  and it runs after all other work.
+        req._detach_from_parent()
+        req.set_priority_class( Request.PRIORITY_BACKGROUND )
+        req.submit()
+        return req
+
+    def _fetch(self, start, stop):
+        self._cache.Output(start, stop).wait()
+
+    def _cancelLocked(self, footprint):
+        for req in self._outstanding.pop(footprint, {}).values():
+            if not req.finished:
+                req.cancel()
+                self.cancelled += 1
+
+    def cancelAll(self):
+        with self._lock:
+            for footprint in self._outstanding.keys():
+                self._cancelLocked(footprint)
+            self._history.clear()
 
 class OpSlicedBlockedArrayCache(OpCache):
+    """
+    A set of OpBlockedArrayCaches with different block shapes (e.g. one for each slicing direction of a viewer).
+    Each request is served by the inner cache whose block shape best matches the requested roi.
+
+    If prefetchSlabs > 0, the caches detect when a viewer scrolls through the data (see _SlabPrefetcher)
+    and request the next prefetchSlabs slabs in the background.
+    """
     name = "OpSlicedBlockedArrayCache"
     description = ""
 
@@ -22,6 +144,7 @@ class OpSlicedBlockedArrayCache(OpCache):
     innerBlockShape = InputSlot()
     outerBlockShape = InputSlot()
     fixAtCurrent = InputSlot(value = False)
+    prefetchSlabs = InputSlot(value = 0)
    
     #Outputs
     Output = OutputSlot()
@@ -35,7 +158,11 @@ class OpSlicedBlockedArrayCache(OpCache):
         with Tracer(self.traceLogger):
             super(OpSlicedBlockedArrayCache, self).__init__(*args, **kwargs)
             self._innerOps = []
-            self._somethingIsDirty = False
+            self._prefetchers = []
+            self.shape = None
+            self._everythingIsDirty = False
+            self._fixedDirtyBlocks = None # The blocks (of _dirtyBlockShape) that became dirty while we were fixed
+            self._dirtyBlockShape = None
 
     def generateReport(self, report):
         report.name = self.name
@@ -47,19 +174,52 @@ class OpSlicedBlockedArrayCache(OpCache):
         report.id = id(self)
         sh = self.Output.meta.shape
         report.roi = ([0]*len(sh), sh)
+        report.statistics = self.statistics().snapshot()
         
         for i, iOp in enumerate(self._innerOps):
             n = MemInfoNode()
             report.children.append(n)
             iOp.generateReport(n)
             
+    def statistics(self):
+        stats = CacheStatistics()
+        for iOp in self._innerOps:
+            stats.merge( iOp.statistics() )
+        return stats
+
+    def resetStatistics(self):
+        for iOp in self._innerOps:
+            iOp.resetStatistics()
+
     def usedMemory(self):
         tot = 0.0
         for iOp in self._innerOps:
             tot += iOp.usedMemory()
         return tot
+
+    def prefetchStatistics(self):
+        """
+        Return the number of prefetched slabs (issued), how many of them were requested later (hits),
+        how many were cancelled, how many were skipped because of the memory budget,
+        and the hit rate (hits / issued, or None if nothing was prefetched).
+        """
+        stats = dict( issued=0, hits=0, cancelled=0, skipped=0 )
+        for prefetcher in self._prefetchers:
+            for name in stats.keys():
+                stats[name] += getattr(prefetcher, name)
+        stats['hitRate'] = stats['hits'] / float(stats['issued']) if stats['issued'] > 0 else None
+        return stats
+
+    def cleanUp(self):
+        for prefetcher in self._prefetchers:
+            prefetcher.cancelAll()
+        super(OpSlicedBlockedArrayCache, self).cleanUp()
     
     def setupOutputs(self):
+        if self._fixedDirtyBlocks is not None and self.inputs["Input"].meta.shape != self.shape:
+            # The tracked dirty blocks don't fit the new shape
+            self._fixedDirtyBlocks = None
+            self._everythingIsDirty = True
         self.shape = self.inputs["Input"].meta.shape
         self._outerShapes = self.inputs["outerBlockShape"].value
         self._innerShapes = self.inputs["innerBlockShape"].value
@@ -95,6 +255,12 @@ class OpSlicedBlockedArrayCache(OpCache):
         self.InnerOutputs.resize( len(self._innerOps) )
         for i, slot in enumerate(self.InnerOutputs):
             slot.connect(self._innerOps[i].Output)
+
+        # Each inner cache is scrolled through along the axis of its thinnest blocks
+        for prefetcher in self._prefetchers:
+            prefetcher.cancelAll()
+        self._prefetchers = [ _SlabPrefetcher( op, int(numpy.argmin(innershape)), self.shape )
+                              for op, innershape in zip(self._innerOps, self._innerShapes) ]
         
     def execute(self, slot, subindex, roi, result):
         assert slot == self.Output
@@ -119,26 +285,55 @@ class OpSlicedBlockedArrayCache(OpCache):
         op = self._innerOps[index]
         op.outputs["Output"][key].writeInto(result).wait()
 
+        prefetchSlabs = self.prefetchSlabs.value
+        if prefetchSlabs > 0 and not self.fixAtCurrent.value:
+            itemsize = numpy.dtype(self.Output.meta.dtype).itemsize
+            self._prefetchers[index].access( map(int, start), map(int, stop), prefetchSlabs, itemsize )
+
     def propagateDirty(self, slot, subindex, roi):
         key = roi.toSlice()
         # We *could* simply forward dirty notifications from our inner operators
         # to our output (by subscribing to their notifyDirty signals),
         # but that would result in duplicates of many (not all!) dirty notifications
         # (since we have more than one inner cache, and each is receiving dirty notifications)
-        # Instead, we simply mark *everything* dirty when we beome unfixed or if the block shape changes.
+        # Instead, we remember which blocks became dirty while we were fixed, and notify our output
+        # of these blocks (merged into a few regions) when we become unfixed.
+        # Everything is dirty if the block shape changes.
         fixed = self.fixAtCurrent.value
         if not fixed:
             if slot == self.Input:
                 self.Output.setDirty( key )        
             elif slot == self.outerBlockShape or slot == self.innerBlockShape:
                 self.Output.setDirty( slice(None) )
+            elif slot == self.prefetchSlabs:
+                pass # Doesn't change the data
             elif slot == self.fixAtCurrent:
                 # Special case: If *nothing* has become dirty since we became 'fixed',
-                #  then there's no reason to send out a big dirty notification.
-                if self._somethingIsDirty:
+                #  then there's no reason to send out a dirty notification.
+                if self._everythingIsDirty:
                     self.Output.setDirty( slice(None) )
-                    self._somethingIsDirty = False
+                elif self._fixedDirtyBlocks is not None:
+                    for dirtyStart, dirtyStop in coalesceDirtyBlocks( self._fixedDirtyBlocks, self._dirtyBlockShape, self.Output.meta.shape ):
+                        self.Output.setDirty( dirtyStart, dirtyStop )
+                self._everythingIsDirty = False
+                self._fixedDirtyBlocks = None
             else:
                 assert False, "Unknown dirty input slot"
-        elif slot != self.fixAtCurrent:
-            self._somethingIsDirty = True
+        elif slot == self.Input and self.Output.meta.shape is not None and not self._everythingIsDirty:
+            self._markFixedDirty( roi )
+        elif slot != self.fixAtCurrent and slot != self.prefetchSlabs:
+            self._everythingIsDirty = True
+
+    def _markFixedDirty(self, roi):
+        shape = self.Output.meta.shape
+        if self._fixedDirtyBlocks is None:
+            # Track the dirty regions with the granularity of the smallest outer block shape.
+            # (Not the smallest extent of each axis: the slabs of the different shapes are orthogonal,
+            #  so that would give single voxel blocks.)
+            smallest = min( self._outerShapes, key=lambda blockShape: numpy.prod(blockShape) )
+            self._dirtyBlockShape = numpy.minimum( smallest, shape )
+            self._fixedDirtyBlocks = numpy.zeros( tuple(getBlockGrid( shape, self._dirtyBlockShape ).gridShape), dtype=bool )
+        start, stop = sliceToRoi( roi.toSlice(), shape )
+        blockStart = numpy.asarray(start) // self._dirtyBlockShape
+        blockStop = (numpy.asarray(stop) + self._dirtyBlockShape - 1) // self._dirtyBlockShape
+        self._fixedDirtyBlocks[ roiToSlice( blockStart, blockStop ) ] = True
@@ -33,6 +33,7 @@ class OpSparseLabelArray(Operator):
         self._sparseNZ = None
         self._oldShape = (0,)
         self._maxLabel = 0            
+        self._labelCounts = numpy.zeros( (256,), dtype=numpy.int64 ) # number of voxels for each label value
 
     def setupOutputs(self):
         if (self._oldShape != self.inputs["shape"].value).any():
@@ -55,6 +56,7 @@ class OpSparseLabelArray(Operator):
 
             self._denseArray = numpy.zeros(shape, numpy.uint8)
             self._sparseNZ =  blist.sorteddict()
+            self._labelCounts[:] = 0
 
         if self.inputs["deleteLabel"].ready() and self.inputs["deleteLabel"].value != -1:
             labelNr = self.inputs["deleteLabel"].value
@@ -63,25 +65,35 @@ class OpSparseLabelArray(Operator):
             self.inputs["deleteLabel"].setValue(-1) #reset state of inputslot
             self.lock.acquire()
 
-            # Find the entries to remove
-            updateNZ = numpy.nonzero(numpy.where(self._denseArray == labelNr,1,0))
-            if len(updateNZ)>0:
-                # Convert to 1-D indexes for the raveled version
-                updateNZRavel = numpy.ravel_multi_index(updateNZ, self._denseArray.shape)                                        
+            # (The label histogram tells us if there is anything to do at all.)
+            if self._labelCounts[labelNr] > 0:
+                # Find the entries to remove
+                updateNZRavel = numpy.flatnonzero(self._denseArray == labelNr)
                 # Zero out the entries we don't want any more
                 self._denseArray.ravel()[updateNZRavel] = neutralElement
                 # Remove the zeros from the sparse list
                 for index in updateNZRavel:
                     self._sparseNZ.pop(index)
-            # Labels are continuous values: Shift all higher label values down by 1.
-            self._denseArray[:] = numpy.where(self._denseArray > labelNr, self._denseArray - 1, self._denseArray)
-            self._maxLabel = self._denseArray.max()
+            if self._labelCounts[labelNr+1:].any():
+                # Labels are continuous values: Shift all higher label values down by 1.
+                higher = numpy.flatnonzero(self._denseArray > labelNr)
+                self._denseArray.ravel()[higher] -= 1
+                self._sparseNZ.update( zip(higher.tolist(), self._denseArray.ravel()[higher].tolist()) )
+            self._labelCounts[labelNr:-1] = self._labelCounts[labelNr+1:].copy()
+            self._labelCounts[-1] = 0
+            self._maxLabel = self._histogramMax()
             self.lock.release()
             self.outputs["nonzeroValues"].setDirty(slice(None))
             self.outputs["nonzeroCoordinates"].setDirty(slice(None))
             self.outputs["Output"].setDirty(slice(None))
             self.outputs["maxLabel"].setValue(self._maxLabel)
 
+    def _histogramMax(self):
+        labels = numpy.flatnonzero(self._labelCounts[1:])
+        if len(labels) == 0:
+            return 0
+        return labels[-1] + 1
+
     def execute(self, slot, subindex, roi, result):
         key = roiToSlice(roi.start,roi.stop)
 
@@ -142,6 +154,10 @@ class OpSparseLabelArray(Operator):
 
         updateNZRavel = numpy.ravel_multi_index(updateNZ, shape)
         updateNZRavel += startRavel
+        updateNZRavelAll = updateNZRavel
+
+        # Remember the old labels for the histogram
+        oldValuesNZ = self._denseArray.ravel()[updateNZRavel]
 
         self._denseArray.ravel()[updateNZRavel] = valuesNZ
 
@@ -162,8 +178,10 @@ class OpSparseLabelArray(Operator):
             for index in updateNZRavel:
                 self._sparseNZ.pop(index)
 
-        # Update our maxlabel
-        self._maxLabel = self._denseArray.max()
+        # Update the label histogram with the difference, and our maxlabel
+        self._labelCounts += numpy.bincount( self._denseArray.ravel()[updateNZRavelAll], minlength=256 )
+        self._labelCounts -= numpy.bincount( oldValuesNZ, minlength=256 )
+        self._maxLabel = self._histogramMax()
 
         self.lock.release()
 
@@ -0,0 +1,242 @@
+#Python
+import threading
+
+#SciPy
+import numpy
+
+#lazyflow
+from lazyflow.roi import getBlockGrid, roiToSlice
+
+class _LabelBlock(object):
+    __slots__ = ['indexes', 'values', 'counts']
+
+    def __init__(self, indexes, values):
+        self.indexes = indexes # Sorted, raveled (block-relative) indexes of the labeled voxels
+        self.values = values   # Their label values
+        self.counts = {}       # label -> number of voxels in this block
+
+class SparseLabelStore(object):
+    """
+    Stores sparse label data blockwise.
+
+    For each block that contains labels, only the labeled voxels are stored:
+    the (sorted) raveled indexes of the voxels within the block and their label values.
+    Memory therefore grows with the number of labeled voxels, not with the volume of the touched blocks.
+
+    Histograms of the label values (the number of voxels for each label, globally and per block)
+    are updated incrementally from each change, so maxLabel() and nonzeroValues() don't need to look at the data,
+    and deleteLabel() only visits the blocks that contain the affected labels.
+
+    All functions take and return coordinates in the global (not block-relative) coordinate system.
+    """
+    def __init__(self, shape, blockShape, dtype=numpy.uint8):
+        self.shape = tuple(shape)
+        self.blockShape = tuple( numpy.minimum(blockShape, shape) )
+        self.dtype = numpy.dtype(dtype)
+        assert self.dtype.kind == 'u' and self.dtype.itemsize <= 2, "Labels must be uint8 or uint16"
+
+        self._grid = getBlockGrid( self.shape, self.blockShape )
+        if numpy.prod(self.blockShape) < 2**32:
+            self._indexDtype = numpy.uint32
+        else:
+            self._indexDtype = numpy.uint64
+
+        self._lock = threading.Lock()
+        self._blocks = {} # block index (tuple) -> _LabelBlock
+        self._labelCounts = numpy.zeros( (numpy.iinfo(self.dtype).max+1,), dtype=numpy.int64 )
+        self._labelBlocks = {} # label -> set of the indexes of the blocks that contain it
+
+    def write(self, start, stop, values, eraser):
+        """
+        Write the given label values into the roi [start, stop).
+        Zeros in the data are ignored (the stored labels are left unchanged).
+        Voxels with the eraser value are erased (reset to zero).
+        """
+        start = numpy.asarray( start, dtype=numpy.int64 )
+        values = numpy.asarray( values )
+        assert values.shape == tuple( numpy.subtract(stop, start) ), "values don't match the roi"
+        block_starts, block_stops, inter_starts, inter_stops = self._grid.intersections( start, stop )
+        with self._lock:
+            for block_start, block_stop, inter_start, inter_stop in zip( block_starts, block_stops, inter_starts, inter_stops ):
+                block_values = values[ roiToSlice( inter_start - start, inter_stop - start ) ]
+                positions = numpy.nonzero( block_values )
+                if len(positions[0]) == 0:
+                    continue
+                new_values = block_values[positions]
+
+                # Raveled block-relative indexes of the written voxels.
+                # (numpy.nonzero() returns the positions in C order, so these are sorted.)
+                offset = inter_start - block_start
+                positions = tuple( p + o for p, o in zip(positions, offset) )
+                indexes = numpy.ravel_multi_index( positions, tuple(block_stop - block_start) ).astype( self._indexDtype )
+
+                block_index = tuple( (block_start // self._grid.blockShape).tolist() )
+                self._writeBlock( block_index, indexes, new_values, new_values == eraser )
+
+    def _writeBlock(self, block_index, indexes, new_values, erase):
+        block = self._blocks.get( block_index )
+        if block is None:
+            if erase.all():
+                return
+            block = _LabelBlock( numpy.zeros( (0,), dtype=self._indexDtype ), numpy.zeros( (0,), dtype=self.dtype ) )
+
+        # Remove the old labels of all written voxels
+        positions = numpy.searchsorted( block.indexes, indexes )
+        found = positions < len(block.indexes)
+        found[found] = ( block.indexes[ positions[found] ] == indexes[found] )
+        positions = positions[found]
+        removed_values = block.values[positions]
+        old_indexes = numpy.delete( block.indexes, positions )
+        old_values = numpy.delete( block.values, positions )
+
+        # Insert the new ones (except for the erased voxels)
+        keep = ~erase
+        indexes = indexes[keep]
+        new_values = new_values[keep].astype( self.dtype )
+        self._countLabels( block_index, block, removed_values, new_values )
+        insert_positions = numpy.searchsorted( old_indexes, indexes )
+        block.indexes = numpy.insert( old_indexes, insert_positions, indexes )
+        block.values = numpy.insert( old_values, insert_positions, new_values )
+
+        if len(block.indexes) == 0:
+            self._blocks.pop( block_index, None )
+        else:
+            self._blocks[block_index] = block
+
+    def _countLabels(self, block_index, block, removed_values, added_values):
+        """
+        Update the histograms with the difference between the removed and the added label values of a block.
+        """
+        diff = numpy.bincount( added_values, minlength=len(self._labelCounts) ) \
+             - numpy.bincount( removed_values, minlength=len(self._labelCounts) )
+        self._labelCounts += diff
+        for label in numpy.flatnonzero( diff ):
+            label = int(label)
+            count = block.counts.get( label, 0 ) + int(diff[label])
+            if count > 0:
+                block.counts[label] = count
+                self._labelBlocks.setdefault( label, set() ).add( block_index )
+            else:
+                block.counts.pop( label, None )
+                blocks = self._labelBlocks.get( label )
+                if blocks is not None:
+                    blocks.discard( block_index )
+                    if not blocks:
+                        del self._labelBlocks[label]
+
+    def read(self, start, stop, out=None):
+        """
+        Return the labels in the roi [start, stop).  Unlabeled voxels are zero.
+        """
+        start = numpy.asarray( start, dtype=numpy.int64 )
+        stop = numpy.asarray( stop, dtype=numpy.int64 )
+        if out is None:
+            out = numpy.zeros( tuple(stop - start), dtype=self.dtype )
+        else:
+            out[...] = 0
+        with self._lock:
+            for block_index, block in self._intersectingBlocks( start, stop ):
+                block_start, block_stop = self._grid.blockBounds( numpy.array(block_index) * self._grid.blockShape )
+                block_shape = tuple( block_stop - block_start )
+                inter_start = numpy.maximum( block_start, start ) - block_start
+                inter_stop = numpy.minimum( block_stop, stop ) - block_start
+
+                # Only the indexes between the first and the last voxel of the intersection can lie within it.
+                first = numpy.ravel_multi_index( tuple(inter_start), block_shape )
+                last = numpy.ravel_multi_index( tuple(inter_stop - 1), block_shape )
+                lo = numpy.searchsorted( block.indexes, first )
+                hi = numpy.searchsorted( block.indexes, last, side='right' )
+                coords = numpy.unravel_index( block.indexes[lo:hi], block_shape )
+                inside = numpy.ones( (hi-lo,), dtype=bool )
+                for c, a, b in zip( coords, inter_start, inter_stop ):
+                    inside &= (c >= a) & (c < b)
+                coords = tuple( c[inside] + (o - s) for c, o, s in zip( coords, block_start, start ) )
+                out[coords] = block.values[lo:hi][inside]
+        return out
+
+    def _intersectingBlocks(self, start, stop):
+        """
+        Return (block_index, block) for the stored blocks that intersect the roi [start, stop).
+        """
+        block_start = start // self._grid.blockShape
+        block_stop = (stop + self._grid.blockShape - 1) // self._grid.blockShape
+        if numpy.prod( block_stop - block_start ) <= len(self._blocks):
+            block_indexes = map( tuple, self._grid.intersectingBlockIndices( start, stop ).tolist() )
+            return [ (i, self._blocks[i]) for i in block_indexes if i in self._blocks ]
+        return [ (i, block) for i, block in self._blocks.items()
+                 if (block_start <= i).all() and (i < block_stop).all() ]
+
+    def deleteLabel(self, label):
+        """
+        Remove all voxels with the given label, and shift all higher labels down by one.
+        """
+        assert label > 0
+        with self._lock:
+            # Only the blocks that contain this label or higher ones are affected
+            affected_blocks = set()
+            for l, block_indexes in self._labelBlocks.items():
+                if l >= label:
+                    affected_blocks |= block_indexes
+
+            for block_index in affected_blocks:
+                block = self._blocks[block_index]
+                if label in block.counts:
+                    keep = block.values != label
+                    block.indexes = block.indexes[keep]
+                    block.values = block.values[keep]
+                block.values[ block.values > label ] -= 1
+                block.counts = dict( (l-1 if l > label else l, count) for l, count in block.counts.items() if l != label )
+                if len(block.indexes) == 0:
+                    del self._blocks[block_index]
+
+            self._labelCounts[label:-1] = self._labelCounts[label+1:].copy()
+            self._labelCounts[-1] = 0
+            self._labelBlocks = dict( (l-1 if l > label else l, block_indexes)
+                                      for l, block_indexes in self._labelBlocks.items() if l != label )
+
+    def maxLabel(self):
+        labels = numpy.flatnonzero( self._labelCounts[1:] )
+        if len(labels) == 0:
+            return 0
+        return int(labels[-1]) + 1
+
+    def nonzeroValues(self):
+        """
+        The label values that are currently stored.
+        """
+        return numpy.flatnonzero( self._labelCounts[1:] ) + 1
+
+    def labelCounts(self):
+        """
+        The number of voxels for each label value (index = label).
+        """
+        return self._labelCounts.copy()
+
+    def blockLabelCounts(self, block_index):
+        """
+        The number of voxels for each label in the given block, as a dict.
+        """
+        block = self._blocks.get( tuple(block_index) )
+        if block is None:
+            return {}
+        return dict( block.counts )
+
+    def nonzeroBlocks(self, label=None):
+        """
+        Return the rois (start, stop) of the blocks that contain labels (or the given label).
+        """
+        with self._lock:
+            if label is None:
+                block_indexes = self._blocks.keys()
+            else:
+                block_indexes = list( self._labelBlocks.get( label, () ) )
+        if not block_indexes:
+            return []
+        starts, stops = self._grid.blockBounds( numpy.array(block_indexes) * self._grid.blockShape )
+        return zip( starts, stops )
+
+    def nbytes(self):
+        """
+        The memory used by the stored labels.
+        """
+        return sum( block.indexes.nbytes + block.values.nbytes for block in self._blocks.values() )
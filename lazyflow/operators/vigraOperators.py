@@ -1,11 +1,14 @@
 #Python
 import os
+import collections
 from collections import deque
 import math
 import traceback
 from functools import partial
 import logging
 import copy
+import time
+import threading
 logger = logging.getLogger(__name__)
 
 #SciPy
@@ -15,9 +18,11 @@ import numpy, vigra
 from lazyflow.graph import Operator, InputSlot, OutputSlot, OrderedSignal
 from lazyflow import roi
 from lazyflow.roi import sliceToRoi, roiToSlice
-from lazyflow.request import RequestPool
+from lazyflow.request import Request, RequestPool
 from operators import OpArrayPiper
 from lazyflow.rtype import SubRegion
+from lazyflow.utility import quantize, quantizationParameters
+from lazyflow.operators.arrayCacheMemoryMgr import ArrayCacheMemoryMgr
 from generic import OpMultiArrayStacker, popFlagsFromTheKey
 
 def zfill_num(n, stop):
@@ -102,7 +107,10 @@ class OpPixelFeaturesPresmoothed(Operator):
     inputSlots = [InputSlot("Input"),
                   InputSlot("Matrix"),
                   InputSlot("Scales"),
-                  InputSlot("FeatureIds")] # The selection of features to compute
+                  InputSlot("FeatureIds"), # The selection of features to compute
+                  InputSlot("HaloEfficiency", value=0.0), # If > 0, compute in cached blocks sized for this useful/computed voxel ratio
+                  InputSlot("ComputeIn2d", value=False), # Compute the features of each z-slice separately (no halo along z)
+                  InputSlot("OutputDtype", value=numpy.float32)] # float32, float16 or (quantized) uint8/uint16
 
     outputSlots = [OutputSlot("Output"),        # The entire block of features as a single image (many channels)
                    OutputSlot("Features", level=1)] # Each feature image listed separately, with feature name provided in metadata
@@ -115,6 +123,11 @@ class OpPixelFeaturesPresmoothed(Operator):
                           'GaussianGradientMagnitude',
                           'DifferenceOfGaussians' ]
 
+    # Memory limits of the halo block mode (see HaloEfficiency)
+    # (The cached blocks also count towards the budget of the ArrayCacheMemoryMgr, which may evict them earlier.)
+    MaxHaloBlockBytes = 64*2**20
+    MaxHaloCacheBytes = 512*2**20
+
     def __init__(self, *args, **kwargs):
         Operator.__init__(self, *args, **kwargs)
         self.source = OpArrayPiper(parent=self)
@@ -129,6 +142,21 @@ class OpPixelFeaturesPresmoothed(Operator):
         # Give our feature IDs input a default value (connected out of the box, but can be changed)
         self.inputs["FeatureIds"].setValue( self.DefaultFeatureIds )
 
+        # State of the halo block mode
+        self._haloLock = threading.Lock()
+        self._haloBlockShape = None
+        self._haloBlocks = collections.OrderedDict() # block start -> features of the block (least recently used first)
+        self._haloBlockBytes = 0
+        self._haloRequests = {} # block start -> request that is computing the block
+        self._haloGeneration = 0
+        self.resetHaloStatistics()
+
+        self._quantization = (None, None) # per-channel (scale, offset) of the uint8/uint16 output types
+
+    def cleanUp(self):
+        super(OpPixelFeaturesPresmoothed, self).cleanUp()
+        ArrayCacheMemoryMgr.instance.unregisterAll(self)
+
     def setupOutputs(self):
         if self.inputs["Scales"].connected() and self.inputs["Matrix"].connected():
 
@@ -166,6 +194,7 @@ class OpPixelFeaturesPresmoothed(Operator):
                 if featureId == 'GaussianSmoothing':
                     for j in range(dimCol):
                         oparray[i].append(OpGaussianSmoothing(self))
+                        oparray[i][j].inputs["ComputeIn2d"].connect(self.inputs["ComputeIn2d"])
                         oparray[i][j].inputs["Input"].connect(self.source.outputs["Output"])
                         oparray[i][j].inputs["sigma"].setValue(self.newScales[j])
                         featureNameArray[i].append("Gaussian Smoothing (s=" + str(self.scales[j]) + ")")
@@ -173,6 +202,7 @@ class OpPixelFeaturesPresmoothed(Operator):
                 elif featureId == 'LaplacianOfGaussian':
                     for j in range(dimCol):
                         oparray[i].append(OpLaplacianOfGaussian(self))
+                        oparray[i][j].inputs["ComputeIn2d"].connect(self.inputs["ComputeIn2d"])
                         oparray[i][j].inputs["Input"].connect(self.source.outputs["Output"])
                         oparray[i][j].inputs["scale"].setValue(self.newScales[j])
                         featureNameArray[i].append("Laplacian of Gaussian (s=" + str(self.scales[j]) + ")")
@@ -180,6 +210,7 @@ class OpPixelFeaturesPresmoothed(Operator):
                 elif featureId == 'StructureTensorEigenvalues':
                     for j in range(dimCol):
                         oparray[i].append(OpStructureTensorEigenvalues(self))
+                        oparray[i][j].inputs["ComputeIn2d"].connect(self.inputs["ComputeIn2d"])
                         oparray[i][j].inputs["Input"].connect(self.source.outputs["Output"])
                         # Note: If you need to change the inner or outer scale,
                         #  you must make a new feature (with a new feature ID) and
@@ -194,6 +225,7 @@ class OpPixelFeaturesPresmoothed(Operator):
                 elif featureId == 'HessianOfGaussianEigenvalues':
                     for j in range(dimCol):
                         oparray[i].append(OpHessianOfGaussianEigenvalues(self))
+                        oparray[i][j].inputs["ComputeIn2d"].connect(self.inputs["ComputeIn2d"])
                         oparray[i][j].inputs["Input"].connect(self.source.outputs["Output"])
                         oparray[i][j].inputs["scale"].setValue(self.newScales[j])
                         featureNameArray[i].append("Hessian of Gaussian Eigenvalues (s=" + str(self.scales[j]) + ")")
@@ -201,6 +233,7 @@ class OpPixelFeaturesPresmoothed(Operator):
                 elif featureId == 'GaussianGradientMagnitude':
                     for j in range(dimCol):
                         oparray[i].append(OpGaussianGradientMagnitude(self))
+                        oparray[i][j].inputs["ComputeIn2d"].connect(self.inputs["ComputeIn2d"])
                         oparray[i][j].inputs["Input"].connect(self.source.outputs["Output"])
                         oparray[i][j].inputs["sigma"].setValue(self.newScales[j])
                         featureNameArray[i].append("Gaussian Gradient Magnitude (s=" + str(self.scales[j]) + ")")
@@ -208,6 +241,7 @@ class OpPixelFeaturesPresmoothed(Operator):
                 elif featureId == 'DifferenceOfGaussians':
                     for j in range(dimCol):
                         oparray[i].append(OpDifferenceOfGaussians(self))
+                        oparray[i][j].inputs["ComputeIn2d"].connect(self.inputs["ComputeIn2d"])
                         oparray[i][j].inputs["Input"].connect(self.source.outputs["Output"])
                         # Note: If you need to change sigma0 or sigma1, you must make a new
                         #  feature (with a new feature ID) and leave this feature here
@@ -227,6 +261,8 @@ class OpPixelFeaturesPresmoothed(Operator):
             featureCount = 0
             self.Features.resize( 0 )
             self.featureOutputChannels = []
+            inputRange = self._inputRange()
+            channelRanges = []
             #connect individual operators
             for i in range(dimRow):
                 for j in range(dimCol):
@@ -245,6 +281,11 @@ class OpPixelFeaturesPresmoothed(Operator):
                         self.Features[featureCount-1].meta.assignFrom( featureMeta )
                         self.featureOutputChannels.append( (channelCount, channelCount + featureChannels) )
                         channelCount += featureChannels
+
+                        featureRange = None
+                        if inputRange is not None:
+                            featureRange = oparray[i][j].outputRange(*inputRange)
+                        channelRanges += [featureRange] * featureChannels
             
             #additional connection with FakeOperator
             if (self.matrix==0).all():
@@ -274,19 +315,27 @@ class OpPixelFeaturesPresmoothed(Operator):
 
             # Output meta is a modified copy of the input meta
             self.Output.meta.assignFrom(self.Input.meta)
-            self.Output.meta.dtype = numpy.float32
             self.Output.meta.axistags = self.stacker.Output.meta.axistags
             self.Output.meta.shape = self.stacker.Output.meta.shape
+            self._setupOutputDtype(channelRanges)
+
+            self._invalidateHaloBlocks()
+            self._haloBlockShape = None
+            efficiency = self.HaloEfficiency.value
+            channelAxis = self.Output.meta.axistags.index('c')
+            if efficiency > 0 and self.Output.meta.shape[channelAxis] > 0:
+                self._haloBlockShape = self._chooseHaloBlockShape(efficiency)
 
     def propagateDirty(self, inputSlot, subindex, roi):
         if inputSlot == self.Input:
+            self._invalidateHaloBlocks()
             channelAxis = self.Input.meta.axistags.index('c')
             numChannels = self.Input.meta.shape[channelAxis]
             dirtyChannels = roi.stop[channelAxis] - roi.start[channelAxis]
             
             # If all the input channels were dirty, the dirty output region is a contiguous block
             if dirtyChannels == numChannels:
-                dirtyKey = roiToSlice(roi.start, roi.stop)
+                dirtyKey = list(roiToSlice(roi.start, roi.stop))
                 dirtyKey[channelAxis] = slice(None)
                 dirtyRoi = sliceToRoi(dirtyKey, self.Output.meta.shape)
                 self.Output.setDirty(dirtyRoi[0], dirtyRoi[1])
@@ -304,11 +353,242 @@ class OpPixelFeaturesPresmoothed(Operator):
 
         elif (inputSlot == self.Matrix
               or inputSlot == self.Scales 
-              or inputSlot == self.FeatureIds):
+              or inputSlot == self.FeatureIds
+              or inputSlot == self.ComputeIn2d
+              or inputSlot == self.OutputDtype):
+            self._invalidateHaloBlocks()
             self.Output.setDirty(slice(None))
+        elif inputSlot == self.HaloEfficiency:
+            # Same features, just computed differently.
+            pass
         else:
             assert False, "Unknown dirty input slot."
-            
+
+    def _inputRange(self):
+        """
+        The range of the input values (from the drange meta or the integer input dtype), or None if unknown.
+        """
+        if self.Input.meta.drange is not None:
+            return self.Input.meta.drange
+        dtype = numpy.dtype(self.Input.meta.dtype)
+        if dtype.kind in 'iu':
+            return (numpy.iinfo(dtype).min, numpy.iinfo(dtype).max)
+        return None
+
+    def _setupOutputDtype(self, channelRanges):
+        """
+        Set the Output dtype from the OutputDtype input.
+        The uint8/uint16 types store each channel with an affine quantization,
+        with the parameters in the meta of the Output (and Features) slots:
+        value ~= stored * meta.quantScale[c] + meta.quantOffset[c]
+        The channel ranges are conservative bounds of the feature values (see OpBaseVigraFilter.outputRange()).
+        """
+        dtype = numpy.dtype(self.OutputDtype.value)
+        if dtype not in (numpy.float32, numpy.float16, numpy.uint8, numpy.uint16):
+            raise RuntimeError("OpPixelFeatures: Unsupported OutputDtype: {}".format( dtype ))
+
+        self._quantization = (None, None)
+        if dtype.kind == 'u':
+            if None in channelRanges:
+                logger.warn("OpPixelFeatures: Can't bound the feature values without a known input range (meta.drange). "
+                            "Storing the features as float16 instead of {}.".format( dtype ))
+                dtype = numpy.dtype(numpy.float16)
+            else:
+                self._quantization = quantizationParameters(channelRanges, dtype)
+
+        scale, offset = self._quantization
+        self.Output.meta.dtype = dtype.type
+        self.Output.meta.quantScale = scale
+        self.Output.meta.quantOffset = offset
+        for featureSlot, (start, stop) in zip(self.Features, self.featureOutputChannels):
+            featureSlot.meta.dtype = dtype.type
+            featureSlot.meta.quantScale = scale and scale[start:stop]
+            featureSlot.meta.quantOffset = offset and offset[start:stop]
+
+    def haloStatistics(self):
+        """
+        Return a dict with the number of Output voxels that were requested ('useful'),
+        the number of input voxels that were read and smoothed to compute them ('computed'),
+        and the ratio of the two ('ratio').
+        Voxels are counted over the spatial and time axes (channels are ignored).
+        In the halo block mode, the ratio can exceed 1 when requests are served from cached blocks.
+        """
+        with self._haloLock:
+            useful, computed = self._usefulVoxels, self._computedVoxels
+        ratio = float(useful) / computed if computed > 0 else None
+        return { 'useful' : useful, 'computed' : computed, 'ratio' : ratio }
+
+    def resetHaloStatistics(self):
+        with self._haloLock:
+            self._usefulVoxels = 0
+            self._computedVoxels = 0
+
+    def _recordHaloVoxels(self, useful=0, computed=0):
+        with self._haloLock:
+            self._usefulVoxels += int(useful)
+            self._computedVoxels += int(computed)
+
+    def _spatialVolume(self, start, stop):
+        """
+        The number of voxels in [start, stop), not counting channels.
+        """
+        extent = list(numpy.subtract(stop, start))
+        extent.pop( self.Output.meta.axistags.index('c') )
+        return numpy.prod(extent)
+
+    def _chooseHaloBlockShape(self, efficiency):
+        """
+        Choose the shape of the cached feature blocks for the halo block mode.
+        Each block covers all channels and a single time step.
+        The spatial block edge b is chosen so that a block with a halo h on each side
+        (big enough for the largest sigma) keeps the given fraction of the voxels it reads:
+        (b/(b+2h))**d == efficiency.  The blocks are clipped to the image and to MaxHaloBlockBytes.
+        """
+        shape = self.Output.meta.shape
+        axistags = self.Output.meta.axistags
+        channelAxis = axistags.index('c')
+        timeAxis = axistags.index('t')
+        spatialAxes = [ i for i in range(len(shape)) if i not in (channelAxis, timeAxis) and shape[i] > 1 ]
+        if self._computeIn2d() and axistags.index('z') in spatialAxes:
+            # No halo along z: each block is a single slice
+            spatialAxes.remove( axistags.index('z') )
+
+        # Must match the padding in _computeFeatures()
+        window_size = 3.5
+        halo = math.ceil(window_size*0.7) + math.ceil(window_size*max(0.7, self.maxSigma))
+
+        blockShape = [1]*len(shape)
+        blockShape[channelAxis] = shape[channelAxis]
+        if spatialAxes:
+            q = min(efficiency, 0.99)**(1.0/len(spatialAxes))
+            edge = int(math.ceil(2*halo*q/(1-q)))
+            for i in spatialAxes:
+                blockShape[i] = min(edge, shape[i])
+
+            itemsize = numpy.dtype(self.Output.meta.dtype).itemsize
+            while numpy.prod(blockShape)*itemsize > self.MaxHaloBlockBytes:
+                largest = max(spatialAxes, key=lambda i: blockShape[i])
+                if blockShape[largest] == 1:
+                    break
+                blockShape[largest] = (blockShape[largest]+1)//2
+        return tuple(blockShape)
+
+    def _invalidateHaloBlocks(self):
+        with self._haloLock:
+            self._haloBlocks.clear()
+            self._haloBlockBytes = 0
+            # Blocks that are still being computed will be returned to their requests, but not cached.
+            self._haloRequests = {}
+            self._haloGeneration += 1
+            ArrayCacheMemoryMgr.instance.unregisterAll(self)
+
+    def _evictBlock(self, blockId):
+        """
+        Called by the ArrayCacheMemoryMgr to free a cached halo block (see OpCache._evictBlock()).
+        The blocks are registered with the id (generation, block start).
+        """
+        generation, key = blockId
+        # Don't wait: we may be called from within another cache (or from within our own register()).
+        if not self._haloLock.acquire(False):
+            return 0
+        try:
+            if generation != self._haloGeneration or key not in self._haloBlocks:
+                # Still being computed
+                return 0
+            block = self._haloBlocks.pop(key)
+            self._haloBlockBytes -= block.nbytes
+            return block.nbytes
+        finally:
+            self._haloLock.release()
+
+    def _executeInHaloBlocks(self, rroi, result):
+        """
+        Serve rroi from the (cached) halo blocks it intersects.
+        The missing blocks are computed in parallel, each of them only once.
+        """
+        start = numpy.array(rroi.start)
+        stop = numpy.array(rroi.stop)
+        grid = roi.getBlockGrid(self.Output.meta.shape, self._haloBlockShape)
+        blockStarts, blockStops, interStarts, interStops = grid.intersections(start, stop)
+
+        blocks = {}
+        newRequests = []
+        pendingRequests = []
+        with self._haloLock:
+            generation = self._haloGeneration
+            for blockStart, blockStop in zip(blockStarts, blockStops):
+                key = tuple(blockStart)
+                if key in self._haloBlocks:
+                    # Move to the end (most recently used)
+                    blocks[key] = self._haloBlocks.pop(key)
+                    self._haloBlocks[key] = blocks[key]
+                    continue
+                req = self._haloRequests.get(key)
+                if req is None or req.cancelled or req.exception is not None:
+                    req = Request( partial(self._computeHaloBlock, key, blockStart, blockStop, generation) )
+                    # The block is shared by all requests that need it, so it must not be cancelled
+                    #  along with the request that happens to create it.
+                    req.uncancellable = True
+                    req._detach_from_parent()
+                    if req.cancelled:
+                        # It was created cancelled, because we are cancelled.
+                        raise Request.CancellationException()
+                    self._haloRequests[key] = req
+                    newRequests.append(req)
+                pendingRequests.append( (key, req) )
+
+        for req in newRequests:
+            req.submit()
+        for key, req in pendingRequests:
+            blocks[key] = req.wait()
+
+        memoryManager = ArrayCacheMemoryMgr.instance
+        for key in blocks:
+            memoryManager.touch( self, (generation, key) )
+
+        for blockStart, interStart, interStop in zip(blockStarts, interStarts, interStops):
+            result[roiToSlice(interStart - start, interStop - start)] = \
+                blocks[tuple(blockStart)][roiToSlice(interStart - blockStart, interStop - blockStart)]
+        return result
+
+    def _computeHaloBlock(self, key, blockStart, blockStop, generation):
+        request = Request._current_request()
+        memoryManager = ArrayCacheMemoryMgr.instance
+        shape = tuple(blockStop - blockStart)
+        blockId = (generation, key)
+        # (Registering may evict other blocks to make room for this one.)
+        memoryManager.register( self, blockId, numpy.prod(shape) * numpy.dtype(self.Output.meta.dtype).itemsize )
+        try:
+            fillStart = time.time()
+            block = numpy.ndarray( shape, dtype=self.Output.meta.dtype )
+            self._computeOutput( SubRegion(self.Output, start=tuple(blockStart), stop=tuple(blockStop)), block )
+        except:
+            with self._haloLock:
+                if self._haloRequests.get(key) is request:
+                    del self._haloRequests[key]
+            memoryManager.unregister( self, blockId )
+            raise
+
+        evicted = []
+        with self._haloLock:
+            if self._haloRequests.get(key) is request:
+                del self._haloRequests[key]
+            cached = (generation == self._haloGeneration)
+            if cached:
+                self._haloBlocks[key] = block
+                self._haloBlockBytes += block.nbytes
+                while self._haloBlockBytes > self.MaxHaloCacheBytes and len(self._haloBlocks) > 1:
+                    evictedKey, evictedBlock = self._haloBlocks.popitem(last=False)
+                    self._haloBlockBytes -= evictedBlock.nbytes
+                    evicted.append( evictedKey )
+
+        if cached:
+            memoryManager.touch( self, blockId, cost=time.time() - fillStart )
+        else:
+            memoryManager.unregister( self, blockId )
+        for evictedKey in evicted:
+            memoryManager.unregister( self, (generation, evictedKey) )
+        return block
 
     def execute(self, slot, subindex, rroi, result):
         assert slot == self.Features or slot == self.Output
@@ -327,226 +607,296 @@ class OpPixelFeaturesPresmoothed(Operator):
             # Get output slot region for this channel
             return self.execute(self.Output, (), rroi, result)
         elif slot == self.outputs["Output"]:
-            key = rroi.toSlice()
-            cnt = 0
-            written = 0
-            assert (rroi.stop<=self.outputs["Output"].meta.shape).all()
-            flag = 'c'
-            channelAxis=self.inputs["Input"].meta.axistags.index('c')
-            axisindex = channelAxis
-            oldkey = list(key)
-            oldkey.pop(axisindex)
+            self._recordHaloVoxels( useful=self._spatialVolume(rroi.start, rroi.stop) )
+            if self._haloBlockShape is not None:
+                return self._executeInHaloBlocks(rroi, result)
+            return self._computeOutput(rroi, result)
+
+    def _computeOutput(self, rroi, result):
+        """
+        Compute rroi into result, converting to the reduced precision output dtype (if any).
+        """
+        features = result
+        if self.Output.meta.dtype != numpy.float32:
+            features = numpy.ndarray( result.shape, dtype=numpy.float32 )
+
+        if self._computeIn2d():
+            self._computeSlices(rroi, features)
+        else:
+            self._computeFeatures(rroi, features)
+
+        if features is not result:
+            scale, offset = self._quantization
+            channelAxis = self.Output.meta.axistags.index('c')
+            if scale is not None:
+                channels = slice(rroi.start[channelAxis], rroi.stop[channelAxis])
+                scale, offset = scale[channels], offset[channels]
+            quantize(features, result, scale, offset, channelAxis)
+        return result
+
+    def _computeIn2d(self):
+        axistags = self.Input.meta.axistags
+        return bool(self.ComputeIn2d.value) and axistags.index('z') < len(axistags)
+
+    def _computeSlices(self, rroi, result):
+        """
+        Compute the features of each z-slice of rroi separately, in parallel.
+        """
+        zAxis = self.Input.meta.axistags.index('z')
+        pool = RequestPool()
+        for z in range(rroi.start[zAxis], rroi.stop[zAxis]):
+            start, stop = list(rroi.start), list(rroi.stop)
+            start[zAxis], stop[zAxis] = z, z+1
+            sliceKey = [slice(None)] * len(start)
+            sliceKey[zAxis] = slice(z - rroi.start[zAxis], z - rroi.start[zAxis] + 1)
+            sliceRoi = SubRegion(self.Output, start=tuple(start), stop=tuple(stop))
+            pool.request( partial(self._computeFeatures, sliceRoi, result[tuple(sliceKey)]) )
+        pool.wait()
+        pool.clean()
+
+    def _computeFeatures(self, rroi, result):
+        """
+        Compute the features of rroi (a region of the Output slot) into result,
+        reading the input with a halo that is big enough for the largest sigma.
+        """
+        key = rroi.toSlice()
+        cnt = 0
+        written = 0
+        assert (rroi.stop<=self.outputs["Output"].meta.shape).all()
+        flag = 'c'
+        channelAxis=self.inputs["Input"].meta.axistags.index('c')
+        axisindex = channelAxis
+        oldkey = list(key)
+        oldkey.pop(axisindex)
 
 
-            inShape  = self.inputs["Input"].meta.shape
-            hasChannelAxis = (self.Input.meta.axistags.axisTypeCount(vigra.AxisType.Channels) > 0)
-            #if (self.Input.meta.axistags.axisTypeCount(vigra.AxisType.Channels) == 0):
-            #    noChannels = True
-            inAxistags = self.inputs["Input"].meta.axistags
-                
-            shape = self.outputs["Output"].meta.shape
-            axistags = self.outputs["Output"].meta.axistags
+        inShape  = self.inputs["Input"].meta.shape
+        hasChannelAxis = (self.Input.meta.axistags.axisTypeCount(vigra.AxisType.Channels) > 0)
+        #if (self.Input.meta.axistags.axisTypeCount(vigra.AxisType.Channels) == 0):
+        #    noChannels = True
+        inAxistags = self.inputs["Input"].meta.axistags
+            
+        shape = self.outputs["Output"].meta.shape
+        axistags = self.outputs["Output"].meta.axistags
 
-            result = result.view(vigra.VigraArray)
-            result.axistags = copy.copy(axistags)
+        result = result.view(vigra.VigraArray)
+        result.axistags = copy.copy(axistags)
 
 
-            hasTimeAxis = self.inputs["Input"].meta.axistags.axisTypeCount(vigra.AxisType.Time)
-            timeAxis=self.inputs["Input"].meta.axistags.index('t')
+        hasTimeAxis = self.inputs["Input"].meta.axistags.axisTypeCount(vigra.AxisType.Time)
+        timeAxis=self.inputs["Input"].meta.axistags.index('t')
 
-            subkey = popFlagsFromTheKey(key,axistags,'c')
-            subshape=popFlagsFromTheKey(shape,axistags,'c')
-            at2 = copy.copy(axistags)
-            at2.dropChannelAxis()
-            subshape=popFlagsFromTheKey(subshape,at2,'t')
-            subkey = popFlagsFromTheKey(subkey,at2,'t')
+        subkey = popFlagsFromTheKey(key,axistags,'c')
+        subshape=popFlagsFromTheKey(shape,axistags,'c')
+        at2 = copy.copy(axistags)
+        at2.dropChannelAxis()
+        subshape=popFlagsFromTheKey(subshape,at2,'t')
+        subkey = popFlagsFromTheKey(subkey,at2,'t')
 
-            oldstart, oldstop = roi.sliceToRoi(key, shape)
+        oldstart, oldstop = roi.sliceToRoi(key, shape)
 
-            start, stop = roi.sliceToRoi(subkey,subkey)
-            maxSigma = max(0.7,self.maxSigma)  #we use 0.7 as an approximation of not doing any smoothing
-            #smoothing was already applied previously
-            
-            window_size = 3.5
-            # The region of the smoothed image we need to give to the feature filter (in terms of INPUT coordinates)
-            # 0.7, because the features receive a pre-smoothed array and don't need much of a neighborhood 
-            vigOpSourceStart, vigOpSourceStop = roi.extendSlice(start, stop, subshape, 0.7, window_size)
-            
-            
-            # The region of the input that we need to give to the smoothing operator (in terms of INPUT coordinates)
-            newStart, newStop = roi.extendSlice(vigOpSourceStart, vigOpSourceStop, subshape, maxSigma, window_size)
-            
-            newStartSmoother = roi.TinyVector(start - vigOpSourceStart)
-            newStopSmoother = roi.TinyVector(stop - vigOpSourceStart)
-            roiSmoother = roi.roiToSlice(newStartSmoother, newStopSmoother)
+        start, stop = roi.sliceToRoi(subkey,subkey)
+        maxSigma = max(0.7,self.maxSigma)  #we use 0.7 as an approximation of not doing any smoothing
+        #smoothing was already applied previously
+        
+        window_size = 3.5
+        # In 2D, the slices are filtered separately, so there is no halo along z
+        computeIn2d = self._computeIn2d()
+        haloScale = numpy.ones( len(subshape) )
+        if computeIn2d:
+            haloScale[_spatialIndex(axistags, 'z')] = 0
+
+        # The region of the smoothed image we need to give to the feature filter (in terms of INPUT coordinates)
+        # 0.7, because the features receive a pre-smoothed array and don't need much of a neighborhood 
+        vigOpSourceStart, vigOpSourceStop = roi.extendSlice(start, stop, subshape, list(0.7*haloScale), window_size)
+        
+        
+        # The region of the input that we need to give to the smoothing operator (in terms of INPUT coordinates)
+        newStart, newStop = roi.extendSlice(vigOpSourceStart, vigOpSourceStop, subshape, list(maxSigma*haloScale), window_size)
+
+        # Everything in the padded region is read and smoothed, but only start..stop is kept.
+        computedVoxels = numpy.prod(newStop - newStart)
+        if hasTimeAxis:
+            computedVoxels *= (oldstop - oldstart)[timeAxis]
+        self._recordHaloVoxels( computed=computedVoxels )
+        
+        newStartSmoother = roi.TinyVector(start - vigOpSourceStart)
+        newStopSmoother = roi.TinyVector(stop - vigOpSourceStart)
+        roiSmoother = roi.roiToSlice(newStartSmoother, newStopSmoother)
 
-            # Translate coordinates (now in terms of smoothed image coordinates)
-            vigOpSourceStart = roi.TinyVector(vigOpSourceStart - newStart)
-            vigOpSourceStop = roi.TinyVector(vigOpSourceStop - newStart)
+        # Translate coordinates (now in terms of smoothed image coordinates)
+        vigOpSourceStart = roi.TinyVector(vigOpSourceStart - newStart)
+        vigOpSourceStop = roi.TinyVector(vigOpSourceStop - newStart)
 
-            readKey = roi.roiToSlice(newStart, newStop)
+        readKey = roi.roiToSlice(newStart, newStop)
 
-            writeNewStart = start - newStart
-            writeNewStop = writeNewStart +  stop - start
+        writeNewStart = start - newStart
+        writeNewStop = writeNewStart +  stop - start
 
-            treadKey=list(readKey)
+        treadKey=list(readKey)
 
-            if hasTimeAxis:
-                if timeAxis < channelAxis:
-                    treadKey.insert(timeAxis, key[timeAxis])
-                else:
-                    treadKey.insert(timeAxis-1, key[timeAxis])
-            if  self.inputs["Input"].meta.axistags.axisTypeCount(vigra.AxisType.Channels) == 0:
-                treadKey =  popFlagsFromTheKey(treadKey,axistags,'c')
+        if hasTimeAxis:
+            if timeAxis < channelAxis:
+                treadKey.insert(timeAxis, key[timeAxis])
             else:
-                treadKey.insert(channelAxis, slice(None,None,None))
+                treadKey.insert(timeAxis-1, key[timeAxis])
+        if  self.inputs["Input"].meta.axistags.axisTypeCount(vigra.AxisType.Channels) == 0:
+            treadKey =  popFlagsFromTheKey(treadKey,axistags,'c')
+        else:
+            treadKey.insert(channelAxis, slice(None,None,None))
 
-            treadKey=tuple(treadKey)
+        treadKey=tuple(treadKey)
 
-            req = self.inputs["Input"][treadKey]
-            
-            sourceArray = req.wait()
-            req.clean()
-            #req.result = None
-            req.destination = None
-            if sourceArray.dtype != numpy.float32:
-                sourceArrayF = sourceArray.astype(numpy.float32)
-                try:
-                    sourceArray.resize((1,), refcheck = False)
-                except:
-                    pass
-                del sourceArray
-                sourceArray = sourceArrayF
-                
-            #if (self.Input.meta.axistags.axisTypeCount(vigra.AxisType.Channels) == 0):
-                #add a channel dimension to make the code afterwards more uniform
-            #    sourceArray = sourceArray.view(numpy.ndarray)
-            #    sourceArray = sourceArray.reshape(sourceArray.shape+(1,))
-            sourceArrayV = sourceArray.view(vigra.VigraArray)
-            sourceArrayV.axistags =  copy.copy(inAxistags)
+        req = self.inputs["Input"][treadKey]
+        
+        sourceArray = req.wait()
+        req.clean()
+        #req.result = None
+        req.destination = None
+        if sourceArray.dtype != numpy.float32:
+            sourceArrayF = sourceArray.astype(numpy.float32)
+            try:
+                sourceArray.resize((1,), refcheck = False)
+            except:
+                pass
+            del sourceArray
+            sourceArray = sourceArrayF
             
-            dimCol = len(self.scales)
-            dimRow = self.matrix.shape[0]
+        #if (self.Input.meta.axistags.axisTypeCount(vigra.AxisType.Channels) == 0):
+            #add a channel dimension to make the code afterwards more uniform
+        #    sourceArray = sourceArray.view(numpy.ndarray)
+        #    sourceArray = sourceArray.reshape(sourceArray.shape+(1,))
+        sourceArrayV = sourceArray.view(vigra.VigraArray)
+        sourceArrayV.axistags =  copy.copy(inAxistags)
+        
+        dimCol = len(self.scales)
+        dimRow = self.matrix.shape[0]
 
-            sourceArraysForSigmas = [None]*dimCol
+        sourceArraysForSigmas = [None]*dimCol
 
-            #connect individual operators
-            try:
-                for j in range(dimCol):
-                    hasScale = False
-                    for i in range(dimRow):
-                        if self.matrix[i,j]:
-                            hasScale = True
-                    if not hasScale:
-                        continue
-                    destSigma = 1.0
-                    if self.scales[j] > destSigma:
-                        tempSigma = math.sqrt(self.scales[j]**2 - destSigma**2)
-                    else:
-                        destSigma = 0.0
-                        tempSigma = self.scales[j]
-                    vigOpSourceShape = list(vigOpSourceStop - vigOpSourceStart)
-                    if hasTimeAxis:
-    
-                        if timeAxis < channelAxis:
-                            vigOpSourceShape.insert(timeAxis, ( oldstop - oldstart)[timeAxis])
-                        else:
-                            vigOpSourceShape.insert(timeAxis-1, ( oldstop - oldstart)[timeAxis])
-                        vigOpSourceShape.insert(channelAxis, inShape[channelAxis])
-    
-                        sourceArraysForSigmas[j] = numpy.ndarray(tuple(vigOpSourceShape),numpy.float32)
-                        for i,vsa in enumerate(sourceArrayV.timeIter()):
-                            droi = (tuple(vigOpSourceStart._asint()), tuple(vigOpSourceStop._asint()))
-                            tmp_key = getAllExceptAxis(len(sourceArraysForSigmas[j].shape),timeAxis, i)
-                            sourceArraysForSigmas[j][tmp_key] = vigra.filters.gaussianSmoothing(vsa,tempSigma, roi = droi, window_size = 3.5 )
+        #connect individual operators
+        try:
+            for j in range(dimCol):
+                hasScale = False
+                for i in range(dimRow):
+                    if self.matrix[i,j]:
+                        hasScale = True
+                if not hasScale:
+                    continue
+                destSigma = 1.0
+                if self.scales[j] > destSigma:
+                    tempSigma = math.sqrt(self.scales[j]**2 - destSigma**2)
+                else:
+                    destSigma = 0.0
+                    tempSigma = self.scales[j]
+                vigOpSourceShape = list(vigOpSourceStop - vigOpSourceStart)
+                if hasTimeAxis:
+
+                    if timeAxis < channelAxis:
+                        vigOpSourceShape.insert(timeAxis, ( oldstop - oldstart)[timeAxis])
                     else:
+                        vigOpSourceShape.insert(timeAxis-1, ( oldstop - oldstart)[timeAxis])
+                    vigOpSourceShape.insert(channelAxis, inShape[channelAxis])
+
+                    sourceArraysForSigmas[j] = numpy.ndarray(tuple(vigOpSourceShape),numpy.float32)
+                    for i,vsa in enumerate(sourceArrayV.timeIter()):
                         droi = (tuple(vigOpSourceStart._asint()), tuple(vigOpSourceStop._asint()))
-                        sourceArraysForSigmas[j] = vigra.filters.gaussianSmoothing(sourceArrayV, sigma = tempSigma, roi = droi, window_size = 3.5)
-            except RuntimeError as e:
-                if e.message.find('kernel longer than line') > -1:
-                    message = "Feature computation error:\nYour image is too small to apply a filter with sigma=%.1f. Please select features with smaller sigmas." % self.scales[j]
-                    raise RuntimeError(message)
+                        tmp_key = getAllExceptAxis(len(sourceArraysForSigmas[j].shape),timeAxis, i)
+                        sourceArraysForSigmas[j][tmp_key] = _presmooth(vsa, tempSigma, droi, computeIn2d)
                 else:
-                    raise e
+                    droi = (tuple(vigOpSourceStart._asint()), tuple(vigOpSourceStop._asint()))
+                    sourceArraysForSigmas[j] = _presmooth(sourceArrayV, tempSigma, droi, computeIn2d)
+        except RuntimeError as e:
+            if e.message.find('kernel longer than line') > -1:
+                message = "Feature computation error:\nYour image is too small to apply a filter with sigma=%.1f. Please select features with smaller sigmas." % self.scales[j]
+                raise RuntimeError(message)
+            else:
+                raise e
 
-            del sourceArrayV
-            try:
-                sourceArray.resize((1,), refcheck = False)
-            except ValueError:
-                # Sometimes this fails, but that's okay.
-                logger.debug("Failed to free array memory.")                
-            del sourceArray
+        del sourceArrayV
+        try:
+            sourceArray.resize((1,), refcheck = False)
+        except ValueError:
+            # Sometimes this fails, but that's okay.
+            logger.debug("Failed to free array memory.")                
+        del sourceArray
 
-            closures = []
+        closures = []
 
-            #connect individual operators
-            for i in range(dimRow):
-                for j in range(dimCol):
-                    val=self.matrix[i,j]
-                    if val:
-                        vop= self.featureOps[i][j]
-                        oslot = vop.outputs["Output"]
-                        req = None
-                        #inTagKeys = [ax.key for ax in oslot.meta.axistags]
-                        #print inTagKeys, flag
-                        if hasChannelAxis:
-                            slices = oslot.meta.shape[axisindex]
-                            if cnt + slices >= rroi.start[axisindex] and rroi.start[axisindex]-cnt<slices and rroi.start[axisindex]+written<rroi.stop[axisindex]:
-                                begin = 0
-                                if cnt < rroi.start[axisindex]:
-                                    begin = rroi.start[axisindex] - cnt
-                                end = slices
-                                if cnt + end > rroi.stop[axisindex]:
-                                    end -= cnt + end - rroi.stop[axisindex]
-                                key_ = copy.copy(oldkey)
-                                key_.insert(axisindex, slice(begin, end, None))
-                                reskey = [slice(None, None, None) for x in range(len(result.shape))]
-                                reskey[axisindex] = slice(written, written+end-begin, None)
-                                
-                                destArea = result[tuple(reskey)]
-                                #readjust the roi for the new source array
-                                roiSmootherList = list(roiSmoother)
-                                
-                                roiSmootherList.insert(axisindex, slice(begin, end, None))
-                                
-                                if hasTimeAxis:
-                                    roiSmootherList.insert(timeAxis, self.Input.meta.shape[timeAxis])
-                                roiSmootherRegion = SubRegion(self.Input, pslice=roiSmootherList)
-                                
-                                closure = partial(oslot.operator.execute, oslot, (), roiSmootherRegion, destArea, sourceArray = sourceArraysForSigmas[j])
-                                closures.append(closure)
-
-                                written += end - begin
-                            cnt += slices
-                        else:
-                            if cnt>=rroi.start[axisindex] and rroi.start[axisindex] + written < rroi.stop[axisindex]:
-                                reskey = [slice(None, None, None) for x in range(len(result.shape))]
-                                slices = oslot.meta.shape[axisindex]
-                                reskey[axisindex]=slice(written, written+slices, None)
-                                #print "key: ", key, "reskey: ", reskey, "oldkey: ", oldkey, "resshape:", result.shape
-                                #print "roiSmoother:", roiSmoother
-                                destArea = result[tuple(reskey)]
-                                #print "destination area:", destArea.shape
-                                logger.debug(oldkey, destArea.shape, sourceArraysForSigmas[j].shape)
-                                oldroi = SubRegion(self.Input, pslice=oldkey)
-                                #print "passing roi:", oldroi
-                                closure = partial(oslot.operator.execute, oslot, (), oldroi, destArea, sourceArray = sourceArraysForSigmas[j])
-                                closures.append(closure)
+        #connect individual operators
+        for i in range(dimRow):
+            for j in range(dimCol):
+                val=self.matrix[i,j]
+                if val:
+                    vop= self.featureOps[i][j]
+                    oslot = vop.outputs["Output"]
+                    req = None
+                    #inTagKeys = [ax.key for ax in oslot.meta.axistags]
+                    #print inTagKeys, flag
+                    if hasChannelAxis:
+                        slices = oslot.meta.shape[axisindex]
+                        if cnt + slices >= rroi.start[axisindex] and rroi.start[axisindex]-cnt<slices and rroi.start[axisindex]+written<rroi.stop[axisindex]:
+                            begin = 0
+                            if cnt < rroi.start[axisindex]:
+                                begin = rroi.start[axisindex] - cnt
+                            end = slices
+                            if cnt + end > rroi.stop[axisindex]:
+                                end -= cnt + end - rroi.stop[axisindex]
+                            key_ = copy.copy(oldkey)
+                            key_.insert(axisindex, slice(begin, end, None))
+                            reskey = [slice(None, None, None) for x in range(len(result.shape))]
+                            reskey[axisindex] = slice(written, written+end-begin, None)
+                            
+                            destArea = result[tuple(reskey)]
+                            #readjust the roi for the new source array
+                            roiSmootherList = list(roiSmoother)
+                            
+                            roiSmootherList.insert(axisindex, slice(begin, end, None))
+                            
+                            if hasTimeAxis:
+                                roiSmootherList.insert(timeAxis, self.Input.meta.shape[timeAxis])
+                            roiSmootherRegion = SubRegion(self.Input, pslice=roiSmootherList)
+                            
+                            closure = partial(oslot.operator.execute, oslot, (), roiSmootherRegion, destArea, sourceArray = sourceArraysForSigmas[j])
+                            closures.append(closure)
 
-                                written += 1
-                            cnt += 1
-            pool = RequestPool()
-            for c in closures:
-                r = pool.request(c)
-            pool.wait()
-            pool.clean()
+                            written += end - begin
+                        cnt += slices
+                    else:
+                        if cnt>=rroi.start[axisindex] and rroi.start[axisindex] + written < rroi.stop[axisindex]:
+                            reskey = [slice(None, None, None) for x in range(len(result.shape))]
+                            slices = oslot.meta.shape[axisindex]
+                            reskey[axisindex]=slice(written, written+slices, None)
+                            #print "key: ", key, "reskey: ", reskey, "oldkey: ", oldkey, "resshape:", result.shape
+                            #print "roiSmoother:", roiSmoother
+                            destArea = result[tuple(reskey)]
+                            #print "destination area:", destArea.shape
+                            logger.debug(oldkey, destArea.shape, sourceArraysForSigmas[j].shape)
+                            oldroi = SubRegion(self.Input, pslice=oldkey)
+                            #print "passing roi:", oldroi
+                            closure = partial(oslot.operator.execute, oslot, (), oldroi, destArea, sourceArray = sourceArraysForSigmas[j])
+                            closures.append(closure)
+
+                            written += 1
+                        cnt += 1
+        pool = RequestPool()
+        for c in closures:
+            r = pool.request(c)
+        pool.wait()
+        pool.clean()
+
+        for i in range(len(sourceArraysForSigmas)):
+            if sourceArraysForSigmas[i] is not None:
+                try:
+                    sourceArraysForSigmas[i].resize((1,))
+                except:
+                    sourceArraysForSigmas[i] = None
 
-            for i in range(len(sourceArraysForSigmas)):
-                if sourceArraysForSigmas[i] is not None:
-                    try:
-                        sourceArraysForSigmas[i].resize((1,))
-                    except:
-                        sourceArraysForSigmas[i] = None
+def _presmooth(image, sigma, roi, computeIn2d):
+    if computeIn2d:
+        smoothSlice = lambda k, image2d, roi2d: vigra.filters.gaussianSmoothing(image2d, sigma, roi = roi2d, window_size = 3.5)
+        return _filterSlices(smoothSlice, image, roi)
+    return vigra.filters.gaussianSmoothing(image, sigma, roi = roi, window_size = 3.5)
 
 ###################################################3
 class OpPixelFeaturesInterpPresmoothed(Operator):
@@ -735,7 +1085,7 @@ class OpPixelFeaturesInterpPresmoothed(Operator):
             
             # If all the input channels were dirty, the dirty output region is a contiguous block
             if dirtyChannels == numChannels:
-                dirtyKey = roiToSlice(roi.start, roi.stop)
+                dirtyKey = list(roiToSlice(roi.start, roi.stop))
                 dirtyKey[channelAxis] = slice(None)
                 dirtyRoi = sliceToRoi(dirtyKey, self.Output.meta.shape)
                 self.Output.setDirty(dirtyRoi[0], dirtyRoi[1])
@@ -1054,7 +1404,8 @@ def getAllExceptAxis(ndim,index,slicer):
     return tuple(res)
 
 class OpBaseVigraFilter(OpArrayPiper):
-    inputSlots = [InputSlot("Input"), InputSlot("sigma", stype = "float")]
+    inputSlots = [InputSlot("Input"), InputSlot("sigma", stype = "float"),
+                  InputSlot("ComputeIn2d", value=False)] # Filter each z-slice separately (no halo along z)
     outputSlots = [OutputSlot("Output")]
 
     name = "OpBaseVigraFilter"
@@ -1075,7 +1426,7 @@ class OpBaseVigraFilter(OpArrayPiper):
 
         kwparams = {}
         for islot in self.inputs.values():
-            if islot.name != "Input":
+            if islot.name not in ("Input", "ComputeIn2d"):
                 kwparams[islot.name] = islot.value
 
         if self.inputs.has_key("sigma"):
@@ -1092,7 +1443,7 @@ class OpBaseVigraFilter(OpArrayPiper):
             kwparams['window_size']=self.window_size_feature
             windowSize = self.window_size_smoother
 
-        largestSigma = max(0.7,sigma) #we use 0.7 as an approximation of not doing any smoothing
+        largestSigma = max(0.7,numpy.max(sigma)) #we use 0.7 as an approximation of not doing any smoothing
         #smoothing was already applied previously
 
         shape = self.outputs["Output"].meta.shape
@@ -1121,7 +1472,11 @@ class OpBaseVigraFilter(OpArrayPiper):
             else:
                 subshape[at2.index('z')-1]=sourceArray.shape[zAxis]
         
-        newStart, newStop = roi.extendSlice(start, stop, subshape, 0.7, window = windowSize)
+        computeIn2d = self._computeIn2d()
+        haloSigma = [0.7]*len(subshape)
+        if computeIn2d:
+            haloSigma[_spatialIndex(axistags, 'z')] = 0
+        newStart, newStop = roi.extendSlice(start, stop, subshape, haloSigma, window = windowSize)
         
         readKey = roi.roiToSlice(newStart, newStop)
 
@@ -1232,7 +1587,11 @@ class OpBaseVigraFilter(OpArrayPiper):
                     if self.supportsRoi:
                         vroi = (tuple(writeNewStart._asint()), tuple(writeNewStop._asint()))
                         try:
-                            temp = self.vigraFilter(image, roi = vroi, **kwparams)
+                            if computeIn2d:
+                                filterSlice = lambda k, image2d, roi2d: self._filterImage(kwparams, image2d, roi2d)
+                                temp = _filterSlices(filterSlice, image, vroi)
+                            else:
+                                temp = self._filterImage(kwparams, image, vroi)
                             
                         except Exception, e:
                             print "EXCEPT 2.1", self.name, image.shape, vroi, kwparams
@@ -1241,7 +1600,12 @@ class OpBaseVigraFilter(OpArrayPiper):
                             sys.exit(1)
                     else:
                         try:
-                            temp = self.vigraFilter(image, **kwparams)
+                            if computeIn2d:
+                                filterSlice = lambda k, image2d, roi2d: self.vigraFilter(image2d, **kwparams)
+                                wholeImage = ((0,)*len(newStart), tuple(newStop - newStart))
+                                temp = _filterSlices(filterSlice, image, wholeImage)
+                            else:
+                                temp = self.vigraFilter(image, **kwparams)
                         except Exception, e:
                             print "EXCEPT 2.2", self.name, image.shape, kwparams
                             traceback.print_exc(e)
@@ -1299,6 +1663,37 @@ class OpBaseVigraFilter(OpArrayPiper):
     def resultingChannels(self):
         raise RuntimeError('resultingChannels() not implemented')
 
+    def spatialAxisCount(self):
+        """
+        The number of spatial axes the filter works on (without the z axis when computing in 2D).
+        """
+        count = self.inputs["Input"].meta.axistags.axisTypeCount(vigra.AxisType.Space)
+        if self._computeIn2d():
+            count -= 1
+        return count
+
+    def _computeIn2d(self):
+        axistags = self.inputs["Input"].meta.axistags
+        return bool(self.inputs["ComputeIn2d"].value) and axistags.index('z') < len(axistags)
+
+    def _filterImage(self, kwparams, image, roi):
+        return self.vigraFilter(image, roi = roi, **kwparams)
+
+    def outputRange(self, low, high):
+        """
+        Bounds (low, high) for all output values of this filter, given the range of its input values.
+        Used to quantize the features (see OpPixelFeaturesPresmoothed.OutputDtype).
+        None if the filter can't bound its output.
+        """
+        return None
+
+# L1 norms of the first and second derivative of a gaussian with sigma=1,
+#  with some slack for vigra's truncated and renormalized kernels.
+# A derivative kernel k (with zero sum) maps input values within a range R
+#  to values within +-|k|_1 * R/2.
+_FirstDerivativeNorm = 1.25 * 2/math.sqrt(2*math.pi)
+_SecondDerivativeNorm = 1.25 * 4/math.sqrt(2*math.pi*math.e)
+
 
 #difference of Gaussians
 def differenceOfGausssians(image,sigma0, sigma1,window_size, roi, out = None):
@@ -1351,11 +1746,15 @@ class OpDifferenceOfGaussians(OpBaseVigraFilter):
     supportsOut = False
     supportsWindow = True
     supportsRoi = True
-    inputSlots = [InputSlot("Input"), InputSlot("sigma0", stype = "float"), InputSlot("sigma1", stype = "float")]
+    inputSlots = [InputSlot("Input"), InputSlot("sigma0", stype = "float"), InputSlot("sigma1", stype = "float"),
+                  InputSlot("ComputeIn2d", value=False)]
 
     def resultingChannels(self):
         return 1
 
+    def outputRange(self, low, high):
+        return (low - high, high - low)
+
 class OpGaussianSmoothing(OpBaseVigraFilter):
     name = "GaussianSmoothing"
     vigraFilter = staticmethod(vigra.filters.gaussianSmoothing)
@@ -1367,6 +1766,9 @@ class OpGaussianSmoothing(OpBaseVigraFilter):
     def resultingChannels(self):
         return 1
 
+    def outputRange(self, low, high):
+        return (low, high)
+
 class OpHessianOfGaussianEigenvalues(OpBaseVigraFilter):
     name = "HessianOfGaussianEigenvalues"
     vigraFilter = staticmethod(vigra.filters.hessianOfGaussianEigenvalues)
@@ -1374,12 +1776,19 @@ class OpHessianOfGaussianEigenvalues(OpBaseVigraFilter):
     supportsRoi = True
     supportsWindow = True
     supportsOut = True
-    inputSlots = [InputSlot("Input"), InputSlot("scale", stype = "float")]
+    inputSlots = [InputSlot("Input"), InputSlot("scale", stype = "float"), InputSlot("ComputeIn2d", value=False)]
 
     def resultingChannels(self):
-        temp = self.inputs["Input"].meta.axistags.axisTypeCount(vigra.AxisType.Space)
+        temp = self.spatialAxisCount()
         return temp
 
+    def outputRange(self, low, high):
+        # Each eigenvalue is bounded by the largest absolute row sum of the hessian
+        sigma = self.inputs["scale"].value
+        d = self.spatialAxisCount()
+        bound = (_SecondDerivativeNorm + (d-1)*_FirstDerivativeNorm**2) / sigma**2 * (high - low) / 2.0
+        return (-bound, bound)
+
 
 class OpStructureTensorEigenvalues(OpBaseVigraFilter):
     name = "StructureTensorEigenvalues"
@@ -1388,12 +1797,19 @@ class OpStructureTensorEigenvalues(OpBaseVigraFilter):
     supportsRoi = True
     supportsWindow = True
     supportsOut = True
-    inputSlots = [InputSlot("Input"), InputSlot("innerScale", stype = "float"),InputSlot("outerScale", stype = "float")]
+    inputSlots = [InputSlot("Input"), InputSlot("innerScale", stype = "float"),InputSlot("outerScale", stype = "float"),
+                  InputSlot("ComputeIn2d", value=False)]
 
     def resultingChannels(self):
-        temp = self.inputs["Input"].meta.axistags.axisTypeCount(vigra.AxisType.Space)
+        temp = self.spatialAxisCount()
         return temp
 
+    def outputRange(self, low, high):
+        # The eigenvalues are non-negative and bounded by the trace (the smoothed squared gradient magnitude)
+        sigma = self.inputs["innerScale"].value
+        d = self.spatialAxisCount()
+        return (0.0, d * (_FirstDerivativeNorm / sigma * (high - low) / 2.0)**2)
+
 
 
 class OpHessianOfGaussianEigenvaluesFirst(OpBaseVigraFilter):
@@ -1404,7 +1820,7 @@ class OpHessianOfGaussianEigenvaluesFirst(OpBaseVigraFilter):
     supportsWindow = True
     supportsRoi = True
 
-    inputSlots = [InputSlot("Input"), InputSlot("scale", stype = "float")]
+    inputSlots = [InputSlot("Input"), InputSlot("scale", stype = "float"), InputSlot("ComputeIn2d", value=False)]
 
     def resultingChannels(self):
         return 1
@@ -1420,7 +1836,7 @@ class OpHessianOfGaussian(OpBaseVigraFilter):
     supportsOut = True
 
     def resultingChannels(self):
-        temp = self.inputs["Input"].meta.axistags.axisTypeCount(vigra.AxisType.Space)*(self.inputs["Input"].meta.axistags.axisTypeCount(vigra.AxisType.Space) + 1) / 2
+        temp = self.spatialAxisCount()*(self.spatialAxisCount() + 1) / 2
         return temp
 
 class OpGaussianGradientMagnitude(OpBaseVigraFilter):
@@ -1434,6 +1850,11 @@ class OpGaussianGradientMagnitude(OpBaseVigraFilter):
     def resultingChannels(self):
         return 1
 
+    def outputRange(self, low, high):
+        sigma = self.inputs["sigma"].value
+        d = self.spatialAxisCount()
+        return (0.0, math.sqrt(d) * _FirstDerivativeNorm / sigma * (high - low) / 2.0)
+
 class OpLaplacianOfGaussian(OpBaseVigraFilter):
     name = "LaplacianOfGaussian"
     vigraFilter = staticmethod(vigra.filters.laplacianOfGaussian)
@@ -1441,12 +1862,17 @@ class OpLaplacianOfGaussian(OpBaseVigraFilter):
     supportsOut = True
     supportsRoi = True
     supportsWindow = True
-    inputSlots = [InputSlot("Input"), InputSlot("scale", stype = "float")]
+    inputSlots = [InputSlot("Input"), InputSlot("scale", stype = "float"), InputSlot("ComputeIn2d", value=False)]
 
 
     def resultingChannels(self):
         return 1
 
+    def outputRange(self, low, high):
+        sigma = self.inputs["scale"].value
+        bound = self.spatialAxisCount() * _SecondDerivativeNorm / sigma**2 * (high - low) / 2.0
+        return (-bound, bound)
+
 class OpImageReader(Operator):
     name = "Image Reader"
     category = "Input"
@@ -1 +1,2 @@
 from request import *
+from processPool import ProcessPool, sharedArray, isSharedArray
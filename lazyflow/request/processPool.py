@@ -0,0 +1,254 @@
+# Built-in
+import os
+import mmap
+import threading
+import traceback
+import collections
+import multiprocessing
+import logging
+
+# Third-party
+import numpy
+
+# lazyflow
+from request import Request, RequestLock
+
+logger = logging.getLogger(__name__)
+
+def sharedArray(shape, dtype):
+    """
+    Allocate a numpy array in anonymous shared memory.
+    Arrays allocated this way can be written by forked child processes, and the writes are visible to the parent.
+    If such an array is given as the destination to :py:meth:`ProcessPool.run`, no extra copy is needed.
+    """
+    dtype = numpy.dtype(dtype)
+    count = int(numpy.prod(shape))
+    buf = mmap.mmap(-1, max(1, count * dtype.itemsize))
+    return numpy.frombuffer(buf, dtype=dtype, count=count).reshape(shape)
+
+def isSharedArray(a):
+    """
+    Return True if the given array is (a view of) an array allocated with :py:func:`sharedArray`.
+    """
+    base = a
+    while base is not None:
+        if isinstance(base, mmap.mmap):
+            return True
+        base = getattr(base, 'base', None)
+    return False
+
+class ProcessPool(object):
+    """
+    Executes CPU-bound functions in forked child processes, so pure-Python or GIL-holding
+    code can run in parallel with the rest of the request system.
+
+    Inputs are not copied: the child is created with ``fork()``, so it sees the parent's memory
+    (including any numpy arrays, closures, or classifier objects passed to the function) copy-on-write.
+    Results are written into a shared-memory array and then appear in the caller's destination.
+
+    While it waits for a free slot or for its child, the calling request is suspended (like a request waiting
+    for a :py:class:`RequestLock`), so it doesn't occupy a worker thread.  A watcher thread waits for the child,
+    polls the calling request for cancellation, and wakes the request when the child is done.
+    If the request is cancelled, the child process is terminated and ``Request.CancellationException`` is raised.
+
+    A child is forked for every call (rather than handing pickled tasks to pre-forked workers), because
+    kernels typically receive objects that can't be pickled, e.g. operators or classifier forests.
+
+    .. note:: The function executed in the child must not use the request system (e.g. request data from a slot).
+              Fetch all inputs first, then hand them to the child.
+    """
+
+    # One process pool shared by all operators.
+    # See initialization after this class definition (below)
+    global_process_pool = None
+
+    @classmethod
+    def reset_global_process_pool(cls, num_processes=multiprocessing.cpu_count()):
+        """
+        Change the maximum number of child processes that may run simultaneously.
+        """
+        cls.global_process_pool = ProcessPool(num_processes)
+
+    #: How often (in seconds) the watcher thread checks the child and the cancellation status of the calling request.
+    poll_interval = 0.05
+
+    def __init__(self, num_processes):
+        """
+        Constructor.
+
+        :param num_processes: The maximum number of child processes that may run simultaneously.
+                              Additional calls to :py:meth:`run()` wait (suspended) until a slot is free.
+        """
+        self.num_processes = num_processes
+        self._semaphore = _RequestSemaphore(num_processes)
+
+    def run(self, fn, destination, *args, **kwargs):
+        """
+        Call ``fn(out, *args, **kwargs)`` in a child process, where ``out`` is an array
+        with the same shape and dtype as destination.  ``fn`` must write its result into ``out``.
+        Return destination.
+
+        If destination was allocated with :py:func:`sharedArray`, the child writes into it directly.
+        Otherwise, a temporary shared array is used and copied into destination when the child has finished.
+
+        Exceptions raised in the child are re-raised in the caller.
+        On platforms without ``fork()``, ``fn`` is simply called in the current thread.
+        """
+        if not hasattr(os, 'fork'):
+            fn(destination, *args, **kwargs)
+            return destination
+
+        if isSharedArray(destination):
+            out = destination
+        else:
+            out = sharedArray(destination.shape, destination.dtype)
+
+        with self._semaphore:
+            self._check_cancelled()
+            self._run_in_child(fn, out, args, kwargs)
+
+        if out is not destination:
+            destination[...] = out
+        return destination
+
+    def _run_in_child(self, fn, out, args, kwargs):
+        parent_conn, child_conn = multiprocessing.Pipe(False)
+        process = multiprocessing.Process( target=_child_main, args=(fn, out, child_conn, args, kwargs) )
+        process.daemon = True
+        process.start()
+
+        # Close our copy of the child's end, so we see EOF if the child dies without reporting.
+        child_conn.close()
+
+        # The watcher thread releases this lock when the child is done.
+        # Acquiring it suspends the calling request instead of blocking its worker thread.
+        finished = RequestLock()
+        finished.acquire()
+        result = {}
+
+        current_request = Request._current_request()
+        def watch():
+            try:
+                result['status'] = self._watch_child(process, parent_conn, current_request)
+            finally:
+                finished.release()
+
+        watcher = threading.Thread( target=watch, name="ProcessPool-watcher-{}".format( process.pid ) )
+        watcher.daemon = True
+        watcher.start()
+        finished.acquire()
+
+        status = result.get('status')
+        if status is _CANCELLED:
+            raise Request.CancellationException()
+        if status is None:
+            raise RuntimeError( "Child process exited unexpectedly (exit code: {})".format( process.exitcode ) )
+
+        exception, traceback_str = status
+        if exception is not None:
+            logger.error( "Exception in child process:\n" + traceback_str )
+            raise exception
+
+    def _watch_child(self, process, parent_conn, request):
+        """
+        Runs in the watcher thread.  Wait until the child reports its status or exits,
+        or until the given request is cancelled (in which case the child is terminated).
+        Return the child's status tuple, ``_CANCELLED``, or None if the child exited without reporting.
+        """
+        try:
+            while True:
+                if parent_conn.poll(self.poll_interval) or not process.is_alive():
+                    # The child may have reported just before exiting.
+                    if parent_conn.poll():
+                        try:
+                            return parent_conn.recv()
+                        except EOFError:
+                            pass
+                    return None
+                if request is not None and request.cancelled:
+                    logger.debug("Request was cancelled.  Terminating child process {}".format( process.pid ))
+                    process.terminate()
+                    return _CANCELLED
+        finally:
+            process.join()
+            parent_conn.close()
+
+    def _is_cancelled(self):
+        current_request = Request._current_request()
+        return current_request is not None and current_request.cancelled
+
+    def _check_cancelled(self):
+        if self._is_cancelled():
+            raise Request.CancellationException()
+
+# Returned by ProcessPool._watch_child() if the calling request was cancelled.
+_CANCELLED = object()
+
+class _RequestSemaphore(object):
+    """
+    A counting semaphore for requests.  Like :py:class:`RequestLock`, a request that has to wait
+    is suspended (so its worker thread can do other work) instead of blocking its thread.
+    Foreign (non-request) threads simply block.
+    """
+    def __init__(self, value):
+        self._value = value
+        self._lock = threading.Lock()
+        self._waiters = collections.deque()
+
+    def acquire(self):
+        with self._lock:
+            if self._value > 0:
+                self._value -= 1
+                return
+            waiter = RequestLock()
+            waiter.acquire()
+            self._waiters.append(waiter)
+        # Wait until release() hands its slot over to us.
+        waiter.acquire()
+
+    def release(self):
+        with self._lock:
+            if self._waiters:
+                self._waiters.popleft().release()
+            else:
+                self._value += 1
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+def _reinit_logging_locks():
+    """
+    The child is forked from a multithreaded process, so another thread may have held one of the
+    logging module's locks at the time of the fork.  That thread doesn't exist in the child,
+    so replace the locks before the child logs anything.
+    """
+    logging._lock = threading.RLock()
+    for handler_ref in getattr(logging, '_handlerList', []):
+        handler = handler_ref() if callable(handler_ref) else handler_ref
+        if handler is not None:
+            handler.createLock()
+
+def _child_main(fn, out, conn, args, kwargs):
+    """
+    Entry point of the child process.
+    Reports a tuple of (exception, traceback) to the parent (both None upon success).
+    """
+    _reinit_logging_locks()
+    try:
+        fn(out, *args, **kwargs)
+    except Exception as ex:
+        traceback_str = traceback.format_exc()
+        try:
+            conn.send( (ex, traceback_str) )
+        except Exception:
+            # The exception can't be pickled.  Send a generic one instead.
+            conn.send( (RuntimeError(traceback_str), traceback_str) )
+    else:
+        conn.send( (None, None) )
+    conn.close()
+
+ProcessPool.reset_global_process_pool()
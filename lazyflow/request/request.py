@@ -7,6 +7,7 @@ import threading
 import multiprocessing
 import platform
 import traceback
+import gc
 
 # Third-party
 import greenlet
@@ -51,16 +52,20 @@ class Request( object ):
     global_thread_pool = None
     
     @classmethod
-    def reset_thread_pool( cls, num_workers = multiprocessing.cpu_count() ):
+    def reset_thread_pool( cls, num_workers = multiprocessing.cpu_count(), queue_type = threadPool.ThreadPool._DefaultQueueType ):
         """
         Change the number of threads allocated to the request system.
         
+        :param num_workers: The number of worker threads.
+        :param queue_type: The queue class used to schedule requests (see :py:class:`ThreadPool <lazyflow.request.threadPool.ThreadPool>`).
+                           Use :py:class:`WorkStealingQueue <lazyflow.request.threadPool.WorkStealingQueue>` to enable work-stealing.
+        
         .. note:: It is only valid to call this during startup.
                   Any existing requests will be dropped from the pool.
         """
         if cls.global_thread_pool is not None:
             cls.global_thread_pool.stop()
-        cls.global_thread_pool = threadPool.ThreadPool( num_workers )
+        cls.global_thread_pool = threadPool.ThreadPool( num_workers, queue_type )
     
     class CancellationException(Exception):
         """
@@ -87,10 +92,10 @@ class Request( object ):
     class CircularWaitException(Exception):
         """
         This exception is raised if a request calls wait() on itself.
-        Currently, this only catches the most basic case.
-        No attempt is made to detect indirect cycles
-        (e.g. if req.wait() is called from within a req's own child.),
-        so don't rely on it to catch tricky deadlocks due to indirect self-waiting.
+        By default, this only catches the most basic case.
+        Indirect cycles (e.g. if req.wait() is called from within a req's own child)
+        are only detected if ``Request.detect_indirect_cycles`` is True.
+        See also ``Request.dump_wait_graph()`` for diagnosing hung requests.
         """
         pass
     
@@ -103,6 +108,26 @@ class Request( object ):
     
     _root_request_counter = itertools.count()
 
+    #: Priority classes (see :py:meth:`set_priority_class`).
+    #: The thread pool always starts the requests of a more urgent class first.
+    PRIORITY_INTERACTIVE = threadPool.PRIORITY_INTERACTIVE
+    PRIORITY_NORMAL = threadPool.PRIORITY_NORMAL
+    PRIORITY_BACKGROUND = threadPool.PRIORITY_BACKGROUND
+
+    #: If True, requests that are not interactive give up their worker at each wait()
+    #: while a request of a more urgent priority class is waiting to be started (preemption).
+    allow_preemption = False
+
+    #: If True, wait() checks whether the current request is (indirectly) being waited for by the request 
+    #: it is about to wait for, and raises CircularWaitException instead of hanging forever.
+    #: The check walks the chain of blocking requests, so it is disabled by default.
+    detect_indirect_cycles = False
+
+    #: Optional observer of blocking waits (e.g. :py:class:`lazyflow.utility.ExecutionProfiler`).
+    #: If not None, ``wait_observer.waitStarted()`` and ``wait_observer.waitFinished()`` are called
+    #: (from the waiting thread/greenlet) around every wait() that can't return immediately.
+    wait_observer = None
+
     def __init__(self, fn):
         """
         Constructor.
@@ -138,7 +163,7 @@ class Request( object ):
         current_request = Request._current_request()
         self.parent_request = current_request
         if current_request is None:
-            self._priority = [ Request._root_request_counter.next() ]
+            self._priority = [ Request.PRIORITY_NORMAL, Request._root_request_counter.next() ]
         else:
             with current_request._lock:
                 current_request.child_requests.add(self)
@@ -161,6 +186,26 @@ class Request( object ):
         """
         return self._priority < other._priority
 
+    @property
+    def priority_class(self):
+        """
+        The priority class of this request (PRIORITY_INTERACTIVE, PRIORITY_NORMAL or PRIORITY_BACKGROUND).
+        """
+        return self._priority[0]
+
+    def set_priority_class(self, priority_class):
+        """
+        Set the priority class of this request.
+        All requests that are created from within this request inherit it.
+        Usually, this is called on a root request (e.g. interactive for a viewer, background for a batch export).
+        Must be called before the request is started.
+        """
+        assert priority_class in (Request.PRIORITY_INTERACTIVE, Request.PRIORITY_NORMAL, Request.PRIORITY_BACKGROUND), \
+            "Unknown priority class: {}".format( priority_class )
+        assert not self.started, "Can't change the priority class of a request that was already started."
+        # (The priority class is the first entry of the priority list, so it takes precedence over the creation order.)
+        self._priority = [priority_class] + self._priority[1:]
+
     def clean(self, _fullClean=True):
         """
         Delete all state from the request, for cleanup purposes.
@@ -297,6 +342,18 @@ class Request( object ):
         # Switch back to the worker that we're currently running in.
         self.greenlet.parent.switch()
 
+    def _detach_from_parent(self):
+        """
+        Make this request independent of the request it was created in.
+        It keeps its priority, but it will no longer be cancelled (or inherit cancellation) along with its parent.
+        Used for requests whose result is shared by several unrelated requests (see :py:class:`lazyflow.requestCoalescer.RequestCoalescer`).
+        """
+        parent = self.parent_request
+        if parent is not None:
+            with parent._lock:
+                parent.child_requests.discard(self)
+            self.parent_request = None
+
     def wait(self, timeout=None):
         """
         Start this request if necessary, then wait for it to complete.  Return the request's result.
@@ -326,15 +383,22 @@ class Request( object ):
         if self.execution_complete and not self.cancelled and self.exception is None:
             return self._result
         
-        # Identify the request that is waiting for us (the current context)
-        current_request = Request._current_request()
-
-        if current_request is None:
-            # 'None' means that this thread is not one of the request worker threads.
-            self._wait_within_foreign_thread( timeout )
-        else:
-            assert timeout is None, "The timeout parameter may only be used when wait() is called from a foreign thread."
-            self._wait_within_request( current_request )
+        observer = Request.wait_observer
+        if observer is not None:
+            observer.waitStarted()
+        try:
+            # Identify the request that is waiting for us (the current context)
+            current_request = Request._current_request()
+    
+            if current_request is None:
+                # 'None' means that this thread is not one of the request worker threads.
+                self._wait_within_foreign_thread( timeout )
+            else:
+                assert timeout is None, "The timeout parameter may only be used when wait() is called from a foreign thread."
+                self._wait_within_request( current_request )
+        finally:
+            if observer is not None:
+                observer.waitFinished()
 
         assert self.finished
         return self._result
@@ -387,6 +451,9 @@ class Request( object ):
         This is the implementation of wait() when executed from another request.
         If we have to wait, suspend the current request instead of blocking the whole worker thread.
         """
+        if Request.allow_preemption:
+            current_request._yield_to_urgent_work()
+
         # Before we suspend the current request, check to see if it's been cancelled since it last blocked
         if current_request.cancelled:
             raise Request.CancellationException()
@@ -400,6 +467,13 @@ class Request( object ):
             else:
                 raise Request.CircularWaitException()
 
+        if Request.detect_indirect_cycles and self.started and not self.finished:
+            # Is the request we're about to wait for (indirectly) waiting for us?
+            path = self._find_wait_path(current_request)
+            if path is not None:
+                cycle = [current_request] + path
+                raise Request.CircularWaitException( "Circular wait detected:\n  " + "\n  -> ".join( map(str, cycle) ) )
+
         with self._lock:
             # If the current request isn't cancelled but we are,
             # then the current request is trying to wait for a request (i.e. self) that was spawned elsewhere and already cancelled.
@@ -454,6 +528,21 @@ class Request( object ):
         if self.exception is not None:
             raise self.exception_info[0], self.exception_info[1], self.exception_info[2]
 
+    def _yield_to_urgent_work(self):
+        """
+        Preemption: If a request of a more urgent priority class is waiting to be started,
+        put this request back on its worker's queue, and let the worker start the urgent one first.
+        This request is resumed when the worker runs out of more urgent work (or when the urgent request has to wait).
+        """
+        if self.priority_class == Request.PRIORITY_INTERACTIVE:
+            return
+        worker = self._assigned_worker
+        if worker is None or not Request.global_thread_pool.has_waiting_work(self.priority_class):
+            return
+        worker.prefer_unassigned = True
+        self._wake_up()
+        self._suspend()
+
     def _handle_finished_request(self, request, *args):
         """
         Called when a request that we were waiting for has completed.
@@ -549,6 +638,82 @@ class Request( object ):
             for child in child_requests:
                 child.cancel()
     
+    def _find_wait_path(self, target):
+        """
+        Follow the blocking_requests relationships starting at this request.
+        If target is reachable, return the chain of requests from self to target (inclusive).
+        Otherwise, return None.
+        """
+        previous = { self : None }
+        to_visit = collections.deque([self])
+        while len(to_visit) > 0:
+            req = to_visit.popleft()
+            if req is target:
+                path = []
+                while req is not None:
+                    path.append(req)
+                    req = previous[req]
+                return list(reversed(path))
+            # (Copy the set, since other threads may be modifying it.)
+            for blocking in list(req.blocking_requests):
+                if blocking not in previous:
+                    previous[blocking] = req
+                    to_visit.append(blocking)
+        return None
+
+    def __str__(self):
+        if self.finished:
+            state = "finished"
+        elif self.started:
+            state = "started"
+        else:
+            state = "not started"
+        if self.cancelled:
+            state += ", cancelled"
+        worker = self._assigned_worker
+        if worker is not None:
+            state += ", " + getattr(worker, 'name', str(worker))
+        return "Request 0x{:x} ({}): {}".format( id(self), state, self.fn )
+
+    @classmethod
+    def wait_graph(cls):
+        """
+        Return the current wait-for graph of all in-flight requests as a dict of ``{ request : [requests it is waiting for] }``.
+        Every request that has been started but not finished is included, even if it isn't waiting for anything.
+        
+        .. note:: The requests are found by scanning the garbage collector's list of objects, 
+                  so there is no bookkeeping overhead during normal execution, but this function is slow.
+                  It is meant for diagnosing hung pipelines.
+        """
+        graph = {}
+        for obj in gc.get_objects():
+            if isinstance(obj, Request) and obj.started and not obj.finished:
+                graph[obj] = list(obj.blocking_requests)
+        return graph
+
+    @classmethod
+    def dump_wait_graph(cls, stream=None):
+        """
+        Write a human-readable description of the wait-for graph of all in-flight requests
+        (including any wait cycles) to the given stream (default: sys.stderr).
+        For requests created by a slot, the description includes the operator, slot, and roi.
+        """
+        stream = stream or sys.stderr
+        graph = cls.wait_graph()
+        stream.write( "Wait graph of {} in-flight requests:\n".format( len(graph) ) )
+        for req in sorted( graph.keys(), key=lambda r: r._priority ):
+            stream.write( "{}\n".format( req ) )
+            for blocking in graph[req]:
+                stream.write( "    is waiting for: {}\n".format( blocking ) )
+
+        reported = set()
+        for req in graph.keys():
+            for blocking in graph[req]:
+                path = blocking._find_wait_path(req)
+                if path is not None and req not in reported:
+                    reported.update(path)
+                    stream.write( "Circular wait detected:\n  " + "\n  -> ".join( map(str, [req] + path) ) + "\n" )
+
     @classmethod
     def _current_request(cls):
         """
@@ -579,6 +744,9 @@ class Request( object ):
         def __call__(self, *args):
             totalargs = args + self.args
             return self.func( *totalargs, **self.kwargs)
+
+        def __str__(self):
+            return str(self.func)
     
     def writeInto(self, destination):
         self.fn = Request._PartialWithAppendedArgs( self.fn, destination=destination )
@@ -2,6 +2,8 @@
 import atexit
 import collections
 import heapq
+import itertools
+import random
 import threading
 import platform
 
@@ -9,9 +11,20 @@ import platform
 # In particular, check that deque operations like push() and pop() are still atomic.
 assert platform.python_implementation() == "CPython"
 
+# Priority classes.  Tasks of a more urgent class (lower number) are always started first.
+# Tasks without a 'priority_class' attribute belong to the normal class.
+# (See Request.set_priority_class())
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL      = 1
+PRIORITY_BACKGROUND  = 2
+
+def _priority_class(task):
+    return getattr(task, 'priority_class', PRIORITY_NORMAL)
+
 class PriorityQueue(object):
     """
     Simple threadsafe heap based on the python heapq module.
+    (Requests compare by their priority, which starts with their priority class.)
     """
     def __init__(self):
         self._heap = []
@@ -28,38 +41,70 @@ class PriorityQueue(object):
     def __len__(self):
         return len(self._heap)
 
-class FifoQueue(object):
+class _ClassedDequeQueue(object):
     """
-    Simple FIFO queue based on collections.deque.
+    Base class for the FIFO and LIFO queues: one collections.deque for each priority class.
+    The items of the most urgent class are always popped first.
     """
     def __init__(self):
-        self._deque = collections.deque() # Documentation says this is threadsafe for push and pop
+        self._deques = {} # priority class -> deque (Documentation says deques are threadsafe for push and pop)
 
     def push(self, item):
-        self._deque.append(item)
-    
+        priority_class = _priority_class(item)
+        try:
+            d = self._deques[priority_class]
+        except KeyError:
+            d = self._deques.setdefault(priority_class, collections.deque())
+        d.append(item)
+
     def pop(self):
-        return self._deque.popleft()
-    
+        for priority_class in sorted(self._deques.keys()):
+            try:
+                return self._pop_from(self._deques[priority_class])
+            except IndexError:
+                pass
+        raise IndexError("pop from an empty queue")
+
     def __len__(self):
-        return len(self._deque)
+        return sum( len(d) for d in self._deques.values() )
 
-class LifoQueue(object):
+class FifoQueue(_ClassedDequeQueue):
     """
-    Simple LIFO queue based on collections.deque.
+    Simple FIFO queue based on collections.deque (FIFO within each priority class).
     """
-    def __init__(self):
-        self._deque = collections.deque() # Documentation says this is threadsafe for push and pop
+    def _pop_from(self, d):
+        return d.popleft()
 
-    def push(self, item):
-        self._deque.append(item)
-    
-    def pop(self):
-        return self._deque.pop()
-    
-    def __len__(self):
-        return len(self._deque)
+class LifoQueue(_ClassedDequeQueue):
+    """
+    Simple LIFO queue based on collections.deque (LIFO within each priority class).
+    """
+    def _pop_from(self, d):
+        return d.pop()
+
+class WorkStealingQueue(PriorityQueue):
+    """
+    Per-worker priority heap used by the work-stealing scheduler.
     
+    When a :py:class:`ThreadPool` is constructed with this queue type, there is no shared queue of unassigned tasks.
+    Instead, each worker owns one of these queues, new tasks are pushed onto the queue of the submitting worker
+    (or distributed round-robin if submitted from a foreign thread), and idle workers steal from a randomly chosen victim.
+    Both the owner and thieves always take the highest-priority task (according to ``__lt__``),
+    so the prioritization of :py:class:`PriorityQueue` is preserved within each queue.
+    """
+    def steal(self):
+        """
+        Non-blocking pop for thieves.
+        If the owner (or another thief) currently holds the lock, give up immediately 
+        instead of contending for it, and raise IndexError as if the queue were empty.
+        """
+        if not self._lock.acquire(False):
+            raise IndexError("Queue is busy")
+        try:
+            return heapq.heappop(self._heap)
+        finally:
+            self._lock.release()
+
 class ThreadPool(object):
     """
     Manages a set of worker threads and dispatches tasks to them.
@@ -76,9 +121,26 @@ class ThreadPool(object):
         :param num_workers: The number of worker threads to create.
         :param queue_type: The type of queue to use for prioritizing tasks.  Possible queue types include :py:class:`PriorityQueue`,
                            :py:class:`FifoQueue`, and :py:class:`LifoQueue`, or any class with ``push()``, ``pop()``, and ``__len__()`` methods.
+                           If :py:class:`WorkStealingQueue` (or a subclass) is given, the pool uses per-worker queues with 
+                           work-stealing and single-worker wakeups instead of one shared queue.
         """
         self.job_condition = threading.Condition()
-        self.unassigned_tasks = queue_type()
+        self.work_stealing = issubclass(queue_type, WorkStealingQueue)
+        if self.work_stealing:
+            # Unassigned tasks are kept in each worker's own queue (see _Worker.unassigned_tasks)
+            self.unassigned_tasks = None
+        else:
+            self.unassigned_tasks = queue_type()
+
+        # Work-stealing bookkeeping: workers that are currently waiting for work,
+        #  and a counter for distributing tasks that are submitted from foreign threads.
+        self._idle_workers = collections.deque()
+        self._idle_lock = threading.Lock()
+        self._round_robin = itertools.count()
+
+        # The number of unassigned (not yet started) tasks in each priority class (see has_waiting_work())
+        self._waiting = collections.Counter()
+        self._waiting_lock = threading.Lock()
 
         self.workers = self._start_workers( num_workers, queue_type )
 
@@ -93,11 +155,35 @@ class ThreadPool(object):
         # Once a task has been assigned, it must always be processed in the same worker
         if hasattr(task, 'assigned_worker') and task.assigned_worker is not None:
             task.assigned_worker.wake_up( task )
+        elif self.work_stealing:
+            # Prefer the queue of the worker that created this task (if any) for better locality.
+            # Otherwise, distribute the task round-robin.
+            current_thread = threading.current_thread()
+            if isinstance(current_thread, _Worker) and current_thread.thread_pool is self:
+                target = current_thread
+            else:
+                target = self._worker_list[ self._round_robin.next() % len(self._worker_list) ]
+            self._count_waiting(task, 1)
+            target.unassigned_tasks.push(task)
+            # Wake up ONE idle worker (if any) so it can run or steal the new task.
+            self._notify_one_idle_worker()
         else:
+            self._count_waiting(task, 1)
             self.unassigned_tasks.push(task)
             # Notify all currently waiting workers that there's new work
             self._notify_all_workers()
 
+    def has_waiting_work(self, priority_class):
+        """
+        Return True if a task of a more urgent priority class than the given one is waiting to be started.
+        """
+        with self._waiting_lock:
+            return any( n > 0 for c, n in self._waiting.items() if c < priority_class )
+
+    def _count_waiting(self, task, delta):
+        with self._waiting_lock:
+            self._waiting[_priority_class(task)] += delta
+
     def stop(self):
         """
         Stop all threads in the pool, and block for them to complete.
@@ -113,10 +199,11 @@ class ThreadPool(object):
         """
         Start a set of workers and return the set.
         """
-        workers = set()
-        for i in range(num_workers):
-            w = _Worker(self, i, queue_type=queue_type)
-            workers.add( w )
+        # All workers must exist before any of them starts, 
+        #  since they may attempt to steal from each other immediately.
+        self._worker_list = [ _Worker(self, i, queue_type=queue_type) for i in range(num_workers) ]
+        workers = set( self._worker_list )
+        for w in self._worker_list:
             w.start()
         return workers
 
@@ -128,6 +215,53 @@ class ThreadPool(object):
             with worker.job_queue_condition:
                 worker.job_queue_condition.notify()
 
+    def _notify_one_idle_worker(self):
+        """
+        Wake up a single worker that is currently waiting for work (work-stealing mode only).
+        If no worker is idle, do nothing: busy workers look for more work as soon as they finish their current task.
+        """
+        with self._idle_lock:
+            if len(self._idle_workers) == 0:
+                return
+            worker = self._idle_workers.popleft()
+        with worker.job_queue_condition:
+            worker.job_queue_condition.notify()
+
+    def _mark_idle(self, worker):
+        with self._idle_lock:
+            if worker not in self._idle_workers:
+                self._idle_workers.append(worker)
+
+    def _mark_busy(self, worker):
+        with self._idle_lock:
+            try:
+                self._idle_workers.remove(worker)
+            except ValueError:
+                pass
+
+    def _has_unassigned_work(self):
+        for worker in self._worker_list:
+            if len(worker.unassigned_tasks) > 0:
+                return True
+        return False
+
+    def _steal(self, thief):
+        """
+        Try to steal an unassigned task from the other workers, starting with a randomly chosen victim.
+        Return None if no task could be found.
+        """
+        num_workers = len(self._worker_list)
+        offset = random.randrange(num_workers)
+        for i in range(num_workers):
+            victim = self._worker_list[ (offset + i) % num_workers ]
+            if victim is thief or len(victim.unassigned_tasks) == 0:
+                continue
+            try:
+                return victim.unassigned_tasks.steal()
+            except IndexError:
+                pass
+        return None
+
 class _Worker(threading.Thread):
     """
     Runs in a loop until stopped.
@@ -142,6 +276,16 @@ class _Worker(threading.Thread):
         self.stopped = False
         self.job_queue_condition = threading.Condition()
         self.job_queue = queue_type()
+
+        # Set by a running task that yields to more urgent work (see Request._yield_to_urgent_work()):
+        #  the next job is then taken from the unassigned tasks, before the tasks in our own queue.
+        self.prefer_unassigned = False
+        
+        # In work-stealing mode, tasks that are not assigned to any worker yet are stored here.
+        if thread_pool.work_stealing:
+            self.unassigned_tasks = queue_type()
+        else:
+            self.unassigned_tasks = None
         
     def run(self):
         """
@@ -193,10 +337,20 @@ class _Worker(threading.Thread):
             next_task = self._pop_job()
 
             while next_task is None and not self.stopped:
+                if self.thread_pool.work_stealing:
+                    # Register as idle BEFORE checking the queues one last time,
+                    #  so a task that is pushed in the meantime can't be missed.
+                    self.thread_pool._mark_idle(self)
+                    next_task = self._pop_job()
+                    if next_task is not None:
+                        break
                 # Wait for work to become available
                 self.job_queue_condition.wait()
                 next_task = self._pop_job()
 
+            if self.thread_pool.work_stealing:
+                self.thread_pool._mark_busy(self)
+
         if not self.stopped:
             assert next_task is not None
             assert next_task.assigned_worker is self
@@ -210,17 +364,53 @@ class _Worker(threading.Thread):
         Otherwise, get one from the global job queue.
         Return None if neither queue has work to do.
         """
+        if self.prefer_unassigned:
+            self.prefer_unassigned = False
+            task = self._pop_unassigned_job()
+            if task is not None:
+                return task
+
         # Try our own queue first
         if len(self.job_queue) > 0:
             return self.job_queue.pop()
 
-        # Otherwise, try to claim a job from the global unassigned list            
+        return self._pop_unassigned_job()
+
+    def _pop_unassigned_job(self):
+        """
+        Claim a task that isn't assigned to any worker yet.
+        Return None if there is no unassigned work.
+        """
+        if self.thread_pool.work_stealing:
+            return self._pop_stealable_job()
+
+        # Try to claim a job from the global unassigned list            
         try:
             task = self.thread_pool.unassigned_tasks.pop()
         except IndexError:
             return None
         else:
+            self.thread_pool._count_waiting(task, -1)
             task.assigned_worker = self # If this fails, then your callable is some built-in that doesn't allow arbitrary  
                                         #  members (e.g. .assigned_worker) to be "monkey-patched" onto it.  You may have to wrap it in a custom class first.
             return task
-    
+
+    def _pop_stealable_job(self):
+        """
+        Work-stealing mode: claim an unassigned task from our own queue, or steal one from another worker.
+        Return None if there is no unassigned work anywhere.
+        """
+        try:
+            task = self.unassigned_tasks.pop()
+        except IndexError:
+            task = self.thread_pool._steal(self)
+            if task is None:
+                return None
+        self.thread_pool._count_waiting(task, -1)
+
+        # If there's more work waiting, pass the wakeup on to another idle worker.
+        if self.thread_pool._has_unassigned_work():
+            self.thread_pool._notify_one_idle_worker()
+
+        task.assigned_worker = self
+        return task
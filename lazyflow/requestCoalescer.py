@@ -0,0 +1,198 @@
+#Python
+import functools
+import threading
+
+#lazyflow
+from lazyflow.request import Request
+from lazyflow.roi import roiToSlice
+from lazyflow.rtype import SubRegion
+from lazyflow.stype import ArrayLike
+
+class _SharedExecution(object):
+    """
+    An in-flight execution of an output slot, whose result is shared by one or more CoalescedRequests.
+    """
+    def __init__(self, request, start, stop):
+        self.request = request
+        self.start = start
+        self.stop = stop
+        self.waiters = 0 # Waiters that are running (see RequestCoalescer._start)
+        self.pending = 0 # Waiters that haven't started yet (they might never run)
+        self.lock = threading.Lock()
+
+    def contains(self, start, stop):
+        return all( a <= b for a,b in zip(self.start, start) ) \
+           and all( a >= b for a,b in zip(self.stop, stop) )
+
+    def available(self):
+        return not self.request.finished and not self.request.cancelled
+
+class CoalescedRequest(Request):
+    """
+    A request for (part of) the result of a shared execution.
+    Each caller of ``slot.get()`` receives its own CoalescedRequest, so it can be waited for,
+    cancelled, or given a destination (via ``writeInto()``) independently of the others.
+    """
+    def __init__(self, coalescer, shared, roi):
+        self._coalescer = coalescer
+        self._shared = shared
+        self._started = False
+        self._released = False
+        super(CoalescedRequest, self).__init__( functools.partial(coalescer._fetch, self, shared, roi) )
+
+    def cancel(self):
+        super(CoalescedRequest, self).cancel()
+        if self.cancelled:
+            self._coalescer._release(self)
+
+class RequestCoalescer(object):
+    """
+    De-duplicates identical in-flight requests for an OutputSlot.
+
+    While an execution of the slot for a given roi is in progress, further calls to ``slot.get()``
+    with the same roi do not execute the operator again.  Instead, they share the result of the running execution.
+    If ``subregions`` is True, a roi that is contained in the roi of a running execution is served from that execution, too.
+
+    The shared execution is only cancelled when all running requests that share it have been cancelled.
+    (A request that hasn't started yet executes the operator on its own if it finds the shared execution cancelled.)
+    Callers that share an execution each receive their own copy of the data,
+    except the last one to finish, which receives the original result if no other request for it is still pending.
+
+    Only array-like slots with SubRegion rois are coalesced.  Other requests are passed through unchanged.
+    Executions that are in progress when the slot is marked dirty are not shared with subsequent callers.
+
+    Use :py:meth:`OutputSlot.enableRequestCoalescing()` to activate coalescing for a slot.
+    """
+    def __init__(self, slot, subregions=False):
+        self.slot = slot
+        self.subregions = subregions
+        self._lock = threading.Lock()
+        self._inflight = {} # (start, stop) -> _SharedExecution
+
+    def get(self, roi):
+        """
+        Return a request for the given roi of our slot.
+        """
+        current_request = Request._current_request()
+        if not isinstance(self.slot.stype, ArrayLike) or not isinstance(roi, SubRegion) \
+           or (current_request is not None and current_request.cancelled):
+            return self.slot._executionRequest(roi)
+
+        start, stop = tuple(roi.start), tuple(roi.stop)
+        with self._lock:
+            shared = self._findShared(start, stop)
+            if shared is None:
+                request = self.slot._executionRequest(roi)
+                # The execution must not be cancelled along with the request that happens to create it.
+                # It is cancelled when all of its waiters have been cancelled (see _release)
+                request._detach_from_parent()
+                shared = _SharedExecution(request, start, stop)
+                self._inflight[(start, stop)] = shared
+                request.notify_finished( functools.partial(self._remove, shared) )
+                request.notify_failed( functools.partial(self._remove, shared) )
+                request.notify_cancelled( functools.partial(self._remove, shared) )
+            shared.pending += 1
+        waiter = CoalescedRequest(self, shared, roi)
+        if waiter.cancelled:
+            # Our parent was cancelled in the meantime.  This waiter will never run.
+            self._release(waiter)
+        return waiter
+
+    def invalidate(self):
+        """
+        Don't share any of the currently running executions with future callers.
+        (The running executions are not cancelled.)
+        """
+        with self._lock:
+            self._inflight.clear()
+
+    def _findShared(self, start, stop):
+        shared = self._inflight.get( (start, stop) )
+        if shared is not None and shared.available():
+            return shared
+        if self.subregions:
+            for shared in self._inflight.values():
+                if shared.available() and shared.contains(start, stop):
+                    return shared
+        return None
+
+    def _remove(self, shared, *args):
+        with self._lock:
+            key = (shared.start, shared.stop)
+            if self._inflight.get(key) is shared:
+                del self._inflight[key]
+
+    def _start(self, waiter):
+        """
+        Count the given (pending) waiter as running.
+        Return False if it can't share the execution, because it was cancelled in the meantime.
+        """
+        shared = waiter._shared
+        with self._lock:
+            if waiter._released:
+                return False
+            waiter._started = True
+            shared.pending -= 1
+            if shared.request.cancelled:
+                waiter._released = True
+                return False
+            shared.waiters += 1
+            return True
+
+    def _release(self, waiter):
+        """
+        Unregister the given waiter from its shared execution.
+        If it was the last waiter (and no other waiter is pending), return True.
+        If it was the last running waiter and it was cancelled, cancel the shared execution.
+        """
+        shared = waiter._shared
+        with self._lock:
+            if waiter._released:
+                return False
+            waiter._released = True
+            if not waiter._started:
+                # Cancelled before it started: it never waited for the execution.
+                shared.pending -= 1
+                return False
+            shared.waiters -= 1
+            cancel = (shared.waiters == 0) and waiter.cancelled
+            last = (shared.waiters == 0) and (shared.pending == 0)
+            if cancel or last:
+                key = (shared.start, shared.stop)
+                if self._inflight.get(key) is shared:
+                    del self._inflight[key]
+
+        if cancel and not shared.request.finished:
+            shared.request.cancel()
+        return last
+
+    def _fetch(self, waiter, shared, roi, destination=None):
+        if not self._start(waiter):
+            # All running waiters were cancelled (and so was the shared execution).  Execute on our own.
+            request = self.slot._executionRequest(roi)
+            if destination is not None:
+                request.writeInto(destination)
+            return request.wait()
+
+        try:
+            result = shared.request.wait()
+        except:
+            self._release(waiter)
+            raise
+
+        if shared.start == tuple(roi.start) and shared.stop == tuple(roi.stop):
+            data = result
+        else:
+            key = roiToSlice( roi.start - shared.start, roi.stop - shared.start )
+            data = result[key]
+
+        # The last waiter may take the original result,
+        # but only after all other waiters have made their copies.
+        with shared.lock:
+            last = self._release(waiter)
+            if destination is not None:
+                destination[...] = data
+                return destination
+            if last and data is result:
+                return result
+            return data.copy()
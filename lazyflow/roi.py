@@ -357,29 +357,32 @@ def getIntersectingBlocks( blockshape, roi, asmatrix=False ):
       [20 40]]]
     """
     assert len(blockshape) == len(roi[0]) == len(roi[1]), "blockshape and roi are mismatched."
-    roistart = TinyVector( roi[0] )
-    roistop = TinyVector( roi[1] )
-    blockshape = TinyVector( blockshape )
-    
-    block_index_map_start = roistart / blockshape
-    block_index_map_stop = ( roistop + (blockshape - 1) ) / blockshape # Add (blockshape-1) first as a faster alternative to ceil() 
-    block_index_map_shape = block_index_map_stop - block_index_map_start
-    
-    num_axes = len(blockshape)
-    block_indices = numpy.indices( block_index_map_shape )
-    block_indices = numpy.rollaxis( block_indices, 0, num_axes+1 )
-    block_indices += block_index_map_start
+    roistart = numpy.asarray( roi[0], dtype=numpy.int64 )
+    roistop = numpy.asarray( roi[1], dtype=numpy.int64 )
+    blockshape = numpy.asarray( blockshape, dtype=numpy.int64 )
+
+    block_indices = _blockIndexRange( roistart // blockshape,
+                                      ( roistop + (blockshape - 1) ) // blockshape, # Add (blockshape-1) first as a faster alternative to ceil() 
+                                      asmatrix )
 
     # Multiply by blockshape to get the list of start coordinates
     block_indices *= blockshape
+    return block_indices
+
+def _blockIndexRange( block_index_start, block_index_stop, asmatrix=False ):
+    """
+    Return all block indexes in the range [block_index_start, block_index_stop) (in C order),
+    as an (N,M) array, or as an array of shape (D1,D2,...,DN,M) if asmatrix=True.
+    """
+    num_axes = len(block_index_start)
+    block_indices = numpy.indices( numpy.maximum(block_index_stop - block_index_start, 0) )
+    block_indices = numpy.rollaxis( block_indices, 0, num_axes+1 )
+    block_indices += block_index_start
 
     if asmatrix:
         return block_indices
-    else:
-        # Reshape into N*M matrix for easy iteration
-        num_indexes = numpy.prod(block_indices.shape[0:-1])
-        axiscount = block_indices.shape[-1]
-        return numpy.reshape( block_indices, (num_indexes, axiscount) )
+    # Reshape into N*M matrix for easy iteration
+    return block_indices.reshape( (-1, num_axes) )
 
 def getBlockBounds(dataset_shape, block_shape, block_start):
     """
@@ -389,15 +392,98 @@ def getBlockBounds(dataset_shape, block_shape, block_start):
     >>> getBlockBounds( [35,35,35], [10,10,10], [10,20,30] )
     (array([10, 20, 30]), array([20, 30, 35]))
     """
+    block_start = numpy.array( block_start )
     assert (numpy.mod( block_start, block_shape ) == 0).all(), "Invalid block_start.  Must be a multiple of the block shape!"
 
-    entire_dataset_roi = roiFromShape( dataset_shape )
-    block_shape = TinyVector( block_shape )
-    block_bounds = ( block_start, block_start + block_shape )
-    
     # Clip to dataset bounds
-    block_bounds = getIntersection( block_bounds, entire_dataset_roi )
-    return block_bounds
+    block_stop = numpy.minimum( block_start + block_shape, dataset_shape )
+    assert (block_start >= 0).all() and (block_stop > block_start).all(), "Rois do not intersect!"
+    return (block_start, block_stop)
+
+class BlockGrid(object):
+    """
+    The division of a dataset of the given shape into blocks of the given block shape.
+    (The blocks at the upper border of the dataset are clipped to the dataset bounds.)
+
+    All coordinates are handled as integer numpy arrays, and all functions work on many blocks at once,
+    which is much faster than doing the same computations block by block (e.g. with getBlockBounds()).
+
+    Use getBlockGrid() to obtain a (cached) instance.
+
+    >>> grid = BlockGrid( (35, 35), (10, 20) )
+    >>> grid.gridShape
+    array([4, 2])
+    >>> block_starts, block_stops = grid.blockBounds( grid.intersectingBlocks( (15, 10), (25, 30) ) )
+    >>> print block_starts
+    [[10  0]
+     [10 20]
+     [20  0]
+     [20 20]]
+    >>> print block_stops
+    [[20 20]
+     [20 35]
+     [30 20]
+     [30 35]]
+    """
+    def __init__(self, shape, blockShape):
+        self.shape = numpy.array( shape, dtype=numpy.int64 )
+        self.blockShape = numpy.array( blockShape, dtype=numpy.int64 )
+        assert self.shape.shape == self.blockShape.shape, "shape and blockShape are mismatched."
+        assert (self.blockShape > 0).all(), "Invalid blockShape: {}".format( blockShape )
+        self.gridShape = (self.shape + self.blockShape - 1) // self.blockShape
+
+    def intersectingBlockIndices(self, start, stop, asmatrix=False):
+        """
+        Return the (grid) indexes of the blocks that intersect the roi [start, stop) as an (N,M) array.
+        (See getIntersectingBlocks() for the meaning of asmatrix.)
+        """
+        start = numpy.asarray( start, dtype=numpy.int64 )
+        stop = numpy.asarray( stop, dtype=numpy.int64 )
+        return _blockIndexRange( start // self.blockShape,
+                                 (stop + self.blockShape - 1) // self.blockShape,
+                                 asmatrix )
+
+    def intersectingBlocks(self, start, stop, asmatrix=False):
+        """
+        Return the start coordinates of the blocks that intersect the roi [start, stop).
+        Same as getIntersectingBlocks( blockShape, (start, stop) ).
+        """
+        return self.intersectingBlockIndices(start, stop, asmatrix) * self.blockShape
+
+    def blockBounds(self, blockStarts):
+        """
+        Return the (clipped) bounds of the blocks with the given start coordinates as two (N,M) arrays.
+        """
+        blockStarts = numpy.asarray( blockStarts, dtype=numpy.int64 )
+        return blockStarts, numpy.minimum( blockStarts + self.blockShape, self.shape )
+
+    def intersections(self, start, stop):
+        """
+        For each block that intersects the roi [start, stop), compute the block bounds and
+        the part of the roi that lies within the block.
+
+        Returns four (N,M) arrays: blockStarts, blockStops, intersectionStarts, intersectionStops
+        """
+        start = numpy.asarray( start, dtype=numpy.int64 )
+        stop = numpy.asarray( stop, dtype=numpy.int64 )
+        blockStarts, blockStops = self.blockBounds( self.intersectingBlocks(start, stop) )
+        return ( blockStarts, blockStops,
+                 numpy.maximum( blockStarts, start ), numpy.minimum( blockStops, stop ) )
+
+_blockGrids = {}
+def getBlockGrid(shape, blockShape):
+    """
+    Return a BlockGrid for the given dataset shape and block shape.
+    Grids are cached, so that the computations they share are only done once per shape/blockShape combination.
+    """
+    key = ( tuple(map(int, shape)), tuple(map(int, blockShape)) )
+    try:
+        return _blockGrids[key]
+    except KeyError:
+        if len(_blockGrids) > 1000:
+            _blockGrids.clear()
+        grid = _blockGrids[key] = BlockGrid(*key)
+        return grid
 
 if __name__ == "__main__":
     import doctest
@@ -1,6 +1,7 @@
 #Python
 import sys
 import copy
+import time
 import logging
 import itertools
 import threading
@@ -14,6 +15,7 @@ import vigra
 from lazyflow import rtype
 from lazyflow.request import Request
 from lazyflow.stype import ArrayLike
+from lazyflow.requestCoalescer import RequestCoalescer
 from lazyflow.metaDict import MetaDict
 from lazyflow.utility import slicingtools, Tracer, OrderedSignal, Singleton
 
@@ -151,6 +153,9 @@ class Slot(object):
         self._settingUp = False
         self._condition = threading.Condition()
 
+        # Only used by OutputSlots (see OutputSlot.enableRequestCoalescing)
+        self._coalescer = None
+
         # Allow slots to be sorted by their order of creation for
         # debug output and diagramming purposes.
         self._global_slot_id = Slot._global_counter.next()
@@ -660,15 +665,67 @@ class Slot(object):
             #  no value and no partner, then something is wrong.
             assert self._type != "input", "This inputSlot has no value and no partner.  You can't ask for its data yet!"
             # normal (outputslot) case
-            # --> construct heavy request object..
-            execWrapper = Slot.RequestExecutionWrapper(self, roi)
-            request = Request(execWrapper)
+            if self._coalescer is not None:
+                # --> share the result of an identical request that is already running, if any
+                return self._coalescer.get(roi)
+            return self._executionRequest(roi)
+
+    def getBatch(self, rois, destinations=None):
+        """Retrieve the content of the slot for many (small) rois at
+        once.  This avoids the overhead of creating one request for
+        each roi: the operator handles all of them in a single call
+        to its executeBatch() method (see
+        :py:meth:`lazyflow.operator.Operator.executeBatch`).
+
+        :param rois: a list of rois (or ``(start, stop)`` pairs)
+
+        :param destinations: optional list of destination areas, one
+          for each roi, into which the results are scattered
+
+        Returns:
+          a request.Request object whose result is the list of
+          results, in the same order as the rois.
+
+        Batches are never shared with other callers (no request
+        coalescing).
+
+        """
+        rois = [ roi if isinstance(roi, rtype.Roi) else self.rtype(self, *roi) for roi in rois ]
+        if destinations is not None:
+            assert len(destinations) == len(rois), \
+                "Got {} destinations for {} rois".format( len(destinations), len(rois) )
+
+        if self._value is not None:
+            if destinations is None:
+                destinations = [None] * len(rois)
+            return ValueRequest( [ self.stype.writeIntoDestination(d, self._value, roi)
+                                   for d, roi in zip(destinations, rois) ] )
+        elif self.partner is not None:
+            return self.partner.getBatch(rois, destinations)
+        else:
+            # (Same sanity checks as in get())
+            assert self.ready(), \
+                "Can't get data from slot {}.{} yet. It isn't ready. First upstream problem slot is: {}"\
+                .format( self.getRealOperator().__class__, self.name, Slot._findUpstreamProblemSlot(self) )
+            assert self._type != "input", "This inputSlot has no value and no partner.  You can't ask for its data yet!"
 
-            # We must decrement the execution count even if the
-            # request is cancelled
+            execWrapper = Slot.BatchExecutionWrapper(self, rois, destinations)
+            request = Request(execWrapper)
             request.notify_cancelled(execWrapper.handleCancel)
             return request
 
+    def _executionRequest(self, roi):
+        """
+        Construct the (heavy) request object that executes the operator for the given roi.
+        """
+        execWrapper = Slot.RequestExecutionWrapper(self, roi)
+        request = Request(execWrapper)
+
+        # We must decrement the execution count even if the
+        # request is cancelled
+        request.notify_cancelled(execWrapper.handleCancel)
+        return request
+
     @staticmethod
     def _findUpstreamProblemSlot(slot):
         if slot.partner is not None:
@@ -679,6 +736,11 @@ class Slot(object):
         return "Couldn't find an upstream problem slot."
 
     class RequestExecutionWrapper(object):
+        #: Optional instrumentation (e.g. :py:class:`lazyflow.utility.ExecutionProfiler`).
+        #: If not None, each execution is passed to ``instrumentation.executeWrapper(wrapper, destination)``,
+        #: which must call ``wrapper._execute(destination)`` and return its result.
+        instrumentation = None
+
         def __init__(self, slot, roi):
             self.started = False
             self.finished = False
@@ -687,7 +749,20 @@ class Slot(object):
             self.lock = threading.Lock()
             self.roi = roi
 
+            # Time spent waiting for the operator to finish setupOutputs()
+            # before execution could start (only measured if we had to wait).
+            self.blockedTime = 0.0
+
+        def __str__(self):
+            return "{}.{}: {}".format( self.slot.getRealOperator().name, self.slot.name, self.roi )
+
         def __call__(self, destination=None):
+            instrumentation = Slot.RequestExecutionWrapper.instrumentation
+            if instrumentation is not None:
+                return instrumentation.executeWrapper(self, destination)
+            return self._execute(destination)
+
+        def _execute(self, destination=None):
             # store whether the user wants the results in a given
             # destination area
             destination_given = destination is not None
@@ -695,10 +770,7 @@ class Slot(object):
             if destination is None:
                 destination = self.slot.stype.allocateDestination(self.roi)
             else:
-                if self.slot.meta.dtype is not None and hasattr(destination, 'dtype'):
-                    assert self.slot.meta.dtype == destination.dtype, \
-                        "Can't provide a destination array of the wrong dtype.  "\
-                        "Slot generates {}, but you gave {}".format( self.slot.meta.dtype, destination.dtype )
+                self._checkDestination(destination)
 
             # We are executing the operator. Incremement the execution
             # count to protect against simultaneous setupOutputs()
@@ -709,32 +781,7 @@ class Slot(object):
                 # Execute the workload, which might not ever return
                 # (if we get cancelled).
                 result_op = self.operator.execute(self.slot, (), self.roi, destination)
-
-                # copy data from result_op to destination, if
-                # destination was actually given by the user, and the
-                # returned result_op is different from destination.
-                # (but don't copy if result_op is None, this means
-                # legacy op which wrote into destination anyway)
-                if destination_given and result_op is not None and id(result_op) != id(destination):
-                    # check that the returned value is compatible with the requested roi
-                    self.slot.stype.check_result_valid(self.roi, result_op)
-
-                    self.slot.stype.copy_data(dst=destination, src = result_op)
-                elif result_op is not None:
-                    # FIXME: this should be moved to a isCompatible
-                    # check in stypes.py
-                    if hasattr(result_op, "shape"):
-                        assert result_op.shape == destination.shape, \
-                          ("ERROR: Operator {} has failed to provide a"
-                           " result of correct shape. result shape is"
-                           " {} vs {}.  roi was {}".format(
-                               self.operator, result_op.shape,
-                               destination.shape, str(self.roi)))
-                    destination = result_op
-
-                    # check that the returned value is compatible with the requested roi
-                    self.slot.stype.check_result_valid(self.roi, destination)
-
+                destination = self._finishResult(self.roi, destination, destination_given, result_op)
 
                 # Decrement the execution count
                 self._decrementOperatorExecutionCount()
@@ -744,6 +791,43 @@ class Slot(object):
                 self._decrementOperatorExecutionCount()
                 raise
 
+        def _checkDestination(self, destination):
+            if self.slot.meta.dtype is not None and hasattr(destination, 'dtype'):
+                assert self.slot.meta.dtype == destination.dtype, \
+                    "Can't provide a destination array of the wrong dtype.  "\
+                    "Slot generates {}, but you gave {}".format( self.slot.meta.dtype, destination.dtype )
+
+        def _finishResult(self, roi, destination, destination_given, result_op):
+            """
+            Return the result of executing the given roi, copied into
+            the destination if it was given by the user.
+            """
+            # copy data from result_op to destination, if
+            # destination was actually given by the user, and the
+            # returned result_op is different from destination.
+            # (but don't copy if result_op is None, this means
+            # legacy op which wrote into destination anyway)
+            if destination_given and result_op is not None and id(result_op) != id(destination):
+                # check that the returned value is compatible with the requested roi
+                self.slot.stype.check_result_valid(roi, result_op)
+
+                self.slot.stype.copy_data(dst=destination, src = result_op)
+            elif result_op is not None:
+                # FIXME: this should be moved to a isCompatible
+                # check in stypes.py
+                if hasattr(result_op, "shape"):
+                    assert result_op.shape == destination.shape, \
+                      ("ERROR: Operator {} has failed to provide a"
+                       " result of correct shape. result shape is"
+                       " {} vs {}.  roi was {}".format(
+                           self.operator, result_op.shape,
+                           destination.shape, str(roi)))
+                destination = result_op
+
+                # check that the returned value is compatible with the requested roi
+                self.slot.stype.check_result_valid(roi, destination)
+            return destination
+
         def _incrementOperatorExecutionCount(self):
             self.started = True
             assert self.operator._executionCount >= 0, \
@@ -751,8 +835,11 @@ class Slot(object):
             # We can't execute while the operator is in the middle of
             # setupOutputs
             with self.operator._condition:
-                while self.operator._settingUp:
-                    self.operator._condition.wait()
+                if self.operator._settingUp:
+                    blockStart = time.time()
+                    while self.operator._settingUp:
+                        self.operator._condition.wait()
+                    self.blockedTime = time.time() - blockStart
                 self.operator._executionCount += 1
 
         def handleCancel(self, *args):
@@ -778,6 +865,41 @@ class Slot(object):
                         self.operator._executionCount -= 1
                         self.operator._condition.notifyAll()
 
+    class BatchExecutionWrapper(RequestExecutionWrapper):
+        """
+        Executes the operator for a list of rois at once (see :py:meth:`Slot.getBatch`).
+        The result is the list of results, in the order of the rois.
+        """
+        def __init__(self, slot, rois, destinations=None):
+            super(Slot.BatchExecutionWrapper, self).__init__(slot, rois)
+            self.destinations = destinations
+
+        def __str__(self):
+            return "{}.{}: batch of {} rois".format( self.slot.getRealOperator().name, self.slot.name, len(self.roi) )
+
+        def _execute(self, destination=None):
+            # (A list of destinations may also be given via Request.writeInto())
+            destinations = destination if destination is not None else self.destinations
+            destinations_given = destinations is not None
+
+            if destinations is None:
+                destinations = [ self.slot.stype.allocateDestination(roi) for roi in self.roi ]
+            else:
+                assert len(destinations) == len(self.roi), \
+                    "Got {} destinations for {} rois".format( len(destinations), len(self.roi) )
+                for d in destinations:
+                    self._checkDestination(d)
+
+            self._incrementOperatorExecutionCount()
+            try:
+                results_op = self.operator.executeBatch(self.slot, (), self.roi, list(destinations))
+                assert len(results_op) == len(self.roi), \
+                    "Operator {} returned {} results for {} rois".format( self.operator, len(results_op), len(self.roi) )
+                return [ self._finishResult(roi, d, destinations_given, result_op)
+                         for roi, d, result_op in zip(self.roi, destinations, results_op) ]
+            finally:
+                self._decrementOperatorExecutionCount()
+
     def setDirty(self, *args, **kwargs):
         """This method is called by a partnering OutputSlot when its
         content changes.
@@ -796,6 +918,11 @@ class Slot(object):
             else:
                 roi = args[0]
 
+            if self._coalescer is not None:
+                # Requests that are already running may produce stale data.
+                # Don't hand out their results any more.
+                self._coalescer.invalidate()
+
             for c in self.partners:
                 c.setDirty(roi)
 
@@ -1251,6 +1378,8 @@ class Slot(object):
         slot = self._getInstance(self, level=self.level - 1)
         self._subSlots.insert(position, slot)
         slot.name = self.name
+        if self._coalescer is not None:
+            slot.enableRequestCoalescing(self._coalescer.subregions)
         if self._value is not None:
             slot.setValue(self._value)
         return slot
@@ -1331,6 +1460,33 @@ class OutputSlot(Slot):
         super(OutputSlot, self).__init__(*args, **kwargs)
         self._type = "output"
 
+    def enableRequestCoalescing(self, subregions=False):
+        """Share the results of running executions of this slot among
+        callers that request the same roi at the same time, instead of
+        executing the operator once for each of them.  Useful for
+        uncached slots that are consumed by several downstream operators.
+
+        :param subregions: If True, a request for a roi that is
+          contained in the roi of a running execution is also served
+          from that execution.
+
+        See :py:class:`lazyflow.requestCoalescer.RequestCoalescer`.
+        For multi-slots, this applies to all subslots.
+
+        """
+        self._coalescer = RequestCoalescer(self, subregions)
+        for subslot in self._subSlots:
+            subslot.enableRequestCoalescing(subregions)
+
+    def disableRequestCoalescing(self):
+        """Undo enableRequestCoalescing().  Requests that are already
+        in flight are not affected.
+
+        """
+        self._coalescer = None
+        for subslot in self._subSlots:
+            subslot.disableRequestCoalescing()
+
     def execute(self, slot, subindex, roi, result):
         """For now, OutputSlots with level > 0 must pretend to be
         operators. That's why this function is here.
@@ -1338,3 +1494,10 @@ class OutputSlot(Slot):
         """
         totalIndex = (self._subSlots.index(slot),) + subindex
         return self.operator.execute(self, totalIndex, roi, result)
+
+    def executeBatch(self, slot, subindex, rois, results):
+        """Like execute(), for Slot.getBatch().
+
+        """
+        totalIndex = (self._subSlots.index(slot),) + subindex
+        return self.operator.executeBatch(self, totalIndex, rois, results)
@@ -10,3 +10,5 @@ from roiRequestBatch import RoiRequestBatch
 from bigRequestStreamer import BigRequestStreamer
 import io
 from lazyflow.utility.fastWhere import fastWhere
+from executionProfiler import ExecutionProfiler, ExecutionStats
+from quantization import quantize, dequantize, quantizationParameters
@@ -1,6 +1,6 @@
 import numpy
 from lazyflow.utility import RoiRequestBatch
-from lazyflow.roi import getIntersectingBlocks, getBlockBounds
+from lazyflow.roi import getBlockGrid
 
 import logging
 logger = logging.getLogger(__name__)
@@ -21,26 +21,18 @@ class BigRequestStreamer(object):
             batchSize=2
 
         # Align the blocking with the start of the roi
-        offsetRoi = ([0] * len(roi[0]), numpy.subtract(roi[1], roi[0]))
-        self._minBlockStarts = getIntersectingBlocks(minBlockShape, offsetRoi)
-        self._minBlockStarts += roi[0] # Un-offset
-
-        totalVolume = numpy.prod( numpy.subtract(roi[1], roi[0]) )
+        # (Compute the bounds of all blocks at once, on the offset grid.)
+        offset_data_shape = numpy.subtract(roi[1], roi[0])
+        grid = getBlockGrid( offset_data_shape, minBlockShape )
+        offset_block_starts, offset_block_stops = grid.blockBounds( grid.intersectingBlocks( [0] * len(roi[0]), offset_data_shape ) )
+        self._minBlockStarts = offset_block_starts + roi[0] # Un-offset
+        self._minBlockStops = offset_block_stops + roi[0]
+
+        totalVolume = numpy.prod( offset_data_shape )
         # For now, simply iterate over the min blocks
         # TODO: Auto-dialate block sizes based on CPU/RAM usage.
         def roiGen():
-            block_iter = self._minBlockStarts.__iter__()
-            while True:
-                block_start = block_iter.next()
-
-                # Use offset blocking
-                offset_block_start = block_start - self._bigRoi[0]
-                offset_data_shape = numpy.subtract(self._bigRoi[1], self._bigRoi[0])
-                offset_block_bounds = getBlockBounds( offset_data_shape, minBlockShape, offset_block_start )
-                
-                # Un-offset
-                block_bounds = ( offset_block_bounds[0] + self._bigRoi[0],
-                                 offset_block_bounds[1] + self._bigRoi[0] )
+            for block_bounds in zip( self._minBlockStarts, self._minBlockStops ):
                 logger.debug( "Requesting Roi: {}".format( block_bounds ) )
                 yield block_bounds
         
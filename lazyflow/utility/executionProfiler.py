@@ -0,0 +1,224 @@
+import time
+import json
+import threading
+import collections
+
+import greenlet
+
+class ExecutionStats(object):
+    """
+    Aggregated execution statistics for one (operator class, slot) pair.
+    All times are in seconds.
+    """
+    def __init__(self):
+        self.calls = 0
+        self.totalTime = 0.0
+        self.exclusiveTime = 0.0
+        self.blockedTime = 0.0
+        self.bytesProduced = 0
+
+    def __repr__(self):
+        return "ExecutionStats(calls={}, totalTime={:.6f}, exclusiveTime={:.6f}, blockedTime={:.6f}, bytesProduced={})"\
+               .format( self.calls, self.totalTime, self.exclusiveTime, self.blockedTime, self.bytesProduced )
+
+class ExecutionProfiler(object):
+    """
+    Records how much time each operator spends in execute(), per operator class and output slot.
+
+    For each (operator class, slot) pair, the profiler records:
+
+    - the number of calls
+    - the total (wall-clock) time spent in execute()
+    - the exclusive time, i.e. the total time minus the time spent waiting for other requests
+      (e.g. upstream slots) from within execute()
+    - the time spent blocked before execute() could start, because the operator was in the middle of setupOutputs()
+    - the number of bytes produced (the nbytes of each destination, summed over the rois of a batch)
+
+    Optionally, each individual execution is also recorded so the run can be exported as a
+    timeline in the Chrome trace event format (load it in chrome://tracing).
+
+    Example Usage:
+
+    >>> profiler = ExecutionProfiler()
+    >>> with profiler:
+    ...     result = op.Output[:].wait()        # doctest: +SKIP
+    >>> print profiler.report()                 # doctest: +SKIP
+    >>> profiler.exportTimeline('trace.json')   # doctest: +SKIP
+
+    When no profiler is installed, the only overhead is a single attribute check per execute() and wait() call.
+    Only one profiler can be installed at a time.
+    """
+    def __init__(self, recordTimeline=True):
+        """
+        :param recordTimeline: If True, keep a record of every execution for :py:meth:`exportTimeline()`.
+                               Otherwise, only aggregated statistics are kept.
+        """
+        self.recordTimeline = recordTimeline
+        self._lock = threading.Lock()
+        self._stats = collections.defaultdict( ExecutionStats )
+        self._events = []
+        self._startTime = time.time()
+
+        # For each greenlet, the stack of executions in progress (innermost last).
+        # Each entry is a list of [time spent waiting].
+        self._frames = {}
+        # For each greenlet, the start times of the wait() calls in progress.
+        self._waitStarts = {}
+
+    def install(self):
+        """
+        Start recording.  Replaces any previously installed instrumentation.
+        """
+        from lazyflow.slot import Slot
+        from lazyflow.request import Request
+        Slot.RequestExecutionWrapper.instrumentation = self
+        Request.wait_observer = self
+
+    def uninstall(self):
+        """
+        Stop recording.  The recorded statistics are kept.
+        """
+        from lazyflow.slot import Slot
+        from lazyflow.request import Request
+        if Slot.RequestExecutionWrapper.instrumentation is self:
+            Slot.RequestExecutionWrapper.instrumentation = None
+        if Request.wait_observer is self:
+            Request.wait_observer = None
+
+    def __enter__(self):
+        self.install()
+        return self
+
+    def __exit__(self, *args):
+        self.uninstall()
+
+    def reset(self):
+        """
+        Discard all recorded statistics.
+        """
+        with self._lock:
+            self._stats = collections.defaultdict( ExecutionStats )
+            self._events = []
+            self._startTime = time.time()
+
+    ##
+    ## Instrumentation interface (called by RequestExecutionWrapper and Request)
+    ##
+
+    def executeWrapper(self, wrapper, destination):
+        current = greenlet.getcurrent()
+        frame = [0.0]
+        self._frames.setdefault( current, [] ).append( frame )
+        start = time.time()
+        try:
+            result = wrapper._execute(destination)
+        finally:
+            stop = time.time()
+            frames = self._frames[current]
+            frames.pop()
+            if len(frames) == 0:
+                del self._frames[current]
+
+        self._record( wrapper, start, stop, frame[0], result )
+        return result
+
+    def waitStarted(self):
+        current = greenlet.getcurrent()
+        self._waitStarts.setdefault( current, [] ).append( time.time() )
+
+    def waitFinished(self):
+        current = greenlet.getcurrent()
+        starts = self._waitStarts[current]
+        elapsed = time.time() - starts.pop()
+        if len(starts) == 0:
+            del self._waitStarts[current]
+
+        # Charge the wait to the innermost execution that is running in this greenlet.
+        # (Executions that were started from within this wait have already finished.)
+        frames = self._frames.get(current)
+        if frames:
+            frames[-1][0] += elapsed
+
+    def _record(self, wrapper, start, stop, waitTime, result):
+        operator = wrapper.slot.getRealOperator()
+        key = ( type(operator).__name__, wrapper.slot.name )
+        if isinstance( result, list ):
+            # A batch execution (see Slot.getBatch()): one result per roi
+            nbytes = sum( getattr( r, 'nbytes', 0 ) for r in result )
+        else:
+            nbytes = getattr( result, 'nbytes', 0 )
+        total = stop - start
+        exclusive = max( 0.0, total - waitTime )
+        with self._lock:
+            stats = self._stats[key]
+            stats.calls += 1
+            stats.totalTime += total
+            stats.exclusiveTime += exclusive
+            stats.blockedTime += wrapper.blockedTime
+            stats.bytesProduced += nbytes
+            if self.recordTimeline:
+                self._events.append( (key, operator.name, start, stop, exclusive, wrapper.blockedTime, nbytes,
+                                      threading.current_thread().name, str(wrapper.roi)) )
+
+    ##
+    ## Results
+    ##
+
+    def stats(self):
+        """
+        Return a dict of ``{ (operator class name, slot name) : ExecutionStats }``.
+        """
+        with self._lock:
+            return dict( self._stats )
+
+    def report(self, sortBy='exclusiveTime'):
+        """
+        Return the aggregated statistics as a table (a string), sorted in descending order by the given statistic.
+        """
+        stats = self.stats()
+        keys = sorted( stats.keys(), key=lambda k: getattr(stats[k], sortBy), reverse=True )
+        header = "{:<50} {:>8} {:>12} {:>12} {:>12} {:>14}".format( "Operator.Slot", "Calls", "Total (s)", "Exclusive (s)", "Blocked (s)", "Bytes" )
+        lines = [ header, "-"*len(header) ]
+        for key in keys:
+            s = stats[key]
+            lines.append( "{:<50} {:>8} {:>12.4f} {:>12.4f} {:>12.4f} {:>14}".format(
+                            ".".join(key), s.calls, s.totalTime, s.exclusiveTime, s.blockedTime, s.bytesProduced ) )
+        return "\n".join( lines )
+
+    def timeline(self):
+        """
+        Return the recorded executions as a list of events in the Chrome trace event format.
+        """
+        with self._lock:
+            events = list( self._events )
+            startTime = self._startTime
+
+        threadIds = {}
+        trace = []
+        for key, opName, start, stop, exclusive, blocked, nbytes, threadName, roi in events:
+            tid = threadIds.setdefault( threadName, len(threadIds) )
+            trace.append( { "name" : ".".join(key),
+                            "cat" : opName,
+                            "ph" : "X",
+                            "ts" : (start - startTime) * 1e6,
+                            "dur" : (stop - start) * 1e6,
+                            "pid" : 0,
+                            "tid" : tid,
+                            "args" : { "roi" : roi,
+                                       "exclusive_us" : exclusive * 1e6,
+                                       "blocked_us" : blocked * 1e6,
+                                       "bytes" : nbytes } } )
+        for threadName, tid in threadIds.items():
+            trace.append( { "name" : "thread_name", "ph" : "M", "pid" : 0, "tid" : tid, "args" : { "name" : threadName } } )
+        return trace
+
+    def exportTimeline(self, fileOrPath):
+        """
+        Write the recorded executions as a Chrome trace (JSON) to the given file path or file-like object.
+        """
+        trace = { "traceEvents" : self.timeline() }
+        if isinstance( fileOrPath, basestring ):
+            with open( fileOrPath, 'w' ) as f:
+                json.dump( trace, f )
+        else:
+            json.dump( trace, fileOrPath )
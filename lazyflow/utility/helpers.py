@@ -109,7 +109,7 @@ def generateRandomRoi(maxShape,minShape = 0,minWidth = 0):
 
 
 class newIterator:
-    def __init__(self,roi,srcGrid,trgtGrid,timeIndex = None,channelIndex = None):
+    def __init__(self,roi,srcGrid,trgtGrid,timeIndex = None,channelIndex = None,bindIndices = ()):
         #cast list due to TinyVector being strange
         self.roi = (list(roi.start),list(roi.stop))
         self.srcGrid = srcGrid
@@ -119,6 +119,9 @@ class newIterator:
             self.hardBind = [timeIndex]
         else:
             self.hardBind = []
+        #further axes that are bound like the time axis (e.g. z, when filtering slice by slice)
+        #sorted backwards, so that they can be popped one after the other
+        self.hardBind = sorted(self.hardBind + list(bindIndices), reverse=True)
             
 
     def nextStop(self,start,grid,roi):
@@ -0,0 +1,64 @@
+import numpy
+
+# The largest finite float16 value.  Larger values are clipped instead of becoming inf.
+FLOAT16_MAX = float(numpy.finfo(numpy.float16).max)
+
+def quantizationParameters(ranges, dtype):
+    """
+    Return the per-channel (scale, offset) for storing values from the given
+    ranges (a list of (low, high), one for each channel) as the given unsigned integer dtype,
+    such that value ~= quantized * scale + offset.
+    Within its range, the error of each value is at most scale/2.
+    """
+    levels = numpy.iinfo(dtype).max
+    scale = []
+    offset = []
+    for low, high in ranges:
+        low, high = float(low), float(high)
+        assert high >= low, "Bad range: {}".format( (low, high) )
+        if high == low:
+            # Constant channel: any scale will do
+            scale.append( 1.0 )
+        else:
+            scale.append( (high - low) / levels )
+        offset.append( low )
+    return tuple(scale), tuple(offset)
+
+def _channelShaped(values, ndim, channelAxis):
+    shape = [1]*ndim
+    shape[channelAxis] = len(values)
+    return numpy.array(values, dtype=numpy.float32).reshape(shape)
+
+def quantize(data, out, scale=None, offset=None, channelAxis=-1):
+    """
+    Store the float data in out, which has a reduced precision dtype:
+    float16 (scale and offset are None) or an unsigned integer type,
+    with the per-channel scale and offset from quantizationParameters().
+    Values outside the representable range are clipped.
+    Note: data is used as a scratch buffer.
+    """
+    if scale is None:
+        assert out.dtype == numpy.float16
+        numpy.clip( data, -FLOAT16_MAX, FLOAT16_MAX, out=data )
+        out[...] = data
+        return out
+
+    data -= _channelShaped( offset, data.ndim, channelAxis )
+    data /= _channelShaped( scale, data.ndim, channelAxis )
+    numpy.rint( data, out=data )
+    numpy.clip( data, 0, numpy.iinfo(out.dtype).max, out=data )
+    out[...] = data
+    return out
+
+def dequantize(data, scale=None, offset=None, channelAxis=-1, out=None):
+    """
+    The inverse of quantize(): return the data as float32.
+    If scale and offset are None, the data is only converted (e.g. from float16).
+    """
+    if out is None:
+        out = numpy.ndarray( data.shape, dtype=numpy.float32 )
+    out[...] = data
+    if scale is not None:
+        out *= _channelShaped( scale, data.ndim, channelAxis )
+        out += _channelShaped( offset, data.ndim, channelAxis )
+    return out
@@ -0,0 +1,185 @@
+import time
+import json
+import threading
+import StringIO
+import numpy
+
+from lazyflow.operators.arrayCacheMemoryMgr import ArrayCacheMemoryMgr, LRUPolicy, LFUPolicy, CostAwarePolicy
+from lazyflow.operators.opCache import CacheStatistics, coalesceDirtyBlocks
+
+class FakeCache(object):
+    """
+    Implements the part of the cache interface that the memory manager uses.
+    """
+    def __init__(self, mgr):
+        self.mgr = mgr
+        self.blocks = {}
+        self.busyBlocks = set()
+
+    def add(self, key, nbytes, cost=0.0):
+        self.mgr.register(self, key, nbytes, cost)
+        self.blocks[key] = nbytes
+
+    def _evictBlock(self, key):
+        if key in self.busyBlocks:
+            return 0
+        return self.blocks.pop(key, 0)
+
+class TestArrayCacheMemoryMgr(object):
+
+    def testBudget(self):
+        mgr = ArrayCacheMemoryMgr( memoryBudget=250 )
+        cache = FakeCache(mgr)
+        cache.add('a', 100)
+        cache.add('b', 100)
+        assert mgr.usedBytes() == 200
+        
+        # Adding a third block exceeds the budget: the least recently used block is evicted.
+        cache.add('c', 100)
+        assert sorted(cache.blocks.keys()) == ['b', 'c']
+        assert mgr.usedBytes() == 200
+
+        # Lowering the budget evicts blocks immediately.
+        mgr.setMemoryBudget(150)
+        assert cache.blocks.keys() == ['c']
+        assert mgr.usedBytes() == 100
+
+        mgr.unregister(cache, 'c')
+        assert mgr.usedBytes() == 0
+
+    def testLRU(self):
+        mgr = ArrayCacheMemoryMgr( memoryBudget=300, policy=LRUPolicy() )
+        cache = FakeCache(mgr)
+        for key in 'abc':
+            cache.add(key, 100)
+            time.sleep(0.01)
+        mgr.touch(cache, 'a')
+        cache.add('d', 100)
+        assert sorted(cache.blocks.keys()) == ['a', 'c', 'd']
+
+    def testLFU(self):
+        mgr = ArrayCacheMemoryMgr( memoryBudget=300, policy=LFUPolicy() )
+        cache = FakeCache(mgr)
+        for key in 'abc':
+            cache.add(key, 100)
+        for _ in range(3):
+            mgr.touch(cache, 'a')
+            mgr.touch(cache, 'c')
+        cache.add('d', 100)
+        assert sorted(cache.blocks.keys()) == ['a', 'c', 'd']
+
+    def testCostAware(self):
+        mgr = ArrayCacheMemoryMgr( memoryBudget=300, policy=CostAwarePolicy() )
+        cache = FakeCache(mgr)
+        cache.add('expensive', 100, cost=10.0)
+        cache.add('cheap', 100, cost=0.1)
+        cache.add('big_and_slow', 200, cost=10.0) # exceeds the budget: one block must go
+        assert sorted(cache.blocks.keys()) == ['big_and_slow', 'expensive']
+
+    def testBusyBlocksAreSkipped(self):
+        mgr = ArrayCacheMemoryMgr( memoryBudget=200 )
+        cache = FakeCache(mgr)
+        cache.add('a', 100)
+        cache.add('b', 100)
+        cache.busyBlocks.add('a')
+        cache.add('c', 100)
+        assert sorted(cache.blocks.keys()) == ['a', 'c']
+
+    def testRegisterAgain(self):
+        mgr = ArrayCacheMemoryMgr( memoryBudget=300, policy=LRUPolicy() )
+        cache = FakeCache(mgr)
+        cache.add('a', 100)
+        cache.add('b', 100)
+        cache.add('a', 150) # (now the most recently used)
+        assert mgr.usedBytes() == 250
+        cache.add('c', 100)
+        assert sorted(cache.blocks.keys()) == ['a', 'c']
+        assert mgr.usedBytes() == 250
+
+    def testConcurrentRegistrations(self):
+        mgr = ArrayCacheMemoryMgr( memoryBudget=1000 )
+        cache = FakeCache(mgr)
+        peak = [0]
+        def addBlocks(prefix):
+            for i in range(200):
+                cache.add( (prefix, i), 100 )
+                peak[0] = max( peak[0], mgr.usedBytes() )
+        threads = [ threading.Thread( target=addBlocks, args=(t,) ) for t in range(4) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert peak[0] <= 1000, peak[0]
+        assert mgr.usedBytes() <= 1000
+
+    def testMultipleCaches(self):
+        mgr = ArrayCacheMemoryMgr( memoryBudget=200 )
+        cache1 = FakeCache(mgr)
+        cache2 = FakeCache(mgr)
+        cache1.add('a', 100)
+        cache2.add('a', 100)
+        cache2.add('b', 100)
+        assert cache1.blocks.keys() == []
+        assert sorted(cache2.blocks.keys()) == ['a', 'b']
+
+        mgr.unregisterAll(cache2)
+        assert mgr.usedBytes() == 0
+
+    def testStatisticsExport(self):
+        mgr = ArrayCacheMemoryMgr()
+        cache = FakeCache(mgr)
+        cache.name = "FakeCache"
+        cache.usedMemory = lambda: 100
+        cache.statistics = lambda: stats
+        stats = CacheStatistics()
+        stats.recordAccess(1, 1, 100)
+        stats.recordAccess(0, 1, 100)
+        stats.recordFill(100, 0.5)
+        mgr.addNamedCache(cache)
+        cache.add('a', 100)
+
+        f = StringIO.StringIO()
+        mgr.exportStatistics(f)
+        mgr.exportStatistics(f)
+        lines = f.getvalue().splitlines()
+        assert len(lines) == 2
+        snapshot = json.loads(lines[0])
+        assert snapshot['tiers']['memory']['usedBytes'] == 100
+        cacheStats = snapshot['caches'][0]['statistics']
+        assert cacheStats['hits'] == 1
+        assert cacheStats['misses'] == 1
+        assert cacheStats['bytesComputed'] == 100
+        assert cacheStats['fillLatencyMean'] == 0.5
+
+class TestCoalesceDirtyBlocks(object):
+
+    def testNothingDirty(self):
+        assert coalesceDirtyBlocks( numpy.zeros( (3,3), dtype=bool ), (10,10), (25,25) ) == []
+
+    def testRegions(self):
+        dirtyBlocks = numpy.zeros( (3,3), dtype=bool )
+        dirtyBlocks[0,0] = True
+        dirtyBlocks[2,1:3] = True
+
+        # The rois cover exactly the dirty blocks (clipped to the shape)
+        rois = coalesceDirtyBlocks( dirtyBlocks, (10,10), (25,25) )
+        assert 2 <= len(rois) <= 3
+        covered = numpy.zeros( (25,25), dtype=int )
+        for start, stop in rois:
+            covered[start[0]:stop[0], start[1]:stop[1]] += 1
+        expected = numpy.zeros( (25,25), dtype=int )
+        expected[0:10, 0:10] = 1
+        expected[20:25, 10:25] = 1
+        assert (covered == expected).all()
+
+        # Too many regions: the bounding box is used
+        rois = coalesceDirtyBlocks( dirtyBlocks, (10,10), (25,25), maxRois=1 )
+        assert rois == [ ([0,0], [25,25]) ], rois
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    ret = nose.run(defaultTest=__file__)
+    if not ret: sys.exit(1)
@@ -0,0 +1,127 @@
+import threading
+
+import numpy
+
+from lazyflow.graph import Graph, Operator, InputSlot, OutputSlot, OperatorWrapper
+from lazyflow.operators import OpArrayPiper
+
+class OpCountingCopy(Operator):
+    """
+    Copies its input and counts how often execute() is called.
+    """
+    Input = InputSlot()
+    Output = OutputSlot()
+
+    def __init__(self, *args, **kwargs):
+        super(OpCountingCopy, self).__init__(*args, **kwargs)
+        self.executionCount = 0
+        self._countLock = threading.Lock()
+
+    def setupOutputs(self):
+        self.Output.meta.assignFrom(self.Input.meta)
+
+    def execute(self, slot, subindex, roi, result):
+        with self._countLock:
+            self.executionCount += 1
+        result[:] = self.Input(roi.start, roi.stop).wait()
+        return result
+
+    def propagateDirty(self, slot, subindex, roi):
+        self.Output.setDirty(roi)
+
+class OpVectorizedCopy(OpCountingCopy):
+    """
+    Handles a whole batch of rois with a single upstream request.
+    """
+    def __init__(self, *args, **kwargs):
+        super(OpVectorizedCopy, self).__init__(*args, **kwargs)
+        self.batchCount = 0
+
+    def executeBatch(self, slot, subindex, rois, results):
+        self.batchCount += 1
+        data = self.Input[:].wait()
+        for roi, result in zip(rois, results):
+            result[:] = data[roi.toSlice()]
+        return results
+
+class TestBatchRequests(object):
+
+    def setUp(self):
+        self.data = numpy.random.randint(0, 100, (100,20)).astype(numpy.uint8)
+        self.rois = [ ((i,0), (i+1,20)) for i in range(100) ] + [ ((10,5), (50,15)) ]
+
+    def _check(self, results):
+        assert len(results) == len(self.rois)
+        for (start, stop), result in zip(self.rois, results):
+            assert (result == self.data[start[0]:stop[0], start[1]:stop[1]]).all()
+
+    def testFallback(self):
+        """
+        Operators without executeBatch() execute each roi, without one request per roi.
+        """
+        op = OpCountingCopy( graph=Graph() )
+        op.Input.setValue(self.data)
+        self._check( op.Output.getBatch(self.rois).wait() )
+        assert op.executionCount == len(self.rois)
+
+    def testExecuteBatch(self):
+        """
+        Operators with executeBatch() get all rois in one call.
+        """
+        op = OpVectorizedCopy( graph=Graph() )
+        op.Input.setValue(self.data)
+        self._check( op.Output.getBatch(self.rois).wait() )
+        assert op.batchCount == 1
+        assert op.executionCount == 0
+
+    def testDestinations(self):
+        """
+        The results are scattered into the given destinations.
+        """
+        for opType in [OpCountingCopy, OpVectorizedCopy]:
+            op = opType( graph=Graph() )
+            op.Input.setValue(self.data)
+            destinations = [ numpy.zeros( numpy.subtract(stop, start), dtype=numpy.uint8 ) for start, stop in self.rois ]
+            results = op.Output.getBatch(self.rois, destinations).wait()
+            self._check( destinations )
+            assert all( r is d for r, d in zip(results, destinations) )
+
+    def testInputSlots(self):
+        """
+        Batches are relayed through input slots (and served directly from slot values).
+        """
+        graph = Graph()
+        opSource = OpArrayPiper( graph=graph )
+        opSource.Input.setValue(self.data)
+        self._check( opSource.Input.getBatch(self.rois).wait() )
+
+        op = OpVectorizedCopy( graph=graph )
+        op.Input.connect( opSource.Output )
+        self._check( op.Input.getBatch(self.rois).wait() )
+
+        opDownstream = OpArrayPiper( graph=graph )
+        opDownstream.Input.connect( op.Output )
+        self._check( opDownstream.Input.getBatch(self.rois).wait() )
+        assert op.batchCount == 1
+
+    def testMultiSlot(self):
+        """
+        Batches can be requested from the subslots of a multi-slot.
+        """
+        graph = Graph()
+        op = OperatorWrapper( OpVectorizedCopy, graph=graph )
+        op.Input.resize(2)
+        op.Input[0].setValue(self.data)
+        op.Input[1].setValue(self.data + 1)
+        self._check( op.Output[0].getBatch(self.rois).wait() )
+        results = op.Output[1].getBatch(self.rois).wait()
+        assert (results[0] == self.data[0:1] + 1).all()
+        assert op.innerOperators[1].batchCount == 1
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    ret = nose.run(defaultTest=__file__)
+    if not ret: sys.exit(1)
@@ -0,0 +1,75 @@
+import numpy
+import h5py
+
+from lazyflow.operators.compressedBlockStore import availableCodecs, getCodec, CompressedBlock, Hdf5Block
+
+class TestCodecs(object):
+
+    def testRoundTrip(self):
+        data = numpy.indices( (20,30,40) ).sum(0).astype( numpy.uint16 )
+        for name in availableCodecs():
+            codec = getCodec( name )
+            compressed = codec.compress( data )
+            decompressed = codec.decompress( compressed, data.dtype, data.shape )
+            assert decompressed.dtype == data.dtype
+            assert (decompressed == data).all(), "Codec {} doesn't reproduce its input".format( name )
+
+    def testIncompressible(self):
+        data = numpy.random.randint( 0, 255, size=(1000,) ).astype( numpy.uint8 )
+        for name in availableCodecs():
+            codec = getCodec( name )
+            decompressed = codec.decompress( codec.compress(data), data.dtype, data.shape )
+            assert (decompressed == data).all(), "Codec {} doesn't reproduce its input".format( name )
+
+    def testFallback(self):
+        # Optional codecs fall back to zlib
+        assert getCodec( 'blosc' ).name in availableCodecs()
+        assert getCodec( 'lzf' ).name in availableCodecs()
+
+class TestCompressedBlock(object):
+
+    def _createBlocks(self, shape, dtype):
+        mem_file_name = 'testCompressedBlock' + str(id(self))
+        return [ CompressedBlock( shape, dtype, getCodec('zlib') ),
+                 Hdf5Block( mem_file_name, shape, dtype, shape ) ]
+
+    def testReadWrite(self):
+        data = numpy.indices( (20,30) ).sum(0).astype( numpy.float32 )
+        for block in self._createBlocks( data.shape, data.dtype ):
+            # Empty blocks are zero
+            assert (block.read() == 0).all()
+
+            block.write( Ellipsis, data )
+            assert (block.read() == data).all()
+            assert (block.read( numpy.s_[5:10, 3:4] ) == data[5:10, 3:4]).all()
+
+            block.write( numpy.s_[0:5, 0:5], 7 )
+            data_copy = data.copy()
+            data_copy[0:5, 0:5] = 7
+            assert (block.read() == data_copy).all()
+
+            assert block.storageSize() > 0
+            assert block.compressionRatio() > 1.0
+            block.close()
+
+    def testHdf5Adapter(self):
+        data = numpy.indices( (20,30) ).sum(0).astype( numpy.float32 )
+        mem_file = h5py.File( 'testHdf5Adapter', driver='core', backing_store=False, mode='w' )
+
+        block = CompressedBlock( data.shape, data.dtype, getCodec('zlib') )
+        block.write( Ellipsis, data )
+        block.copyToHdf5( mem_file, 'exported' )
+        assert (mem_file['exported'][...] == data).all()
+
+        block2 = CompressedBlock( data.shape, data.dtype, getCodec('zlib') )
+        block2.copyFromHdf5( mem_file['exported'] )
+        assert (block2.read() == data).all()
+        mem_file.close()
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    ret = nose.run(defaultTest=__file__)
+    if not ret: sys.exit(1)
@@ -0,0 +1,77 @@
+import numpy
+import vigra
+from numpy.testing import assert_array_almost_equal
+
+from lazyflow.graph import Graph
+from lazyflow.operators import OpPixelFeaturesPresmoothed
+from lazyflow.operators import imgFilterOperators
+
+class TestComputeIn2d(object):
+    """
+    In 2D mode, the features of each z-slice must be the same as the features of that slice on its own.
+    """
+
+    def setUp(self):
+        self.scales = [0.3, 1.0, 3.5]
+        self.featureIds = OpPixelFeaturesPresmoothed.DefaultFeatureIds
+        self.matrix = numpy.ones( (len(self.featureIds), len(self.scales)), dtype=bool )
+        data = numpy.random.random( (40,30,5,1) ).astype(numpy.float32)
+        self.data = vigra.taggedView( data, 'xyzc' )
+
+    def _makeOp(self, data, computeIn2d):
+        op = OpPixelFeaturesPresmoothed(graph=Graph())
+        op.Input.setValue(data)
+        op.Scales.setValue(self.scales)
+        op.FeatureIds.setValue(self.featureIds)
+        op.Matrix.setValue(self.matrix)
+        op.ComputeIn2d.setValue(computeIn2d)
+        return op
+
+    def testFeaturesOfSlices(self):
+        op = self._makeOp(self.data, True)
+        for z in range(self.data.shape[2]):
+            opSlice = self._makeOp(self.data[:,:,z,:], False)
+            assert op.Output.meta.shape[-1] == opSlice.Output.meta.shape[-1]
+            expected = opSlice.Output[:].wait()
+            assert_array_almost_equal( op.Output[:, :, z:z+1, :].wait()[:,:,0,:], expected, 4 )
+            assert_array_almost_equal( op.Output[5:20, 10:30, z:z+1, 3:11].wait()[:,:,0,:],
+                                       expected[5:20, 10:30, 3:11], 4 )
+
+        # Several slices at once
+        features = op.Output[:, :, 1:4, :].wait()
+        for z in range(1,4):
+            assert_array_almost_equal( features[:,:,z-1,:], op.Output[:, :, z:z+1, :].wait()[:,:,0,:], 4 )
+
+    def testHaloBlocks(self):
+        op = self._makeOp(self.data, True)
+        op.HaloEfficiency.setValue(0.5)
+        assert op._haloBlockShape[2] == 1
+        opDirect = self._makeOp(self.data, True)
+        assert_array_almost_equal( op.Output[3:17, :, 1:3, :].wait(), opDirect.Output[3:17, :, 1:3, :].wait(), 4 )
+
+    def testFilterOperators(self):
+        opSmoothing = imgFilterOperators.OpGaussianSmoothing(graph=Graph())
+        opSmoothing.Input.setValue(self.data)
+        opSmoothing.Sigma.setValue((2.0, 1.0))
+        opSmoothing.ComputeIn2d.setValue(True)
+        smoothed = opSmoothing.Output[:].wait()
+
+        opHessian = imgFilterOperators.OpHessianOfGaussianEigenvalues(graph=Graph())
+        opHessian.Input.setValue(self.data)
+        opHessian.Sigma.setValue(1.5)
+        opHessian.ComputeIn2d.setValue(True)
+        assert opHessian.Output.meta.shape == (40,30,5,2)
+        eigenvalues = opHessian.Output[:].wait()
+
+        for z in range(self.data.shape[2]):
+            image = self.data[:,:,z,:]
+            assert_array_almost_equal( smoothed[:,:,z,:], vigra.filters.gaussianSmoothing(image, (2.0, 1.0), window_size=4), 4 )
+            assert_array_almost_equal( eigenvalues[:,:,z,:], vigra.filters.hessianOfGaussianEigenvalues(image, 1.5, window_size=4), 4 )
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    ret = nose.run(defaultTest=__file__)
+    if not ret: sys.exit(1)
@@ -0,0 +1,88 @@
+import os
+import numpy
+
+from lazyflow.operators.diskCacheTier import DiskCacheTier
+
+class FakeCache(object):
+    pass
+
+class TestDiskCacheTier(object):
+
+    def setUp(self):
+        self.tier = DiskCacheTier()
+
+    def tearDown(self):
+        self.tier.close()
+
+    def testStoreAndLoad(self):
+        tier = self.tier
+        cache = FakeCache()
+        data = numpy.random.random((10,20)).astype(numpy.float32)
+        assert tier.store(cache, (0,1), data)
+        assert len(os.listdir(tier.directory)) == 1
+
+        loaded = tier.load(cache, (0,1))
+        assert loaded.dtype == data.dtype
+        assert (loaded == data).all()
+
+        # Blocks of other caches are separate
+        assert tier.load(FakeCache(), (0,1)) is None
+        assert tier.load(cache, (1,1)) is None
+
+        stats = tier.stats()
+        assert stats['hits'] == 1
+        assert stats['misses'] == 2
+        assert stats['stores'] == 1
+        assert stats['usedBytes'] == tier.usedBytes() > 0
+
+    def testDiscard(self):
+        tier = self.tier
+        cache = FakeCache()
+        data = numpy.zeros((10,10), dtype=numpy.uint8)
+        for index in [ (0,0), (0,1), (1,0), (1,1) ]:
+            tier.store(cache, index, data)
+
+        # Discard the right column of blocks
+        tier.discard(cache, (0,1), (2,2))
+        assert tier.load(cache, (0,0)) is not None
+        assert tier.load(cache, (1,0)) is not None
+        assert tier.load(cache, (0,1)) is None
+        assert tier.load(cache, (1,1)) is None
+
+        tier.discardAll(cache)
+        assert tier.usedBytes() == 0
+        assert os.listdir(tier.directory) == []
+
+    def testDiskBudget(self):
+        cache = FakeCache()
+        blocks = [ numpy.random.randint(0, 255, size=(1000,)).astype(numpy.uint8) for i in range(3) ]
+        self.tier.store(cache, (0,), blocks[0])
+        blockSize = self.tier.usedBytes()
+        self.tier.close()
+
+        # Room for two (incompressible) blocks
+        self.tier = tier = DiskCacheTier( diskBudget=2*blockSize+10 )
+        for i, block in enumerate(blocks[:2]):
+            tier.store(cache, (i,), block)
+
+        # The least recently used block is deleted to make room
+        tier.load(cache, (0,))
+        tier.store(cache, (2,), blocks[2])
+        assert tier.stats()['evictions'] == 1
+        assert tier.load(cache, (1,)) is None
+        assert (tier.load(cache, (0,)) == blocks[0]).all()
+        assert (tier.load(cache, (2,)) == blocks[2]).all()
+        assert tier.usedBytes() <= tier.diskBudget
+
+    def testObjectDtype(self):
+        data = numpy.ndarray((2,2), dtype=object)
+        assert not self.tier.store(FakeCache(), (0,0), data)
+        assert self.tier.usedBytes() == 0
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    ret = nose.run(defaultTest=__file__)
+    if not ret: sys.exit(1)
@@ -0,0 +1,113 @@
+import json
+import time
+import StringIO
+
+import numpy
+
+from lazyflow.graph import Graph, Operator, InputSlot, OutputSlot
+from lazyflow.slot import Slot
+from lazyflow.request import Request
+from lazyflow.utility import ExecutionProfiler
+
+class OpSlowCopy(Operator):
+    """
+    Copies its input, but takes (at least) Delay seconds for each execution.
+    """
+    Input = InputSlot()
+    Output = OutputSlot()
+
+    Delay = 0.05
+
+    def setupOutputs(self):
+        self.Output.meta.assignFrom(self.Input.meta)
+
+    def execute(self, slot, subindex, roi, result):
+        result[:] = self.Input(roi.start, roi.stop).wait()
+        time.sleep(self.Delay)
+        return result
+
+    def propagateDirty(self, slot, subindex, roi):
+        self.Output.setDirty(roi)
+
+class TestExecutionProfiler(object):
+
+    def setUp(self):
+        self.data = numpy.random.randint(0, 100, (10,20)).astype(numpy.uint8)
+        graph = Graph()
+        self.op1 = OpSlowCopy(graph=graph)
+        self.op1.Input.setValue(self.data)
+        self.op2 = OpSlowCopy(graph=graph)
+        self.op2.Input.connect(self.op1.Output)
+
+    def tearDown(self):
+        assert Slot.RequestExecutionWrapper.instrumentation is None
+        assert Request.wait_observer is None
+
+    def testStats(self):
+        with ExecutionProfiler() as profiler:
+            result = self.op2.Output[:].wait()
+            result = self.op2.Output[2:5].wait()
+        assert (result == self.data[2:5]).all()
+
+        stats = profiler.stats()
+        s = stats[('OpSlowCopy', 'Output')]
+        assert s.calls == 4, s
+        # Both operators produced both rois
+        assert s.bytesProduced == 2*(self.data.nbytes + self.data[2:5].nbytes), s
+        assert s.totalTime >= 4*OpSlowCopy.Delay, s
+
+        # The downstream operator's total time includes the time it waited for the upstream operator,
+        # but its exclusive time does not.
+        assert s.exclusiveTime < s.totalTime, s
+        assert s.exclusiveTime >= 4*OpSlowCopy.Delay, s
+
+        report = profiler.report()
+        assert 'OpSlowCopy.Output' in report
+
+    def testBatch(self):
+        rois = [ ((0,0), (2,20)), ((5,0), (8,20)) ]
+        with ExecutionProfiler() as profiler:
+            results = self.op1.Output.getBatch(rois).wait()
+        assert (results[1] == self.data[5:8]).all()
+
+        s = profiler.stats()[('OpSlowCopy', 'Output')]
+        assert s.calls == 1, s
+        assert s.bytesProduced == self.data[0:2].nbytes + self.data[5:8].nbytes, s
+
+    def testUninstalled(self):
+        profiler = ExecutionProfiler()
+        self.op2.Output[:].wait()
+        assert len(profiler.stats()) == 0
+
+        with profiler:
+            self.op2.Output[:].wait()
+        assert profiler.stats()[('OpSlowCopy', 'Output')].calls == 2
+
+        profiler.reset()
+        assert len(profiler.stats()) == 0
+
+    def testTimeline(self):
+        with ExecutionProfiler() as profiler:
+            reqs = [ self.op2.Output[i:i+1] for i in range(4) ]
+            for req in reqs:
+                req.submit()
+            for req in reqs:
+                req.wait()
+
+        f = StringIO.StringIO()
+        profiler.exportTimeline(f)
+        trace = json.loads( f.getvalue() )
+        events = filter( lambda e: e['ph'] == 'X', trace['traceEvents'] )
+        assert len(events) == 8
+        for e in events:
+            assert e['name'] == 'OpSlowCopy.Output'
+            assert e['dur'] >= OpSlowCopy.Delay * 1e6
+            assert e['args']['bytes'] == self.data[0:1].nbytes
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    ret = nose.run(defaultTest=__file__)
+    if not ret: sys.exit(1)
@@ -0,0 +1,132 @@
+import threading
+import numpy
+import vigra
+from numpy.testing import assert_array_almost_equal
+
+from lazyflow.graph import Graph
+from lazyflow.request import Request
+from lazyflow.rtype import SubRegion
+from lazyflow.operators import OpPixelFeaturesPresmoothed
+from lazyflow.operators.arrayCacheMemoryMgr import ArrayCacheMemoryMgr
+
+class TestHaloBlocks(object):
+    """
+    In the halo block mode, OpPixelFeaturesPresmoothed must compute the same features as usual,
+    but read and smooth fewer voxels for small tiles.
+    """
+
+    def setUp(self):
+        self.scales = [0.3, 1.0, 3.5]
+        self.featureIds = OpPixelFeaturesPresmoothed.DefaultFeatureIds
+        self.matrix = numpy.ones( (len(self.featureIds), len(self.scales)), dtype=bool )
+        data = numpy.random.random( (100,100,1) ).astype(numpy.float32)
+        self.data = vigra.taggedView( data, 'xyc' )
+
+    def _makeOp(self, efficiency):
+        op = OpPixelFeaturesPresmoothed(graph=Graph())
+        op.Input.setValue(self.data)
+        op.Scales.setValue(self.scales)
+        op.FeatureIds.setValue(self.featureIds)
+        op.Matrix.setValue(self.matrix)
+        op.HaloEfficiency.setValue(efficiency)
+        return op
+
+    def _tiles(self, size):
+        for x in range(0, 100, size):
+            for y in range(0, 100, size):
+                yield numpy.s_[x:x+size, y:y+size, :]
+
+    def testSameFeatures(self):
+        opDirect = self._makeOp(0.0)
+        opBlocks = self._makeOp(0.5)
+        assert opDirect._haloBlockShape is None
+        assert opBlocks._haloBlockShape is not None
+
+        for slicing in [slice(None), numpy.s_[5:20, 90:100, 3:17]] + list(self._tiles(10)):
+            assert_array_almost_equal( opDirect.Output[slicing].wait(), opBlocks.Output[slicing].wait(), 4 )
+        assert_array_almost_equal( opDirect.Features[4][7:13, 20:40, :].wait(),
+                                   opBlocks.Features[4][7:13, 20:40, :].wait(), 4 )
+
+    def testStatistics(self):
+        opDirect = self._makeOp(0.0)
+        opBlocks = self._makeOp(0.5)
+        for op in [opDirect, opBlocks]:
+            for slicing in self._tiles(10):
+                op.Output[slicing].wait()
+
+        direct = opDirect.haloStatistics()
+        blocks = opBlocks.haloStatistics()
+        assert direct['useful'] == blocks['useful'] == 100*100
+        assert direct['ratio'] < blocks['ratio']
+
+        # Requesting the same tiles again is served from the cached blocks
+        for slicing in self._tiles(10):
+            opBlocks.Output[slicing].wait()
+        assert opBlocks.haloStatistics()['computed'] == blocks['computed']
+
+        opBlocks.resetHaloStatistics()
+        assert opBlocks.haloStatistics() == { 'useful' : 0, 'computed' : 0, 'ratio' : None }
+
+    def testDirtyInput(self):
+        op = self._makeOp(0.5)
+        before = op.Output[10:20, 10:20, :].wait()
+
+        op.Input.setValue( numpy.zeros_like(self.data) )
+        after = op.Output[10:20, 10:20, :].wait()
+        assert (before != 0).any()
+        assert_array_almost_equal( after, 0, 4 )
+
+    def testCancelledTile(self):
+        # A block must not be lost with a cancelled tile that started computing it
+        op = self._makeOp(0.5)
+        slicing = numpy.s_[10:20, 10:20, :]
+        started = threading.Event()
+        proceed = threading.Event()
+        def cancelledTile():
+            started.set()
+            proceed.wait()
+            # (The tile is cancelled while its execute() is already running.)
+            result = numpy.ndarray( (10, 10, op.Output.meta.shape[-1]), dtype=numpy.float32 )
+            op.execute( op.Output, (), SubRegion(op.Output, pslice=slicing), result )
+
+        req = Request(cancelledTile)
+        req.submit()
+        started.wait()
+        req.cancel()
+        proceed.set()
+        req.finished_event.wait()
+        assert req.cancelled
+
+        expected = self._makeOp(0.0).Output[slicing].wait()
+        assert_array_almost_equal( op.Output[slicing].wait(), expected, 4 )
+        assert len(op._haloRequests) == 0
+
+    def testMemoryManager(self):
+        mgr = ArrayCacheMemoryMgr.instance
+        usedBytes = mgr.usedBytes()
+        op = self._makeOp(0.5)
+        expected = op.Output[0:30, 0:30, :].wait()
+        assert op._haloBlockBytes > 0
+        assert mgr.usedBytes() == usedBytes + op._haloBlockBytes
+
+        # The memory manager can evict the blocks
+        oldBudget = mgr.memoryBudget()
+        try:
+            mgr.setMemoryBudget(0)
+            assert op._haloBlockBytes == 0
+        finally:
+            mgr.setMemoryBudget(oldBudget)
+        assert_array_almost_equal( op.Output[0:30, 0:30, :].wait(), expected, 4 )
+
+        # Invalid blocks are unregistered
+        usedBytes = mgr.usedBytes() - op._haloBlockBytes
+        op.Input.setValue( numpy.zeros_like(self.data) )
+        assert mgr.usedBytes() == usedBytes
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    ret = nose.run(defaultTest=__file__)
+    if not ret: sys.exit(1)
@@ -1,9 +1,12 @@
+import time
 import threading
 import numpy
 import vigra
 from lazyflow.graph import Graph
 from lazyflow.roi import sliceToRoi, roiToSlice
 from lazyflow.operators import OpArrayPiper, OpArrayCache
+from lazyflow.operators.arrayCacheMemoryMgr import ArrayCacheMemoryMgr, MemInfoNode, LRUPolicy
+from lazyflow.operators.diskCacheTier import DiskCacheTier
 
 class KeyMaker():
     def __getitem__(self, *args):
@@ -208,6 +211,36 @@ class TestOpArrayCache(object):
         assert (data == self.data[slicing]).all()
         assert opProvider.accessCount == expectedAccessCount
 
+    def testStatistics(self):
+        opCache = self.opCache
+        opProvider = self.opProvider
+        stats = opCache.statistics()
+        blockBytes = 1000 * self.data.dtype.itemsize
+
+        slicing = make_key[0:1, 0:10, 10:20, 0:10, 0:1]
+        opCache.Output( slicing ).wait() # miss
+        opCache.Output( slicing ).wait() # hit
+        opCache.Output( make_key[0:1, 0:20, 10:20, 0:10, 0:1] ).wait() # partial hit
+        assert (stats.hits, stats.partialHits, stats.misses) == (1, 1, 1)
+        assert stats.bytesServed == 4*blockBytes
+        assert stats.bytesComputed == 2*blockBytes
+        assert len(stats.fillLatencies) == 2
+
+        # Only clean blocks count as invalidated
+        opProvider.Input.setDirty( make_key[0:1, 0:20, 0:20, 0:10, 0:1] )
+        assert stats.dirtyInvalidations == 2
+
+        report = MemInfoNode()
+        opCache.generateReport(report)
+        assert report.statistics['misses'] == 1
+        assert report.statistics['bytesComputed'] == 2*blockBytes
+
+        opCache._freeMemory()
+        assert stats.evictions > 0
+
+        opCache.resetStatistics()
+        assert stats.snapshot()['hits'] == 0
+
     def testUncachedBehaviour(self):
         opCache = self.opCache
         opProvider = self.opProvider        
@@ -234,6 +267,176 @@ class TestOpArrayCache(object):
         assert len(gotDirtyKeys) == 1, \
             "Expected 1 dirty notification, got {}".format( len(gotDirtyKeys) )
 
+    def testCoalescedDirtyRegions(self):
+        opCache = self.opCache
+        opProvider = self.opProvider
+        opCache.Output( make_key[:,:,:,:,:] ).wait()
+
+        gotDirtyKeys = []
+        def handleDirty(slot, roi):
+            gotDirtyKeys.append( list(roiToSlice(roi.start, roi.stop)) )
+        opCache.Output.notifyDirty(handleDirty)
+
+        # Two small changes at opposite corners while the cache is fixed
+        opCache.fixAtCurrent.setValue(True)
+        opProvider.Input.setDirty( make_key[0:1, 0:1, 0:1, 0:1, 0:1] )
+        opProvider.Input.setDirty( make_key[0:1, 99:100, 99:100, 9:10, 0:1] )
+        assert len(gotDirtyKeys) == 0
+
+        # When the cache becomes unfixed, only the blocks around the changes are dirty, not everything in between
+        opCache.fixAtCurrent.setValue(False)
+        assert sorted(gotDirtyKeys) == sorted( [ make_key[0:1, 0:10, 0:10, 0:10, 0:1], make_key[0:1, 90:100, 90:100, 0:10, 0:1] ] ), gotDirtyKeys
+
+class TestOpArrayCacheBlockedStorage(TestOpArrayCache):
+    """
+    Run all of the above tests again, with a separate buffer for each block.
+    """
+    def setUp(self):
+        super(TestOpArrayCacheBlockedStorage, self).setUp()
+        self.opCache.blockedStorage.setValue(True)
+
+    def testOnlyRequestedBlocksAllocated(self):
+        opCache = self.opCache
+        slicing = make_key[0:1, 5:15, 10:20, 0:10, 0:1]
+        data = opCache.Output( slicing ).wait()
+        assert (data == self.data[slicing]).all()
+
+        # Two blocks of 1*10*10*10*1 pixels
+        assert len(opCache._blocks) == 2
+        assert opCache.usedMemory() == 2 * 1000 * self.data.dtype.itemsize
+
+    def testEvictColdBlocks(self):
+        opCache = self.opCache
+        opProvider = self.opProvider
+        blockBytes = 1000 * self.data.dtype.itemsize
+
+        mgr = ArrayCacheMemoryMgr.instance
+        oldBudget = mgr.memoryBudget()
+        oldPolicy = mgr.evictionPolicy()
+        mgr.setMemoryBudget( 3*blockBytes )
+        mgr.setEvictionPolicy( LRUPolicy() )
+        try:
+            slicings = [ make_key[0:1, 0:10, 10*i:10*(i+1), 0:10, 0:1] for i in range(4) ]
+            for slicing in slicings[:3]:
+                opCache.Output( slicing ).wait()
+            assert opCache.usedMemory() == 3*blockBytes
+
+            # Touch the first block again, so the second one is the least recently used
+            time.sleep(0.01)
+            accessCount = opProvider.accessCount
+            opCache.Output( slicings[0] ).wait()
+            assert opProvider.accessCount == accessCount
+
+            # Only the coldest block is evicted to make room for the new one
+            data = opCache.Output( slicings[3] ).wait()
+            assert (data == self.data[slicings[3]]).all()
+            assert opCache.usedMemory() == 3*blockBytes
+            assert sorted(opCache._blocks.keys()) == [ (0,0,0,0,0), (0,0,2,0,0), (0,0,3,0,0) ]
+
+            # The evicted block is computed again when needed
+            accessCount = opProvider.accessCount
+            data = opCache.Output( slicings[1] ).wait()
+            assert (data == self.data[slicings[1]]).all()
+            assert opProvider.accessCount == accessCount + 1
+        finally:
+            mgr.setMemoryBudget( oldBudget )
+            mgr.setEvictionPolicy( oldPolicy )
+
+class TestOpArrayCacheDiskTier(object):
+
+    def setUp(self):
+        self.dataShape = (1,100,100,10,1)
+        self.data = (numpy.random.random(self.dataShape) * 100).astype(int)
+        self.data = self.data.view(vigra.VigraArray)
+        self.data.axistags = vigra.defaultAxistags('txyzc')
+
+        graph = Graph()
+        opProvider = OpArrayPiperWithAccessCount(graph=graph)
+        opProvider.Input.setValue(self.data)
+        self.opProvider = opProvider
+
+        opCache = OpArrayCache(graph=graph)
+        opCache.Input.connect(opProvider.Output)
+        opCache.blockShape.setValue( (10,10,10,10,10) )
+        opCache.blockedStorage.setValue(True)
+        self.opCache = opCache
+
+        self.mgr = ArrayCacheMemoryMgr.instance
+        self.diskTier = DiskCacheTier()
+        self.mgr.setDiskTier( self.diskTier )
+
+    def tearDown(self):
+        self.mgr.setDiskTier(None)
+        self.diskTier.close()
+
+    def testSpilledBlocksAreReloaded(self):
+        opCache = self.opCache
+        opProvider = self.opProvider
+
+        slicing = make_key[0:1, 0:20, 0:10, 0:10, 0:1]
+        opCache.Output( slicing ).wait()
+        accessCount = opProvider.accessCount
+
+        # Evict everything: the blocks go to disk
+        opCache._freeMemory()
+        assert opCache.usedMemory() == 0
+        assert self.diskTier.stats()['blocks'] == 2
+
+        # Served from disk, without recomputing
+        data = opCache.Output( slicing ).wait()
+        assert (data == self.data[slicing]).all()
+        assert opProvider.accessCount == accessCount
+        assert self.diskTier.stats()['hits'] == 2
+
+        # Dirty blocks are removed from disk
+        opCache._freeMemory()
+        dirtykey = make_key[0:1, 0:5, 0:5, 0:3, 0:1]
+        self.data[dirtykey] = 0
+        opProvider.Input.setDirty(dirtykey)
+        assert self.diskTier.stats()['blocks'] == 1
+
+        data = opCache.Output( slicing ).wait()
+        assert (data == self.data[slicing]).all()
+        assert opProvider.accessCount == accessCount + 1
+
+        stats = self.mgr.tierStatistics()
+        assert stats['disk']['hits'] == 3
+        assert stats['memory']['misses'] >= 4
+
+    def testDenseStorage(self):
+        opCache = self.opCache
+        opProvider = self.opProvider
+        opCache.blockedStorage.setValue(False)
+
+        slicing = make_key[0:1, 0:20, 0:10, 0:10, 0:1]
+        opCache.Output( slicing ).wait()
+        accessCount = opProvider.accessCount
+
+        opCache._freeMemory()
+        assert opCache.usedMemory() == 0
+
+        # Only the blocks that were clean are restored
+        data = opCache.Output( make_key[0:1, 0:30, 0:10, 0:10, 0:1] ).wait()
+        assert (data == self.data[0:1, 0:30, 0:10, 0:10, 0:1]).all()
+        assert opProvider.accessCount == accessCount + 1
+
+    def testNothingSpilledIfFreeingFails(self):
+        opCache = self.opCache
+        opCache.blockedStorage.setValue(False)
+
+        slicing = make_key[0:1, 0:20, 0:10, 0:10, 0:1]
+        opCache.Output( slicing ).wait()
+
+        # A view of the dense cache prevents it from being freed, so nothing may be spilled.
+        view = opCache._cache[0:1]
+        assert opCache._freeMemory() == 0
+        assert opCache.usedMemory() > 0
+        assert self.diskTier.stats()['blocks'] == 0
+        del view
+
+        assert opCache._freeMemory() > 0
+        assert self.diskTier.stats()['blocks'] == 2
+
 class TestOpArrayCacheWithObjectDtype(object):
     """
     This test is here to convince me that the OpArrayCache can be used with objects as the dtype.
@@ -1,9 +1,13 @@
+import time
 import threading
 import numpy
 import vigra
 from lazyflow.graph import Graph
+from lazyflow.request import Request
 from lazyflow.roi import sliceToRoi, roiToSlice
 from lazyflow.operators import OpArrayPiper, OpBlockedArrayCache
+from lazyflow.operators.arrayCacheMemoryMgr import ArrayCacheMemoryMgr, MemInfoNode, LRUPolicy
+from lazyflow.operators.diskCacheTier import DiskCacheTier
 
 class KeyMaker():
     def __getitem__(self, *args):
@@ -25,6 +29,25 @@ class OpArrayPiperWithAccessCount(OpArrayPiper):
         super(OpArrayPiperWithAccessCount, self).execute(slot, subindex, roi, result)
         
 
+class OpSlowArrayPiper(OpArrayPiper):
+    """
+    An array piper that takes some time for each request, and records how many requests it served in parallel.
+    """
+    def __init__(self, *args, **kwargs):
+        super(OpSlowArrayPiper, self).__init__(*args, **kwargs)
+        self.running = 0
+        self.maxRunning = 0
+        self._lock = threading.Lock()
+
+    def execute(self, slot, subindex, roi, result):
+        with self._lock:
+            self.running += 1
+            self.maxRunning = max(self.maxRunning, self.running)
+        time.sleep(0.02)
+        super(OpSlowArrayPiper, self).execute(slot, subindex, roi, result)
+        with self._lock:
+            self.running -= 1
+
 class TestOpBlockedArrayCache(object):
 
     def setUp(self):
@@ -282,6 +305,142 @@ class TestOpBlockedArrayCache(object):
         assert opProvider.accessCount <= maxAccess
         oldAccessCount = opProvider.accessCount
 
+    def testStatistics(self):
+        opCache = self.opCache
+
+        # Two outer blocks
+        slicing = make_key[0:1, 0:40, 0:20, 0:10, 0:1]
+        opCache.Output( slicing ).wait()
+        opCache.Output( slicing ).wait()
+
+        # The statistics of the inner caches are combined
+        stats = opCache.statistics()
+        assert stats.misses == 2
+        assert stats.hits == 2
+        assert stats.bytesServed == 2 * 40*20*10 * self.data.dtype.itemsize
+
+        report = MemInfoNode()
+        opCache.generateReport(report)
+        assert report.statistics['hits'] == 2
+        assert sum( child.statistics['hits'] for child in report.children ) == 2
+
+        opCache.resetStatistics()
+        assert opCache.statistics().hits == 0
+
+    def testBlockTable(self):
+        opCache = self.opCache
+
+        # The whole volume: 5*5*1 outer blocks
+        data = opCache.Output( make_key[:,:,:,:,:] ).wait()
+        assert (data == self.data).all()
+
+        # The blocks are kept in a table, without any child operators
+        assert len(opCache.children) == 0
+        assert len(opCache._blocks) == 25
+        assert opCache.usedMemory() == self.data.nbytes
+        assert opCache.fractionOfUsedMemoryDirty() == 0.0
+
+        # Dirty notifications only change the state table
+        dirtykey = make_key[0:1, 0:20, 0:20, 0:10, 0:1]
+        self.opProvider.Input.setDirty(dirtykey)
+        assert opCache.fractionOfUsedMemoryDirty() == 1.0 / 25
+
+    def testEvictColdBlocks(self):
+        opCache = self.opCache
+        opProvider = self.opProvider
+        blockBytes = 20*20*10 * self.data.dtype.itemsize
+
+        mgr = ArrayCacheMemoryMgr.instance
+        oldBudget = mgr.memoryBudget()
+        oldPolicy = mgr.evictionPolicy()
+        mgr.setMemoryBudget( 2*blockBytes )
+        mgr.setEvictionPolicy( LRUPolicy() )
+        try:
+            slicings = [ make_key[0:1, 0:20, 20*i:20*(i+1), 0:10, 0:1] for i in range(3) ]
+            for slicing in slicings:
+                time.sleep(0.01)
+                data = opCache.Output( slicing ).wait()
+                assert (data == self.data[slicing]).all()
+
+            # The coldest block was evicted to make room for the last one
+            assert opCache.usedMemory() == 2*blockBytes
+            assert sorted(opCache._blocks.keys()) == [ (0,0,1,0,0), (0,0,2,0,0) ]
+            assert opCache.statistics().evictions == 1
+
+            # The evicted block is computed again when needed
+            accessCount = opProvider.accessCount
+            data = opCache.Output( slicings[0] ).wait()
+            assert (data == self.data[slicings[0]]).all()
+            assert opProvider.accessCount == accessCount + 1
+        finally:
+            mgr.setMemoryBudget( oldBudget )
+            mgr.setEvictionPolicy( oldPolicy )
+
+    def testSpilledBlocksWhileFixed(self):
+        opCache = self.opCache
+        opProvider = self.opProvider
+
+        mgr = ArrayCacheMemoryMgr.instance
+        diskTier = DiskCacheTier()
+        mgr.setDiskTier( diskTier )
+        try:
+            slicing = make_key[0:1, 0:20, 0:40, 0:10, 0:1]
+            opCache.Output( slicing ).wait()
+            accessCount = opProvider.accessCount
+
+            # Spill both blocks to disk
+            for index in opCache._blocks.keys():
+                assert opCache._evictBlock( index ) > 0
+            assert opCache.usedMemory() == 0
+
+            # A fixed cache serves the spilled blocks too (not zeros), without recomputing
+            opCache.fixAtCurrent.setValue(True)
+            data = opCache.Output( slicing ).wait()
+            assert (data == self.data[slicing]).all()
+            assert opProvider.accessCount == accessCount
+            assert diskTier.stats()['hits'] == 2
+        finally:
+            # (Blocks of fixed caches can't be evicted: don't leave them to the other tests.)
+            opCache.fixAtCurrent.setValue(False)
+            mgr.setDiskTier(None)
+            diskTier.close()
+
+    def testParallelFetch(self):
+        opProvider = OpSlowArrayPiper(graph=self.opProvider.graph)
+        opProvider.Input.setValue(self.data)
+        opCache = self.opCache
+        opCache.Input.connect(opProvider.Output)
+        opCache.maxParallelFetches.setValue(3)
+
+        # 5*5 outer blocks are missing
+        data = opCache.Output( make_key[:,:,:,:,:] ).wait()
+        assert (data == self.data).all()
+
+        # The missing blocks were fetched concurrently, but never more than 3 at a time
+        assert opProvider.maxRunning <= 3
+        if len(Request.global_thread_pool.workers) > 1:
+            assert opProvider.maxRunning > 1
+
+    def testCoalescedDirtyRegions(self):
+        opCache = self.opCache
+        opProvider = self.opProvider
+        opCache.Output( make_key[:,:,:,:,:] ).wait()
+
+        gotDirtyKeys = []
+        def handleDirty(slot, roi):
+            gotDirtyKeys.append( list(roiToSlice(roi.start, roi.stop)) )
+        opCache.Output.notifyDirty(handleDirty)
+
+        # Two small changes at opposite corners while the cache is fixed
+        opCache.fixAtCurrent.setValue(True)
+        opProvider.Input.setDirty( make_key[0:1, 0:1, 0:1, 0:1, 0:1] )
+        opProvider.Input.setDirty( make_key[0:1, 99:100, 99:100, 9:10, 0:1] )
+        assert len(gotDirtyKeys) == 0
+
+        # When the cache becomes unfixed, only the outer blocks around the changes are dirty, not everything in between
+        opCache.fixAtCurrent.setValue(False)
+        assert sorted(gotDirtyKeys) == sorted( [ make_key[0:1, 0:20, 0:20, 0:10, 0:1], make_key[0:1, 80:100, 80:100, 0:10, 0:1] ] ), gotDirtyKeys
+
 if __name__ == "__main__":
     import sys
     import nose
@@ -2,6 +2,7 @@ import numpy
 import vigra
 from lazyflow.graph import Graph
 from lazyflow.operators import OpBlockedSparseLabelArray
+from lazyflow.roi import sliceToRoi
 
 from lazyflow.utility.slicingtools import sl, slicing2shape
 
@@ -195,6 +196,30 @@ class TestOpBlockedSparseLabelArray(object):
         assert expectedData.max() == 2
         assert op.maxLabel.value == 2
 
+    def testNonzeroBlocks(self):
+        """
+        Only blocks that contain labels are listed.
+        """
+        op = self.op
+        blockSlicings = op.nonzeroBlocks.value
+        assert len(blockSlicings) == 2*4*1
+
+        labeled = numpy.zeros_like(self.data)
+        for slicing in blockSlicings:
+            labeled[slicing] = self.data[slicing]
+        assert (labeled == self.data).all()
+
+    def testBatchOutput(self):
+        """
+        The nonzero blocks can be read in a single batch.
+        """
+        op = self.op
+        blockSlicings = op.nonzeroBlocks.value
+        rois = [ sliceToRoi(slicing, op.Output.meta.shape) for slicing in blockSlicings ]
+        blocks = op.Output.getBatch(rois).wait()
+        assert len(blocks) == len(blockSlicings)
+        for slicing, block in zip(blockSlicings, blocks):
+            assert (block == self.data[slicing]).all()
 
 if __name__ == "__main__":
     import sys
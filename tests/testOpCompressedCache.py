@@ -5,10 +5,13 @@ import functools
 
 import numpy
 import vigra
+import h5py
 
 from lazyflow.graph import Graph
 from lazyflow.operators import OpCompressedCache, OpArrayPiper
+from lazyflow.operators.arrayCacheMemoryMgr import ArrayCacheMemoryMgr, MemInfoNode
 from lazyflow.utility.slicingtools import slicing2shape
+from lazyflow.roi import roiToSlice
 
 logger = logging.getLogger("tests.testOpCompressedCache")
 cacheLogger = logging.getLogger("lazyflow.operators.opCompressedCache")
@@ -215,7 +218,270 @@ class TestOpCompressedCache( object ):
         #logger.debug("Checking data...")    
         assert (readData == expectedData).all(), "Incorrect output!"
 
+    def testMemoryBudget(self):
+        sampleData = numpy.indices((100, 200, 150), dtype=numpy.float32).sum(0)
+        sampleData = sampleData.view( vigra.VigraArray )
+        sampleData.axistags = vigra.defaultAxistags('xyz')
+        
+        graph = Graph()
+        opData = OpArrayPiper( graph=graph )
+        opData.Input.setValue( sampleData )
+        
+        op = OpCompressedCache( parent=None, graph=graph )
+        op.BlockShape.setValue( [100, 75, 50] )
+        op.Input.connect( opData.Output )
+
+        mgr = ArrayCacheMemoryMgr.instance
+        oldBudget = mgr.memoryBudget()
+        try:
+            # With a tiny budget, each block evicts all others as soon as it is cached.
+            mgr.setMemoryBudget(1)
+            readData = op.Output[:].wait()
+            assert (readData == sampleData.view(numpy.ndarray)).all(), "Incorrect output!"
+
+            cleanBlocks = op.CleanBlocks.value
+            assert len(cleanBlocks) <= 1, "Expected blocks to be evicted, but {} blocks are cached".format( len(cleanBlocks) )
+
+            # Evicted blocks are simply recomputed
+            slicing = numpy.s_[ 10:90, 0:200, 20:30 ]
+            readData = op.Output[slicing].wait()
+            assert (readData == sampleData[slicing].view(numpy.ndarray)).all(), "Incorrect output!"
+        finally:
+            mgr.setMemoryBudget(oldBudget)
+
+    def testCacheMemoryBudget(self):
+        sampleData = numpy.indices((100, 200, 150), dtype=numpy.float32).sum(0)
+        sampleData = sampleData.view( vigra.VigraArray )
+        sampleData.axistags = vigra.defaultAxistags('xyz')
+        
+        graph = Graph()
+        opData = OpArrayPiper( graph=graph )
+        opData.Input.setValue( sampleData )
+        
+        op = OpCompressedCache( parent=None, graph=graph )
+        op.BlockShape.setValue( [100, 100, 50] )
+        op.Input.connect( opData.Output )
+
+        # Find the size of one block
+        op.Output[0:100, 0:100, 0:50].wait()
+        blockSize = op.usedMemory()
+        assert blockSize > 0
+        assert blockSize < 100*100*50*4, "Expected the block to be compressed"
+
+        # Room for about two blocks
+        op.MemoryBudget.setValue( int(2.5*blockSize) )
+        op.Output[0:100, 0:100, 0:50].wait()
+        op.Output[0:100, 100:200, 0:50].wait()
+        op.Output[0:100, 0:100, 0:50].wait() # (Now the second block is the least recently used)
+        op.Output[0:100, 0:100, 50:100].wait()
+        assert op.usedMemory() <= 2.5*blockSize
+
+        cleanBlockStarts = set( tuple(block_roi[0]) for block_roi in op.CleanBlocks.value )
+        assert cleanBlockStarts == set( [ (0,0,0), (0,0,50) ] ), "Wrong blocks evicted: {}".format( cleanBlockStarts )
+
+        # Evicted blocks are simply recomputed
+        readData = op.Output[:].wait()
+        assert (readData == sampleData.view(numpy.ndarray)).all(), "Incorrect output!"
+        assert op.usedMemory() <= 2.5*blockSize
+
+    def testBlockRegisteredBeforeEviction(self):
+        sampleData = numpy.indices((100, 200, 150), dtype=numpy.float32).sum(0)
+        sampleData = sampleData.view( vigra.VigraArray )
+        sampleData.axistags = vigra.defaultAxistags('xyz')
+
+        graph = Graph()
+        opData = OpArrayPiper( graph=graph )
+        opData.Input.setValue( sampleData )
+
+        op = OpCompressedCache( parent=None, graph=graph )
+        op.BlockShape.setValue( [100, 100, 50] )
+        op.Input.connect( opData.Output )
+
+        # Try to evict the block while it is being registered (as a concurrent eviction would).
+        evicted = []
+        mgr = op._memory_manager
+        class EvictingManager(object):
+            def register(self, cache, block_start, storage_size, cost=0.0):
+                if not evicted:
+                    evicted.append( op._evictBlock( block_start ) )
+                mgr.register( cache, block_start, storage_size, cost )
+            def __getattr__(self, name):
+                return getattr(mgr, name)
+        op._memory_manager = EvictingManager()
+        try:
+            op.Output[0:100, 0:100, 0:50].wait()
+        finally:
+            op._memory_manager = mgr
+
+        # The block can't be evicted before it is registered, so the sizes stay consistent.
+        assert evicted == [0]
+        assert (0,0,0) in op._cacheBlocks
+        assert op._blockSizes.keys() == [(0,0,0)]
+        assert op.usedMemory() == op._cacheBlocks[(0,0,0)].storageSize()
+        op.cleanUp()
+
+    def testMemoryReport(self):
+        sampleData = numpy.indices((100, 200, 150), dtype=numpy.float32).sum(0)
+        sampleData = sampleData.view( vigra.VigraArray )
+        sampleData.axistags = vigra.defaultAxistags('xyz')
+        
+        graph = Graph()
+        opData = OpArrayPiper( graph=graph )
+        opData.Input.setValue( sampleData )
+        
+        op = OpCompressedCache( parent=None, graph=graph )
+        op.BlockShape.setValue( [100, 100, 150] )
+        op.Input.connect( opData.Output )
+        assert op.usedMemory() == 0
+        assert op.fractionOfUsedMemoryDirty() == 0
+
+        op.Output[:].wait()
+        assert op.usedMemory() > 0
+        assert op.fractionOfUsedMemoryDirty() == 0
+
+        # One of the two (equally compressible) blocks becomes dirty
+        opData.Input.setDirty( numpy.s_[0:10, 0:10, 0:10] )
+        assert 0.3 < op.fractionOfUsedMemoryDirty() < 0.7
+
+        report = MemInfoNode()
+        op.generateReport(report)
+        assert report.usedMemory == op.usedMemory()
+        assert report.fractionOfUsedMemoryDirty == op.fractionOfUsedMemoryDirty()
+        assert report.lastAccessTime is not None
+
+    def testStatistics(self):
+        sampleData = numpy.indices((100, 200, 150), dtype=numpy.float32).sum(0)
+        sampleData = sampleData.view( vigra.VigraArray )
+        sampleData.axistags = vigra.defaultAxistags('xyz')
+        
+        graph = Graph()
+        opData = OpArrayPiper( graph=graph )
+        opData.Input.setValue( sampleData )
+        
+        op = OpCompressedCache( parent=None, graph=graph )
+        op.BlockShape.setValue( [100, 100, 150] )
+        op.Input.connect( opData.Output )
+        stats = op.statistics()
+        blockBytes = 100*100*150*4
+
+        op.Output[0:100, 0:100, :].wait() # miss
+        op.Output[0:100, 0:100, :].wait() # hit
+        op.Output[:].wait()               # partial hit
+        assert (stats.hits, stats.partialHits, stats.misses) == (1, 1, 1)
+        assert stats.bytesServed == 4*blockBytes
+        assert stats.bytesComputed == 2*blockBytes
+        assert len(stats.fillLatencies) == 2
+        assert stats.fillLatencyPercentile(90) >= stats.fillLatencyPercentile(50) > 0
+
+        opData.Input.setDirty( numpy.s_[0:10, 0:10, 0:10] )
+        assert stats.dirtyInvalidations == 1
+
+        report = MemInfoNode()
+        op.generateReport(report)
+        assert report.statistics['hits'] == 1
+        assert report.statistics['dirtyInvalidations'] == 1
+
+    def testByteStore(self):
+        sampleData = numpy.indices((100, 200, 150), dtype=numpy.float32).sum(0)
+        sampleData = sampleData.view( vigra.VigraArray )
+        sampleData.axistags = vigra.defaultAxistags('xyz')
         
+        graph = Graph()
+        opData = OpArrayPiper( graph=graph )
+        opData.Input.setValue( sampleData )
+        
+        op = OpCompressedCache( parent=None, graph=graph )
+        op.BlockShape.setValue( [100, 75, 50] )
+        op.Codec.setValue( 'zlib' )
+        op.Input.connect( opData.Output )
+
+        slicing = numpy.s_[ 0:100, 50:150, 20:130 ]
+        readData = op.Output[slicing].wait()
+        assert (readData == sampleData[slicing].view(numpy.ndarray)).all(), "Incorrect output!"
+
+        # Read again from the cached (compressed) blocks
+        readData = op.Output[slicing].wait()
+        assert (readData == sampleData[slicing].view(numpy.ndarray)).all(), "Incorrect output!"
+        assert op.statistics().hits == 1
+
+        ratios = op.compressionRatios()
+        assert len(ratios) == 1*2*3
+        assert all( ratio > 1.0 for ratio in ratios.values() ), "Sample data should be compressible"
+
+        # Partial writes
+        op.Input[10:20, 10:20, 10:20] = numpy.zeros( (10,10,10), dtype=numpy.float32 )
+        expectedData = sampleData.view(numpy.ndarray).copy()
+        expectedData[10:20, 10:20, 10:20] = 0
+        readData = op.Output[0:50, 0:50, 0:50].wait()
+        assert (readData == expectedData[0:50, 0:50, 0:50]).all(), "Incorrect output!"
+
+    def testByteStoreRecreatedBlock(self):
+        sampleData = numpy.indices((100, 200, 150), dtype=numpy.float32).sum(0)
+        sampleData = sampleData.view( vigra.VigraArray )
+        sampleData.axistags = vigra.defaultAxistags('xyz')
+
+        graph = Graph()
+        opData = OpArrayPiper( graph=graph )
+        opData.Input.setValue( sampleData )
+
+        op = OpCompressedCache( parent=None, graph=graph )
+        op.BlockShape.setValue( [100, 75, 50] )
+        op.Codec.setValue( 'zlib' )
+        op.Input.connect( opData.Output )
+
+        slicing = numpy.s_[ 0:100, 0:75, 0:50 ]
+        op.Output[slicing].wait()
+
+        # Evict the block, and recreate it as a concurrent request would before it fills it.
+        block_roi = ( (0, 0, 0), (100, 75, 50) )
+        assert op._evictBlock( block_roi[0] ) > 0
+        block = op._getCacheBlock( block_roi )
+        assert not block.isWritten()
+
+        # The empty block must not be read as data
+        readData = numpy.ndarray( (100, 75, 50), dtype=numpy.float32 )
+        op._copyFromBlock( block_roi[0], block_roi, slice(None), readData, slice(None) )
+        assert (readData == sampleData[slicing].view(numpy.ndarray)).all(), "Incorrect output!"
+        assert block.isWritten()
+
+    def testByteStoreHdf5Slots(self):
+        sampleData = numpy.indices((100, 200, 150), dtype=numpy.float32).sum(0)
+        sampleData = sampleData.view( vigra.VigraArray )
+        sampleData.axistags = vigra.defaultAxistags('xyz')
+        
+        graph = Graph()
+        opData = OpArrayPiper( graph=graph )
+        opData.Input.setValue( sampleData )
+
+        # Export a block from a byte store cache...
+        op = OpCompressedCache( parent=None, graph=graph )
+        op.BlockShape.setValue( [100, 75, 50] )
+        op.Codec.setValue( 'zlib' )
+        op.Input.connect( opData.Output )
+
+        blockSlicing = numpy.s_[ 0:100, 75:150, 50:100 ]
+        roi = ( (0, 75, 50), (100, 150, 100) )
+        mem_file = h5py.File( 'testByteStoreHdf5Slots', driver='core', backing_store=False, mode='w' )
+        group = mem_file.create_group( 'blocks' )
+        op.OutputHdf5( *roi ).writeInto( group ).wait()
+        assert len(group.keys()) == 1
+        dataset = group[ group.keys()[0] ]
+        assert (dataset[...] == sampleData[blockSlicing].view(numpy.ndarray)).all()
+
+        # ...and import it into another one
+        dummyData = numpy.zeros( sampleData.shape, dtype=numpy.float32 ).view( vigra.VigraArray )
+        dummyData.axistags = vigra.defaultAxistags('xyz')
+        opDummyData = OpArrayPiper( graph=graph )
+        opDummyData.Input.setValue( dummyData )
+        op2 = OpCompressedCache( parent=None, graph=graph )
+        op2.BlockShape.setValue( [100, 75, 50] )
+        op2.Codec.setValue( 'zlib' )
+        op2.Input.connect( opDummyData.Output )
+        op2.InputHdf5[ roiToSlice(*roi) ] = dataset
+
+        readData = op2.Output[blockSlicing].wait()
+        assert (readData == sampleData[blockSlicing].view(numpy.ndarray)).all()
+        mem_file.close()
 
 if __name__ == "__main__":
     # Set up logging for debug
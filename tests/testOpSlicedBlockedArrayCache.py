@@ -4,6 +4,7 @@ import vigra
 from lazyflow.graph import Graph
 from lazyflow.roi import sliceToRoi, roiToSlice
 from lazyflow.operators import OpArrayPiper, OpSlicedBlockedArrayCache
+from lazyflow.operators.arrayCacheMemoryMgr import ArrayCacheMemoryMgr
 
 class KeyMaker():
     def __getitem__(self, *args):
@@ -287,6 +288,90 @@ class TestOpSlicedBlockedArrayCache(object):
         assert opProvider.accessCount <= maxAccess
         oldAccessCount = opProvider.accessCount
 
+    def testCoalescedDirtyRegions(self):
+        opCache = self.opCache
+        opProvider = self.opProvider
+        opCache.Output( make_key[:,:,:,:,:] ).wait()
+
+        gotDirtyKeys = []
+        def handleDirty(slot, roi):
+            gotDirtyKeys.append( list(roiToSlice(roi.start, roi.stop)) )
+        opCache.Output.notifyDirty(handleDirty)
+
+        # Two small changes at opposite corners while the cache is fixed
+        opCache.fixAtCurrent.setValue(True)
+        opProvider.Input.setDirty( make_key[0:1, 0:1, 0:1, 0:1, 0:1] )
+        opProvider.Input.setDirty( make_key[0:1, 99:100, 99:100, 9:10, 0:1] )
+        assert len(gotDirtyKeys) == 0
+
+        # The changes are tracked on the grid of the smallest outer block shape (clipped to the volume),
+        #  not with single voxel blocks
+        assert tuple(opCache._dirtyBlockShape) == (1,2,20,10,1), opCache._dirtyBlockShape
+
+        # When the cache becomes unfixed, only the (smallest outer) blocks around the changes are dirty, not everything in between
+        opCache.fixAtCurrent.setValue(False)
+        assert sorted(gotDirtyKeys) == sorted( [ make_key[0:1, 0:2, 0:20, 0:10, 0:1], make_key[0:1, 98:100, 80:100, 0:10, 0:1] ] ), gotDirtyKeys
+
+    def _waitForPrefetches(self):
+        for prefetcher in self.opCache._prefetchers:
+            for requests in prefetcher._outstanding.values():
+                for req in requests.values():
+                    req.wait()
+
+    def testPrefetch(self):
+        opCache = self.opCache
+        opProvider = self.opProvider
+        opCache.prefetchSlabs.setValue(2)
+
+        # Scroll through z: after two adjacent slices, the next two are prefetched
+        for z in (0, 1):
+            slicing = make_key[0:1, 0:100, 0:100, z:z+1, 0:1]
+            data = opCache.Output( slicing ).wait()
+            assert (data == self.data[slicing]).all()
+        self._waitForPrefetches()
+        assert opCache.prefetchStatistics()['issued'] == 2
+
+        # The next slice is already cached
+        accessCount = opProvider.accessCount
+        slicing = make_key[0:1, 0:100, 0:100, 2:3, 0:1]
+        data = opCache.Output( slicing ).wait()
+        assert (data == self.data[slicing]).all()
+        assert opProvider.accessCount == accessCount
+        self._waitForPrefetches()
+
+        stats = opCache.prefetchStatistics()
+        assert stats['hits'] == 1
+        assert stats['issued'] == 3 # Slice 3 was already prefetched, slice 4 is new
+        assert stats['hitRate'] == 1.0 / 3
+
+        # Jumping elsewhere breaks the pattern: nothing new is prefetched
+        slicing = make_key[0:1, 0:100, 0:100, 8:9, 0:1]
+        opCache.Output( slicing ).wait()
+        assert opCache.prefetchStatistics()['issued'] == 3
+
+    def testNoPrefetchByDefault(self):
+        opCache = self.opCache
+        for z in range(4):
+            opCache.Output( make_key[0:1, 0:100, 0:100, z:z+1, 0:1] ).wait()
+        assert opCache.prefetchStatistics()['issued'] == 0
+
+    def testPrefetchRespectsMemoryBudget(self):
+        opCache = self.opCache
+        opCache.prefetchSlabs.setValue(2)
+
+        mgr = ArrayCacheMemoryMgr.instance
+        oldBudget = mgr.memoryBudget()
+        # (No room for anything, not even after evicting the blocks of other caches.)
+        mgr.setMemoryBudget( 1 )
+        try:
+            for z in (0, 1):
+                opCache.Output( make_key[0:1, 0:100, 0:100, z:z+1, 0:1] ).wait()
+        finally:
+            mgr.setMemoryBudget( oldBudget )
+        stats = opCache.prefetchStatistics()
+        assert stats['issued'] == 0
+        assert stats['skipped'] == 1
+
 if __name__ == "__main__":
     import sys
     import nose
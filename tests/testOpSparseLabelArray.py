@@ -89,6 +89,32 @@ class TestOpSparseLabelArray(object):
         
         assert expectedOutput.max() == 2
         assert op.maxLabel.value == 2
+
+    def testEraseAll(self):
+        op = self.op
+        slicing = self.slicing
+        data = self.data
+
+        # Add some 3s, then erase them again: the max label must go down again.
+        newSlicing = list(slicing)
+        newSlicing[1] = slice(1,2)
+        op.Input[newSlicing] = 3 * numpy.ones(slicing2shape(newSlicing), dtype=numpy.uint8)
+        assert op.maxLabel.value == 3
+
+        op.Input[newSlicing] = 100 * numpy.ones(slicing2shape(newSlicing), dtype=numpy.uint8)
+        expectedData = data.copy()
+        expectedData[newSlicing] = 0
+        assert (op.Output[...].wait() == expectedData).all()
+        assert op.maxLabel.value == expectedData.max() == 2
+
+    def testDeleteLabelNonzeroValues(self):
+        op = self.op
+        op.deleteLabel.setValue(1)
+
+        # The stored values were shifted, too
+        expectedData = numpy.where(self.data == 1, 0, self.data)
+        expectedData = numpy.where(expectedData == 2, 1, expectedData)
+        assert sorted(op.nonzeroValues.value) == sorted(expectedData[expectedData != 0])
         
 
 if __name__ == "__main__":
@@ -0,0 +1,168 @@
+import os
+import time
+import numpy
+
+from lazyflow.graph import Graph, Operator, InputSlot, OutputSlot
+from lazyflow.request import Request, ProcessPool, sharedArray, isSharedArray
+
+def double(out, data):
+    out[...] = 2*data
+
+def record_pid(out):
+    out[...] = os.getpid()
+
+def fail(out):
+    raise ValueError("Intentional failure")
+
+def sleep_forever(out):
+    time.sleep(100)
+
+def sleep_briefly(out):
+    time.sleep(1.0)
+
+class TestProcessPool(object):
+
+    @classmethod
+    def setupClass(cls):
+        cls.process_pool = ProcessPool(num_processes=2)
+
+    def testBasic(self):
+        data = numpy.random.randint(0, 100, (10,20))
+        destination = numpy.zeros_like(data)
+        result = self.process_pool.run( double, destination, data )
+        assert result is destination
+        assert (destination == 2*data).all()
+
+    def testRunsInChildProcess(self):
+        destination = numpy.zeros((1,), dtype=numpy.int64)
+        self.process_pool.run( record_pid, destination )
+        assert destination[0] != 0
+        assert destination[0] != os.getpid()
+
+    def testSharedDestination(self):
+        data = numpy.random.randint(0, 100, (10,20))
+        destination = sharedArray( data.shape, data.dtype )
+        assert isSharedArray( destination )
+        assert isSharedArray( destination[2:5] )
+        assert not isSharedArray( numpy.zeros_like(data) )
+
+        # Write directly into a view of the shared array
+        self.process_pool.run( double, destination[2:5], data[2:5] )
+        assert (destination[2:5] == 2*data[2:5]).all()
+        assert (destination[:2] == 0).all()
+
+    def testException(self):
+        try:
+            self.process_pool.run( fail, numpy.zeros((1,)) )
+        except ValueError:
+            pass
+        else:
+            assert False, "Expected the exception to be re-raised in the parent."
+
+    def testWithinRequests(self):
+        data = numpy.random.randint(0, 100, (10,20))
+        def f(i):
+            destination = numpy.zeros_like(data)
+            return self.process_pool.run( double, destination, data+i )
+
+        reqs = map( lambda i: Request( lambda: f(i) ), range(4) )
+        for req in reqs:
+            req.submit()
+        for i, req in enumerate(reqs):
+            assert (req.wait() == 2*(data+i)).all()
+
+    def testCancel(self):
+        """
+        Cancelling a request must terminate the child process it is waiting for.
+        """
+        def child():
+            self.process_pool.run( sleep_forever, numpy.zeros((1,)) )
+            assert False, "Should not get here: child should have been cancelled."
+
+        def parent():
+            req = Request( child )
+            req.submit()
+            req.wait()
+
+        req = Request( parent )
+        req.submit()
+        time.sleep(0.5)
+        req.cancel()
+
+        start = time.time()
+        while not req.finished and time.time() - start < 10:
+            time.sleep(0.1)
+        assert req.finished, "Cancelled request did not finish."
+        assert req.cancelled
+
+    def testWaitingDoesNotBlockWorkers(self):
+        """
+        Requests waiting for a child process (or for a free slot) are suspended,
+        so the worker threads remain free for other requests.
+        """
+        num_workers = len(Request.global_thread_pool.workers)
+        process_pool = ProcessPool(num_processes=num_workers)
+
+        # One more call than there are slots (and worker threads)
+        reqs = [ Request( lambda: process_pool.run( sleep_briefly, numpy.zeros((1,)) ) )
+                 for _ in range(num_workers+1) ]
+        for req in reqs:
+            req.submit()
+        time.sleep(0.2)
+
+        start = time.time()
+        quick = Request( lambda: 42 )
+        quick.submit()
+        quick.finished_event.wait(10)
+        assert quick.finished
+        assert time.time() - start < 0.5, \
+            "Request had to wait for a worker thread: took {:.2f} seconds".format( time.time() - start )
+
+        for req in reqs:
+            req.wait()
+
+class OpDoubleInSubprocess(Operator):
+    Input = InputSlot()
+    Output = OutputSlot()
+
+    executeInSubprocess = True
+
+    def setupOutputs(self):
+        self.Output.meta.assignFrom(self.Input.meta)
+
+    def execute(self, slot, subindex, roi, result):
+        data = self.Input(roi.start, roi.stop).wait()
+        return self._double( result, data )
+
+    @Operator.subprocessKernel
+    def _double(self, destination, data):
+        destination[...] = 2*data
+        destination[0] = os.getpid()
+
+    def propagateDirty(self, slot, subindex, roi):
+        self.Output.setDirty(roi)
+
+class TestSubprocessKernel(object):
+
+    def testOperator(self):
+        data = numpy.random.randint(0, 100, (10,20)).astype(numpy.int64)
+        op = OpDoubleInSubprocess( graph=Graph() )
+        op.Input.setValue( data )
+
+        result = op.Output[:].wait()
+        assert (result[1:] == 2*data[1:]).all()
+        assert (result[0] != os.getpid()).all()
+
+        # The same kernel can be run in-thread by clearing the flag
+        op.executeInSubprocess = False
+        result = op.Output[:].wait()
+        assert (result[1:] == 2*data[1:]).all()
+        assert (result[0] == os.getpid()).all()
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    ret = nose.run(defaultTest=__file__)
+    if not ret: sys.exit(1)
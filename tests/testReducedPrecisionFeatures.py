@@ -0,0 +1,113 @@
+import numpy
+import vigra
+
+from lazyflow.graph import Graph
+from lazyflow.operators import OpPixelFeaturesPresmoothed, OpTrainRandomForest, OpPredictRandomForest, OpValueCache
+from lazyflow.utility import dequantize
+
+class TestReducedPrecisionFeatures(object):
+    """
+    The reduced precision output types of OpPixelFeaturesPresmoothed must stay within their documented tolerance.
+    """
+
+    def setUp(self):
+        self.scales = [0.3, 1.0, 3.5]
+        self.featureIds = OpPixelFeaturesPresmoothed.DefaultFeatureIds
+        self.matrix = numpy.ones( (len(self.featureIds), len(self.scales)), dtype=bool )
+        data = numpy.random.random( (100,100,1) ).astype(numpy.float32)
+        self.data = vigra.taggedView( data, 'xyc' )
+
+    def _makeOp(self, dtype, drange=(0.0, 1.0), graph=None):
+        op = OpPixelFeaturesPresmoothed(graph=graph or Graph())
+        op.Input.setValue(self.data)
+        op.Input.meta.drange = drange
+        op.Scales.setValue(self.scales)
+        op.FeatureIds.setValue(self.featureIds)
+        op.Matrix.setValue(self.matrix)
+        op.OutputDtype.setValue(dtype)
+        return op
+
+    def testFloat16(self):
+        expected = self._makeOp(numpy.float32).Output[:].wait()
+        op = self._makeOp(numpy.float16)
+        assert op.Output.meta.dtype == numpy.float16
+        assert op.Output.meta.quantScale is None
+        features = op.Output[:].wait()
+        assert features.dtype == numpy.float16
+        assert numpy.allclose( dequantize(features), expected, rtol=2**-11, atol=1e-6 )
+
+    def testQuantized(self):
+        expected = self._makeOp(numpy.float32).Output[:].wait()
+        for dtype in [numpy.uint8, numpy.uint16]:
+            op = self._makeOp(dtype)
+            assert op.Output.meta.dtype == dtype
+            scale = numpy.array(op.Output.meta.quantScale)
+            offset = op.Output.meta.quantOffset
+            assert len(scale) == len(offset) == op.Output.meta.shape[-1]
+
+            features = op.Output[:].wait()
+            assert features.dtype == dtype
+            error = numpy.abs( dequantize(features, scale, offset) - expected )
+            assert (error <= 0.51*scale).all() # (with some slack for float32 rounding)
+
+            # Channel subsets are quantized with the parameters of their channels
+            assert (op.Output[..., 5:9].wait() == features[..., 5:9]).all()
+            start, stop = op.featureOutputChannels[4]
+            assert op.Features[4].meta.quantScale == tuple(scale[start:stop])
+            assert (op.Features[4][:].wait() == features[..., start:stop]).all()
+
+    def testUnknownRange(self):
+        # Float input without a drange can't be quantized: falls back to float16
+        op = self._makeOp(numpy.uint8, drange=None)
+        assert op.Output.meta.dtype == numpy.float16
+
+    def _train(self, opFeatures):
+        labels = numpy.zeros( (100,100,1), dtype=numpy.uint8 )
+        labels[10:20, 10:20] = 1
+        labels[60:70, 60:70] = 2
+        labels = vigra.taggedView( labels, 'xyc' )
+
+        opTrain = OpTrainRandomForest(graph=opFeatures.graph)
+        opTrain.fixClassifier.setValue(False)
+        opTrain.Images.resize(1)
+        opTrain.Images[0].connect( opFeatures.Output )
+        opTrain.Labels.resize(1)
+        opTrain.Labels[0].setValue( labels )
+
+        # Train only once for all predictions
+        opForests = OpValueCache(graph=opFeatures.graph)
+        opForests.Input.connect( opTrain.Classifier )
+        return opForests
+
+    def _predict(self, opForests, opFeatures):
+        opPredict = OpPredictRandomForest(graph=opFeatures.graph)
+        opPredict.Image.connect( opFeatures.Output )
+        opPredict.Classifier.connect( opForests.Output )
+        opPredict.LabelsCount.setValue(2)
+        return opPredict.PMaps[:].wait()
+
+    def testPrediction(self):
+        # A forest trained on float32 features predicts (almost) the same from quantized features
+        graph = Graph()
+        opFloat = self._makeOp(numpy.float32, graph=graph)
+        opQuantized = self._makeOp(numpy.uint16, graph=graph)
+        opForests = self._train(opFloat)
+        expected = self._predict(opForests, opFloat)
+        assert numpy.abs( self._predict(opForests, opQuantized) - expected ).max() < 0.1
+
+    def testQuantizedTraining(self):
+        # A forest trained on quantized features learns in the dequantized feature space
+        graph = Graph()
+        opFloat = self._makeOp(numpy.float32, graph=graph)
+        opQuantized = self._makeOp(numpy.uint16, graph=graph)
+        opForests = self._train(opQuantized)
+        expected = self._predict(opForests, opQuantized)
+        assert numpy.abs( self._predict(opForests, opFloat) - expected ).max() < 0.1
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    ret = nose.run(defaultTest=__file__)
+    if not ret: sys.exit(1)
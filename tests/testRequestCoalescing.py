@@ -0,0 +1,198 @@
+import time
+import threading
+
+import numpy
+
+from lazyflow.graph import Graph, Operator, InputSlot, OutputSlot
+from lazyflow.request import Request, RequestPool
+from lazyflow.requestCoalescer import CoalescedRequest
+
+class OpCountingSlowCopy(Operator):
+    """
+    Copies its input (slowly) and counts how often execute() is called.
+    """
+    Input = InputSlot()
+    Output = OutputSlot()
+
+    Delay = 0.2
+
+    def __init__(self, *args, **kwargs):
+        super(OpCountingSlowCopy, self).__init__(*args, **kwargs)
+        self.executionCount = 0
+        self._countLock = threading.Lock()
+
+    def setupOutputs(self):
+        self.Output.meta.assignFrom(self.Input.meta)
+
+    def execute(self, slot, subindex, roi, result):
+        with self._countLock:
+            self.executionCount += 1
+        result[:] = self.Input(roi.start, roi.stop).wait()
+        time.sleep(self.Delay)
+        return result
+
+    def propagateDirty(self, slot, subindex, roi):
+        self.Output.setDirty(roi)
+
+class TestRequestCoalescing(object):
+
+    @classmethod
+    def setupClass(cls):
+        # Our operator sleeps in execute(), which blocks the worker thread.
+        # Make sure there are enough workers for the requests to overlap.
+        Request.reset_thread_pool(num_workers=4)
+
+    @classmethod
+    def teardownClass(cls):
+        Request.reset_thread_pool()
+
+    def setUp(self):
+        self.data = numpy.random.randint(0, 100, (10,20)).astype(numpy.uint8)
+        self.op = OpCountingSlowCopy( graph=Graph() )
+        self.op.Input.setValue(self.data)
+
+    def _waitAll(self, requests):
+        pool = RequestPool()
+        for req in requests:
+            pool.add(req)
+        pool.wait()
+        return map( lambda req: req.result, requests )
+
+    def testDisabled(self):
+        reqs = [ self.op.Output[2:5] for _ in range(3) ]
+        assert not any( isinstance(req, CoalescedRequest) for req in reqs )
+        self._waitAll( reqs )
+        assert self.op.executionCount == 3
+
+    def testIdenticalRois(self):
+        self.op.Output.enableRequestCoalescing()
+        reqs = [ self.op.Output[2:5] for _ in range(3) ]
+        results = self._waitAll( reqs )
+        assert self.op.executionCount == 1
+        for result in results:
+            assert (result == self.data[2:5]).all()
+
+        # Each caller gets its own array
+        assert len( set( map(id, results) ) ) == 3
+
+        # Once the execution is finished, it isn't shared any more.
+        result = self.op.Output[2:5].wait()
+        assert self.op.executionCount == 2
+        assert (result == self.data[2:5]).all()
+
+    def testDifferentRois(self):
+        self.op.Output.enableRequestCoalescing()
+        reqs = [ self.op.Output[0:5], self.op.Output[2:5] ]
+        results = self._waitAll( reqs )
+        assert self.op.executionCount == 2
+        assert (results[0] == self.data[0:5]).all()
+        assert (results[1] == self.data[2:5]).all()
+
+    def testSubregions(self):
+        self.op.Output.enableRequestCoalescing(subregions=True)
+        reqs = [ self.op.Output[0:5], self.op.Output[2:5, 3:7], self.op.Output[1:2] ]
+        destination = numpy.zeros( (3,4), dtype=numpy.uint8 )
+        reqs[1].writeInto(destination)
+        results = self._waitAll( reqs )
+        assert self.op.executionCount == 1
+        assert (results[0] == self.data[0:5]).all()
+        assert results[1] is destination
+        assert (destination == self.data[2:5, 3:7]).all()
+        assert (results[2] == self.data[1:2]).all()
+
+    def testDirty(self):
+        self.op.Output.enableRequestCoalescing()
+        req1 = self.op.Output[2:5]
+        self.op.Output.setDirty()
+        req2 = self.op.Output[2:5]
+        self._waitAll( [req1, req2] )
+        assert self.op.executionCount == 2
+
+    def testCancel(self):
+        """
+        The shared execution must keep running until all of the requests that share it are cancelled.
+        """
+        self.op.Output.enableRequestCoalescing()
+        req1 = self.op.Output[2:5]
+        req2 = self.op.Output[2:5]
+        shared = req1._shared.request
+        assert req2._shared.request is shared
+
+        req1.submit()
+        req2.submit()
+        time.sleep(0.05)
+
+        req1.cancel()
+        assert req1.cancelled
+        assert not shared.cancelled
+
+        req2.cancel()
+        assert req2.cancelled
+        assert shared.cancelled
+
+        # A new request does not share the cancelled execution.
+        result = self.op.Output[2:5].wait()
+        assert (result == self.data[2:5]).all()
+
+    def testDroppedRequest(self):
+        """
+        A request that is never waited for must not keep the shared execution alive.
+        """
+        self.op.Output.enableRequestCoalescing()
+        dropped = self.op.Output[2:5]
+        req = self.op.Output[2:5]
+        shared = req._shared.request
+        assert dropped._shared.request is shared
+
+        req.submit()
+        time.sleep(0.05)
+        req.cancel()
+        assert shared.cancelled
+
+    def testPendingRequest(self):
+        """
+        A request that starts after the shared execution was cancelled computes the data on its own.
+        """
+        self.op.Output.enableRequestCoalescing()
+        pending = self.op.Output[2:5]
+        req = self.op.Output[2:5]
+        shared = req._shared.request
+
+        req.submit()
+        time.sleep(0.05)
+        req.cancel()
+        assert shared.cancelled
+
+        result = pending.wait()
+        assert (result == self.data[2:5]).all()
+        assert self.op.executionCount == 2
+
+    def testParentCancelled(self):
+        """
+        Cancelling one of the requesting parents must not affect the other.
+        """
+        self.op.Output.enableRequestCoalescing()
+        results = {}
+        def fetch(name):
+            results[name] = self.op.Output[2:5].wait()
+
+        parent1 = Request( lambda: fetch(1) )
+        parent2 = Request( lambda: fetch(2) )
+        parent1.submit()
+        parent2.submit()
+        time.sleep(0.05)
+        parent1.cancel()
+        parent2.wait()
+
+        assert parent1.cancelled
+        assert 1 not in results
+        assert (results[2] == self.data[2:5]).all()
+        assert self.op.executionCount == 1
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    ret = nose.run(defaultTest=__file__)
+    if not ret: sys.exit(1)
@@ -1,4 +1,5 @@
 from lazyflow.request.request import Request, RequestLock
+from lazyflow.request.threadPool import WorkStealingQueue
 import time
 import random
 import nose
@@ -713,6 +714,183 @@ class TestRequestExceptions(object):
         # Set it back to what it was
         Request.reset_thread_pool()
 
+    def testIndirectCircularWait(self):
+        """
+        If cycle detection is enabled, a request that waits for its own parent 
+        (which is waiting for the child) raises instead of hanging forever.
+        """
+        Request.detect_indirect_cycles = True
+        try:
+            root_holder = []
+            def child():
+                return root_holder[0].wait()
+
+            def root():
+                return Request( child ).wait()
+
+            root_req = Request( root )
+            root_holder.append( root_req )
+            root_req.submit()
+            try:
+                root_req.wait()
+            except Request.CircularWaitException:
+                pass
+            else:
+                assert False, "Expected a CircularWaitException"
+        finally:
+            Request.detect_indirect_cycles = False
+
+    def testDumpWaitGraph(self):
+        """
+        The wait graph lists in-flight requests and the requests they are waiting for.
+        """
+        import StringIO
+        child_started = threading.Event()
+        release_child = threading.Event()
+        def child():
+            child_started.set()
+            release_child.wait()
+
+        child_holder = []
+        def parent():
+            req = Request( child )
+            child_holder.append( req )
+            req.submit()
+            req.wait()
+        
+        parent_req = Request( parent )
+        parent_req.submit()
+        child_started.wait()
+        
+        # Wait until the parent is suspended
+        while len(parent_req.blocking_requests) == 0:
+            time.sleep(0.01)
+
+        graph = Request.wait_graph()
+        assert parent_req in graph
+        assert child_holder[0] in graph
+        assert graph[parent_req] == [ child_holder[0] ]
+        
+        stream = StringIO.StringIO()
+        Request.dump_wait_graph( stream )
+        assert "is waiting for" in stream.getvalue()
+
+        release_child.set()
+        parent_req.wait()
+        assert parent_req not in Request.wait_graph()
+
+    def testWorkStealingThreadPool(self):
+        """
+        The request system must work the same when the thread pool uses work-stealing queues.
+        """
+        Request.reset_thread_pool(num_workers=4, queue_type=WorkStealingQueue)
+        try:
+            def leaf(i):
+                return i
+
+            def branch(i):
+                children = map( lambda j: Request( partial(leaf, j) ), range(10) )
+                for child in children:
+                    child.submit()
+                return i + sum( map( lambda child: child.wait(), children ) )
+
+            reqs = map( lambda i: Request( partial(branch, i) ), range(100) )
+            for req in reqs:
+                req.submit()
+            results = map( lambda req: req.wait(), reqs )
+            assert results == map( lambda i: i + 45, range(100) )
+        finally:
+            # Set it back to what it was
+            Request.reset_thread_pool()
+
+    def testPriorityClassInheritance(self):
+        """
+        Child requests inherit the priority class of their parent.
+        """
+        def parent():
+            req = Request( lambda: None )
+            req.wait()
+            return req.priority_class
+
+        req = Request( parent )
+        assert req.priority_class == Request.PRIORITY_NORMAL
+        req.set_priority_class( Request.PRIORITY_BACKGROUND )
+        assert req.priority_class == Request.PRIORITY_BACKGROUND
+        req.submit()
+        assert req.wait() == Request.PRIORITY_BACKGROUND
+
+    def testInteractiveBeforeBackground(self):
+        """
+        Interactive requests are started before background requests that are already queued.
+        """
+        Request.reset_thread_pool(num_workers=1)
+        try:
+            started = threading.Event()
+            release = threading.Event()
+            def block():
+                started.set()
+                release.wait()
+
+            order = []
+            def work(name):
+                order.append(name)
+
+            blocker = Request( block )
+            blocker.submit()
+            started.wait()
+
+            background = map( lambda i: Request( partial(work, "background") ), range(5) )
+            for req in background:
+                req.set_priority_class( Request.PRIORITY_BACKGROUND )
+                req.submit()
+            interactive = Request( partial(work, "interactive") )
+            interactive.set_priority_class( Request.PRIORITY_INTERACTIVE )
+            interactive.submit()
+
+            release.set()
+            for req in [blocker, interactive] + background:
+                req.wait()
+            assert order == ["interactive"] + 5*["background"]
+        finally:
+            Request.reset_thread_pool()
+
+    def testPreemption(self):
+        """
+        With preemption enabled, a background request gives its worker to waiting interactive work at wait() points.
+        """
+        Request.reset_thread_pool(num_workers=1)
+        Request.allow_preemption = True
+        try:
+            order = []
+            interactive_submitted = threading.Event()
+            def background():
+                order.append("background started")
+                interactive_submitted.wait()
+                # This wait() is a preemption point (the child is finished before we wait for it)
+                Request( lambda: None ).wait()
+                order.append("background finished")
+
+            def interactive():
+                order.append("interactive")
+
+            bg_req = Request( background )
+            bg_req.set_priority_class( Request.PRIORITY_BACKGROUND )
+            bg_req.submit()
+            while not order:
+                time.sleep(0.01)
+
+            int_req = Request( interactive )
+            int_req.set_priority_class( Request.PRIORITY_INTERACTIVE )
+            int_req.submit()
+            interactive_submitted.set()
+
+            bg_req.wait()
+            int_req.wait()
+            assert order == ["background started", "interactive", "background finished"], order
+        finally:
+            Request.allow_preemption = False
+            Request.reset_thread_pool()
+
 if __name__ == "__main__":
 
     # Logging is OFF by default when running from command-line nose, i.e.:
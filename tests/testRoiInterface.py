@@ -140,7 +140,45 @@ class TestRoiUtilities(TestCase):
         
         roi = (TinyVector((1,2,3,4,5)), TinyVector(shape))
         assert lazyflow.roi.roiToSlice(roi[0], roi[1]) == (slice(1,2), slice(2,4), slice(3,6), slice(4,8), slice(5,10))
-        
+
+    def test_getIntersectingBlocks(self):
+        blockshape = (10,20,30)
+        roi = ((15,25,35), (25,45,65))
+        starts = lazyflow.roi.getIntersectingBlocks(blockshape, roi)
+        expected = [ (a,b,c) for a in (10,20) for b in (20,40) for c in (30,60) ]
+        assert map(tuple, starts.tolist()) == expected
+
+        matrix = lazyflow.roi.getIntersectingBlocks(blockshape, roi, asmatrix=True)
+        assert matrix.shape == (2,2,2,3)
+        assert (matrix.reshape(-1,3) == starts).all()
+
+    def test_getBlockBounds(self):
+        start, stop = lazyflow.roi.getBlockBounds( (35,35,35), (10,20,30), (30,20,30) )
+        assert list(start) == [30,20,30]
+        assert list(stop) == [35,35,35]
+
+    def test_blockGrid(self):
+        shape = (35,47,13)
+        blockshape = (10,20,5)
+        grid = lazyflow.roi.getBlockGrid(shape, blockshape)
+        assert grid is lazyflow.roi.getBlockGrid(list(shape), numpy.array(blockshape))
+        assert list(grid.gridShape) == [4,3,3]
+
+        for i in range(20):
+            roi = generateRandomRoi(shape, minWidth=1)
+            block_starts, block_stops, inter_starts, inter_stops = grid.intersections(*roi)
+
+            # Must agree with the block-by-block functions
+            assert (block_starts == lazyflow.roi.getIntersectingBlocks(blockshape, roi)).all()
+            for block_start, block_stop, inter_start, inter_stop in zip(block_starts, block_stops, inter_starts, inter_stops):
+                bounds = lazyflow.roi.getBlockBounds(shape, blockshape, block_start)
+                assert (bounds[0] == block_start).all() and (bounds[1] == block_stop).all()
+                intersection = lazyflow.roi.getIntersection(roi, bounds)
+                assert (intersection[0] == inter_start).all() and (intersection[1] == inter_stop).all()
+
+            # The intersections cover the roi exactly
+            assert numpy.prod(inter_stops - inter_starts, axis=1).sum() == numpy.prod(numpy.subtract(roi[1], roi[0]))
+
 if __name__ == "__main__":
     import nose
     ret = nose.run(defaultTest=__file__, env={'NOSE_NOCAPTURE' : 1})
@@ -0,0 +1,100 @@
+import numpy
+
+from lazyflow.operators.sparseLabelStore import SparseLabelStore
+
+class TestSparseLabelStore(object):
+
+    def setUp(self):
+        self.shape = (37,45,23)
+        self.store = SparseLabelStore( self.shape, (10,16,8) )
+        self.expected = numpy.zeros( self.shape, dtype=numpy.uint8 )
+        self.eraser = 100
+
+    def _write(self, start, stop, values):
+        self.store.write( start, stop, values, self.eraser )
+        expected = self.expected[ tuple( slice(a,b) for a,b in zip(start, stop) ) ]
+        expected[values != 0] = values[values != 0]
+        expected[values == self.eraser] = 0
+
+    def _randomRoi(self, rng):
+        start = [ rng.randint(0, s) for s in self.shape ]
+        stop = [ rng.randint(a+1, s+1) for a, s in zip(start, self.shape) ]
+        return start, stop
+
+    def _check(self, rng):
+        store = self.store
+        expected = self.expected
+        start, stop = self._randomRoi(rng)
+        assert (store.read( start, stop ) == expected[ tuple( slice(a,b) for a,b in zip(start, stop) ) ]).all()
+        assert (store.read( (0,0,0), self.shape ) == expected).all()
+
+        assert store.maxLabel() == expected.max()
+        assert list(store.nonzeroValues()) == list(numpy.unique(expected[expected != 0]))
+        assert (store.labelCounts()[1:10] == numpy.bincount( expected.ravel(), minlength=10 )[1:10]).all()
+
+    def testRandomWrites(self):
+        rng = numpy.random.RandomState(0)
+        for i in range(100):
+            start, stop = self._randomRoi(rng)
+            values = rng.randint( 0, 5, size=numpy.subtract(stop, start) ).astype( numpy.uint8 )
+            if i % 3 == 0:
+                values[values == 4] = self.eraser
+            self._write( start, stop, values )
+            self._check(rng)
+
+    def testDeleteLabel(self):
+        rng = numpy.random.RandomState(1)
+        for i in range(10):
+            start, stop = self._randomRoi(rng)
+            values = rng.randint( 0, 5, size=numpy.subtract(stop, start) ).astype( numpy.uint8 )
+            self._write( start, stop, values )
+
+        self.store.deleteLabel(2)
+        self.expected[self.expected == 2] = 0
+        self.expected[self.expected > 2] -= 1
+        self._check(rng)
+
+    def testBlockHistograms(self):
+        store = self.store
+        self._write( (0,0,0), (2,2,2), numpy.ones( (2,2,2), dtype=numpy.uint8 ) )
+        self._write( (12,0,0), (14,2,2), 2*numpy.ones( (2,2,2), dtype=numpy.uint8 ) )
+        self._write( (22,0,0), (23,1,1), 3*numpy.ones( (1,1,1), dtype=numpy.uint8 ) )
+        assert store.blockLabelCounts( (0,0,0) ) == { 1 : 8 }
+        assert store.blockLabelCounts( (1,0,0) ) == { 2 : 8 }
+        assert store.blockLabelCounts( (3,0,0) ) == {}
+        assert [ tuple(start) for start, stop in store.nonzeroBlocks(2) ] == [ (10,0,0) ]
+
+        # Deleting label 2 doesn't touch the block with label 1
+        block = store._blocks[(0,0,0)]
+        store.deleteLabel(2)
+        assert store._blocks[(0,0,0)] is block and store.blockLabelCounts( (0,0,0) ) == { 1 : 8 }
+        assert store.blockLabelCounts( (1,0,0) ) == {}
+        assert store.blockLabelCounts( (2,0,0) ) == { 2 : 1 }
+        assert [ tuple(start) for start, stop in store.nonzeroBlocks(2) ] == [ (20,0,0) ]
+        assert store.nonzeroBlocks(3) == []
+        assert store.maxLabel() == 2
+
+    def testNonzeroBlocks(self):
+        store = self.store
+        assert store.nonzeroBlocks() == []
+        values = numpy.ones( (2,2,2), dtype=numpy.uint8 )
+        self._write( (9,15,7), (11,17,9), values )
+        blocks = sorted( (tuple(start), tuple(stop)) for start, stop in store.nonzeroBlocks() )
+        assert len(blocks) == 8
+        assert blocks[0] == ( (0,0,0), (10,16,8) )
+        assert blocks[-1] == ( (10,16,8), (20,32,16) )
+
+        # Erasing all labels of a block removes it
+        self._write( (9,15,7), (10,16,8), numpy.array( [[[self.eraser]]], dtype=numpy.uint8 ) )
+        assert len(store.nonzeroBlocks()) == 7
+
+        # Only the labeled voxels are stored
+        assert store.nbytes() == 7 * (4 + 1)
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    ret = nose.run(defaultTest=__file__)
+    if not ret: sys.exit(1)
@@ -0,0 +1,81 @@
+import numpy
+import vigra
+
+from lazyflow.graph import Graph
+from lazyflow.request import ProcessPool
+from lazyflow.operators import OpTrainRandomForest, OpPredictRandomForest, OpValueCache
+
+class TestStreamingPrediction(object):
+    """
+    OpPredictRandomForest must predict the same in small chunks as in a single chunk.
+    """
+
+    def setUp(self):
+        features = numpy.random.random( (100,100,5) ).astype(numpy.float32)
+        self.features = vigra.taggedView( features, 'xyc' )
+        labels = numpy.zeros( (100,100,1), dtype=numpy.uint8 )
+        labels[::10, ::10] = numpy.random.randint( 1, 4, labels[::10, ::10].shape )
+        labels = vigra.taggedView( labels, 'xyc' )
+
+        self.graph = Graph()
+        self.opTrain = OpTrainRandomForest(graph=self.graph)
+        self.opTrain.fixClassifier.setValue(False)
+        self.opTrain.Images.resize(1)
+        self.opTrain.Images[0].setValue( self.features )
+        self.opTrain.Labels.resize(1)
+        self.opTrain.Labels[0].setValue( labels )
+
+        # Train only once for all predictions
+        self.opForests = OpValueCache(graph=self.graph)
+        self.opForests.Input.connect( self.opTrain.Classifier )
+
+    def _makeOp(self, chunkPixels, labelsCount=3):
+        op = OpPredictRandomForest(graph=self.graph)
+        op.ChunkPixels = chunkPixels
+        op.Image.setValue( self.features )
+        op.Classifier.connect( self.opForests.Output )
+        op.LabelsCount.setValue( labelsCount )
+        return op
+
+    def testChunks(self):
+        expected = self._makeOp( 100*100 ).PMaps[:].wait()
+        assert numpy.allclose( expected.sum(axis=-1), 1, atol=1e-5 )
+        for chunkPixels in [1000, 999, 37]:
+            op = self._makeOp( chunkPixels )
+            assert numpy.allclose( op.PMaps[:].wait(), expected, atol=1e-6 )
+            assert numpy.allclose( op.PMaps[10:23, 40:95, 1:3].wait(), expected[10:23, 40:95, 1:3], atol=1e-6 )
+
+    def testExtraLabels(self):
+        # Channels beyond the trained labels duplicate the last label
+        expected = self._makeOp( 100*100 ).PMaps[:].wait()
+        op = self._makeOp( 1000, labelsCount=5 )
+        result = op.PMaps[:].wait()
+        assert numpy.allclose( result[..., :3], expected, atol=1e-6 )
+        assert numpy.allclose( result[..., 3], expected[..., 2], atol=1e-6 )
+        assert numpy.allclose( result[..., 4], expected[..., 2], atol=1e-6 )
+
+    def testSubprocess(self):
+        # In a child process, each forest predicts the whole roi at once (not one child process per chunk)
+        expected = self._makeOp( 100*100 ).PMaps[:].wait()
+        op = self._makeOp( 1000 )
+        op.executeInSubprocess = True
+
+        pool = ProcessPool.global_process_pool
+        runs = []
+        def countingRun(*args, **kwargs):
+            runs.append(args)
+            return ProcessPool.run(pool, *args, **kwargs)
+        pool.run = countingRun
+        try:
+            assert numpy.allclose( op.PMaps[:].wait(), expected, atol=1e-6 )
+        finally:
+            del pool.run
+        assert len(runs) == len( self.opForests.Output[:].wait() )
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    ret = nose.run(defaultTest=__file__)
+    if not ret: sys.exit(1)
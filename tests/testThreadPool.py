@@ -1,6 +1,7 @@
 import time
 import threading
-from lazyflow.request.threadPool import ThreadPool
+from lazyflow.request.threadPool import ThreadPool, WorkStealingQueue, FifoQueue, LifoQueue, \
+                                        PRIORITY_INTERACTIVE, PRIORITY_NORMAL, PRIORITY_BACKGROUND
 
 class TestThreadPool(object):
     """
@@ -80,6 +81,119 @@ class TestThreadPool(object):
         e.wait()
         assert gen_thread_ids[0] == gen_thread_ids[1], "Callable should always execute on the same worker thread!"
 
+class TestWorkStealingThreadPool(TestThreadPool):
+    """
+    Same tests as above, but with per-worker queues and work-stealing.
+    """
+    
+    @classmethod
+    def setupClass(cls):
+        cls.thread_pool = ThreadPool(num_workers = 4, queue_type=WorkStealingQueue)
+
+    def testManyTasks(self):
+        """
+        Submit lots of tasks from a foreign thread and from within the workers themselves.
+        Every task must be executed exactly once.
+        """
+        num_tasks = 1000
+        lock = threading.Lock()
+        executed = []
+        done = threading.Event()
+
+        def record(i):
+            with lock:
+                executed.append(i)
+                if len(executed) == 2*num_tasks:
+                    done.set()
+
+        class Task(object):
+            def __init__(self, i, spawn):
+                self.i = i
+                self.spawn = spawn
+
+            def __call__(self):
+                if self.spawn:
+                    # Spawn a child task from within the worker thread
+                    self.thread_pool.wake_up( Task(self.i + num_tasks, False) )
+                record(self.i)
+        Task.thread_pool = self.thread_pool
+
+        for i in range(num_tasks):
+            self.thread_pool.wake_up( Task(i, True) )
+
+        assert done.wait(10.0) is not False, "Not all tasks were executed."
+        assert sorted(executed) == range(2*num_tasks)
+
+class TestPriorityClasses(object):
+    """
+    The FIFO and LIFO queues start the tasks of a more urgent priority class first.
+    """
+
+    class Task(object):
+        def __init__(self, name, priority_class=None):
+            self.name = name
+            if priority_class is not None:
+                self.priority_class = priority_class
+
+    def _popAll(self, queue):
+        names = []
+        while len(queue) > 0:
+            names.append( queue.pop().name )
+        return names
+
+    def testFifoQueue(self):
+        queue = FifoQueue()
+        queue.push( self.Task("b1", PRIORITY_BACKGROUND) )
+        queue.push( self.Task("n1") ) # No priority class: normal
+        queue.push( self.Task("b2", PRIORITY_BACKGROUND) )
+        queue.push( self.Task("i1", PRIORITY_INTERACTIVE) )
+        queue.push( self.Task("n2", PRIORITY_NORMAL) )
+        assert len(queue) == 5
+        assert self._popAll(queue) == ["i1", "n1", "n2", "b1", "b2"]
+
+    def testLifoQueue(self):
+        queue = LifoQueue()
+        queue.push( self.Task("b1", PRIORITY_BACKGROUND) )
+        queue.push( self.Task("n1") )
+        queue.push( self.Task("b2", PRIORITY_BACKGROUND) )
+        queue.push( self.Task("i1", PRIORITY_INTERACTIVE) )
+        queue.push( self.Task("n2", PRIORITY_NORMAL) )
+        assert self._popAll(queue) == ["i1", "n2", "n1", "b2", "b1"]
+
+    def testHasWaitingWork(self):
+        """
+        The thread pool knows whether more urgent tasks are waiting to be started.
+        """
+        thread_pool = ThreadPool(num_workers = 1)
+        try:
+            started = threading.Event()
+            release = threading.Event()
+            done = threading.Event()
+            def block():
+                started.set()
+                release.wait()
+
+            class Task(object):
+                def __init__(self, priority_class):
+                    self.priority_class = priority_class
+                def __call__(self):
+                    done.set()
+
+            # Keep the only worker busy, so the next task stays in the queue
+            thread_pool.wake_up( block )
+            started.wait()
+            thread_pool.wake_up( Task(PRIORITY_INTERACTIVE) )
+
+            assert thread_pool.has_waiting_work( PRIORITY_BACKGROUND )
+            assert thread_pool.has_waiting_work( PRIORITY_NORMAL )
+            assert not thread_pool.has_waiting_work( PRIORITY_INTERACTIVE )
+
+            release.set()
+            done.wait()
+            assert not thread_pool.has_waiting_work( PRIORITY_BACKGROUND )
+        finally:
+            thread_pool.stop()
+
 
 if __name__ == "__main__":
     import sys